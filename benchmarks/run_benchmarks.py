@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Times the Python code paths of *treesapp assign* on synthetic inputs of increasing size.
+The outputs of Prodigal, hmmsearch and EPA-ng are replaced by files written by synthetic_data.py so the benchmarks
+run offline and without any of the external dependencies installed.
+
+Results are written as JSON and can be compared against those of a previous run with --baseline to catch regressions.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+from collections import namedtuple, OrderedDict
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import synthetic_data
+import treesapp
+from treesapp.refpkg import ReferencePackage
+from treesapp.taxonomic_hierarchy import TaxonomicHierarchy
+from treesapp.file_parsers import parse_domain_tables
+from treesapp.fasta import format_fasta, read_fasta_to_dict
+from treesapp.phylo_seq import assignments_to_treesaps
+from treesapp import assign
+
+__author__ = 'Connor Morgan-Lang'
+
+TEST_DATA = os.path.join(os.path.dirname(BENCHMARK_DIR), "tests", "test_data")
+TEMPLATE_JPLACE = os.path.join(TEST_DATA, "p_amoA_FunGene9.5_isolates_assign", "intermediates",
+                               "epa_result.XmoA_hmm_purified_group0-BMGE.jplace")
+# The same HMM filtering thresholds as the *treesapp assign* defaults
+ThresholdArgs = namedtuple("ThresholdArgs", ["max_e", "max_ie", "min_acc", "min_score", "perc_aligned"])
+THRESHOLDS = ThresholdArgs(max_e=1E-3, max_ie=1E-1, min_acc=0.7, min_score=20, perc_aligned=10)
+
+
+class BenchmarkContext:
+    """
+    The inputs shared by all benchmarks of a single size. Inputs derived from the synthetic files
+    (e.g. the parsed HMM matches) are only loaded when a benchmark first requires them.
+    """
+    def __init__(self, size: int, work_dir: str):
+        self.size = size
+        self.work_dir = work_dir
+        self.paths = synthetic_data.write_dataset(work_dir, size, TEMPLATE_JPLACE)
+        self.refpkg_dict = {"XmoA": load_refpkg("XmoA")}
+        self._hmm_matches = None
+        self._fasta_dict = None
+        self._classified = None
+
+    def hmm_matches(self) -> dict:
+        if self._hmm_matches is None:
+            self._hmm_matches = parse_domain_tables(THRESHOLDS, [self.paths["domtbl"]])
+        return self._hmm_matches
+
+    def fasta_dict(self) -> dict:
+        if self._fasta_dict is None:
+            self._fasta_dict = read_fasta_to_dict(self.paths["fasta"])
+        return self._fasta_dict
+
+    def classified_pqueries(self) -> dict:
+        if self._classified is None:
+            self._classified = assignments_to_treesaps(synthetic_data.classification_rows(self.size))
+            for pqueries in self._classified.values():
+                for pquery in pqueries:
+                    pquery.abundance = 1.0
+        return self._classified
+
+    def placed_pqueries(self, mode=None) -> dict:
+        """
+        Parses the synthetic JPlace file again for every call since the PQuery instances are modified in place
+        by select_query_placements and filter_placements.
+        """
+        tree_saps, _ = assign.parse_raxml_output(self.paths["epa_dir"], self.refpkg_dict)
+        if mode:
+            assign.select_query_placements(tree_saps, self.refpkg_dict, mode)
+        return tree_saps
+
+
+def load_refpkg(prefix: str) -> ReferencePackage:
+    refpkg = ReferencePackage()
+    refpkg.f__json = os.path.join(TEST_DATA, "refpkgs", prefix + "_build.pkl")
+    refpkg.slurp()
+    return refpkg
+
+
+# Each benchmark takes a BenchmarkContext and returns the function to be timed.
+# Anything done before returning is setup and is not timed.
+def bench_format_fasta(ctx: BenchmarkContext):
+    output_fasta = os.path.join(ctx.work_dir, "formatted_ORFs.faa")
+    return lambda: format_fasta(ctx.paths["fasta"], "prot", output_fasta)
+
+
+def bench_parse_domain_tables(ctx: BenchmarkContext):
+    return lambda: parse_domain_tables(THRESHOLDS, [ctx.paths["domtbl"]])
+
+
+def bench_bin_hmm_matches(ctx: BenchmarkContext):
+    hmm_matches, fasta_dict = ctx.hmm_matches(), ctx.fasta_dict()
+    return lambda: assign.bin_hmm_matches(hmm_matches, fasta_dict)
+
+
+def bench_parse_raxml_output(ctx: BenchmarkContext):
+    return lambda: assign.parse_raxml_output(ctx.paths["epa_dir"], ctx.refpkg_dict)
+
+
+def bench_select_max_lwr(ctx: BenchmarkContext):
+    tree_saps = ctx.placed_pqueries()
+    return lambda: assign.select_query_placements(tree_saps, ctx.refpkg_dict, "max_lwr")
+
+
+def bench_select_aelw(ctx: BenchmarkContext):
+    tree_saps = ctx.placed_pqueries()
+    return lambda: assign.select_query_placements(tree_saps, ctx.refpkg_dict, "aelw")
+
+
+def bench_filter_placements(ctx: BenchmarkContext):
+    tree_saps = ctx.placed_pqueries(mode="max_lwr")
+    return lambda: assign.filter_placements(tree_saps, ctx.refpkg_dict, False, 0.1)
+
+
+def bench_write_classification_table(ctx: BenchmarkContext):
+    tree_saps = ctx.classified_pqueries()
+    output_table = os.path.join(ctx.work_dir, "marker_contig_map.tsv")
+    return lambda: assign.write_classification_table(tree_saps, "synthetic", output_table)
+
+
+def bench_taxonomic_hierarchy_feed(ctx: BenchmarkContext):
+    t_hierarchy = TaxonomicHierarchy()
+    # TaxonomicHierarchy.feed consumes the lineage_ex lists, so they are generated for every repeat
+    lineages = synthetic_data.lineages_with_ranks(ctx.size)
+
+    def feed_all():
+        for lineage, lineage_ex in lineages:
+            t_hierarchy.feed(lineage, lineage_ex)
+    return feed_all
+
+
+BENCHMARKS = OrderedDict([("format_fasta", bench_format_fasta),
+                          ("parse_domain_tables", bench_parse_domain_tables),
+                          ("bin_hmm_matches", bench_bin_hmm_matches),
+                          ("parse_raxml_output", bench_parse_raxml_output),
+                          ("select_query_placements.max_lwr", bench_select_max_lwr),
+                          ("select_query_placements.aelw", bench_select_aelw),
+                          ("filter_placements", bench_filter_placements),
+                          ("write_classification_table", bench_write_classification_table),
+                          ("TaxonomicHierarchy.feed", bench_taxonomic_hierarchy_feed)])
+
+
+def time_benchmark(bench_func, ctx: BenchmarkContext, repeats: int) -> dict:
+    """
+    Runs the setup for a benchmark and times the function it returns, once for each repeat.
+
+    :return: A dictionary of the timing statistics
+    """
+    timings = []
+    for _ in range(repeats):
+        timed_func = bench_func(ctx)
+        start = time.perf_counter()
+        timed_func()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    return {"size": ctx.size,
+            "repeats": repeats,
+            "min_seconds": round(best, 6),
+            "median_seconds": round(statistics.median(timings), 6),
+            "records_per_second": round(ctx.size / best, 1) if best > 0 else None}
+
+
+def compare_results(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compares the minimum times of each benchmark and size found in both results and baseline.
+
+    :param results: The results of the current run
+    :param baseline: The results of a previous run, loaded from its JSON file
+    :param tolerance: The proportion a benchmark may be slower than the baseline before it is a regression
+    :return: A list of strings describing each regression
+    """
+    regressions = []
+    for name, runs in results["benchmarks"].items():
+        baseline_runs = {run["size"]: run for run in baseline.get("benchmarks", {}).get(name, [])}
+        for run in runs:
+            if run["size"] not in baseline_runs:
+                continue
+            previous = baseline_runs[run["size"]]["min_seconds"]
+            ratio = run["min_seconds"] / previous if previous > 0 else 1.0
+            print("{}\t{}\t{:.4f}s\t{:.4f}s\t{:.2f}x".format(name, run["size"], previous, run["min_seconds"], ratio))
+            if ratio > 1 + tolerance:
+                regressions.append("{} ({} records) is {:.2f}x slower than the baseline".format(name, run["size"],
+                                                                                               ratio))
+    return regressions
+
+
+def get_arguments(sys_args):
+    parser = argparse.ArgumentParser(description="Benchmarks the Python code paths of treesapp assign "
+                                                 "using synthetic inputs.")
+    parser.add_argument("-s", "--sizes", type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+                        help="The number of records to benchmark each function with. [ DEFAULT = 10^3 to 10^6 ]")
+    parser.add_argument("-r", "--repeats", type=int, default=3,
+                        help="The number of times each benchmark is timed. The minimum is reported. [ DEFAULT = 3 ]")
+    parser.add_argument("-b", "--benchmarks", nargs='+', default=list(BENCHMARKS.keys()),
+                        choices=list(BENCHMARKS.keys()), help="The benchmarks to run. [ DEFAULT = all ]")
+    parser.add_argument("-o", "--output", default="benchmark_results.json",
+                        help="Path to write the benchmark results (JSON). [ DEFAULT = benchmark_results.json ]")
+    parser.add_argument("-w", "--work_dir", default=None,
+                        help="Directory to write the synthetic inputs to. Inputs already there are reused. "
+                             "A temporary directory is used and removed by default.")
+    parser.add_argument("--baseline", default=None,
+                        help="Path to the results of a previous run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="The proportion a benchmark can be slower than the baseline before "
+                             "it is reported as a regression. [ DEFAULT = 0.2 ]")
+    return parser.parse_args(sys_args)
+
+
+def main(sys_args=None):
+    args = get_arguments(sys_args)
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s: %(message)s")
+
+    work_dir = args.work_dir if args.work_dir else tempfile.mkdtemp(prefix="treesapp_benchmarks_")
+    results = {"metadata": {"treesapp_version": treesapp.__version__,
+                            "python": platform.python_version(),
+                            "platform": platform.platform(),
+                            "processor": platform.processor(),
+                            "date": time.strftime("%Y-%m-%d %H:%M:%S")},
+               "benchmarks": {name: [] for name in args.benchmarks}}
+    try:
+        for size in sorted(args.sizes):
+            size_dir = os.path.join(work_dir, "n{}".format(size))
+            if not os.path.isdir(size_dir):
+                os.makedirs(size_dir)
+            ctx = BenchmarkContext(size, size_dir)
+            for name in args.benchmarks:
+                run = time_benchmark(BENCHMARKS[name], ctx, args.repeats)
+                results["benchmarks"][name].append(run)
+                print("{}\t{}\t{:.4f}s\t{} records/s".format(name, size, run["min_seconds"], run["records_per_second"]))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    with open(args.output, 'w') as results_handler:
+        json.dump(results, results_handler, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_handler:
+            baseline = json.load(baseline_handler)
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            print("Performance regressions:\n\t" + "\n\t".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
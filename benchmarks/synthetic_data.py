@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Generators for synthetic inputs that stand in for the outputs of TreeSAPP's external dependencies
+(Prodigal, hmmsearch and EPA-ng) so the Python code paths of *treesapp assign* can be benchmarked in isolation.
+All generators are seeded so the same size always produces the same records.
+"""
+
+import os
+import re
+import json
+import random
+
+__author__ = 'Connor Morgan-Lang'
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+RANKS = ["superkingdom", "phylum", "class", "order", "family", "genus", "species"]
+RANK_PREFIXES = ['d', 'p', 'c', 'o', 'f', 'g', 's']
+
+
+def orf_name(i: int) -> str:
+    return "orf_{}".format(i)
+
+
+def write_protein_fasta(fasta_file: str, num_seqs: int, seed=1) -> None:
+    """
+    Writes a FASTA file of random protein sequences, as if predicted by Prodigal.
+    Sequences are slices of a random string so generating millions of sequences remains fast.
+    """
+    rng = random.Random(seed)
+    residues = "".join(rng.choice(AMINO_ACIDS) for _ in range(10000))
+    with open(fasta_file, 'w') as fa_out:
+        buffer = []
+        for i in range(num_seqs):
+            seq_len = rng.randint(100, 400)
+            offset = rng.randint(0, len(residues) - seq_len)
+            buffer.append(">{}\n{}\n".format(orf_name(i), residues[offset:offset + seq_len]))
+            if len(buffer) >= 10000:
+                fa_out.write("".join(buffer))
+                buffer.clear()
+        fa_out.write("".join(buffer))
+    return
+
+
+def write_domain_table(domtbl_file: str, num_seqs: int, hmm_name="XmoA", hmm_len=250, seed=1) -> None:
+    """
+    Writes an hmmsearch domain table (--domtblout) with a single alignment for each of the sequences written by
+    write_protein_fasta. Roughly a third of the alignments only cover part of the HMM profile so the sequences are
+    distributed across several bins by assign.bin_hmm_matches.
+    """
+    rng = random.Random(seed)
+    line_format = "{:<20} - {:>5} {:<20} - {:>5} {:>9} {:>6} {:>5} {:>3} {:>3} {:>9} {:>9} {:>6} {:>5} " \
+                  "{:>5} {:>5} {:>5} {:>5} {:>5} {:>5} {:>4} -\n"
+    with open(domtbl_file, 'w') as tbl_out:
+        tbl_out.write("# target name        accession   tlen query name           accession   qlen\n")
+        buffer = []
+        for i in range(num_seqs):
+            if i % 3 == 0:
+                hmm_from, hmm_to = rng.choice([(1, 120), (120, hmm_len)])
+            else:
+                hmm_from, hmm_to = 1, hmm_len
+            ali_len = hmm_to - hmm_from + 1
+            evalue = "{:.1e}".format(10 ** -rng.randint(20, 100))
+            score = round(rng.uniform(50, 500), 1)
+            buffer.append(line_format.format(orf_name(i), ali_len + 20, hmm_name, hmm_len, evalue, score, 0.1, 1, 1,
+                                             evalue, evalue, score, 0.1, hmm_from, hmm_to, 5, ali_len + 4,
+                                             1, ali_len + 10, 0.95))
+            if len(buffer) >= 10000:
+                tbl_out.write("".join(buffer))
+                buffer.clear()
+        tbl_out.write("".join(buffer))
+    return
+
+
+def write_jplace(jplace_file: str, template_jplace: str, num_seqs: int, refpkg_name="XmoA", seed=1) -> None:
+    """
+    Writes a JPlace file, as if from EPA-ng, with between one and three placements per query sequence onto the
+    tree of template_jplace (e.g. one from tests/test_data).
+    """
+    rng = random.Random(seed)
+    with open(template_jplace) as template:
+        jplace = json.load(template)
+    edge_lengths = {int(num): float(length) for length, num in re.findall(r":([0-9.eE-]+){(\d+)}", jplace["tree"])}
+    edges = sorted(edge_lengths)
+
+    placements = []
+    for i in range(num_seqs):
+        num_placements = rng.randint(1, 3)
+        weights = [rng.random() for _ in range(num_placements)]
+        total = sum(weights)
+        pplaces = []
+        for weight, edge in zip(sorted(weights, reverse=True), rng.sample(edges, num_placements)):
+            pplaces.append([edge, -10000.0 - rng.random(), round(weight / total, 6),
+                            round(edge_lengths[edge] * rng.random(), 6), round(rng.uniform(0.01, 1.0), 6)])
+        placements.append({"p": pplaces, "n": ["{}|{}|1_{}".format(orf_name(i), refpkg_name, rng.randint(100, 400))]})
+
+    jplace["placements"] = placements
+    with open(jplace_file, 'w') as jplace_out:
+        json.dump(jplace, jplace_out)
+    return
+
+
+def lineage_taxa(i: int) -> list:
+    """
+    Returns the taxon names of a seven-rank lineage. Each rank has ten times as many taxa as the rank above it
+    and a taxon's parent is determined by its number, so the lineages always form a valid hierarchy.
+    """
+    return ["{}{}".format(rank.capitalize(), i % (3 * 10 ** depth)) for depth, rank in enumerate(RANKS)]
+
+
+def lineages_with_ranks(num_lineages: int) -> list:
+    """
+    :return: A list of tuples, each with a lineage string and a list of dictionaries with the taxa names and ranks,
+     as returned by entrez_utils and used by TaxonomicHierarchy.feed
+    """
+    lineages = []
+    for i in range(num_lineages):
+        taxa = lineage_taxa(i)
+        lineage_ex = [{"ScientificName": taxon, "Rank": rank} for taxon, rank in zip(taxa, RANKS)]
+        lineages.append(("; ".join(taxa), lineage_ex))
+    return lineages
+
+
+def classification_rows(num_seqs: int, refpkg_name="XmoA", seed=1) -> list:
+    """
+    :return: A list of lists, each containing the fields of a classification table row (marker_contig_map.tsv)
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(num_seqs):
+        taxa = lineage_taxa(i)[:rng.randint(1, len(RANKS))]
+        lineage = "; ".join(["r__Root"] + ["{}__{}".format(p, t) for p, t in zip(RANK_PREFIXES, taxa)])
+        distances = ",".join([str(round(rng.random(), 3)) for _ in range(3)])
+        rows.append(["synthetic", orf_name(i), refpkg_name, "1", str(rng.randint(100, 400)), lineage,
+                     str(round(rng.uniform(0, 100), 2)), str(rng.randint(0, 184)),
+                     "{:.1e}".format(10 ** -rng.randint(20, 100)), str(round(rng.random(), 3)),
+                     str(round(rng.random(), 3)), distances])
+    return rows
+
+
+def write_dataset(output_dir: str, size: int, template_jplace: str) -> dict:
+    """
+    Writes the synthetic files for a benchmark size, unless they already exist.
+
+    :return: A dictionary mapping the input types to their paths
+    """
+    paths = {"fasta": os.path.join(output_dir, "synthetic_ORFs.faa"),
+             "domtbl": os.path.join(output_dir, "XmoA_search_to_ORFs_domtbl.txt"),
+             "epa_dir": os.path.join(output_dir, "epa") + os.sep}
+    paths["jplace"] = os.path.join(paths["epa_dir"], "epa_result.XmoA_hmm_purified_group0-BMGE.jplace")
+    if not os.path.isdir(paths["epa_dir"]):
+        os.makedirs(paths["epa_dir"])
+    if not os.path.isfile(paths["fasta"]):
+        write_protein_fasta(paths["fasta"], size)
+    if not os.path.isfile(paths["domtbl"]):
+        write_domain_table(paths["domtbl"], size)
+    if not os.path.isfile(paths["jplace"]):
+        write_jplace(paths["jplace"], template_jplace, size)
+    return paths
@@ -18,6 +18,10 @@ def get_options():
                         help="The field separator used in table to merge. There can only be one! [ DEFAULT = '\\t' ]")
     parser.add_argument("-o", "--output_table", required=True, dest="output",
                         help="Name of the file to write merged tables to.")
+    parser.add_argument("-b", "--database", required=False, dest="db", default=None,
+                        help="Path to a TreeSAPP classification store (SQLite). Only classification tables that are "
+                             "new or modified since they were last merged are parsed, and the merged output is "
+                             "written from the database, with fields separated by --separator.")
     args = parser.parse_args()
 
     if not (args.list or args.dir):
@@ -104,7 +108,13 @@ def main():
         tables += fetch_tables_from_dir(args.dir)
     if not tables:
         sys.exit("ERROR: No tables were found for merging.")
-    merge_tables(tables, args.sep, args.output)
+    if args.db:
+        from treesapp.classification_store import ClassificationStore
+        with ClassificationStore(args.db) as classification_store:
+            classification_store.add_tables(tables)
+            classification_store.export_table(args.output, sep=args.sep)
+    else:
+        merge_tables(tables, args.sep, args.output)
 
 
 main()
@@ -43,8 +43,8 @@ SETUP_METADATA = \
                                   language="c++",
                                   include_dirs=["./treesapp/include"])
                         ],
-        "install_requires": ["samsum", "pyfastx",
-                             "pygtrie", "six",
+        "install_requires": ["samsum>=0.1.4", "pyfastx",
+                             "six",
                              "biopython", "ete3",
                              "numpy", "scipy", "scikit-learn", "joblib",
                              "seaborn", "matplotlib", "tqdm", "packaging"],
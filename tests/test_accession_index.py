@@ -0,0 +1,88 @@
+import os
+import gzip
+import shutil
+import unittest
+
+from .testing_utils import get_test_data
+
+
+class Accession2TaxidIndexTester(unittest.TestCase):
+    def setUp(self) -> None:
+        self.output_dir = "./tests/accession_index_test/"
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.mkdir(self.output_dir)
+        self.accession2taxid = os.path.join(self.output_dir, "create_test.accession2taxid")
+        shutil.copy(get_test_data("create_test.accession2taxid"), self.accession2taxid)
+        return
+
+    def tearDown(self) -> None:
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+
+    def test_build_accession2taxid_index(self):
+        from treesapp.accession_index import Accession2TaxidIndex, build_accession2taxid_index
+        index_path = os.path.join(self.output_dir, "test.tsidx")
+        # A small chunk size ensures the sorted chunks are merged
+        self.assertEqual(91, build_accession2taxid_index(self.accession2taxid, index_path, chunk_size=10))
+        self.assertTrue(Accession2TaxidIndex.is_index(index_path))
+        self.assertFalse(Accession2TaxidIndex.is_index(self.accession2taxid))
+        # No temporary files are left behind
+        self.assertEqual({"create_test.accession2taxid", "test.tsidx"}, set(os.listdir(self.output_dir)))
+
+        with Accession2TaxidIndex(index_path) as acc_index:
+            self.assertEqual(91, len(acc_index))
+            self.assertEqual(("BAJ94456.1", "112509"), acc_index.lookup("BAJ94456"))
+            self.assertEqual(("AFO51911.1", "1212765"), acc_index.lookup("AFO51911"))
+            self.assertIsNone(acc_index.lookup("BAJ94456.1"))
+            self.assertIsNone(acc_index.lookup("AAAAAAAA"))
+            self.assertIsNone(acc_index.lookup("ZZZZZZZZ"))
+
+        # Gzip-compressed files are indexed the same way, and duplicate accessions are only indexed once
+        with open(self.accession2taxid) as a2t_handler, gzip.open(self.accession2taxid + ".gz", 'wt') as gz_handler:
+            lines = a2t_handler.readlines()
+            gz_handler.writelines(lines + lines[1:3])
+        self.assertEqual(91, build_accession2taxid_index(self.accession2taxid + ".gz", index_path))
+
+        # Only the first record of a duplicated accession is indexed, even when it is not the smallest
+        with open(self.accession2taxid, 'a') as a2t_handler:
+            a2t_handler.write("BAJ94456\tBAJ94456.2\t1\t0\n")
+        with open(self.accession2taxid) as a2t_handler:
+            lines = a2t_handler.readlines()
+        with open(self.accession2taxid, 'w') as a2t_handler:
+            a2t_handler.writelines([lines[0], lines[-1]] + lines[1:-1])
+        build_accession2taxid_index(self.accession2taxid, index_path, chunk_size=10)
+        with Accession2TaxidIndex(index_path) as acc_index:
+            self.assertEqual(("BAJ94456.2", "1"), acc_index.lookup("BAJ94456"))
+        return
+
+    def test_fetch_accession2taxid_index(self):
+        from treesapp.accession_index import fetch_accession2taxid_index
+        acc_index = fetch_accession2taxid_index(self.accession2taxid)
+        self.assertTrue(os.path.isfile(self.accession2taxid + ".tsidx"))
+        self.assertEqual(("AGE95467.1", "6035"), acc_index.lookup("AGE95467"))
+        acc_index.close()
+        # The index itself can be provided in place of the accession2taxid file
+        with fetch_accession2taxid_index(self.accession2taxid + ".tsidx") as acc_index:
+            self.assertEqual(91, len(acc_index))
+        return
+
+    def test_map_accession2taxid(self):
+        from treesapp.entrez_utils import EntrezRecord, map_accession2taxid, scan_accession2taxid
+        records = [EntrezRecord(acc, "") for acc in ["BAJ94456", "AOW44514", "AOW44514", "XP_999999999"]]
+        er_acc_dict = map_accession2taxid(records, self.accession2taxid)
+        self.assertEqual(["112509", "34020", "34020", ""], [record.ncbi_tax for record in records])
+        self.assertEqual(["BAJ94456.1", "AOW44514.1", "AOW44514.1", ""], [record.versioned for record in records])
+        self.assertEqual(3, len(er_acc_dict))
+        # The accession2taxid file is read directly when it can't be indexed
+        self.assertEqual({"BAJ94456": ("BAJ94456.1", "112509")},
+                         scan_accession2taxid(self.accession2taxid, {"BAJ94456", "XP_999999999"}))
+        with open(self.accession2taxid) as a2t_handler, gzip.open(self.accession2taxid + ".gz", 'wt') as gz_handler:
+            gz_handler.writelines(a2t_handler.readlines())
+        self.assertEqual({"BAJ94456": ("BAJ94456.1", "112509")},
+                         scan_accession2taxid(self.accession2taxid + ".gz", {"BAJ94456", "XP_999999999"}))
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
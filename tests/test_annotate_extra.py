@@ -114,6 +114,30 @@ class MyTestCase(unittest.TestCase):
 
         return
 
+    def test_parse_marker_classification_table(self):
+        import shutil
+        from treesapp.annotate_extra import parse_marker_classification_table
+        from treesapp.assign import write_classification_table
+        from treesapp.file_parsers import read_classification_table, pyarrow_available
+        from treesapp.phylo_seq import assignments_to_treesaps
+        tsv_table = utils.get_test_data(os.path.join("test_output_TarA", "final_outputs", "marker_contig_map.tsv"))
+        master_dat, field_order = parse_marker_classification_table(tsv_table)
+        self.assertEqual(117, sum([len(assignments) for assignments in master_dat.values()]))
+        self.assertEqual("Distances", field_order[11])
+        if not pyarrow_available():
+            return
+        # The classification table is read from the Parquet variant when the plain-text table is missing
+        output_dir = "./tests/layer_tables/"
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        os.mkdir(output_dir)
+        pqueries = assignments_to_treesaps(read_classification_table(tsv_table))
+        write_classification_table(pqueries, "TarA", output_dir + "marker_contig_map.parquet")
+        master_dat, _ = parse_marker_classification_table(output_dir + "marker_contig_map.tsv")
+        self.assertEqual(117, sum([len(assignments) for assignments in master_dat.values()]))
+        shutil.rmtree(output_dir)
+        return
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -80,6 +80,184 @@ class AssignerTester(unittest.TestCase):
         self.assertTrue(ts_assigner.stage_status("abundance"))
         return
 
+    def test_classify_pqueries(self):
+        from treesapp import assign
+        from treesapp.refpkg import ReferencePackage
+        # Lay out the JPlace files for two reference packages as EPA-ng would
+        shutil.copy(get_test_data(os.path.join("p_amoA_FunGene9.5_isolates_assign", "intermediates",
+                                               "epa_result.XmoA_hmm_purified_group0-BMGE.jplace")),
+                    self.output_dir)
+        shutil.copy(get_test_data(os.path.join("test_output_TarA", "iTOL_output", "McrA",
+                                               "McrA_complete_profile.jplace")),
+                    os.path.join(self.output_dir, "epa_result.McrA_hmm_purified_group0-BMGE.jplace"))
+        refpkg_dict = {}
+        for prefix in ["XmoA", "McrA"]:
+            refpkg = ReferencePackage(prefix)
+            refpkg.f__json = get_test_data(os.path.join("refpkgs", prefix + "_build.pkl"))
+            refpkg.slurp()
+            refpkg_dict[prefix] = refpkg
+
+        serial_saps, serial_itol = assign.classify_pqueries(self.output_dir, refpkg_dict, min_lwr=0.1, num_proc=1)
+        pool_saps, pool_itol = assign.classify_pqueries(self.output_dir, refpkg_dict, min_lwr=0.1, num_proc=2)
+        self.assertEqual({"XmoA", "McrA"}, set(pool_saps.keys()))
+        self.assertEqual(set(serial_itol.keys()), set(pool_itol.keys()))
+        for refpkg_code in serial_saps:
+            self.assertEqual([pq.recommended_lineage for pq in serial_saps[refpkg_code]],
+                             [pq.recommended_lineage for pq in pool_saps[refpkg_code]])
+        self.assertEqual(81, len(pool_saps["XmoA"]))
+        # The PQuery instances in the merged JPlace must be the same objects as those in the classified dictionary
+        self.assertTrue(pool_itol["McrA"].pqueries[0] is pool_saps["McrA"][0])
+
+        # The JPlace instances are not kept when the iTOL outputs are skipped
+        skip_saps, skip_itol = assign.classify_pqueries(self.output_dir, refpkg_dict, min_lwr=0.1, num_proc=2,
+                                                        itol=False)
+        self.assertEqual(0, len(skip_itol))
+        self.assertEqual(81, len(skip_saps["XmoA"]))
+        return
+
+    def test_rebuild_itol_data(self):
+        import json
+        from treesapp import assign
+        from treesapp import phylo_seq
+        from treesapp.refpkg import ReferencePackage
+        from treesapp.file_parsers import read_classification_table
+        assign_output = get_test_data("p_amoA_FunGene9.5_isolates_assign")
+        refpkg = ReferencePackage("XmoA")
+        refpkg.f__json = get_test_data(os.path.join("refpkgs", "XmoA_build.pkl"))
+        refpkg.slurp()
+        classified_lines = read_classification_table(os.path.join(assign_output, "final_outputs",
+                                                                  "marker_contig_map.tsv"))
+        tree_saps, itol_data = assign.rebuild_itol_data(os.path.join(assign_output, "intermediates") + os.sep,
+                                                        {"XmoA": refpkg}, classified_lines)
+        self.assertEqual({"XmoA"}, set(itol_data.keys()))
+        # Only the PQueries in the classification table are classified
+        self.assertEqual(len(classified_lines), len([pq for pq in tree_saps["XmoA"] if pq.classified]))
+
+        # Queries loaded from a placement cache and those identical to a representative were not placed in this run
+        placed = [pq for pq in tree_saps["XmoA"] if pq.classified][0]
+        cached, member = phylo_seq.PQuery(), phylo_seq.PQuery()
+        cached.place_name, cached.ref_name, cached.classified = "cached|XmoA|1_100", "XmoA", True
+        cached.consensus_placement = placed.consensus_placement
+        member.place_name, member.ref_name = "member|XmoA|1_100", "XmoA"
+        member.transfer_classification(placed)
+        tree_saps["XmoA"] += [cached, member]
+
+        itol_dir = os.path.join(self.output_dir, "iTOL_output") + os.sep
+        assign.produce_itol_inputs(tree_saps, {"XmoA": refpkg}, itol_data, itol_dir, self.output_dir)
+        master_jplace = os.path.join(itol_dir, "XmoA", "XmoA_complete_profile.jplace")
+        self.assertTrue(os.path.isfile(master_jplace))
+        with open(master_jplace) as jplace_handler:
+            jplace_names = [p["n"][0] for p in json.load(jplace_handler)["placements"]]
+        self.assertEqual(len(classified_lines) + 2, len(jplace_names))
+        self.assertTrue({"cached|XmoA|1_100", "member|XmoA|1_100", placed.place_name}.issubset(jplace_names))
+        self.assertEqual(placed.place_name, placed.consensus_placement.name)
+        return
+
+    def test_dereplicate_queries(self):
+        from treesapp import assign
+        from treesapp import phylo_seq
+        extracted_seq_dict = {"McrA": {0: {-1: "MKVL", -2: "MKVL", -3: "MKIL"}, 1: {-4: "MKVL"}},
+                              "PuhA": {0: {-1: "MKVL"}}}
+        numeric_contig_index = {"McrA": {-1: "seq1|McrA|1_4", -2: "seq2|McrA|1_4",
+                                         -3: "seq3|McrA|1_4", -4: "seq4|McrA|5_8"},
+                                "PuhA": {-1: "seq1|PuhA|1_4"}}
+        derep_seq_dict, query_members = assign.dereplicate_queries(extracted_seq_dict, numeric_contig_index)
+        # Identical sequences are only collapsed within a reference package
+        self.assertEqual({"McrA": {0: {-1: "MKVL", -3: "MKIL"}, 1: {}}, "PuhA": {0: {-1: "MKVL"}}}, derep_seq_dict)
+        self.assertEqual({"seq1|McrA|1_4": ["seq2|McrA|1_4", "seq4|McrA|5_8"]}, query_members)
+
+        # Expand the placed representative back to all of the identical query sequences
+        pqueries = []
+        for place_name in numeric_contig_index["McrA"].values():
+            pquery = phylo_seq.PQuery()
+            pquery.place_name, pquery.ref_name = place_name, "McrA"
+            pqueries.append(pquery)
+        representative = pqueries[0]
+        representative.recommended_lineage = "r__Root; d__Archaea"
+        representative.consensus_placement = phylo_seq.PhyloPlace()
+        tree_saps = {"McrA": [representative, pqueries[2]]}
+        self.assertEqual(2, assign.expand_dereplicated_pqueries(tree_saps, query_members, pqueries))
+        self.assertEqual(["seq1|McrA|1_4", "seq3|McrA|1_4", "seq2|McrA|1_4", "seq4|McrA|5_8"],
+                         [pquery.place_name for pquery in tree_saps["McrA"]])
+        self.assertEqual("r__Root; d__Archaea", tree_saps["McrA"][3].recommended_lineage)
+        self.assertEqual(representative.consensus_placement, tree_saps["McrA"][3].consensus_placement)
+        return
+
+    def test_map_read_sets(self):
+        from treesapp import assign
+        from treesapp.checkpoint import CheckpointManifest
+        orfs = os.path.join(self.output_dir, "Assign_classified.fna")
+        with open(orfs, 'w') as fasta_handler:
+            fasta_handler.write(">orf1\nATGAAA\n")
+        read_sets = [("day1", orfs, None), ("day2", orfs, None)]
+        checkpoints = CheckpointManifest(os.path.join(self.output_dir, "checkpoints.json"))
+        for sample_name, _, _ in read_sets:
+            sam_file = self.output_dir + sample_name + ".sam"
+            open(sam_file, 'w').close()
+            checkpoints.complete("abundance", os.path.basename(sam_file), [orfs, orfs, None], [sam_file],
+                                 {"pairing": "se"})
+        # Read sets that were already aligned are not aligned again, so BWA isn't needed
+        self.assertEqual([("day1", self.output_dir + "day1.sam"), ("day2", self.output_dir + "day2.sam")],
+                         list(assign.map_read_sets("bwa_not_found", orfs, self.output_dir, read_sets, "se",
+                                                   num_threads=4, checkpoints=checkpoints)))
+        return
+
+    def test_map_read_sets_alignment(self):
+        from samsum import commands as samsum_cmd
+        from treesapp import assign
+        from treesapp.file_parsers import read_reads_table
+        orfs = os.path.join(self.output_dir, "Assign_classified.fna")
+        with open(orfs, 'w') as fasta_handler:
+            fasta_handler.write(">orf1\nATGAAA\n>orf2\nATGCCC\n")
+        # A stand-in for BWA, which aligns each line of the reads file (its last argument) to orf1 or orf2
+        bwa_exe = os.path.join(self.output_dir, "bwa")
+        with open(bwa_exe, 'w') as bwa_handler:
+            bwa_handler.write("#!/bin/sh\n"
+                              "[ \"$1\" = index ] && exit 0\n"
+                              "for last; do :; done\n"
+                              "printf '@SQ\\tSN:orf1\\tLN:6\\n@SQ\\tSN:orf2\\tLN:6\\n'\n"
+                              "n=0\n"
+                              "while read -r ref; do\n"
+                              "  n=$((n+1))\n"
+                              "  printf 'r%d\\t0\\t%s\\t1\\t60\\t6M\\t*\\t0\\t0\\tATGAAA\\tIIIIII\\n' $n $ref\n"
+                              "done < \"$last\"\n")
+        os.chmod(bwa_exe, 0o755)
+        reads_table = os.path.join(self.output_dir, "reads_table.tsv")
+        with open(reads_table, 'w') as table_handler:
+            for sample_name, refs in [("day 1", ["orf1", "orf1", "orf2"]), ("day2", ["orf2"])]:
+                reads = os.path.join(self.output_dir, sample_name.replace(' ', '') + ".fq")
+                with open(reads, 'w') as reads_handler:
+                    reads_handler.write("\n".join(refs) + "\n")
+                table_handler.write("{}\t{}\n".format(sample_name, reads))
+
+        read_sets = read_reads_table(reads_table)
+        sample_abundances = {sample_name: {} for sample_name, _, _ in read_sets}
+        sam_files = []
+        for sample_name, sam_file in assign.map_read_sets(bwa_exe, orfs, self.output_dir, read_sets, "se",
+                                                          num_threads=2):
+            sam_files.append(sam_file)
+            ref_seq_abunds = samsum_cmd.ref_sequence_abundances(aln_file=sam_file, seq_file=orfs, min_aln=10,
+                                                                p_cov=50, map_qual=1, multireads=False)
+            sample_abundances[sample_name] = {ref_seq.name: ref_seq.reads_mapped for ref_seq in ref_seq_abunds.values()}
+        # The sample name with a space is sanitised before it is used to name the SAM file
+        self.assertEqual([self.output_dir + "day2.sam", self.output_dir + "day_1.sam"], sorted(sam_files))
+
+        matrix_file = os.path.join(self.output_dir, "abundance_matrix.tsv")
+        assign.write_abundance_matrix(sample_abundances, ["orf1", "orf2"], matrix_file)
+        with open(matrix_file) as matrix_handler:
+            self.assertEqual(["Query\tday_1\tday2\n", "orf1\t2\t0\n", "orf2\t1\t1\n"], matrix_handler.readlines())
+        return
+
+    def test_write_abundance_matrix(self):
+        from treesapp import assign
+        matrix_file = os.path.join(self.output_dir, "abundance_matrix.tsv")
+        assign.write_abundance_matrix({"day2": {"orf1": 1.5}, "day1": {"orf1": 0.5, "orf2": 2.0}},
+                                      ["orf1", "orf2"], matrix_file)
+        with open(matrix_file) as matrix_handler:
+            self.assertEqual(["Query\tday2\tday1\n", "orf1\t1.5\t0.5\n", "orf2\t0.0\t2.0\n"],
+                             matrix_handler.readlines())
+        return
+
 
 if __name__ == '__main__':
     unittest.main()
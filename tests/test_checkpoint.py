@@ -0,0 +1,89 @@
+import os
+import shutil
+import unittest
+
+
+class CheckpointTester(unittest.TestCase):
+    def setUp(self) -> None:
+        self.output_dir = "./tests/checkpoint_test/"
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.mkdir(self.output_dir)
+        self.manifest = os.path.join(self.output_dir, "checkpoints.json")
+        self.input_file = os.path.join(self.output_dir, "queries.faa")
+        self.output_file = os.path.join(self.output_dir, "queries.sto")
+        for path, contents in [(self.input_file, ">seq1\nMKV\n"), (self.output_file, "# STOCKHOLM 1.0\n")]:
+            with open(path, 'w') as file_handler:
+                file_handler.write(contents)
+        return
+
+    def tearDown(self) -> None:
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+
+    def test_is_complete(self):
+        from treesapp.checkpoint import CheckpointManifest
+        checkpoints = CheckpointManifest(self.manifest)
+        self.assertFalse(checkpoints.is_complete("align", "queries.faa", [self.input_file]))
+        checkpoints.complete("align", "queries.faa", [self.input_file], [self.output_file], {"e_value": 1E-3})
+        self.assertTrue(checkpoints.is_complete("align", "queries.faa", [self.input_file], {"e_value": 1E-3}))
+        # Units are distinguished by both their stage and name
+        self.assertFalse(checkpoints.is_complete("place", "queries.faa", [self.input_file], {"e_value": 1E-3}))
+        self.assertFalse(checkpoints.is_complete("align", "refs.faa", [self.input_file], {"e_value": 1E-3}))
+        # Changed parameters
+        self.assertFalse(checkpoints.is_complete("align", "queries.faa", [self.input_file], {"e_value": 1E-5}))
+
+        # The manifest is read by the next run
+        checkpoints = CheckpointManifest(self.manifest)
+        self.assertTrue(checkpoints.is_complete("align", "queries.faa", [self.input_file], {"e_value": 1E-3}))
+        self.assertEqual([self.output_file], checkpoints.outputs("align", "queries.faa"))
+
+        # Changing the contents of an input file
+        with open(self.input_file, 'a') as file_handler:
+            file_handler.write(">seq2\nMKL\n")
+        self.assertFalse(checkpoints.is_complete("align", "queries.faa", [self.input_file], {"e_value": 1E-3}))
+
+        # Removing an output file
+        checkpoints.complete("align", "queries.faa", [self.input_file], [self.output_file])
+        self.assertTrue(checkpoints.is_complete("align", "queries.faa", [self.input_file]))
+        os.remove(self.output_file)
+        self.assertFalse(checkpoints.is_complete("align", "queries.faa", [self.input_file]))
+        return
+
+    def test_complete_shared_manifest(self):
+        from treesapp.checkpoint import CheckpointManifest
+        # Units recorded through another instance of the same manifest are kept
+        assign_checkpoints = CheckpointManifest(self.manifest)
+        abundance_checkpoints = CheckpointManifest(self.manifest)
+        abundance_checkpoints.complete("abundance", "queries.sam", [self.input_file], [self.output_file])
+        assign_checkpoints.complete("place", "queries", [self.input_file], [self.output_file])
+        checkpoints = CheckpointManifest(self.manifest)
+        self.assertTrue(checkpoints.is_complete("abundance", "queries.sam", [self.input_file]))
+        self.assertTrue(checkpoints.is_complete("place", "queries", [self.input_file]))
+
+        # A corrupt manifest is ignored, rather than failing the run
+        with open(self.manifest, 'w') as manifest_handler:
+            manifest_handler.write("{")
+        self.assertFalse(CheckpointManifest(self.manifest).is_complete("place", "queries", [self.input_file]))
+        return
+
+    def test_sub_indices_for_seq_names_jplace(self):
+        from treesapp.jplace_utils import sub_indices_for_seq_names_jplace, jplace_parser
+        from treesapp.refpkg import ReferencePackage
+        from .testing_utils import get_test_data
+        jplace_file = os.path.join(self.output_dir, "epa_result.McrA_hmm_purified_group0-BMGE.jplace")
+        shutil.copy(get_test_data(os.path.join("test_output_TarA", "iTOL_output", "McrA",
+                                               "McrA_complete_profile.jplace")), jplace_file)
+        refpkg = ReferencePackage("McrA")
+        with open(jplace_file) as jplace_handler:
+            original = jplace_handler.read()
+        # Placements whose query sequences were already named, such as those reused from a previous run, are unchanged
+        sub_indices_for_seq_names_jplace(self.output_dir, {"McrA": {}}, {"McrA": refpkg})
+        with open(jplace_file) as jplace_handler:
+            self.assertEqual(original, jplace_handler.read())
+        self.assertTrue(len(jplace_parser(jplace_file).pqueries) > 0)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import unittest
+
+from .testing_utils import get_test_data
+
+
+class ClassificationStoreTester(unittest.TestCase):
+    def setUp(self) -> None:
+        self.output_dir = "./tests/classification_store_test/"
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.mkdir(self.output_dir)
+        self.db_path = os.path.join(self.output_dir, "classifications.db")
+        self.tara_table = get_test_data(os.path.join("test_output_TarA", "final_outputs", "marker_contig_map.tsv"))
+        self.amoa_table = get_test_data(os.path.join("p_amoA_FunGene9.5_isolates_assign", "final_outputs",
+                                                     "marker_contig_map.tsv"))
+        return
+
+    def tearDown(self) -> None:
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+
+    def test_add_tables(self):
+        from treesapp.classification_store import ClassificationStore
+        from treesapp.file_parsers import read_classification_table
+        tara_lines = read_classification_table(self.tara_table)
+        amoa_lines = read_classification_table(self.amoa_table)
+        with ClassificationStore(self.db_path) as store:
+            self.assertEqual(len(tara_lines) + len(amoa_lines), store.add_tables([self.tara_table, self.amoa_table]))
+            # Unchanged tables are not ingested again
+            self.assertEqual(0, store.add_table(self.tara_table))
+            self.assertEqual(len(tara_lines), store.add_table(self.tara_table, force=True))
+            self.assertEqual(len(tara_lines) + len(amoa_lines), len(store.query()))
+            self.assertEqual(2, len(store.samples()))
+
+        # Rows are inserted in batches, replacing only the rows previously inserted from the same table
+        with ClassificationStore(self.db_path) as store:
+            self.assertEqual(len(tara_lines),
+                             store.append_rows(iter(tara_lines), os.path.abspath(self.tara_table), batch_size=10))
+            self.assertEqual(len(tara_lines) + len(amoa_lines), len(store.query()))
+
+        # Reopen the store to ensure the classifications persist
+        with ClassificationStore(self.db_path) as store:
+            self.assertEqual([fields[1] for fields in tara_lines],
+                             [fields[1] for fields in store.query(samples=["TarA"])])
+        return
+
+    def test_add_tables_shared_sample(self):
+        from treesapp.classification_store import ClassificationStore
+        from treesapp.file_parsers import read_classification_table
+        tara_lines = read_classification_table(self.tara_table)
+        # A second table from the same sample, e.g. another assign run of TarA
+        tara_subset = os.path.join(self.output_dir, "marker_contig_map.tsv")
+        with open(self.tara_table) as tara_handler, open(tara_subset, 'w') as subset_handler:
+            subset_handler.writelines(tara_handler.readlines()[:6])
+        with ClassificationStore(self.db_path) as store:
+            self.assertEqual(len(tara_lines) + 5, store.add_tables([self.tara_table, tara_subset]))
+            self.assertEqual(len(tara_lines) + 5, len(store.query(samples=["TarA"])))
+            # Re-ingesting one of the tables only replaces its own rows
+            self.assertEqual(5, store.add_table(tara_subset, force=True))
+            self.assertEqual(len(tara_lines) + 5, len(store.query(samples=["TarA"])))
+        return
+
+    def test_query(self):
+        from treesapp.classification_store import ClassificationStore
+        from treesapp.file_parsers import read_classification_table
+        tara_lines = read_classification_table(self.tara_table)
+        with ClassificationStore(self.db_path) as store:
+            store.add_tables([self.tara_table, self.amoa_table])
+            self.assertEqual(len([f for f in tara_lines if f[2] == "McrA"]), len(store.query(refpkgs=["McrA"])))
+            self.assertEqual(len([f for f in tara_lines if float(f[9]) >= 0.9]),
+                             len(store.query(samples=["TarA"], min_lwr=0.9)))
+            # Lineage queries include descendents but not taxa that only share a name prefix
+            lineage = "r__Root; d__Archaea"
+            archaea = store.query(samples=["TarA"], lineage=lineage)
+            self.assertEqual(len([f for f in tara_lines if f[5] == lineage or f[5].startswith(lineage + "; ")]),
+                             len(archaea))
+            self.assertEqual(0, len(store.query(lineage="r__Root; d__Archae")))
+
+            summary = store.summarize(group_by=("sample", "marker"))
+            self.assertEqual(len(tara_lines), sum([n for sample, _, n, _ in summary if sample == "TarA"]))
+
+            # Export the classifications and ensure they can be read as a classification table
+            merged_table = os.path.join(self.output_dir, "merged_marker_contig_map.tsv")
+            self.assertEqual(len(tara_lines), store.export_table(merged_table, samples=["TarA"]))
+            self.assertEqual(len(tara_lines), len(read_classification_table(merged_table)))
+            # Fields can be separated by something other than tabs
+            self.assertEqual(len(tara_lines), store.export_table(merged_table, sep=',', samples=["TarA"]))
+            with open(merged_table) as merged_handler:
+                self.assertEqual(",".join(tara_lines[0]), merged_handler.readlines()[1].strip())
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,7 +26,7 @@ class TreesappTester(unittest.TestCase):
     def tearDown(self) -> None:
         # Clean up output directories
         output_prefix = os.path.join(os.path.abspath("./"), "TreeSAPP_")
-        for test_name in ["assign", "train", "update", "evaluate", "create", "package", "purity", "MCC", "colour"]:
+        for test_name in ["assign", "train", "update", "evaluate", "create", "package", "purity", "MCC", "colour", "itol"]:
             output_dir = output_prefix + test_name
             if os.path.isdir(output_dir):
                 rmtree(output_dir)
@@ -37,8 +37,11 @@ class TreesappTester(unittest.TestCase):
         from treesapp.file_parsers import read_classification_table
         from .testing_utils import get_test_data
         classification_table = os.path.join(self.ts_assign_output, "final_outputs", "marker_contig_map.tsv")
-        # Copy the classification table to replace after overwrite
-        copyfile(classification_table, os.path.join(self.ts_assign_output, "tmp.tsv"))
+        # Copy the classification table to replace after overwrite, even if the test fails
+        backup_table = os.path.join(self.ts_assign_output, "tmp.tsv")
+        copyfile(classification_table, backup_table)
+        self.addCleanup(os.remove, backup_table)
+        self.addCleanup(copyfile, backup_table, classification_table)
         pre_lines = read_classification_table(get_test_data(classification_table))
         abundance_command_list = ["--treesapp_output", self.ts_assign_output,
                                   "--reads", get_test_data("test_TarA.1.fq"),
@@ -53,9 +56,6 @@ class TreesappTester(unittest.TestCase):
         # Ensure the name of the sample is substituted for the sample ID
         self.assertEqual({"test_TarA.1"}, set([line[0] for line in post_lines]))
         self.assertEqual(1773, round(sum(abund_dict.values())))
-        # Replace the classification table
-        copyfile(os.path.join(self.ts_assign_output, "tmp.tsv"), classification_table)
-        os.remove(os.path.join(self.ts_assign_output, "tmp.tsv"))
         return
 
     def test_assign_prot(self):
@@ -143,6 +143,34 @@ class TreesappTester(unittest.TestCase):
         self.assertTrue(test_refpkg.pfit[0] < 0)
         return
 
+    def test_create_profile_align(self):
+        from treesapp.commands import create
+        from treesapp.refpkg import ReferencePackage
+        from treesapp.fasta import read_fasta_to_dict
+        from .testing_utils import get_test_data
+        create_commands_list = ["--fastx_input", get_test_data("ENOG4111FIN.txt"),
+                                "--output", "./TreeSAPP_create",
+                                "--refpkg_name", "PuhA",
+                                "--similarity", "0.90",
+                                "--profile", get_test_data("PuhA_search.hmm"),
+                                "--molecule", "prot",
+                                "--screen", "Bacteria,Archaea",
+                                "--num_procs", str(self.num_procs),
+                                "--min_taxonomic_rank", 'p',
+                                "--stage", "support",
+                                "--profile_align", "--outdet_align", "--cluster", "--headless",
+                                "--overwrite", "--delete"]
+        create(create_commands_list)
+        test_refpkg = ReferencePackage()
+        test_refpkg.f__json = "./TreeSAPP_create/final_outputs/PuhA_build.pkl"
+        test_refpkg.slurp()
+        self.assertTrue(test_refpkg.validate())
+        # Sequences aligned to the profile only retain its match states, so all are the same length
+        ref_msa = read_fasta_to_dict(test_refpkg.f__msa)
+        self.assertEqual(1, len({len(seq) for seq in ref_msa.values()}))
+        self.assertEqual(test_refpkg.num_seqs, len(ref_msa))
+        return
+
     def test_create_eggnog(self):
         from treesapp.commands import create
         from treesapp.refpkg import ReferencePackage
@@ -216,6 +244,25 @@ class TreesappTester(unittest.TestCase):
         self.assertTrue(True)
         return
 
+    def test_itol(self):
+        from treesapp.commands import itol
+        from .testing_utils import get_test_data
+        output_dir = os.path.join(os.path.abspath("./"), "TreeSAPP_itol")
+        if os.path.isdir(output_dir):
+            rmtree(output_dir)
+        os.mkdir(output_dir)
+        assign_output = get_test_data("p_amoA_FunGene9.5_isolates_assign/")
+        for sub_dir in ["final_outputs", "intermediates"]:
+            os.mkdir(os.path.join(output_dir, sub_dir))
+        copyfile(os.path.join(assign_output, "final_outputs", "marker_contig_map.tsv"),
+                 os.path.join(output_dir, "final_outputs", "marker_contig_map.tsv"))
+        copyfile(os.path.join(assign_output, "intermediates", "epa_result.XmoA_hmm_purified_group0-BMGE.jplace"),
+                 os.path.join(output_dir, "intermediates", "epa_result.XmoA_hmm_purified_group0-BMGE.jplace"))
+        itol(["--treesapp_output", output_dir, "--refpkg_dir", self.refpkg_dir])
+        self.assertTrue(os.path.isfile(os.path.join(output_dir, "iTOL_output", "XmoA",
+                                                    "XmoA_complete_profile.jplace")))
+        return
+
     def test_layer(self):
         from treesapp.commands import layer
         from .testing_utils import get_test_data
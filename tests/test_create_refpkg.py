@@ -0,0 +1,61 @@
+import unittest
+
+
+class CreateRefpkgTester(unittest.TestCase):
+    def setUp(self) -> None:
+        from treesapp.entrez_utils import EntrezRecord
+        self.records = dict()
+        for num_id in range(1, 12):
+            record = EntrezRecord(acc="ACC{}".format(num_id), ver="")
+            record.short_id = "{}_Crt".format(num_id)
+            record.sequence = "MKVL"
+            record.lineage = "r__Root; d__Archaea"
+            self.records[str(num_id)] = record
+        return
+
+    def test_partition_records(self):
+        from treesapp.create_refpkg import partition_records
+        partitions = partition_records(self.records, 3)
+        self.assertEqual([3, 4, 4], [len(partition) for partition in partitions])
+        # Partitions are contiguous in the order of the numerical IDs, not their string representations
+        self.assertEqual(['1', '2', '3'], list(partitions[0].keys()))
+        self.assertEqual(['8', '9', '10', '11'], list(partitions[2].keys()))
+        self.assertEqual(11, len(partition_records(self.records, 20)))
+        self.assertEqual([self.records], partition_records(self.records, 0))
+        return
+
+    def test_remove_outlier_sequences(self):
+        import os
+        import shutil
+        import pytest
+        from treesapp.create_refpkg import remove_outlier_sequences
+        output_dir = "./tests/outlier_test/"
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        os.mkdir(output_dir)
+        # Stand-ins for MAFFT, which 'aligns' by copying its input (the last argument) to standard output,
+        # and OD-seq, which reports the first sequence of each partition as an outlier
+        mafft_exe, odseq_exe = output_dir + "mafft", output_dir + "OD-seq"
+        for exe, script in [(mafft_exe, 'for last; do :; done\ncat "$last"\n'), (odseq_exe, 'head -n 2 "$2" >"$6"\n')]:
+            with open(exe, 'w') as exe_handler:
+                exe_handler.write("#!/bin/sh\n" + script)
+            os.chmod(exe, 0o755)
+        remove_outlier_sequences(self.records, odseq_exe, mafft_exe, output_dir, num_threads=2, partition_size=4)
+        self.assertEqual(["ACC1", "ACC4", "ACC8"],
+                         sorted([record.accession for record in self.records.values() if not record.cluster_rep]))
+
+        # OD-seq is not run for a partition that MAFFT failed to align
+        with open(mafft_exe, 'w') as exe_handler:
+            exe_handler.write("#!/bin/sh\nfor last; do :; done\n" +
+                              'case "$last" in *od_input_1.fasta) ;; *) cat "$last" ;; esac\n')
+        with open(odseq_exe, 'a') as exe_handler:
+            exe_handler.write("touch " + output_dir + "odseq_ran\n")
+        with pytest.raises(SystemExit):
+            remove_outlier_sequences(self.records, odseq_exe, mafft_exe, output_dir, num_threads=2, partition_size=4)
+        self.assertFalse(os.path.isfile(output_dir + "odseq_ran"))
+        shutil.rmtree(output_dir)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
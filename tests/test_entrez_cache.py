@@ -0,0 +1,82 @@
+import os
+import time
+import shutil
+import unittest
+
+from .testing_utils import get_test_data
+
+
+class EntrezCacheTester(unittest.TestCase):
+    def setUp(self) -> None:
+        self.output_dir = "./tests/entrez_cache_test/"
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.mkdir(self.output_dir)
+        self.db_path = os.path.join(self.output_dir, "entrez.db")
+        self.taxonomy_record = {"TaxId": "2173", "ScientificName": "Methanobrevibacter smithii", "Rank": "species",
+                                "Lineage": "cellular organisms; Archaea", "AkaTaxIds": ["12345"],
+                                "LineageEx": [{"TaxId": "131567", "ScientificName": "cellular organisms",
+                                               "Rank": "no rank"}]}
+        return
+
+    def tearDown(self) -> None:
+        from treesapp.entrez_utils import configure_entrez_cache
+        configure_entrez_cache("")
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+
+    def test_lookup(self):
+        from treesapp.entrez_cache import EntrezCache
+        with EntrezCache(self.db_path, ttl=1) as cache:
+            self.assertEqual(1, cache.store("Taxonomy:fetch", [("2173", self.taxonomy_record)]))
+            self.assertEqual({"2173": self.taxonomy_record}, cache.lookup("Taxonomy:fetch", ["2173", "2172"]))
+            # Records are keyed by both the database and the query method
+            self.assertEqual({}, cache.lookup("Taxonomy:search", ["2173"]))
+            # Records older than the time-to-live are not used
+            cache.conn.execute("UPDATE records SET fetched = ?", (time.time() - 2 * 86400,))
+            self.assertEqual({}, cache.lookup("Taxonomy:fetch", ["2173"]))
+        # The records persist between runs
+        with EntrezCache(self.db_path, ttl=3) as cache:
+            self.assertEqual(["2173"], list(cache.lookup("Taxonomy:fetch", ["2173"]).keys()))
+        return
+
+    def test_prewarm_from_refpkg(self):
+        from treesapp.entrez_cache import EntrezCache
+        from treesapp.refpkg import ReferencePackage
+        refpkg = ReferencePackage("McrA")
+        refpkg.f__json = get_test_data(os.path.join("refpkgs", "McrA_build.pkl"))
+        refpkg.slurp()
+        with EntrezCache(self.db_path) as cache:
+            # Only the accessions whose lineages were fetched from Entrez are prewarmed
+            self.assertEqual(0, cache.prewarm_from_refpkg(refpkg, "protein"))
+            refpkg.entrez_accessions = ["AAU82276", "AFI62039"]
+            self.assertEqual(2, cache.prewarm_from_refpkg(refpkg, "protein"))
+            record = cache.lookup("protein:fetch", ["AAU82276"])["AAU82276"]
+            self.assertEqual("uncultured archaeon GZfos13E1", record["GBSeq_organism"])
+            # Prewarmed records are kept apart from those fetched from Entrez
+            self.assertEqual(0, len(cache))
+            self.assertEqual([("AAU82276", "McrA")],
+                             cache.conn.execute("SELECT id, refpkg FROM prewarmed WHERE id = 'AAU82276'").fetchall())
+            self.assertEqual(0, cache.prewarm_from_refpkg(refpkg, "protein"))
+            # Records fetched from Entrez take precedence over the prewarmed records
+            entrez_record = {"GBSeq_primary-accession": "AAU82276", "GBSeq_organism": "Methanosarcina sp."}
+            cache.store("protein:fetch", [("AAU82276", entrez_record)])
+            self.assertEqual(entrez_record, cache.lookup("protein:fetch", ["AAU82276"])["AAU82276"])
+        return
+
+    def test_tolerant_entrez_query(self):
+        from treesapp import entrez_utils
+        self.assertEqual([("2173", self.taxonomy_record), ("12345", self.taxonomy_record)],
+                         sorted(entrez_utils.key_entrez_records([self.taxonomy_record], ["2173", "12345", "2172"]),
+                                reverse=True))
+        entrez_utils.configure_entrez_cache(self.db_path)
+        entrez_utils.entrez_cache().store("Taxonomy:fetch", [("2173", self.taxonomy_record)])
+        # All of the records are cached so Entrez isn't queried
+        records, durations, failures = entrez_utils.tolerant_entrez_query(["2173"])
+        self.assertEqual([self.taxonomy_record], records)
+        self.assertEqual([], durations)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
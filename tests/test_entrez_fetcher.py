@@ -0,0 +1,114 @@
+import time
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+TAXA_SET = '<?xml version="1.0" ?>\n' \
+           '<!DOCTYPE TaxaSet PUBLIC "-//NLM//DTD Taxon, 14th January 2002//EN" ' \
+           '"https://www.ncbi.nlm.nih.gov/entrez/query/DTD/taxon.dtd">\n<TaxaSet>{}</TaxaSet>\n'
+TAXON = '<Taxon><TaxId>{0}</TaxId><ScientificName>Taxon {0}</ScientificName><Rank>species</Rank></Taxon>'
+
+
+class MockEntrezHandler(BaseHTTPRequestHandler):
+    """
+    Serves efetch requests to the Taxonomy database. Requests including the taxid '0' are rejected, as NCBI does for
+    malformed IDs, and the first request is answered with 'Too Many Requests' to test the rate is throttled.
+    Requests including a taxid in the server's 'stalled' set are answered after a second, to test time-outs.
+    """
+    def do_POST(self):
+        params = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
+        taxids = params["id"][0].split(',')
+        with self.server.lock:
+            self.server.requests.append(taxids)
+            first = len(self.server.requests) == 1
+        if first:
+            self.send_error(429)
+            return
+        if '0' in taxids:
+            self.send_error(400)
+            return
+        if self.server.stalled.intersection(taxids):
+            time.sleep(1)
+        body = TAXA_SET.format(''.join(TAXON.format(taxid) for taxid in taxids)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        return
+
+
+class EntrezFetcherTester(unittest.TestCase):
+    def setUp(self) -> None:
+        from treesapp.entrez_fetcher import configure_eutils, _eutils
+        self.eutils = dict(_eutils)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), MockEntrezHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.stalled = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        configure_eutils("http://127.0.0.1:{}/".format(self.server.server_port))
+        return
+
+    def tearDown(self) -> None:
+        from treesapp.entrez_fetcher import configure_eutils
+        self.server.shutdown()
+        self.server.server_close()
+        configure_eutils(self.eutils["url"], self.eutils["api_key"])
+        return
+
+    def test_token_bucket(self):
+        from treesapp.entrez_fetcher import TokenBucket
+        bucket = TokenBucket(rate=20)
+        start = time.monotonic()
+        for _ in range(11):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+        bucket.throttle()
+        self.assertEqual(10, bucket.rate)
+        bucket.recover()
+        self.assertEqual(11, bucket.rate)
+        return
+
+    def test_stream(self):
+        from treesapp.entrez_fetcher import EntrezFetcher, TokenBucket
+        fetcher = EntrezFetcher("Taxonomy", "fetch", max_in_flight=3, bucket=TokenBucket(100))
+        taxids = [str(taxid) for taxid in range(1, 17)]
+        taxids.insert(5, '0')
+        chunks = list(fetcher.stream(taxids, chunk_size=8))
+        fetched = [record["TaxId"] for _, records in chunks for record in records]
+        self.assertEqual(set(taxids).difference({'0'}), set(fetched))
+        self.assertEqual(16, len(fetched))
+        self.assertEqual(['0'], fetcher.failures)
+        # Three chunks, the first retried after the 'Too Many Requests' response, and the failed chunk of eight is
+        # bisected three times (six requests) rather than being queried one taxid at a time
+        self.assertEqual(10, len(self.server.requests))
+        self.assertEqual(10, fetcher.num_requests)
+        return
+
+    def test_timeout(self):
+        from treesapp.entrez_fetcher import EntrezFetcher, TokenBucket
+        fetcher = EntrezFetcher("Taxonomy", "fetch", max_in_flight=2, bucket=TokenBucket(100))
+        fetcher.timeout = 0.2
+        fetcher.retry_delay = 0
+        self.server.stalled.add('7')
+        taxids = [str(taxid) for taxid in range(1, 9)]
+        fetched = [record["TaxId"] for _, records in fetcher.stream(taxids, chunk_size=4) for record in records]
+        # Requests that time out are retried then bisected like any other failed request
+        self.assertEqual(set(taxids).difference({'7'}), set(fetched))
+        self.assertEqual(['7'], fetcher.failures)
+        return
+
+    def test_tolerant_entrez_query(self):
+        from treesapp.entrez_utils import tolerant_entrez_query
+        records, durations, failures = tolerant_entrez_query([1, 2, 0, 4], "Taxonomy", chunk_size=2)
+        self.assertEqual(["1", "2", "4"], sorted(record["TaxId"] for record in records))
+        self.assertEqual(["\t0"], failures)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -32,6 +32,9 @@ class MyTestCase(unittest.TestCase):
     def tearDown(self) -> None:
         if os.path.isfile(self.create_inst.acc_to_lin):
             os.remove(self.create_inst.acc_to_lin)
+        # Remove the index built the first time the accession2taxid file is used
+        if os.path.isfile(self.accession2taxid + ".tsidx"):
+            os.remove(self.accession2taxid + ".tsidx")
 
     def test_fetch_entrez_lineages(self):
         entrez_record_dict = self.create_inst.fetch_entrez_lineages(self.test_fa, 'prot')
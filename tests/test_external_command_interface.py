@@ -0,0 +1,125 @@
+import os
+import shutil
+import unittest
+
+from .testing_utils import get_test_data
+
+
+class ExternalCommandTester(unittest.TestCase):
+    def setUp(self) -> None:
+        self.output_dir = "./tests/external_command_test/"
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.mkdir(self.output_dir)
+        return
+
+    def tearDown(self) -> None:
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+
+    def test_launch_write_command(self):
+        from treesapp.external_command_interface import launch_write_command
+        # Arguments are passed verbatim, without being interpreted by a shell
+        stdout, returncode = launch_write_command(["echo", "a b", "$HOME", ">", "/dev/null"])
+        self.assertEqual(0, returncode)
+        self.assertEqual("a b $HOME > /dev/null\n", stdout)
+
+        # Redirect the standard output to a file rather than collecting it
+        out_file = os.path.join(self.output_dir, "echo.txt")
+        stdout, _ = launch_write_command(["echo", "redirected"], stdout=out_file)
+        self.assertEqual("", stdout)
+        with open(out_file) as out_handler:
+            self.assertEqual("redirected\n", out_handler.read())
+        stdout, _ = launch_write_command(["sort"], stdin=out_file)
+        self.assertEqual("redirected\n", stdout)
+
+        with self.assertRaises(SystemExit):
+            launch_write_command(["ls", os.path.join(self.output_dir, "missing")])
+        with self.assertRaises(SystemExit):
+            launch_write_command(["treesapp_missing_executable"])
+        return
+
+    def test_command_pipeline(self):
+        from treesapp.external_command_interface import CommandPipeline
+        with CommandPipeline([["printf", "c\\nb\\na\\n"], ["sort"]]) as pipeline:
+            self.assertEqual(["a", "b", "c"], [line.strip() for line in pipeline.stdout])
+        self.assertEqual([0, 0], [proc.returncode for proc in pipeline.processes])
+
+        # The consumer stopping early is not a failure
+        with CommandPipeline([["seq", "1", "1000000"], ["cat"]]) as pipeline:
+            self.assertEqual("1", pipeline.stdout.readline().strip())
+
+        out_file = os.path.join(self.output_dir, "sorted.txt")
+        with CommandPipeline([["printf", "2\\n1\\n"], ["sort"]], stdout=out_file):
+            pass
+        with open(out_file) as out_handler:
+            self.assertEqual("1\n2\n", out_handler.read())
+
+        with self.assertRaises(SystemExit):
+            with CommandPipeline([["printf", "1\\n"], ["ls", os.path.join(self.output_dir, "missing")]]):
+                pass
+        return
+
+    def test_stream_domain_table(self):
+        from treesapp.external_command_interface import CommandPipeline
+        from treesapp.hmmer_tbl_parser import DomainTableParser
+        domtbl = get_test_data("NxrA_search_to_ORFs_domtbl.txt")
+        file_table = DomainTableParser(domtbl)
+        file_table.read_domtbl_lines()
+        with CommandPipeline([["cat", domtbl]]) as pipeline:
+            streamed_table = DomainTableParser(pipeline.stdout)
+            streamed_table.read_domtbl_lines()
+        self.assertEqual(file_table.lines, streamed_table.lines)
+        return
+
+    def test_command_scheduler(self):
+        from treesapp.external_command_interface import CommandScheduler
+        # With a single thread the jobs run one at a time, in order of priority
+        log_file = os.path.join(self.output_dir, "order.txt")
+        scheduler = CommandScheduler("test", max_threads=1)
+        for name, priority in [("low", 0), ("high", 2), ("mid", 1)]:
+            scheduler.submit(["sh", "-c", "echo {} >> {}".format(name, log_file)], priority=priority)
+        scheduler.run()
+        with open(log_file) as log_handler:
+            self.assertEqual(["high", "mid", "low"], [line.strip() for line in log_handler])
+
+        # Jobs are yielded in the order they were submitted if requested, and output is collected
+        scheduler = CommandScheduler("test", max_threads=4)
+        for i in range(6):
+            scheduler.submit(["echo", str(i)], threads=2, memory=10)
+        self.assertEqual([str(i) + "\n" for i in range(6)],
+                         [job.output for job in scheduler.as_completed(ordered=True)])
+        self.assertTrue(all(job.state == "done" for job in scheduler.jobs))
+        return
+
+    def test_command_scheduler_resources(self):
+        from treesapp.external_command_interface import CommandScheduler, CommandJob
+        scheduler = CommandScheduler("test", max_threads=4, max_memory=1000)
+        self.assertTrue(scheduler.fits(CommandJob(["true"], threads=2, memory=500), 2, 500, 1))
+        self.assertFalse(scheduler.fits(CommandJob(["true"], threads=3, memory=500), 2, 500, 1))
+        self.assertFalse(scheduler.fits(CommandJob(["true"], threads=1, memory=600), 4, 500, 1))
+        # Jobs demanding more than the maximum run alone rather than never
+        self.assertTrue(scheduler.fits(CommandJob(["true"], threads=8, memory=2000), 4, 1000, 0))
+        return
+
+    def test_command_scheduler_failure(self):
+        from treesapp.external_command_interface import CommandScheduler
+        scheduler = CommandScheduler("test", max_threads=2, fail_fast=False)
+        failed = scheduler.submit(["false"])
+        dependent = scheduler.submit(["echo", "unreachable"], depends_on=[failed])
+        independent = scheduler.submit(["echo", "reachable"])
+        scheduler.run()
+        self.assertEqual("failed", failed.state)
+        self.assertEqual("cancelled", dependent.state)
+        self.assertEqual("done", independent.state)
+
+        scheduler = CommandScheduler("test", max_threads=2)
+        scheduler.submit(["false"])
+        scheduler.submit(["sleep", "10"])
+        with self.assertRaises(SystemExit):
+            scheduler.run()
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -99,6 +99,47 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(10, len(split_files))
         return
 
+    def test_split_fa_by_length(self):
+        from treesapp.fasta import split_fa_by_length, read_fasta_to_dict
+        fasta_dict = read_fasta_to_dict(self.test_fa)
+        split_files = split_fa_by_length(fastx=self.test_fa, outdir="./", num_chunks=8)
+        self.assertEqual(8, len(split_files))
+        split_dicts = [read_fasta_to_dict(f) for f in split_files]
+        merged_dict = dict()
+        for split_dict in split_dicts:
+            merged_dict.update(split_dict)
+        self.assertEqual(fasta_dict, merged_dict)
+        # The total sequence lengths of the chunks should differ by no more than the longest sequence
+        chunk_lengths = [sum([len(seq) for seq in split_dict.values()]) for split_dict in split_dicts]
+        self.assertTrue(max(chunk_lengths) - min(chunk_lengths) <= max([len(seq) for seq in fasta_dict.values()]))
+        # Never create more chunks than there are sequences
+        self.assertEqual(len(fasta_dict), len(split_fa_by_length(fastx=self.test_fa, outdir="./", num_chunks=1000)))
+        return
+
+    def test_format_fasta(self):
+        from treesapp.fasta import format_fasta, split_fa_by_length, read_fasta_to_dict
+        from treesapp.utilities import concatenate_files
+        test_fa_prefix, _ = os.path.splitext(os.path.basename(self.test_fa))
+        header_registry = format_fasta(self.test_fa, "prot", test_fa_prefix + "_formatted.faa")
+        formatted_seqs = read_fasta_to_dict(test_fa_prefix + "_formatted.faa")
+        self.assertEqual(len(header_registry), len(formatted_seqs))
+
+        # Formatting several FASTA files, provided lazily, must be the same as formatting them once concatenated
+        split_files = split_fa_by_length(fastx=self.test_fa, outdir="./", num_chunks=4)
+        open(test_fa_prefix + ".empty.faa", 'w').close()
+        concatenate_files(split_files, test_fa_prefix + "_concatenated.faa")
+        chunk_registry = format_fasta((f for f in split_files + [test_fa_prefix + ".empty.faa"]), "prot",
+                                      test_fa_prefix + "_chunks_formatted.faa",
+                                      copy_fasta=test_fa_prefix + "_chunks_copy.faa")
+        concat_registry = format_fasta(test_fa_prefix + "_concatenated.faa", "prot",
+                                       test_fa_prefix + "_concat_formatted.faa")
+        self.assertEqual([h.original for h in concat_registry.values()],
+                         [h.original for h in chunk_registry.values()])
+        self.assertEqual(read_fasta_to_dict(test_fa_prefix + "_concat_formatted.faa"),
+                         read_fasta_to_dict(test_fa_prefix + "_chunks_formatted.faa"))
+        self.assertEqual(read_fasta_to_dict(self.test_fa), read_fasta_to_dict(test_fa_prefix + "_chunks_copy.faa"))
+        return
+
     def test_fq2fa(self):
         from treesapp.fasta import fq2fa
         split_files = fq2fa(fastx=self.test_fq, outdir="./", max_seq_count=6)
@@ -49,6 +49,91 @@ class TreesappTester(unittest.TestCase):
         self.assertEqual(98, len(cluster_dict))
         return
 
+    def test_read_classification_table(self):
+        import os
+        import shutil
+        from treesapp.file_parsers import read_classification_table, classification_table_variants, pyarrow_available, \
+            read_classification_parquet
+        from treesapp.phylo_seq import assignments_to_treesaps
+        from treesapp.assign import write_classification_table, abundify_tree_saps
+        output_dir = "./tests/classification_tables/"
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        os.mkdir(output_dir)
+
+        tsv_lines = read_classification_table(get_test_data(os.path.join("test_output_TarA", "final_outputs",
+                                                                         "marker_contig_map.tsv")))
+        self.assertEqual(117, len(tsv_lines))
+        pqueries = assignments_to_treesaps(tsv_lines)
+        abundify_tree_saps(pqueries, {"{}|{}|{}_{}".format(f[1], f[2], f[3], f[4]): float(f[6]) for f in tsv_lines})
+
+        # Ensure each of the formats can be written and read back identically
+        formats = ["tsv", "tsv.gz"]
+        if pyarrow_available():
+            formats.append("parquet")
+        for table_format in formats:
+            table_path = os.path.join(output_dir, "marker_contig_map." + table_format)
+            write_classification_table(pqueries, "TarA", table_path)
+            self.assertEqual(tsv_lines, read_classification_table(table_path))
+        self.assertEqual(len(formats), len(classification_table_variants(output_dir + "marker_contig_map.tsv")))
+        if pyarrow_available():
+            import pyarrow.parquet as pq
+            # The numerical columns are stored as numbers and missing abundances as nulls
+            schema = pq.read_schema(output_dir + "marker_contig_map.parquet")
+            self.assertEqual(["int64", "double", "int64", "double"],
+                             [str(schema.field(name).type) for name in ["Start_pos", "Abundance", "iNode", "LWR"]])
+            pqueries["McrA"][0].abundance = None
+            pqueries["McrA"][1].abundance = 2
+            for table_format in ["tsv", "parquet"]:
+                write_classification_table(pqueries, "TarA", output_dir + "marker_contig_map." + table_format)
+            self.assertEqual(read_classification_table(output_dir + "marker_contig_map.tsv"),
+                             read_classification_parquet(output_dir + "marker_contig_map.parquet"))
+            # Copying the tables does not make the Parquet table stale
+            copy_dir = "./tests/classification_tables_copy/"
+            shutil.copytree(output_dir, copy_dir)
+            self.assertEqual(copy_dir + "marker_contig_map.parquet",
+                             classification_table_variants(copy_dir + "marker_contig_map.tsv")[0])
+            # Though modifying the plain-text table does, even if the number of rows is unchanged
+            with open(copy_dir + "marker_contig_map.tsv") as tsv_handler:
+                tsv_text = tsv_handler.read()
+            with open(copy_dir + "marker_contig_map.tsv", 'w') as tsv_handler:
+                tsv_handler.write(tsv_text.replace("TarA\t", "TarB\t", 1))
+            self.assertEqual(copy_dir + "marker_contig_map.tsv",
+                             classification_table_variants(copy_dir + "marker_contig_map.tsv")[0])
+            shutil.rmtree(copy_dir)
+
+        # Test filtering the rows while reading
+        mcra_lines = read_classification_table(output_dir + "marker_contig_map.tsv", refpkgs=["McrA"])
+        self.assertEqual(len([fields for fields in tsv_lines if fields[2] == "McrA"]), len(mcra_lines))
+        self.assertEqual(mcra_lines,
+                         read_classification_table(output_dir + "marker_contig_map.tsv.gz", refpkgs=["McrA"]))
+        high_lwr_lines = read_classification_table(output_dir + "marker_contig_map.tsv", min_lwr=0.9)
+        self.assertTrue(0 < len(high_lwr_lines) < len(tsv_lines))
+        self.assertTrue(min([float(fields[9]) for fields in high_lwr_lines]) >= 0.9)
+        shutil.rmtree(output_dir)
+        return
+
+    def test_read_reads_table(self):
+        import os
+        from treesapp.file_parsers import read_reads_table
+        fwd, rev = get_test_data("test_TarA.1.fq"), get_test_data("test_TarA.2.fq")
+        reads_table = "./tests/reads_table.tsv"
+        with open(reads_table, 'w') as table_handler:
+            table_handler.write("# sample\tforward\treverse\n"
+                                "day1\t{}\t{}\n"
+                                "day2\t{}\n".format(fwd, rev, fwd))
+        self.assertEqual([("day1", fwd, rev), ("day2", fwd, None)], read_reads_table(reads_table))
+        # Sample names are sanitised for use in file names, and must then be unique
+        with open(reads_table, 'a') as table_handler:
+            table_handler.write("Bob's day/3\t{}\n".format(rev))
+        self.assertEqual(("Bobs_day_3", rev, None), read_reads_table(reads_table)[2])
+        with open(reads_table, 'a') as table_handler:
+            table_handler.write("Bobs day 3\t{}\n".format(rev))
+        with pytest.raises(SystemExit):
+            read_reads_table(reads_table)
+        os.remove(reads_table)
+        return
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+
+
+class LcaCalculationsTester(unittest.TestCase):
+    def setUp(self) -> None:
+        self.lineages = ["d__Bacteria; p__Firmicutes; c__Clostridia; o__Clostridiales",
+                         "d__Bacteria; p__Firmicutes; c__Negativicutes",
+                         "d__Bacteria; p__Firmicutes; c__Negativicutes; o__Selenomonadales"]
+        return
+
+    def test_megan_lca(self):
+        from treesapp.lca_calculations import megan_lca
+        from treesapp.taxonomy_index import TaxonomyIndex
+        self.assertEqual("d__Bacteria; p__Firmicutes", megan_lca(self.lineages))
+        self.assertEqual("d__Bacteria; p__Firmicutes; c__Negativicutes", megan_lca(self.lineages[1:]))
+        self.assertEqual("Unclassified", megan_lca(["d__Bacteria; p__Firmicutes", "d__Archaea"]))
+        self.assertEqual(self.lineages[0], megan_lca([self.lineages[0:1]]))
+
+        # The same LCAs are found using a TaxonomyIndex of the lineages
+        t_index = TaxonomyIndex()
+        for lineage in self.lineages + ["d__Archaea"]:
+            t_index.add(lineage)
+        self.assertEqual("d__Bacteria; p__Firmicutes", megan_lca(self.lineages, t_index))
+        self.assertEqual("d__Bacteria; p__Firmicutes; c__Negativicutes", megan_lca(self.lineages[1:], t_index))
+        self.assertEqual("Unclassified", megan_lca([self.lineages[0], "d__Archaea"], t_index))
+        # Lineages missing from the index are compared as strings
+        self.assertEqual("d__Bacteria", megan_lca([self.lineages[0], "d__Bacteria; p__Bacillota"], t_index))
+        return
+
+    def test_compute_taxonomic_distance(self):
+        from treesapp.lca_calculations import compute_taxonomic_distance
+        from treesapp.taxonomic_hierarchy import TaxonomicHierarchy
+        self.assertEqual((0, 0), compute_taxonomic_distance(self.lineages[0], self.lineages[0]))
+        self.assertEqual((2, 0), compute_taxonomic_distance(self.lineages[0], self.lineages[1]))
+        self.assertEqual((1, 0), compute_taxonomic_distance(self.lineages[1], self.lineages[2]))
+        self.assertEqual((2, 0), compute_taxonomic_distance("d__Bacteria; p__Firmicutes", "d__Archaea"))
+
+        # Distances between lineages of taxon IDs must be the same as between the lineage strings
+        t_hierarchy = TaxonomicHierarchy()
+        for l1 in self.lineages:
+            for l2 in self.lineages:
+                self.assertEqual(compute_taxonomic_distance(l1, l2),
+                                 compute_taxonomic_distance(t_hierarchy.intern_lineage(l1),
+                                                            t_hierarchy.intern_lineage(l2)))
+        return
+
+    def test_weighted_taxonomic_distance(self):
+        from treesapp.lca_calculations import weighted_taxonomic_distance
+        wtd, status = weighted_taxonomic_distance(self.lineages, "d__Bacteria; p__Firmicutes")
+        self.assertEqual(round((2**2 + 2**1 + 2**2) / (3 * 2**7), 5), wtd)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import shutil
+import unittest
+
+NODES = [("1", "1", "no rank"), ("131567", "1", "no rank"), ("2157", "131567", "superkingdom"),
+         ("28890", "2157", "phylum"), ("183925", "28890", "class"), ("2158", "183925", "order"),
+         ("2159", "2158", "family"), ("2172", "2159", "genus"), ("2173", "2172", "species"),
+         ("2", "131567", "superkingdom"), ("33208", "131567", "kingdom"), ("629395", "33208", "genus")]
+NAMES = [("1", "root", "scientific name"), ("131567", "cellular organisms", "scientific name"),
+         ("2157", "Archaea", "scientific name"), ("2157", "Archaebacteria", "synonym"),
+         ("28890", "Euryarchaeota", "scientific name"), ("183925", "Methanobacteria", "scientific name"),
+         ("2158", "Methanobacteriales", "scientific name"), ("2159", "Methanobacteriaceae", "scientific name"),
+         ("2172", "Methanobrevibacter", "scientific name"),
+         ("2173", "Methanobrevibacter smithii", "scientific name"),
+         ("2", "Bacteria", "scientific name", "Bacteria <bacteria>"), ("33208", "Metazoa", "scientific name"),
+         ("629395", "Bacteria", "scientific name", "Bacteria <walking sticks>")]
+
+
+class NCBITaxonomyTester(unittest.TestCase):
+    def setUp(self) -> None:
+        self.taxdump_dir = "./tests/taxdump_test/"
+        if os.path.isdir(self.taxdump_dir):
+            shutil.rmtree(self.taxdump_dir)
+        os.mkdir(self.taxdump_dir)
+        # Formatted as in the NCBI taxdump, with fields separated by '\t|\t' and lines ending in '\t|'
+        with open(os.path.join(self.taxdump_dir, "nodes.dmp"), 'w') as nodes_handler:
+            for taxid, parent, rank in NODES:
+                nodes_handler.write("\t|\t".join([taxid, parent, rank, "", "0"]) + "\t|\n")
+        with open(os.path.join(self.taxdump_dir, "names.dmp"), 'w') as names_handler:
+            for taxid, name, name_class, *unique_name in NAMES:
+                names_handler.write("\t|\t".join([taxid, name, "".join(unique_name), name_class]) + "\t|\n")
+        with open(os.path.join(self.taxdump_dir, "merged.dmp"), 'w') as merged_handler:
+            merged_handler.write("12345\t|\t2173\t|\n")
+        return
+
+    def tearDown(self) -> None:
+        from treesapp.entrez_utils import configure_local_taxonomy
+        configure_local_taxonomy("")
+        if os.path.isdir(self.taxdump_dir):
+            shutil.rmtree(self.taxdump_dir)
+
+    def test_taxonomy_records(self):
+        from treesapp.ncbi_taxonomy import load_ncbi_taxonomy, NCBITaxonomy
+        taxonomy = load_ncbi_taxonomy(self.taxdump_dir)
+        self.assertEqual(12, len(taxonomy))
+        self.assertEqual("2157", taxonomy.taxid_from_name("Archaebacteria"))
+        self.assertEqual("", taxonomy.taxid_from_name("Eukaryota"))
+        # Homonyms are resolved by their unique names or lineages, otherwise they are ambiguous
+        self.assertTrue(taxonomy.is_ambiguous("Bacteria"))
+        self.assertEqual("", taxonomy.taxid_from_name("Bacteria"))
+        self.assertEqual("629395", taxonomy.taxid_from_name("Bacteria <walking sticks>"))
+        self.assertEqual("629395", taxonomy.taxid_from_name("Bacteria", "Eukaryota; Metazoa; Arthropoda"))
+        self.assertEqual("", taxonomy.taxid_from_name("Bacteria", "cellular organisms"))
+        records, failures = taxonomy.taxonomy_records(["2173", "12345", "999"])
+        self.assertEqual(["999"], failures)
+        self.assertEqual("cellular organisms; Archaea; Euryarchaeota; Methanobacteria; Methanobacteriales; "
+                         "Methanobacteriaceae; Methanobrevibacter", records[0]["Lineage"])
+        self.assertEqual({"TaxId": "2157", "ScientificName": "Archaea", "Rank": "superkingdom"},
+                         records[0]["LineageEx"][1])
+        self.assertEqual(("Methanobrevibacter smithii", "species"), (records[0]["ScientificName"], records[0]["Rank"]))
+        # Merged taxids are resolved, but the record is for the queried taxid
+        self.assertEqual("12345", records[1]["TaxId"])
+        self.assertEqual(records[0]["Lineage"], records[1]["Lineage"])
+
+        # The binary form is written for the next run and can be loaded directly
+        binary_path = os.path.join(self.taxdump_dir, NCBITaxonomy.binary_name)
+        self.assertTrue(os.path.isfile(binary_path))
+        taxonomy = load_ncbi_taxonomy(binary_path)
+        self.assertEqual(records, taxonomy.taxonomy_records(["2173", "12345"])[0])
+        return
+
+    def test_fetch_lineages_from_taxids(self):
+        from treesapp import entrez_utils
+        from treesapp.taxonomic_hierarchy import TaxonomicHierarchy
+        entrez_utils.configure_local_taxonomy(self.taxdump_dir)
+        t_hierarchy = TaxonomicHierarchy()
+        by_taxid = entrez_utils.EntrezRecord("WP_011954400", "")
+        by_taxid.ncbi_tax = "2173"
+        by_organism = entrez_utils.EntrezRecord("NA", "NA")
+        by_organism.organism = "Methanobrevibacter"
+        for e_record in [by_taxid, by_organism]:
+            e_record.tracking_stamp()
+
+        entrez_utils.fetch_taxids_from_organisms(entrez_utils.entrez_records_to_organism_set([by_organism], 3))
+        self.assertEqual("2172", by_organism.ncbi_tax)
+        entrez_utils.fetch_lineages_from_taxids([by_taxid, by_organism], t_hierarchy)
+        self.assertEqual("d__Archaea; p__Euryarchaeota; c__Methanobacteria; o__Methanobacteriales; "
+                         "f__Methanobacteriaceae; g__Methanobrevibacter; s__Methanobrevibacter smithii",
+                         by_taxid.lineage)
+        self.assertEqual("Methanobrevibacter", by_organism.organism)
+        self.assertTrue(by_organism.lineage.endswith("g__Methanobrevibacter"))
+        self.assertEqual(7, by_taxid.bitflag)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
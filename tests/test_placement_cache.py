@@ -0,0 +1,117 @@
+import os
+import shutil
+import unittest
+
+
+def make_pquery(seq_name: str, seq: str, ref_name="McrA", lineage="r__Root; d__Archaea"):
+    from treesapp.phylo_seq import PQuery, PhyloPlace
+    pquery = PQuery()
+    pquery.seq_name, pquery.ref_name, pquery.seq = seq_name, ref_name, seq
+    pquery.start, pquery.end = 2, len(seq) - 1
+    pquery.place_name = "{}|{}|{}_{}".format(seq_name, ref_name, pquery.start, pquery.end)
+    pquery.recommended_lineage = lineage
+    pquery.avg_evo_dist, pquery.distances = 0.42, "0.1,0.2,0.3"
+    pquery.consensus_placement = PhyloPlace()
+    pquery.consensus_placement.edge_num, pquery.consensus_placement.like_weight_ratio = 12, 0.9
+    return pquery
+
+
+def store_pqueries(db_path: str, prefix: str) -> None:
+    from treesapp.placement_cache import PlacementCache
+    from treesapp.refpkg import ReferencePackage
+    refpkg = ReferencePackage("McrA")
+    with PlacementCache(db_path) as cache:
+        for i in range(20):
+            cache.store({"McrA": [make_pquery(prefix + str(i), "MKVLAAG" + str(i) + "M")]}, {"McrA": refpkg}, {})
+    return
+
+
+class PlacementCacheTester(unittest.TestCase):
+    def setUp(self) -> None:
+        from treesapp.refpkg import ReferencePackage
+        self.output_dir = "./tests/placement_cache_test/"
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.mkdir(self.output_dir)
+        self.db_path = os.path.join(self.output_dir, "placements.db")
+        self.refpkg_dict = {"McrA": ReferencePackage("McrA")}
+        self.refpkg_dict["McrA"].date = "2020-06-01"
+        return
+
+    def tearDown(self) -> None:
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+
+    def test_lookup(self):
+        from treesapp.placement_cache import PlacementCache
+        params = {"p_sum": "max_lwr", "min_lwr": 0.1}
+        with PlacementCache(self.db_path) as cache:
+            placed = make_pquery("seq1", "MKVLAAGL")
+            self.assertEqual({}, cache.lookup([placed], self.refpkg_dict, params))
+            self.assertEqual(1, cache.store({"McrA": [placed]}, self.refpkg_dict, params))
+
+            # The same sequence from a different ORF in another sample
+            query = make_pquery("contig_9_2", "AKVLAAGA", lineage="")
+            query.consensus_placement = None
+            hits = cache.lookup([query, make_pquery("seq3", "MKVWWWGL")], self.refpkg_dict, params)
+            self.assertEqual([query.place_name], list(hits.keys()))
+            self.assertEqual("r__Root; d__Archaea", query.recommended_lineage)
+            self.assertEqual(12, query.consensus_placement.edge_num)
+            self.assertEqual(0.9, query.consensus_placement.like_weight_ratio)
+
+            # Different classification parameters or reference package versions are misses
+            self.assertEqual({}, cache.lookup([query], self.refpkg_dict, {"p_sum": "aelw", "min_lwr": 0.1}))
+            self.refpkg_dict["McrA"].update = "2021-01-01"
+            self.assertEqual({}, cache.lookup([query], self.refpkg_dict, params))
+        return
+
+    def test_eviction(self):
+        from treesapp.placement_cache import PlacementCache
+        with PlacementCache(self.db_path, max_entries=3) as cache:
+            pqueries = [make_pquery("seq" + str(i), "MKVLAAG" + "A" * i) for i in range(3)]
+            for pquery in pqueries:
+                cache.store({"McrA": [pquery]}, self.refpkg_dict, {})
+            # Using the first entry means the second is now the least recently used
+            self.assertEqual(1, len(cache.lookup(pqueries[:1], self.refpkg_dict, {})))
+            cache.store({"McrA": [make_pquery("seq3", "MKVLAAGCCC")]}, self.refpkg_dict, {})
+            self.assertEqual(3, len(cache))
+            hits = cache.lookup(pqueries, self.refpkg_dict, {})
+            self.assertEqual({pqueries[0].place_name, pqueries[2].place_name}, set(hits.keys()))
+        return
+
+    def test_concurrent_writers(self):
+        from multiprocessing import Process
+        from treesapp.placement_cache import PlacementCache
+        writers = [Process(target=store_pqueries, args=(self.db_path, "sample{}_".format(i))) for i in range(4)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        self.assertEqual([0] * 4, [writer.exitcode for writer in writers])
+        with PlacementCache(self.db_path) as cache:
+            # Each writer stored the same 20 sequences
+            self.assertEqual(20, len(cache))
+        return
+
+    def test_merge_cached_pqueries(self):
+        from treesapp.placement_cache import merge_cached_pqueries
+        placed = make_pquery("seq1", "MKVLAAGL")
+        cached = make_pquery("seq2", "MKVLAAGL")
+        tree_saps = {"McrA": [placed]}
+        self.assertEqual(1, merge_cached_pqueries(tree_saps, {placed.place_name: placed, cached.place_name: cached}))
+        self.assertEqual([placed, cached], tree_saps["McrA"])
+        return
+
+    def test_exclude_cached_queries(self):
+        from treesapp.assign import exclude_cached_queries
+        extracted_seq_dict = {"McrA": {0: {-1: "MKV", -2: "MKL"}, 1: {-3: "MKV"}}}
+        numeric_contig_index = {"McrA": {-1: "seq1|McrA|1_3", -2: "seq2|McrA|1_3", -3: "seq3|McrA|4_6"}}
+        uncached = exclude_cached_queries(extracted_seq_dict, numeric_contig_index, {"seq1|McrA|1_3": None,
+                                                                                      "seq3|McrA|4_6": None})
+        self.assertEqual({"McrA": {0: {-2: "MKL"}, 1: {}}}, uncached)
+        self.assertEqual(2, len(extracted_seq_dict["McrA"][0]))
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
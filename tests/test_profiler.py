@@ -0,0 +1,86 @@
+import os
+import shutil
+import unittest
+
+
+class ProfilerTester(unittest.TestCase):
+    def setUp(self) -> None:
+        from treesapp import profiler
+        # Stages left running by other tests' TreeSAPP instances would otherwise appear to enclose these
+        profiler.set_current_stage("")
+        profiler.set_command_log("")
+        self.output_dir = "./tests/profiler_test/"
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.mkdir(self.output_dir)
+        return
+
+    def tearDown(self) -> None:
+        if os.path.isdir(self.output_dir):
+            shutil.rmtree(self.output_dir)
+
+    def test_usage_delta(self):
+        from treesapp.profiler import resource_usage, usage_delta
+        start = resource_usage()
+        _ = [i ** 2 for i in range(100000)]
+        delta = usage_delta(start, resource_usage())
+        self.assertTrue(delta["wall_time"] >= 0)
+        self.assertTrue(delta["cpu_user"] + delta["cpu_system"] >= 0)
+        self.assertTrue(delta["max_rss_kb"] > 0)
+        return
+
+    def test_stage_profile(self):
+        import json
+        from treesapp.assign import Assigner
+        from treesapp.external_command_interface import launch_write_command
+        ts_assign = Assigner()
+        ts_assign.output_dir = self.output_dir
+        # Checking the status of a stage has no side effects
+        self.assertTrue(ts_assign.stage_status("clean"))
+        self.assertEqual([], os.listdir(self.output_dir))
+        ts_assign.profile_stage("clean")
+        launch_write_command(["ls", self.output_dir])
+        # Profiling a stage that is already being profiled must not restart it
+        ts_assign.profile_stage("clean")
+        ts_assign.end_profile_stage()
+        launch_write_command(["ls", self.output_dir])
+        ts_assign.profile_stage("align")
+        ts_assign.write_profile()
+
+        with open(os.path.join(self.output_dir, "TreeSAPP_assign_profile.json")) as profile_handler:
+            records = json.load(profile_handler)["records"]
+        self.assertEqual(["clean", "align"], [r["name"] for r in records if r["kind"] == "stage"])
+        commands = [r for r in records if r["kind"] == "command"]
+        self.assertEqual(2, len(commands))
+        # Commands run between stages aren't attributed to either
+        self.assertEqual(["clean", ""], [command["stage"] for command in commands])
+        self.assertEqual(1, len([r for r in records if r["kind"] == "total"]))
+        with open(os.path.join(self.output_dir, "TreeSAPP_assign_profile.tsv")) as profile_handler:
+            self.assertEqual(len(records) + 1, len(profile_handler.readlines()))
+        # The intermediate log of external commands is removed once merged into the profile
+        self.assertFalse(os.path.isfile(os.path.join(self.output_dir, "TreeSAPP_assign_profile_commands.jsonl")))
+        return
+
+    def test_stage_peak_rss(self):
+        from treesapp.profiler import StageProfiler, reset_peak_rss, _rss_resets
+        num_resets = len(_rss_resets)
+        reset_peak_rss()
+        if len(_rss_resets) == num_resets:
+            # The peak RSS can only be reset on Linux
+            return
+        profiler = StageProfiler("assign")
+        profiler.start("big")
+        big = bytearray(200 * 1024 * 1024)
+        big[::4096] = b"1" * len(big[::4096])
+        del big
+        profiler.start("small")
+        profiler.stop()
+        stages = {r["name"]: r for r in profiler.summarize() if r["kind"] == "stage"}
+        total = profiler.summarize()[-1]
+        self.assertTrue(stages["big"]["max_rss_kb"] - stages["small"]["max_rss_kb"] > 100 * 1024)
+        self.assertTrue(total["max_rss_kb"] >= stages["big"]["max_rss_kb"])
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
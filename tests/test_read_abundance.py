@@ -0,0 +1,179 @@
+import io
+import unittest
+
+
+def sam_line(qname: str, flag: int, rname: str, pos: int, mapq: int, cigar: str) -> str:
+    return "\t".join([qname, str(flag), rname, str(pos), str(mapq), cigar, "*", "0", "0", "*", "*"]) + "\n"
+
+
+class StreamingAbundanceTester(unittest.TestCase):
+    def setUp(self) -> None:
+        self.ref_lengths = {"orf1|McrA|1_100 description": 100, "orf2|McrA|1_200": 200}
+        self.sam_lines = ["@HD\tVN:1.6\n",
+                          "@SQ\tSN:orf1|McrA|1_100\tLN:100\n",
+                          sam_line("r1", 0, "orf1|McrA|1_100", 1, 60, "50M"),
+                          sam_line("r2", 0, "orf1|McrA|1_100", 51, 60, "50M"),
+                          sam_line("r3", 0, "orf2|McrA|1_200", 1, 60, "50M"),
+                          sam_line("r4", 4, "*", 0, 0, "*")]
+        return
+
+    def test_filters(self):
+        from treesapp.read_abundance import StreamingAbundance
+        counter = StreamingAbundance(self.ref_lengths, p_cov=50)
+        # Like samsum, low mapping quality (r5) and short alignments (r6) are still counted
+        counter.count(self.sam_lines + [sam_line("r5", 0, "orf2|McrA|1_200", 1, 0, "50M"),  # Counted, MAPQ 0
+                                        sam_line("r6", 0, "orf2|McrA|1_200", 1, 60, "5M95S"),  # Counted, 5% aligned
+                                        sam_line("r8", 0, "orf2|McrA|1_200", 1, 60, "100S"),  # No reference span
+                                        sam_line("r7", 4, "orf2|McrA|1_200", 1, 0, "*")])  # Unmapped, not counted
+        self.assertEqual(6, counter.num_alignments)
+        references = counter.summarize()
+        self.assertEqual({"orf1|McrA|1_100", "orf2|McrA|1_200"}, set(references.keys()))
+        self.assertEqual("orf1|McrA|1_100 description", references["orf1|McrA|1_100"].name)
+        self.assertEqual(2, references["orf1|McrA|1_100"].reads_mapped)
+        self.assertEqual(1.0, references["orf1|McrA|1_100"].covered)
+        # orf2 was only 25% covered so its three reads are counted as unmapped, along with r4 and r8
+        self.assertEqual(0, references["orf2|McrA|1_200"].reads_mapped)
+        self.assertEqual(0.0, references["orf2|McrA|1_200"].fpkm)
+        self.assertEqual(5.0, counter.unmapped_weight)
+        return
+
+    def test_weights(self):
+        from treesapp.read_abundance import StreamingAbundance
+        # A single-end read's secondary alignments divide its weight
+        counter = StreamingAbundance(self.ref_lengths, p_cov=0)
+        counter.count([sam_line("r1", 0, "orf1|McrA|1_100", 1, 60, "50M"),
+                       sam_line("r1", 256, "orf2|McrA|1_200", 1, 0, "50M")])
+        references = counter.summarize()
+        self.assertEqual(0.5, references["orf1|McrA|1_100"].weight_total)
+        self.assertEqual(0.5, references["orf2|McrA|1_200"].weight_total)
+
+        # Both mates aligned contribute half of a fragment each, ambiguous alignments of paired reads are not counted
+        paired = StreamingAbundance(self.ref_lengths, p_cov=0)
+        paired.count([sam_line("r1", 65, "orf1|McrA|1_100", 1, 60, "50M"),
+                      sam_line("r1", 129, "orf1|McrA|1_100", 51, 60, "50M"),
+                      sam_line("r1", 321, "orf2|McrA|1_200", 1, 0, "50M"),
+                      sam_line("r2", 73, "orf2|McrA|1_200", 1, 60, "50M"),  # An orphan is a whole fragment
+                      sam_line("r2", 133, "orf2|McrA|1_200", 1, 0, "*"),
+                      sam_line("r3", 77, "*", 0, 0, "*"),
+                      sam_line("r3", 141, "*", 0, 0, "*")])
+        references = paired.summarize()
+        self.assertEqual(1.0, references["orf1|McrA|1_100"].weight_total)
+        self.assertEqual(1.0, references["orf2|McrA|1_200"].weight_total)
+        self.assertEqual(1.0, paired.unmapped_weight)
+
+        # Single- and paired-end reads cannot be mixed
+        mixed = StreamingAbundance(self.ref_lengths)
+        mixed.count([sam_line("r1", 0, "orf1|McrA|1_100", 1, 60, "50M"),
+                     sam_line("r2", 65, "orf1|McrA|1_100", 1, 60, "50M")])
+        with self.assertRaises(SystemExit):
+            mixed.summarize()
+        return
+
+    def test_fpkm_tpm(self):
+        from treesapp.read_abundance import StreamingAbundance
+        counter = StreamingAbundance(self.ref_lengths, p_cov=20)
+        counter.count(self.sam_lines)
+        references = counter.summarize()
+        # Four reads in total: two to the 100bp ORF, one to the 200bp ORF, one unmapped
+        self.assertAlmostEqual((2 / 100) / (4 / 1E6), references["orf1|McrA|1_100"].fpkm)
+        self.assertAlmostEqual((1 / 200) / (4 / 1E6), references["orf2|McrA|1_200"].fpkm)
+        self.assertAlmostEqual(0.8E6, references["orf1|McrA|1_100"].tpm)
+        self.assertAlmostEqual(1E6, sum(ref_seq.tpm for ref_seq in references.values()))
+        return
+
+    def test_samsum_parity(self):
+        import os
+        import random
+        import tempfile
+        from samsum import commands as samsum_cmd
+        from treesapp.read_abundance import StreamingAbundance
+        random.seed(8)
+        ref_lengths = {"orf{}".format(i): random.randint(150, 900) for i in range(1, 9)}
+        ref_lengths["orf9"] = 20000  # Too long to be sufficiently covered
+        ref_names = sorted(ref_lengths)
+
+        def random_alignment(qname: str, flag: int) -> str:
+            rname = random.choice(ref_names)
+            aligned = random.choice([0, 5, 60, 100, 100, 100])
+            cigar = {0: "100S", 100: "100M"}.get(aligned, "{}M{}S".format(aligned, 100 - aligned))
+            return sam_line(qname, flag, rname, random.randint(1, ref_lengths[rname] - 100), random.randint(0, 60),
+                            cigar)
+
+        se_lines, pe_lines = [], []
+        for i in range(600):
+            qname = "read{}".format(i)
+            if random.random() < 0.15:
+                se_lines.append(sam_line(qname, 4, "*", 0, 0, "*"))
+                pe_lines += [sam_line(qname, 77, "*", 0, 0, "*"), sam_line(qname, 141, "*", 0, 0, "*")]
+                continue
+            se_lines.append(random_alignment(qname, 0))
+            if random.random() < 0.1:
+                se_lines.append(random_alignment(qname, 256))
+            pe_lines.append(random_alignment(qname, 65))
+            if random.random() < 0.1:
+                pe_lines.append(random_alignment(qname, 321))
+            if random.random() < 0.2:
+                pe_lines.append(sam_line(qname, 133, pe_lines[-1].split('\t')[2], 1, 0, "*"))
+            else:
+                pe_lines.append(random_alignment(qname, 129))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fasta = os.path.join(tmp_dir, "orfs.fna")
+            with open(fasta, 'w') as fa_handler:
+                for name in ref_names:
+                    fa_handler.write(">{} description\n{}\n".format(name, "A" * ref_lengths[name]))
+            for sam_lines in [se_lines, pe_lines]:
+                sam_file = os.path.join(tmp_dir, "reads.sam")
+                with open(sam_file, 'w') as sam_handler:
+                    sam_handler.write("".join(sam_lines))
+                expected = samsum_cmd.ref_sequence_abundances(aln_file=sam_file, seq_file=fasta,
+                                                              min_aln=10, p_cov=50, map_qual=1, multireads=False)
+                counter = StreamingAbundance({name + " description": length for name, length in ref_lengths.items()},
+                                             p_cov=50)
+                counter.count(sam_lines)
+                observed = counter.summarize()
+                self.assertEqual(set(expected.keys()), set(observed.keys()))
+                self.assertEqual(0, observed["orf9"].reads_mapped)
+                self.assertTrue(sum(ref_seq.reads_mapped for ref_seq in observed.values()) > 0)
+                for name, ref_seq in expected.items():
+                    self.assertEqual(ref_seq.reads_mapped, observed[name].reads_mapped)
+                    self.assertAlmostEqual(ref_seq.fpkm, observed[name].fpkm, delta=ref_seq.fpkm * 1E-4)
+                    self.assertAlmostEqual(ref_seq.tpm, observed[name].tpm, delta=ref_seq.tpm * 1E-4)
+        return
+
+    def test_tee(self):
+        from treesapp.read_abundance import StreamingAbundance
+        counter = StreamingAbundance(self.ref_lengths)
+        retained = io.StringIO()
+        counter.count(self.sam_lines, tee=retained)
+        self.assertEqual("".join(self.sam_lines), retained.getvalue())
+
+        # Alignments are still counted when the stream they're copied to is closed by its reader
+        class ClosedPipe(io.StringIO):
+            def write(self, s):
+                raise BrokenPipeError
+        counter = StreamingAbundance(self.ref_lengths)
+        counter.count(self.sam_lines, tee=ClosedPipe())
+        self.assertEqual(3, counter.num_alignments)
+        return
+
+    def test_unknown_reference(self):
+        from treesapp.read_abundance import StreamingAbundance
+        counter = StreamingAbundance(self.ref_lengths)
+        with self.assertRaises(SystemExit):
+            counter.count([sam_line("r1", 0, "orf3", 1, 60, "50M")])
+        return
+
+    def test_bwa_mem_command(self):
+        from treesapp.assign import bwa_mem_command
+        self.assertEqual(["bwa", "mem", "-t", "4", "-p", "orfs.fna", "reads.fq"],
+                         bwa_mem_command("bwa", "orfs.fna", "reads.fq", "pe", num_threads=4))
+        self.assertEqual(["bwa", "mem", "-t", "2", "orfs.fna", "fwd.fq", "rev.fq"],
+                         bwa_mem_command("bwa", "orfs.fna", "fwd.fq", "pe", reverse="rev.fq"))
+        self.assertEqual(["bwa", "mem", "-t", "2", "-S", "-P", "orfs.fna", "reads.fq"],
+                         bwa_mem_command("bwa", "orfs.fna", "reads.fq", "se"))
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -114,6 +114,21 @@ class RefPkgTester(unittest.TestCase):
         self.db.slurp()
         self.assertTrue("McrA" == self.db.prefix)
 
+    def test_slurp_taxonomic_hierarchy(self):
+        from treesapp.refpkg import ReferencePackage
+        self.db.f__json = self.new_pkl_path
+        self.db.pickle_package()
+        pickled_refpkg = ReferencePackage("McrA")
+        pickled_refpkg.f__json = self.new_pkl_path
+        pickled_refpkg.slurp()
+        rebuilt_refpkg = ReferencePackage("McrA")
+        rebuilt_refpkg.lineage_ids = pickled_refpkg.lineage_ids
+        rebuilt_refpkg.load_taxonomic_hierarchy()
+        self.assertFalse("taxa_trie_state" in pickled_refpkg.__dict__)
+        self.assertEqual(set(rebuilt_refpkg.taxa_trie.hierarchy.keys()), set(pickled_refpkg.taxa_trie.hierarchy.keys()))
+        self.assertEqual(rebuilt_refpkg.taxa_trie.lineages_fed, pickled_refpkg.taxa_trie.lineages_fed)
+        return
+
     def test_taxonomically_label_tree(self):
         from treesapp.taxonomic_hierarchy import Taxon
         labelled_rt = self.db.taxonomically_label_tree()
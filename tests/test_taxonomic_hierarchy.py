@@ -161,6 +161,77 @@ class TaxonomicHierarchyTester(unittest.TestCase):
         self.assertEqual(1, test_th.get_taxon("d__Archaea").coverage)
         return
 
+    def test_bulk_load_lineages(self):
+        from treesapp.taxonomic_hierarchy import TaxonomicHierarchy
+        test_th = TaxonomicHierarchy()
+        test_th.feed_leaf_nodes([])
+        deferred = test_th.bulk_load_lineages({Cauto_leaf.lineage: 2,
+                                               Ameta_leaf.lineage: 1,
+                                               _conflict_node_one.lineage: 1,
+                                               _conflict_node_two.lineage: 1,
+                                               _conflict_node_four.lineage: 1})
+        # n__environmental samples and c__Fake have different parents than in the lineages they were first found in
+        self.assertEqual([_conflict_node_two.lineage, _conflict_node_four.lineage], deferred)
+        self.assertEqual(3, test_th.get_taxon("p__Firmicutes").coverage)
+        self.assertEqual(2, test_th.get_taxon("s__Clostridium autoethanogenum").coverage)
+        self.assertEqual("r__Root; d__Bacteria; p__Firmicutes; c__Clostridia; o__Clostridiales; f__Clostridiaceae",
+                         test_th.emit("f__Clostridiaceae", with_prefix=True))
+        self.assertTrue(test_th.rooted)
+        # The coverage of taxa in the deferred lineages is left for digest_taxon to increment
+        self.assertEqual(0, test_th.get_taxon("c__Fake").coverage)
+        self.assertEqual(1, test_th.get_taxon("n__environmental samples").coverage)
+        self.assertFalse("n__environmental samples_1" in test_th.hierarchy)
+        return
+
+    def test_serialize(self):
+        import pickle
+        from treesapp.taxonomic_hierarchy import TaxonomicHierarchy
+        test_th = TaxonomicHierarchy()
+        test_th.feed_leaf_nodes([Cauto_leaf, Ameta_leaf, _conflict_node_one, _conflict_node_two])
+        state = pickle.loads(pickle.dumps(test_th.serialize()))
+        loaded_th = TaxonomicHierarchy()
+        self.assertTrue(loaded_th.load_serialized(state))
+        self.assertEqual(set(test_th.hierarchy.keys()), set(loaded_th.hierarchy.keys()))
+        self.assertEqual(test_th.rank_prefix_map, loaded_th.rank_prefix_map)
+        self.assertEqual(4, loaded_th.lineages_fed)
+        self.assertTrue(loaded_th.rooted)
+        self.assertEqual(3, loaded_th.get_taxon("p__Firmicutes").coverage)
+        self.assertEqual(test_th.emit("n__environmental samples_1", with_prefix=True),
+                         loaded_th.emit("n__environmental samples_1", with_prefix=True))
+        self.assertEqual("r__Root; d__Bacteria; p__Firmicutes",
+                         loaded_th.get_prefixed_lineage_from_bare("Bacteria; Firmicutes"))
+
+        # States from a different version of serialize are not loaded
+        state["version"] = 0
+        self.assertFalse(TaxonomicHierarchy().load_serialized(state))
+        self.assertFalse(TaxonomicHierarchy().load_serialized(None))
+        return
+
+    def test_lca(self):
+        from treesapp.taxonomic_hierarchy import TaxonomicHierarchy, Taxon
+        t_hierarchy = TaxonomicHierarchy()
+        t_hierarchy.feed_leaf_nodes([Cauto_leaf, Ameta_leaf, Mmult_leaf, Melsd_leaf])
+        cauto = t_hierarchy.get_taxon("s__Clostridium autoethanogenum")
+        ameta = t_hierarchy.get_taxon("s__Alkaliphilus metalliredigens")
+        mmult = t_hierarchy.get_taxon("s__Mitsuokella multacida")
+        melsd = t_hierarchy.get_taxon("s__Megasphaera elsdenii")
+        self.assertEqual("f__Clostridiaceae", t_hierarchy.lca(cauto, ameta).prefix_taxon())
+        self.assertEqual("c__Negativicutes", t_hierarchy.lca(mmult, melsd).prefix_taxon())
+        self.assertEqual(cauto, t_hierarchy.lca(cauto, cauto))
+        self.assertEqual(t_hierarchy.get_taxon("p__Firmicutes"), t_hierarchy.lca(cauto, melsd.parent))
+        self.assertEqual("p__Firmicutes", t_hierarchy.lca_of_taxa([cauto, ameta, mmult]).prefix_taxon())
+        self.assertIsNone(t_hierarchy.lca(cauto, None))
+        self.assertIsNone(t_hierarchy.lca_of_taxa([]))
+
+        # Taxa added after the table was built are answered by Taxon.lca
+        archaea = t_hierarchy.digest_taxon("Archaea", "domain", "d")
+        self.assertIsNone(t_hierarchy.lca(cauto, archaea))
+        self.assertEqual(Taxon.lca(archaea, mmult), t_hierarchy.lca_of_taxa([archaea, mmult]))
+        # Re-parenting taxa resets the table
+        t_hierarchy.root_domains(t_hierarchy.find_root_taxon())
+        self.assertEqual("r__Root", t_hierarchy.lca(cauto, archaea).prefix_taxon())
+        return
+
     def test_remove_leaf_nodes(self):
         self.db.feed("Archaea; Euryarchaeota", [{'ScientificName': 'Archaea', 'Rank': 'superkingdom'},
                                                 {'ScientificName': 'Euryarchaeota', 'Rank': 'phylum'}])
@@ -426,6 +497,30 @@ class TaxonomicHierarchyTester(unittest.TestCase):
 
         return
 
+    def test_intern_lineage(self):
+        from treesapp.taxonomic_hierarchy import TaxonomicHierarchy
+        t_hierarchy = TaxonomicHierarchy()
+        t_hierarchy.feed_leaf_nodes([Ameta_leaf, Mmult_leaf])
+        # Taxa already in the hierarchy are indexed in sorted order
+        self.assertEqual(0, t_hierarchy.intern_taxon("c__Clostridia"))
+        self.assertEqual(len(t_hierarchy.hierarchy), len(t_hierarchy.taxon_names))
+
+        ameta_ids = t_hierarchy.intern_lineage(Ameta_leaf.lineage)
+        mmult_ids = t_hierarchy.intern_lineage(Mmult_leaf.lineage)
+        self.assertEqual(8, len(ameta_ids))
+        self.assertEqual(ameta_ids[:3], mmult_ids[:3])
+        self.assertNotEqual(ameta_ids[3], mmult_ids[3])
+        # The same lineage string returns the same tuple instance
+        self.assertTrue(ameta_ids is t_hierarchy.intern_lineage(Ameta_leaf.lineage))
+        self.assertEqual(Ameta_leaf.lineage, t_hierarchy.lineage_from_ids(ameta_ids))
+        self.assertEqual("r__Root; d__Bacteria", t_hierarchy.lineage_from_ids(ameta_ids[:2]))
+
+        # Taxa that are not in the hierarchy are assigned new IDs
+        novel_ids = t_hierarchy.intern_lineage("r__Root; d__Archaea")
+        self.assertEqual(len(t_hierarchy.taxon_names) - 1, novel_ids[1])
+        self.assertEqual(tuple(), t_hierarchy.intern_lineage(""))
+        return
+
 
 class TaxonTester(unittest.TestCase):
     def setUp(self) -> None:
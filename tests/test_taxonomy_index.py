@@ -0,0 +1,96 @@
+import unittest
+
+
+class TaxonomyIndexTester(unittest.TestCase):
+    def setUp(self) -> None:
+        self.lineages = ["r__Root; d__Bacteria; p__Firmicutes; c__Clostridia",
+                         "r__Root; d__Bacteria; p__Firmicutes; c__Negativicutes",
+                         "r__Root; d__Bacteria; p__Proteobacteria",
+                         "r__Root; d__Archaea"]
+        return
+
+    def test_add(self):
+        from treesapp.taxonomy_index import TaxonomyIndex
+        t_index = TaxonomyIndex()
+        for lineage in self.lineages:
+            t_index[lineage] = lineage.split("; ")[-1]
+        self.assertEqual(4, len(t_index))
+        self.assertTrue("r__Root; d__Archaea" in t_index)
+        # Prefixes are nodes but not keys unless values are assigned to them
+        self.assertFalse("r__Root; d__Bacteria" in t_index)
+        self.assertTrue(t_index.has_node("r__Root; d__Bacteria"))
+        self.assertTrue(t_index.has_subtrie("r__Root; d__Bacteria"))
+        self.assertFalse(t_index.has_subtrie("r__Root; d__Archaea"))
+        self.assertEqual("c__Clostridia", t_index["r__Root; d__Bacteria; p__Firmicutes; c__Clostridia"])
+        with self.assertRaises(KeyError):
+            _ = t_index["r__Root; d__Bacteria"]
+
+        t_index.add("r__Root; d__Bacteria; p__Proteobacteria", True, prefixes=True)
+        self.assertEqual(6, len(t_index))
+        self.assertEqual(["r__Root", "r__Root; d__Bacteria", self.lineages[0], self.lineages[1],
+                          self.lineages[2], self.lineages[3]], list(t_index))
+        self.assertEqual([(self.lineages[2], True)], t_index.items(prefix=self.lineages[2]))
+        t_index.clear()
+        self.assertEqual(0, len(t_index))
+        return
+
+    def test_longest_prefix(self):
+        from treesapp.utilities import load_taxonomic_trie
+        from treesapp.lca_calculations import optimal_taxonomic_assignment
+        t_index = load_taxonomic_trie(self.lineages)
+        self.assertEqual("r__Root; d__Bacteria; p__Firmicutes",
+                         t_index.longest_prefix("r__Root; d__Bacteria; p__Firmicutes; c__Bacilli; o__Bacillales"))
+        self.assertEqual("", t_index.longest_prefix("d__Bacteria"))
+        self.assertEqual("r__Root", optimal_taxonomic_assignment(t_index, "d__Bacteria; p__Firmicutes"))
+        return
+
+    def test_lca(self):
+        from treesapp.utilities import load_taxonomic_trie
+        t_index = load_taxonomic_trie(self.lineages)
+        clostridia = t_index.node_id(self.lineages[0])
+        firmicutes = t_index.node_id("r__Root; d__Bacteria; p__Firmicutes")
+        self.assertTrue(t_index.is_ancestor(firmicutes, clostridia))
+        self.assertFalse(t_index.is_ancestor(clostridia, firmicutes))
+        self.assertEqual(firmicutes, t_index.lca(clostridia, t_index.node_id(self.lineages[1])))
+        self.assertEqual("r__Root; d__Bacteria", t_index.lineage_lca(self.lineages[0:3]))
+        self.assertEqual("r__Root", t_index.lineage_lca(self.lineages))
+        self.assertEqual(-1, t_index.node_id("d__Bacteria"))
+        # The ancestor tables are rebuilt after the index is modified
+        t_index.add("r__Root; d__Bacteria; p__Firmicutes; c__Clostridia; o__Clostridiales")
+        self.assertEqual(clostridia, t_index.lca(clostridia, t_index.node_id(self.lineages[0] + "; o__Clostridiales")))
+        return
+
+    def test_euler_tour_lca(self):
+        from random import Random
+        from treesapp.taxonomy_index import EulerTourLCA
+        # A forest of two trees: 0 -> (1 -> (3, 4), 2) and 5 -> 6
+        lca_table = EulerTourLCA([-1, 0, 0, 1, 1, -1, 5])
+        self.assertEqual(1, lca_table.query(3, 4))
+        self.assertEqual(0, lca_table.query(4, 2))
+        self.assertEqual(1, lca_table.query(1, 3))
+        self.assertEqual(3, lca_table.query(3, 3))
+        self.assertEqual(-1, lca_table.query(3, 6))
+        self.assertEqual(0, lca_table.query_set([3, 4, 2]))
+        self.assertEqual(-1, lca_table.query_set([]))
+
+        # Compare with the LCA found by walking the ancestors of each node in a random tree
+        rng = Random(7)
+        parents = [-1] + [rng.randrange(0, i) for i in range(1, 300)]
+        lca_table = EulerTourLCA(parents)
+
+        def ancestors(node):
+            path = []
+            while node >= 0:
+                path.append(node)
+                node = parents[node]
+            return path
+
+        for _ in range(500):
+            a, b = rng.randrange(300), rng.randrange(300)
+            b_ancestors = set(ancestors(b))
+            self.assertEqual(next(n for n in ancestors(a) if n in b_ancestors), lca_table.query(a, b))
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -61,6 +61,54 @@ class ExecutableWrapperTester(unittest.TestCase):
         self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, "vsearch_test.uc")))
         return
 
+    def test_hmmsearch_orfs(self):
+        from treesapp.wrapper import hmmsearch_orfs
+        from treesapp.refpkg import ReferencePackage
+        # A stand-in for hmmsearch that writes a previously generated domain table to its --domtblout path
+        hmmsearch_exe = os.path.join(self.tmp_dir, "hmmsearch")
+        with open(hmmsearch_exe, 'w') as exe_handler:
+            exe_handler.write("#!/bin/sh\n" +
+                              'while [ "$1" != "--domtblout" ]; do shift; done\n' +
+                              'cat "' + get_test_data("NxrA_search_to_ORFs_domtbl.txt") + '" >"$2"\n')
+        os.chmod(hmmsearch_exe, 0o755)
+        refpkg_dict = dict()
+        for prefix in ["NxrA", "NorC", "McrA"]:
+            refpkg = ReferencePackage(prefix)
+            refpkg.molecule = "prot"
+            refpkg.f__search_profile = os.path.join(self.tmp_dir, prefix + "_search.hmm")
+            open(refpkg.f__search_profile, 'w').close()
+            refpkg_dict[prefix] = refpkg
+        domtbls = hmmsearch_orfs(hmmsearch_exe, refpkg_dict, self.test_fasta, self.tmp_dir + os.sep, num_threads=4)
+        # The domain tables are listed in the order of the reference packages, whichever search finished first
+        self.assertEqual([os.path.join(self.tmp_dir, prefix + "_search_to_ORFs_domtbl.txt")
+                          for prefix in ["NxrA", "NorC", "McrA"]], domtbls)
+        self.assertTrue(all(os.path.getsize(domtbl) > 0 for domtbl in domtbls))
+        return
+
+    def test_stream_hmmsearch(self):
+        from collections import namedtuple
+        from treesapp.wrapper import stream_hmmsearch
+        from treesapp.file_parsers import parse_domain_tables
+        args_tuple = namedtuple("args_tuple", ["max_e", "max_ie", "min_acc", "min_score", "perc_aligned"])
+        # A stand-in for hmmsearch that writes a previously generated domain table to its --domtblout path
+        hmmsearch_exe = os.path.join(self.tmp_dir, "hmmsearch")
+        with open(hmmsearch_exe, 'w') as exe_handler:
+            exe_handler.write("#!/bin/sh\n" +
+                              'while [ "$1" != "--domtblout" ]; do shift; done\n' +
+                              'cat "' + get_test_data("NxrA_search_to_ORFs_domtbl.txt") + '" >"$2"\n')
+        os.chmod(hmmsearch_exe, 0o755)
+        domain_table = stream_hmmsearch(hmmsearch_exe, "NxrA_search.hmm", self.test_fasta)
+        hmm_matches = parse_domain_tables(args_tuple(max_e=1E-5, max_ie=1E-3, min_acc=0.7, min_score=20,
+                                                     perc_aligned=40), [domain_table])
+        self.assertEqual(8, len({match.orf for match in hmm_matches["NxrA"]}))
+
+        # A failed search is not mistaken for one without any matches
+        with open(hmmsearch_exe, 'w') as exe_handler:
+            exe_handler.write("#!/bin/sh\nexit 1\n")
+        with pytest.raises(SystemExit):
+            stream_hmmsearch(hmmsearch_exe, "NxrA_search.hmm", self.test_fasta)
+        return
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -16,6 +16,7 @@ assign         Classify query [protein|genomic] sequences using reference packag
 colour         Colours a reference package's phylogeny based on taxonomic or phenotypic data
 create         Create a reference package for a new gene, domain or orthologous group
 evaluate       Evaluate the classification performance using clade exclusion analysis
+itol           Generate inputs for iTOL from the classifications of `treesapp assign`
 layer          Layer extra annotation information on classifications with iTOL colours-style file(s)
 package        Facilitate operations on reference packages
 phylotu        Sort query sequences into clusters inferred from a reference package's phylogeny
@@ -39,6 +40,7 @@ def main(sys_args=None) -> int:
         "train": ts_commands.train,
         "colour": ts_commands.colour,
         "layer": ts_commands.layer,
+        "itol": ts_commands.itol,
         "purity": ts_commands.purity,
         "package": ts_commands.package,
         "phylotu": phyclust.cluster_phylogeny
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import gzip
+import mmap
+import heapq
+import struct
+import logging
+import tempfile
+
+__author__ = 'Connor Morgan-Lang'
+
+
+class Accession2TaxidIndex:
+    """
+    A sorted, fixed-width binary index of an NCBI accession2taxid file that is memory-mapped for lookups.
+    Each accession is found by a binary search, O(log n), so the multi-GB accession2taxid files are only read once,
+    when the index is built, rather than for every run.
+
+    The index is a header (magic bytes and the number of records) followed by records of an accession, padded with
+    null bytes to key_width, its version number and taxid, sorted by accession.
+    """
+    magic = b"TSA2TIX1"
+    header = struct.Struct(">8sQ")
+    key_width = 32
+    record = struct.Struct(">{}sHI".format(key_width))
+    suffix = ".tsidx"
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self.num_records = 0
+        try:
+            self._handle = open(index_path, 'rb')
+            self._map = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self.num_records = self.header.unpack_from(self._map, 0)
+        except (IOError, ValueError, struct.error):
+            logging.error("Unable to read accession2taxid index '{}'.\n".format(index_path))
+            sys.exit(13)
+        if magic != self.magic or len(self._map) != self.header.size + self.num_records * self.record.size:
+            logging.error("'{}' is not a complete accession2taxid index.\n".format(index_path))
+            sys.exit(13)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.num_records
+
+    def close(self) -> None:
+        if self._map:
+            self._map.close()
+            self._handle.close()
+            self._map = None
+        return
+
+    @classmethod
+    def is_index(cls, file_path: str) -> bool:
+        try:
+            with open(file_path, 'rb') as file_handler:
+                return file_handler.read(len(cls.magic)) == cls.magic
+        except IOError:
+            return False
+
+    def _key(self, i: int) -> bytes:
+        offset = self.header.size + i * self.record.size
+        return self._map[offset:offset + self.key_width]
+
+    def lookup(self, accession: str):
+        """
+        Finds the versioned accession and taxid of an accession.
+
+        :param accession: An accession without a version (e.g. 'WP_056230317')
+        :return: A tuple of the versioned accession and taxid as strings, or None if the accession is not indexed
+        """
+        key = accession.encode().ljust(self.key_width, b'\0')
+        lo, hi = 0, self.num_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.num_records or self._key(lo) != key:
+            return None
+        _, version, taxid = self.record.unpack_from(self._map, self.header.size + lo * self.record.size)
+        return (accession + '.' + str(version) if version else accession), str(taxid)
+
+
+def pack_accession2taxid_line(line: str):
+    """
+    Converts a line of an accession2taxid file into an index record.
+
+    :return: The packed record, or None if the line is a header or cannot be indexed
+    """
+    try:
+        accession, versioned, taxid = line.split("\t")[0:3]
+        taxid = int(taxid)
+    except ValueError:
+        return None
+    version = 0
+    if versioned.startswith(accession + '.'):
+        try:
+            version = int(versioned[len(accession) + 1:])
+        except ValueError:
+            version = 0
+    key = accession.encode()
+    if len(key) > Accession2TaxidIndex.key_width or version > 0xFFFF or taxid > 0xFFFFFFFF:
+        return None
+    return Accession2TaxidIndex.record.pack(key, version, taxid)
+
+
+def record_key(record: bytes) -> bytes:
+    return record[:Accession2TaxidIndex.key_width]
+
+
+def write_sorted_chunk(records: list, tmp_dir: str) -> str:
+    # Sorting by the accession alone is stable, so duplicated accessions remain in the order they were read
+    records.sort(key=record_key)
+    chunk_handle, chunk_path = tempfile.mkstemp(suffix=".chunk", dir=tmp_dir)
+    with os.fdopen(chunk_handle, 'wb') as chunk_handler:
+        chunk_handler.writelines(records)
+    records.clear()
+    return chunk_path
+
+
+def read_chunk_records(chunk_path: str):
+    size = Accession2TaxidIndex.record.size
+    with open(chunk_path, 'rb') as chunk_handler:
+        for record in iter(lambda: chunk_handler.read(size), b''):
+            yield record
+
+
+def build_accession2taxid_index(accession2taxid: str, index_path: str, chunk_size=5000000) -> int:
+    """
+    Builds an Accession2TaxidIndex from an NCBI accession2taxid file, which may be gzip-compressed.
+    Records are sorted in chunks of chunk_size that are merged into the index, so memory is bounded regardless of the
+    size of the accession2taxid file. The index is first written to a temporary file, in the same directory, that then
+    replaces index_path. If an accession is listed more than once only its first record in the file is indexed.
+
+    :param accession2taxid: Path to an NCBI accession2taxid file
+    :param index_path: Path to write the index to
+    :param chunk_size: The number of records sorted in memory at once
+    :return: The number of records in the index
+    """
+    logging.info("Indexing '{}' for accession look-ups. This is only done once... ".format(accession2taxid))
+    try:
+        if accession2taxid.endswith(".gz"):
+            rosetta_handler = gzip.open(accession2taxid, 'rt')
+        else:
+            rosetta_handler = open(accession2taxid, 'r')
+    except IOError:
+        logging.error("Unable to open '" + accession2taxid + "' for reading.\n")
+        sys.exit(13)
+
+    tmp_dir = os.path.dirname(os.path.abspath(index_path))
+    chunk_paths = []
+    tmp_path = ""
+    records = []
+    skipped = 0
+    try:
+        for line in rosetta_handler:
+            record = pack_accession2taxid_line(line)
+            if record is None:
+                skipped += 1
+                continue
+            records.append(record)
+            if len(records) >= chunk_size:
+                chunk_paths.append(write_sorted_chunk(records, tmp_dir))
+        rosetta_handler.close()
+        if records or not chunk_paths:
+            chunk_paths.append(write_sorted_chunk(records, tmp_dir))
+
+        num_records = 0
+        prev_key = None
+        tmp_handle, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=tmp_dir)
+        with os.fdopen(tmp_handle, 'wb') as index_handler:
+            index_handler.write(Accession2TaxidIndex.header.pack(Accession2TaxidIndex.magic, 0))
+            # Ties are merged in the order of the chunks, so the first record of duplicated accessions is kept
+            for record in heapq.merge(*[read_chunk_records(chunk_path) for chunk_path in chunk_paths],
+                                      key=record_key):
+                if record_key(record) == prev_key:
+                    continue
+                prev_key = record_key(record)
+                index_handler.write(record)
+                num_records += 1
+            index_handler.seek(0)
+            index_handler.write(Accession2TaxidIndex.header.pack(Accession2TaxidIndex.magic, num_records))
+        # Temporary files are only readable by their owner, unlike the files written by open()
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, index_path)
+    finally:
+        for chunk_path in chunk_paths:
+            os.remove(chunk_path)
+        # The temporary index is only left if it could not replace index_path
+        if tmp_path and os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+    logging.info("done.\n")
+    logging.debug("{} accessions indexed. {} lines, including the header, were not indexed.\n".format(num_records,
+                                                                                                    skipped))
+    return num_records
+
+
+def fetch_accession2taxid_index(accession2taxid: str):
+    """
+    Finds the index for an accession2taxid file, building it if it doesn't exist or is older than the file.
+    The index is written alongside the accession2taxid file with the suffix '.tsidx'.
+    Alternatively, the path to an index itself can be provided.
+
+    :param accession2taxid: Path to either an NCBI accession2taxid file or an Accession2TaxidIndex
+    :return: An Accession2TaxidIndex instance, or None if the index could not be written
+    """
+    if Accession2TaxidIndex.is_index(accession2taxid):
+        return Accession2TaxidIndex(accession2taxid)
+    if not os.path.isfile(accession2taxid):
+        logging.error("Unable to open '" + accession2taxid + "' for reading.\n")
+        sys.exit(13)
+
+    index_path = accession2taxid + Accession2TaxidIndex.suffix
+    if not os.path.isfile(index_path) or os.path.getmtime(index_path) < os.path.getmtime(accession2taxid):
+        try:
+            build_accession2taxid_index(accession2taxid, index_path)
+        except (IOError, OSError) as err:
+            logging.warning("Unable to write the accession2taxid index '{}': {}\n".format(index_path, err))
+            return None
+    return Accession2TaxidIndex(index_path)
@@ -11,6 +11,8 @@ import glob
 import logging
 
 from treesapp.classy import Layerer
+from treesapp.file_parsers import CLASSIFICATION_TABLE_FIELDS, classification_table_variants, \
+    read_classification_table
 
 
 def check_arguments(layerer: Layerer, args):
@@ -26,7 +28,7 @@ def check_arguments(layerer: Layerer, args):
         layerer.treesapp_output += os.sep
     layerer.var_output_dir = layerer.treesapp_output + "intermediates" + os.sep
     layerer.final_output_dir = layerer.treesapp_output + "final_outputs" + os.sep
-    if not os.path.isfile(layerer.final_output_dir + "marker_contig_map.tsv"):
+    if not classification_table_variants(layerer.final_output_dir + "marker_contig_map.tsv"):
         logging.error("Could not find a classification file in " + layerer.final_output_dir + "\n")
         sys.exit(3)
     if args.colours_style:
@@ -83,18 +85,13 @@ def parse_marker_classification_table(marker_classification_file):
     Function to read marker_contig_map.tsv and gather the relevant information for adding extra annotations
     This function is different from Clade_exclusion_analyzer::read_classification_table(assignment_file)
     as we are interested in all fields in this function.
+    Any variant of the classification table (see file_parsers.classification_table_variants) is read.
     :param marker_classification_file:
     :return:
     """
     master_dat = dict()
     field_order = dict()
-    try:
-        classifications = open(marker_classification_file, 'r')
-    except IOError:
-        logging.error("Unable to open " + marker_classification_file + " for reading!\n")
-        sys.exit(3)
-
-    header_fields = classifications.readline().strip().split("\t")
+    header_fields = list(CLASSIFICATION_TABLE_FIELDS)
     x = 0
     for field in header_fields:
         field_order[x] = field
@@ -103,20 +100,12 @@ def parse_marker_classification_table(marker_classification_file):
     node_pos = identify_field_position("iNode", header_fields)
     query_pos = identify_field_position("Query", header_fields)
 
-    line = classifications.readline()
-    while line:
-        fields = line.strip().split("\t")
-        if len(fields) != len(header_fields):
-            logging.error("Inconsistent number of columns in table! Offending line:\n" + line + "\n")
-            sys.exit(3)
+    for fields in read_classification_table(marker_classification_file):
         if fields[marker_pos] not in master_dat:
             master_dat[fields[marker_pos]] = list()
         jplace_seq = ClassifiedSequence(fields[marker_pos])
         jplace_seq.load_assignment_line(fields, header_fields, query_pos, node_pos)
         master_dat[fields[marker_pos]].append(jplace_seq)
-        line = classifications.readline()
-
-    classifications.close()
 
     return master_dat, field_order
 
@@ -8,13 +8,17 @@ try:
     import profile
     import sys
     import os
+    import copy
     import shutil
     import re
     import glob
+    import gzip
     import time
+    import hashlib
     import traceback
-    import subprocess
     import logging
+    import subprocess
+    import io
     from os import path
     from os import listdir
     from os.path import isfile, join
@@ -31,9 +35,11 @@ try:
     from treesapp.refpkg import ReferencePackage
     from treesapp.treesapp_args import TreeSAPPArgumentParser
     from treesapp.fasta import get_headers, write_new_fasta, read_fasta_to_dict, FASTA,\
-        multiple_alignment_dimensions, Header, fastx_split
+        multiple_alignment_dimensions, Header, fastx_split, format_fasta
     from treesapp.entish import index_tree_edges, map_internal_nodes_leaves
-    from treesapp.external_command_interface import launch_write_command
+    from treesapp.external_command_interface import launch_write_command, start_process, CommandScheduler, CommandJob,\
+        CommandPipeline
+    from treesapp.read_abundance import StreamingAbundance
     from treesapp import lca_calculations as ts_lca
     from treesapp import jplace_utils
     from treesapp import file_parsers
@@ -62,6 +68,7 @@ class Assigner(classy.TreeSAPP):
         self.classified_nuc_seqs = ""
         self.composition = ""
         self.target_refpkgs = list()
+        self.prodigal_chunks_per_thread = 4  # Number of input FASTA chunks per process for parallel ORF prediction
 
         # Stage names only holds the required stages; auxiliary stages (e.g. RPKM, update) are added elsewhere
         self.stages = {0: classy.ModuleFunction("orf-call", 0, self.predict_orfs),
@@ -101,6 +108,8 @@ class Assigner(classy.TreeSAPP):
         if args.svm:
             self.svc_filter = True
 
+        self.composition = args.composition
+
         # TODO: transfer all of this HMM-parsing stuff to the assigner_instance
         # Parameterizing the hmmsearch output parsing:
         args.perc_aligned = 10
@@ -123,13 +132,18 @@ class Assigner(classy.TreeSAPP):
         """
         Bases the stage(s) to run on args.stage which is broadly set to either 'continue' or any other valid stage
 
-        This function ensures all the required inputs are present for beginning at the desired first stage,
-        otherwise, the pipeline begins at the first possible stage to continue and ends once the desired stage is done.
+        ORF prediction is skipped if the checkpoint manifest shows it was completed for the same input sequences.
+        Every other stage up to args.stage is run, since within them the work that was already completed by a
+        previous run (e.g. the hmmsearch, hmmalign and EPA-ng commands for each reference package) is skipped
+        using the checkpoint manifest.
 
         :return: None
         """
         if args.molecule == "dna":
-            if os.path.isfile(self.aa_orfs_file) and os.path.isfile(self.nuc_orfs_file):
+            if self.checkpoints and self.checkpoints.is_complete("orf-call", self.sample_prefix,
+                                                                 [self.input_sequences],
+                                                                 {"composition": self.composition}):
+                logging.info("Using the ORFs predicted by a previous run.\n")
                 self.change_stage_status("orf-call", False)
                 self.query_sequences = self.aa_orfs_file
         else:
@@ -154,7 +168,8 @@ class Assigner(classy.TreeSAPP):
         else:
             self.change_stage_status("abundance", False)
 
-        self.validate_continue(args)
+        if args.stage != "continue":
+            self.edit_stages(self.first_stage(), self.stage_lookup(args.stage).order)
         return
 
     def get_info(self):
@@ -166,60 +181,94 @@ class Assigner(classy.TreeSAPP):
 
         return info_string
 
-    def predict_orfs(self, composition: str, num_threads: int) -> None:
+    def predict_orfs(self, composition: str, num_threads: int, format_orfs=False) -> dict:
         """
         Predict ORFs from the input FASTA file using Prodigal
 
+        When format_orfs is True the amino acid ORFs of each chunk are formatted (see fasta.format_fasta) as soon as
+        Prodigal finishes with it, while the remaining chunks are still being processed. The formatted FASTA
+        (Assigner.formatted_input) and the concatenated ORFs (Assigner.aa_orfs_file) are written in that same pass,
+        so the clean stage doesn't need to read the ORFs again.
+
         :param composition: Sample composition being either a single organism or a metagenome [single | meta]
         :param num_threads: The number of CPU threads to use
-        :return: None
+        :param format_orfs: Flag indicating whether the amino acid ORFs should be formatted while they are predicted
+        :return: A dictionary of Header instances indexed by a numerical identifier if format_orfs, otherwise empty
         """
 
         logging.info("Predicting open-reading frames using Prodigal... ")
 
         start_time = time.time()
 
-        if num_threads > 1 and composition == "meta":
-            # Split the input FASTA into num_threads files to run Prodigal in parallel
-            split_files = fastx_split(self.input_sequences, self.output_dir, num_threads)
+        if num_threads > 1:
+            # Split the input FASTA into more files than there are processes, balanced by total sequence length,
+            # so processes that finish early continue with the remaining chunks in the queue
+            split_files = fastx_split(self.input_sequences, self.output_dir,
+                                      num_threads * self.prodigal_chunks_per_thread, balanced=True)
         else:
             split_files = [self.input_sequences]
 
-        task_list = list()
+        # Prodigal is single-threaded. Its gene coordinates are written to stdout by default and are not needed.
+        scheduler = CommandScheduler("Prodigal", num_threads, fail_fast=False)
+        # In single-genome mode Prodigal is trained on the complete genome first
+        # and the training file is then applied to each of the chunks
+        training_file = ""
+        training_jobs = []
+        if composition == "single" and len(split_files) > 1:
+            training_file = self.var_output_dir + self.sample_prefix + "_prodigal.trn"
+            training_jobs.append(scheduler.submit([self.executables["prodigal"],
+                                                   "-i", self.input_sequences,
+                                                   "-p", composition,
+                                                   "-t", training_file],
+                                                  priority=1, stdout=os.devnull))
+
+        chunk_outputs = dict()
+        chunk_prefixes = list()
         for fasta_chunk in split_files:
             chunk_prefix = self.var_output_dir + '.'.join(os.path.basename(fasta_chunk).split('.')[:-1])
             prodigal_command = [self.executables["prodigal"]]
             prodigal_command += ["-i", fasta_chunk]
             prodigal_command += ["-p", composition]
+            if training_file:
+                prodigal_command += ["-t", training_file]
             prodigal_command += ["-a", chunk_prefix + "_ORFs.faa"]
             prodigal_command += ["-d", chunk_prefix + "_ORFs.fna"]
-            prodigal_command += ["1>/dev/null", "2>/dev/null"]
-            task_list.append(prodigal_command)
-
-        num_tasks = len(task_list)
-        if num_tasks > 0:
-            cl_farmer = wrapper.CommandLineFarmer("Prodigal -p " + composition, num_threads)
-            cl_farmer.add_tasks_to_queue(task_list)
-
-            cl_farmer.task_queue.close()
-            cl_farmer.task_queue.join()
-
-        tmp_prodigal_aa_orfs = glob.glob(self.var_output_dir + self.sample_prefix + "*_ORFs.faa")
-        tmp_prodigal_nuc_orfs = glob.glob(self.var_output_dir + self.sample_prefix + "*_ORFs.fna")
-        if not tmp_prodigal_aa_orfs or not tmp_prodigal_nuc_orfs:
-            logging.error("Prodigal outputs were not generated:\n"
-                          "Amino acid ORFs: " + ", ".join(tmp_prodigal_aa_orfs) + "\n" +
-                          "Nucleotide ORFs: " + ", ".join(tmp_prodigal_nuc_orfs) + "\n")
+            chunk_job = scheduler.submit(prodigal_command, depends_on=training_jobs, stdout=os.devnull)
+            chunk_outputs[chunk_job.index] = chunk_prefix + "_ORFs.faa"
+            chunk_prefixes.append(chunk_prefix)
+
+        if len(chunk_prefixes) == 0:
+            logging.error("No sequences were found in '{}' to predict ORFs from.\n".format(self.input_sequences))
+            sys.exit(5)
+
+        tmp_prodigal_aa_orfs = [prefix + "_ORFs.faa" for prefix in chunk_prefixes]
+        tmp_prodigal_nuc_orfs = [prefix + "_ORFs.fna" for prefix in chunk_prefixes]
+        header_registry = dict()
+        # Chunks are started whenever a thread is free, but the outputs are yielded in the order of the chunks,
+        # rather than the order they finished, so the ORFs are always concatenated in the same order
+        finished_chunks = finished_prodigal_chunks(chunk_outputs, scheduler.as_completed(ordered=True))
+        if format_orfs:
+            header_registry = format_fasta(finished_chunks, "prot", self.formatted_input,
+                                           copy_fasta=self.aa_orfs_file)
+        else:
+            for _ in finished_chunks:
+                continue
+
+        missing_outputs = [f for f in tmp_prodigal_aa_orfs + tmp_prodigal_nuc_orfs if not os.path.isfile(f)]
+        if missing_outputs:
+            logging.error("Prodigal outputs were not generated:\n" + "\n".join(missing_outputs) + "\n")
             sys.exit(5)
 
-        # Concatenate outputs
-        if not os.path.isfile(self.aa_orfs_file) and not os.path.isfile(self.nuc_orfs_file):
+        # Concatenate outputs. The amino acid ORFs were already written while formatting, if format_orfs
+        if not format_orfs:
             utilities.concatenate_files(tmp_prodigal_aa_orfs, self.aa_orfs_file)
-            utilities.concatenate_files(tmp_prodigal_nuc_orfs, self.nuc_orfs_file)
-            intermediate_files = list(tmp_prodigal_aa_orfs + tmp_prodigal_nuc_orfs + split_files)
-            for tmp_file in intermediate_files:
-                if tmp_file != self.input_sequences:
-                    os.remove(tmp_file)
+        utilities.concatenate_files(tmp_prodigal_nuc_orfs, self.nuc_orfs_file)
+        intermediate_files = list(tmp_prodigal_aa_orfs + tmp_prodigal_nuc_orfs + split_files)
+        if training_file:
+            intermediate_files.append(training_file)
+        for tmp_file in intermediate_files:
+            if tmp_file != self.input_sequences:
+                os.remove(tmp_file)
 
         logging.info("done.\n")
 
@@ -230,7 +279,10 @@ class Assigner(classy.TreeSAPP):
                       ':'.join([str(hours), str(minutes), str(round(seconds, 2))]) + "\n")
 
         self.query_sequences = self.aa_orfs_file
-        return
+        if self.checkpoints:
+            self.checkpoints.complete("orf-call", self.sample_prefix, [self.input_sequences],
+                                      [self.aa_orfs_file, self.nuc_orfs_file], {"composition": composition})
+        return header_registry
 
     def clean(self):
         return
@@ -255,17 +307,35 @@ class Assigner(classy.TreeSAPP):
             nuc_orfs = FASTA(self.nuc_orfs_file)
             nuc_orfs.load_fasta()
             nuc_orfs.change_dict_keys()
-            if not os.path.isfile(self.classified_nuc_seqs):
-                logging.info("Creating nucleotide FASTA file of classified sequences '{}'... "
-                             "".format(self.classified_nuc_seqs))
-                write_classified_sequences(pqueries, nuc_orfs.fasta_dict, self.classified_nuc_seqs)
-                logging.info("done.\n")
+            logging.info("Creating nucleotide FASTA file of classified sequences '{}'... "
+                         "".format(self.classified_nuc_seqs))
+            write_classified_sequences(pqueries, nuc_orfs.fasta_dict, self.classified_nuc_seqs)
+            logging.info("done.\n")
         else:
             logging.warning("Unable to read '" + self.nuc_orfs_file + "'.\n" +
                             "Cannot create the nucleotide FASTA file of classified sequences!\n")
         return
 
 
+def finished_prodigal_chunks(chunk_outputs: dict, finished_jobs):
+    """
+    Generator yielding the output file of each Prodigal chunk once its job has completed.
+    TreeSAPP exits if Prodigal was unsuccessful for any of the chunks.
+
+    :param chunk_outputs: A dictionary mapping the index of each chunk's CommandJob to the path of
+     the amino acid ORF file it writes
+    :param finished_jobs: An iterable of the finished CommandJob instances, such as CommandScheduler.as_completed()
+    :return: The path to a chunk's amino acid ORF file
+    """
+    for job in finished_jobs:  # type: CommandJob
+        if job.state != "done":
+            logging.error("Prodigal did not complete successfully! Command used:\n" + " ".join(job.cmd_list) + "\n" +
+                          "Output:\n" + job.output + "\n")
+            sys.exit(5)
+        if job.index in chunk_outputs:
+            yield chunk_outputs[job.index]
+
+
 def replace_contig_names(numeric_contig_index: dict, fasta: FASTA):
     for marker in numeric_contig_index:
         assign_re = re.compile(r"(.*)\|{0}\|(\d+_\d+)$".format(marker))
@@ -413,6 +483,85 @@ def bin_hmm_matches(hmm_matches: dict, fasta_dict: dict) -> (dict, dict):
     return extracted_seq_dict, numeric_contig_index
 
 
+def exclude_cached_queries(extracted_seq_dict: dict, numeric_contig_index: dict, cached_pqueries: dict) -> dict:
+    """
+    Removes the query sequences that were found in a PlacementCache from the binned sequences so they are not
+    aligned and placed again. The original extracted_seq_dict is not modified.
+
+    :param extracted_seq_dict: A dictionary of refpkg names mapped to bin numbers mapped to query sequence
+     negative integer code names mapped to their extracted sequence, as returned by bin_hmm_matches
+    :param numeric_contig_index: A dictionary mapping the negative integer code names of each refpkg's query sequences
+     to their place_name, after replace_contig_names
+    :param cached_pqueries: A dictionary of PQuery instances found in the cache, indexed by their place_name
+    :return: A copy of extracted_seq_dict without the cached query sequences
+    """
+    uncached_seq_dict = dict()
+    for marker, bins in extracted_seq_dict.items():
+        uncached_seq_dict[marker] = dict()
+        for bin_num, bin_seqs in bins.items():
+            uncached_seq_dict[marker][bin_num] = {num: seq for num, seq in bin_seqs.items()
+                                                  if numeric_contig_index[marker][num] not in cached_pqueries}
+    return uncached_seq_dict
+
+
+def dereplicate_queries(extracted_seq_dict: dict, numeric_contig_index: dict) -> (dict, dict):
+    """
+    Collapses the identical sequences extracted for each reference package so only one representative of each unique
+    sequence is aligned and placed. The representative is the first of the identical sequences found in the bins.
+
+    :param extracted_seq_dict: A dictionary of refpkg names mapped to bin numbers mapped to query sequence
+     negative integer code names mapped to their extracted sequence, as returned by bin_hmm_matches
+    :param numeric_contig_index: A dictionary mapping the negative integer code names of each refpkg's query sequences
+     to their place_name, after replace_contig_names
+    :return: A tuple of a copy of extracted_seq_dict containing only the representative sequences,
+     and a dictionary mapping the place_name of each representative with duplicates to a list of the place_names
+     of its duplicates
+    """
+    derep_seq_dict = dict()
+    query_members = dict()
+    num_duplicates = 0
+    for marker, bins in extracted_seq_dict.items():
+        derep_seq_dict[marker] = dict()
+        representatives = dict()  # Sequences mapped to the place_name of their representative
+        for bin_num in sorted(bins):
+            derep_seq_dict[marker][bin_num] = dict()
+            for num, seq in bins[bin_num].items():
+                if seq in representatives:
+                    query_members.setdefault(representatives[seq], []).append(numeric_contig_index[marker][num])
+                    num_duplicates += 1
+                else:
+                    representatives[seq] = numeric_contig_index[marker][num]
+                    derep_seq_dict[marker][bin_num][num] = seq
+    logging.debug("{} identical query sequences will be classified by the placement of {} representatives.\n"
+                  "".format(num_duplicates, len(query_members)))
+    return derep_seq_dict, query_members
+
+
+def expand_dereplicated_pqueries(tree_saps: dict, query_members: dict, pqueries: list) -> int:
+    """
+    Adds the PQuery instances of query sequences that were not placed because they were identical to a representative,
+    copying the representative's placements and classification, to tree_saps.
+
+    :param tree_saps: A dictionary of PQuery instances indexed by their reference package's prefix
+    :param query_members: A dictionary mapping the place_name of each representative PQuery to a list of the
+     place_names of the identical query sequences, as returned by dereplicate_queries
+    :param pqueries: A list of all the PQuery instances loaded from the homology search
+    :return: The number of PQuery instances added
+    """
+    pquery_map = {pquery.place_name: pquery for pquery in pqueries}
+    num_added = 0
+    for refpkg_pqueries in tree_saps.values():
+        members = []
+        for rep_pquery in refpkg_pqueries:  # type: PQuery
+            for member_name in query_members.get(rep_pquery.place_name, []):
+                member = pquery_map[member_name]  # type: PQuery
+                member.transfer_classification(rep_pquery)
+                members.append(member)
+        refpkg_pqueries.extend(members)
+        num_added += len(members)
+    return num_added
+
+
 def write_grouped_fastas(extracted_seq_dict: dict, numeric_contig_index: dict, refpkg_dict: dict, output_dir: str):
     hmmalign_input_fastas = list()
     bulk_marker_fasta = dict()
@@ -646,7 +795,7 @@ def get_alignment_dims(refpkg_dict: dict):
 
 
 def multiple_alignments(executables: dict, single_query_sequence_files: list,
-                        refpkg_dict: dict, tool="hmmalign", num_proc=4) -> dict:
+                        refpkg_dict: dict, tool="hmmalign", num_proc=4, checkpoints=None) -> dict:
     """
     Wrapper function for the multiple alignment functions - only purpose is to make an easy decision at this point...
 
@@ -655,11 +804,12 @@ def multiple_alignments(executables: dict, single_query_sequence_files: list,
     :param refpkg_dict: A dictionary of ReferencePackage instances indexed by their respective prefix
     :param tool: Tool to use for aligning query sequences to a reference multiple alignment [hmmalign|papara]
     :param num_proc: The number of alignment jobs to run in parallel
+    :param checkpoints: A CheckpointManifest used to skip the query sequence files that were already aligned
     :return: Dictionary of multiple sequence alignment (FASTA) files indexed by denominator
     """
     if tool == "hmmalign":
         concatenated_msa_files = prepare_and_run_hmmalign(executables, single_query_sequence_files, refpkg_dict,
-                                                          num_proc)
+                                                          num_proc, checkpoints)
     else:
         logging.error("Unrecognized tool '" + str(tool) + "' for multiple sequence alignment.\n")
         sys.exit(3)
@@ -694,7 +844,8 @@ def create_ref_phy_files(refpkgs: dict, output_dir: str, query_fasta_files: list
     return
 
 
-def prepare_and_run_hmmalign(execs: dict, single_query_fasta_files: list, refpkg_dict: dict, n_proc=2) -> dict:
+def prepare_and_run_hmmalign(execs: dict, single_query_fasta_files: list, refpkg_dict: dict, n_proc=2,
+                             checkpoints=None) -> dict:
     """
     Runs `hmmalign` to add the query sequences into the reference FASTA multiple alignments
 
@@ -702,15 +853,18 @@ def prepare_and_run_hmmalign(execs: dict, single_query_fasta_files: list, refpkg
     :param single_query_fasta_files: List of unaligned query sequences in FASTA format
     :param refpkg_dict: A dictionary of ReferencePackage instances indexed by their respective prefix attributes
     :param n_proc: The number of alignment jobs to run in parallel
+    :param checkpoints: A CheckpointManifest. Query sequence files that were already aligned to the same reference
+     package by a previous run are not aligned again.
     :return: Dictionary of multiple sequence alignment (FASTA) files generated by hmmalign indexed by denominator
     """
 
     hmmalign_singlehit_files = dict()
     mfa_out_dict = dict()
+    align_units = dict()
     logging.info("Running hmmalign... ")
 
     start_time = time.time()
-    task_list = list()
+    scheduler = CommandScheduler("cmalign/hmmalign --mapali", n_proc)
 
     # Run hmmalign on each fasta file
     for query_fa_in in sorted(single_query_fasta_files):
@@ -733,18 +887,23 @@ def prepare_and_run_hmmalign(execs: dict, single_query_fasta_files: list, refpkg
 
         # Get the paths to either the HMM or CM profile files
         if refpkg.kind == "phylogenetic_rRNA":
-            task_list.append(wrapper.hmmalign_command(execs["cmalign"], refpkg.f__msa, refpkg.f__profile,
-                                                      query_fa_in, query_mfa_out))
+            aligner = "cmalign"
         else:
-            task_list.append(wrapper.hmmalign_command(execs["hmmalign"], refpkg.f__msa, refpkg.f__profile,
-                                                      query_fa_in, query_mfa_out))
-
-    if len(task_list) > 0:
-        cl_farmer = wrapper.CommandLineFarmer("cmalign/hmmalign --mapali", n_proc)
-        cl_farmer.add_tasks_to_queue(task_list)
-
-        cl_farmer.task_queue.close()
-        cl_farmer.task_queue.join()
+            aligner = "hmmalign"
+        align_inputs = [query_fa_in, refpkg.f__msa, refpkg.f__profile]
+        if checkpoints and checkpoints.is_complete("align", os.path.basename(query_fa_in), align_inputs):
+            continue
+        # The largest query files are started first so they don't extend the time required at the end
+        job = scheduler.submit(wrapper.hmmalign_command(execs[aligner], refpkg.f__msa, refpkg.f__profile,
+                                                        query_fa_in, query_mfa_out),
+                               memory=wrapper.DEPENDENCY_MEMORY[aligner], priority=os.path.getsize(query_fa_in))
+        align_units[job.index] = (os.path.basename(query_fa_in), align_inputs, query_mfa_out)
+
+    # Each alignment is recorded as it finishes so an interrupted run only repeats the unfinished alignments
+    for job in scheduler.as_completed():
+        if checkpoints:
+            unit, align_inputs, query_mfa_out = align_units[job.index]
+            checkpoints.complete("align", unit, align_inputs, [query_mfa_out])
 
     logging.info("done.\n")
 
@@ -957,20 +1116,7 @@ def filter_short_sequences(aa_dictionary, length_threshold):
     return long_queries
 
 
-def align_reads_to_nucs(bwa_exe: str, reference_fasta: str, aln_output_dir: str,
-                        reads: str, pairing: str, reverse=None, num_threads=2) -> str:
-    """
-    Align the predicted ORFs to the reads using BWA MEM
-
-    :param bwa_exe: Path to the BWA executable
-    :param reference_fasta: A FASTA file containing the sequences to be aligned to
-    :param aln_output_dir: Path to the directory to write the index and SAM files
-    :param reads: FASTQ file containing reads to be aligned to the reference FASTA file
-    :param pairing: Either 'se' or 'pe' indicating the reads are single-end or paired-end, respectively
-    :param reverse: Path to reverse-orientation mate pair reads [OPTIONAL]
-    :param num_threads: Number of threads for BWA MEM to use
-    :return: Path to the SAM file
-    """
+def make_aln_output_dir(aln_output_dir: str) -> None:
     if not os.path.exists(aln_output_dir):
         try:
             os.makedirs(aln_output_dir)
@@ -979,19 +1125,23 @@ def align_reads_to_nucs(bwa_exe: str, reference_fasta: str, aln_output_dir: str,
                 logging.warning("Overwriting files in " + aln_output_dir + ".\n")
             else:
                 raise OSError("Unable to make " + aln_output_dir + "!\n")
+    return
 
-    logging.info("Aligning reads to ORFs with BWA MEM... ")
 
-    sam_file = aln_output_dir + '.'.join(os.path.basename(reference_fasta).split('.')[0:-1]) + ".sam"
-    if os.path.isfile(sam_file):
-        logging.info("Alignment map file {} found.\n".format(sam_file))
-        return sam_file
+def bwa_index(bwa_exe: str, reference_fasta: str, aln_output_dir: str) -> None:
     index_command = [bwa_exe, "index"]
     index_command += [reference_fasta]
-    index_command += ["1>", "/dev/null", "2>", aln_output_dir + "treesapp_bwa_index.stderr"]
 
-    launch_write_command(index_command)
+    launch_write_command(index_command, stdout=os.devnull, stderr=aln_output_dir + "treesapp_bwa_index.stderr")
+    return
+
 
+def bwa_mem_command(bwa_exe: str, reference_fasta: str, reads: str, pairing: str, reverse=None, num_threads=2) -> list:
+    """
+    Builds the BWA MEM command for aligning reads to an indexed reference FASTA file.
+
+    :return: The command as a list of strings
+    """
     bwa_command = [bwa_exe, "mem"]
     bwa_command += ["-t", str(num_threads)]
     if pairing == "pe" and not reverse:
@@ -1004,19 +1154,177 @@ def align_reads_to_nucs(bwa_exe: str, reference_fasta: str, aln_output_dir: str,
     bwa_command.append(reads)
     if pairing == "pe" and reverse:
         bwa_command.append(reverse)
-    bwa_command += ["1>", sam_file, "2>", aln_output_dir + "treesapp_bwa_mem.stderr"]
+    return bwa_command
+
+
+def align_reads_to_nucs(bwa_exe: str, reference_fasta: str, aln_output_dir: str,
+                        reads: str, pairing: str, reverse=None, num_threads=2, checkpoints=None) -> str:
+    """
+    Align the predicted ORFs to the reads using BWA MEM
+
+    :param bwa_exe: Path to the BWA executable
+    :param reference_fasta: A FASTA file containing the sequences to be aligned to
+    :param aln_output_dir: Path to the directory to write the index and SAM files
+    :param reads: FASTQ file containing reads to be aligned to the reference FASTA file
+    :param pairing: Either 'se' or 'pe' indicating the reads are single-end or paired-end, respectively
+    :param reverse: Path to reverse-orientation mate pair reads [OPTIONAL]
+    :param num_threads: Number of threads for BWA MEM to use
+    :param checkpoints: A CheckpointManifest. If provided, an existing SAM file is only reused if it was made from
+     the same sequences and reads. Otherwise, any existing SAM file is reused.
+    :return: Path to the SAM file
+    """
+    make_aln_output_dir(aln_output_dir)
 
-    p_bwa = subprocess.Popen(' '.join(bwa_command), shell=True, preexec_fn=os.setsid)
-    p_bwa.wait()
-    if p_bwa.returncode != 0:
-        logging.error("bwa mem did not complete successfully for:\n" +
-                      str(' '.join(bwa_command)) + "\n")
+    logging.info("Aligning reads to ORFs with BWA MEM... ")
+
+    sam_file = aln_output_dir + '.'.join(os.path.basename(reference_fasta).split('.')[0:-1]) + ".sam"
+    aln_inputs = [reference_fasta, reads, reverse]
+    if checkpoints:
+        reuse = checkpoints.is_complete("abundance", os.path.basename(sam_file), aln_inputs, {"pairing": pairing})
+    else:
+        reuse = os.path.isfile(sam_file)
+    if reuse:
+        logging.info("Alignment map file {} found.\n".format(sam_file))
+        return sam_file
+    bwa_index(bwa_exe, reference_fasta, aln_output_dir)
+
+    bwa_command = bwa_mem_command(bwa_exe, reference_fasta, reads, pairing, reverse, num_threads)
+    launch_write_command(bwa_command, stdout=sam_file, stderr=aln_output_dir + "treesapp_bwa_mem.stderr")
+    if checkpoints:
+        checkpoints.complete("abundance", os.path.basename(sam_file), aln_inputs, [sam_file], {"pairing": pairing})
 
     logging.info("done.\n")
 
     return sam_file
 
 
+def stream_read_abundances(bwa_exe: str, reference_fasta: str, aln_output_dir: str, reads: str, pairing: str,
+                           reverse=None, num_threads=2, p_cov=50, bam_file=None, samtools_exe=None) -> dict:
+    """
+    Aligns reads to the predicted ORFs with BWA MEM and calculates the abundance of each ORF from the alignments as
+    they are streamed from BWA MEM, so no SAM file is written. The alignments are filtered and weighted as samsum does
+    for SAM files, so the abundances are the same as those from align_reads_to_nucs and ref_sequence_abundances.
+    Like samsum, neither a mapping quality nor an aligned length threshold is applied (see StreamingAbundance).
+
+    :param bwa_exe: Path to the BWA executable
+    :param reference_fasta: A FASTA file containing the sequences to be aligned to
+    :param aln_output_dir: Path to the directory to write the index files
+    :param reads: FASTQ file containing reads to be aligned to the reference FASTA file
+    :param pairing: Either 'se' or 'pe' indicating the reads are single-end or paired-end, respectively
+    :param reverse: Path to reverse-orientation mate pair reads [OPTIONAL]
+    :param num_threads: Number of threads for BWA MEM to use
+    :param p_cov: The minimum percentage of an ORF covered by reads for it to be assigned abundance
+    :param bam_file: Path to a BAM file the alignments are also written to by samtools [OPTIONAL]
+    :param samtools_exe: Path to the samtools executable, required if bam_file is provided
+    :return: A dictionary of RefAbundance instances indexed by the ORF names
+    """
+    make_aln_output_dir(aln_output_dir)
+    ref_lengths = {name: len(seq) for name, seq in read_fasta_to_dict(reference_fasta).items()}
+    counter = StreamingAbundance(ref_lengths, p_cov=p_cov)
+
+    logging.info("Aligning reads to ORFs with BWA MEM and counting the alignments... ")
+    bwa_index(bwa_exe, reference_fasta, aln_output_dir)
+    bwa_command = bwa_mem_command(bwa_exe, reference_fasta, reads, pairing, reverse, num_threads)
+
+    bam_proc, bam_stream = None, None
+    if bam_file:
+        bam_proc = start_process([samtools_exe, "view", "-b", "-o", bam_file, "-"], stdin=subprocess.PIPE)
+        bam_stream = io.TextIOWrapper(bam_proc.stdin)
+    with CommandPipeline([bwa_command]) as pipeline:
+        counter.count(pipeline.stdout, tee=bam_stream)
+    if bam_proc:
+        try:
+            bam_stream.close()
+        except BrokenPipeError:
+            pass
+        bam_proc.wait()
+        if bam_proc.returncode != 0:
+            # The abundances are unaffected since every alignment was counted, only the BAM file is incomplete
+            logging.warning("samtools did not complete successfully writing the alignments to '{}'."
+                            " It has been removed.\n".format(bam_file))
+            if os.path.isfile(bam_file):
+                os.remove(bam_file)
+    logging.info("done.\n")
+
+    return counter.summarize()
+
+
+def map_read_sets(bwa_exe: str, reference_fasta: str, aln_output_dir: str, read_sets: list, pairing: str,
+                  num_threads=2, checkpoints=None):
+    """
+    Aligns multiple read sets (e.g. the samples of a time-series) to the predicted ORFs with BWA MEM.
+    The ORFs are indexed once and the read sets are aligned concurrently, with the threads divided between them.
+
+    :param bwa_exe: Path to the BWA executable
+    :param reference_fasta: A FASTA file containing the sequences to be aligned to
+    :param aln_output_dir: Path to the directory to write the index and SAM files
+    :param read_sets: A list of tuples with the sample name, forward FASTQ path and reverse FASTQ path (or None)
+    :param pairing: Either 'se' or 'pe' indicating the reads are single-end or paired-end, respectively
+    :param num_threads: The total number of threads for the BWA MEM processes to use
+    :param checkpoints: A CheckpointManifest. If provided, SAM files made from the same sequences and reads are reused.
+    :return: A generator of tuples with the sample name and the path to its SAM file, yielded as each is written
+    """
+    make_aln_output_dir(aln_output_dir)
+    aligner = CommandScheduler("BWA MEM", max_threads=num_threads)
+    # Use as many threads as possible per sample while keeping all threads busy
+    sample_threads = max(1, num_threads // min(len(read_sets), num_threads))
+    job_samples = dict()
+    reused = list()
+    for sample_name, reads, reverse in read_sets:
+        sam_file = aln_output_dir + sample_name + ".sam"
+        if checkpoints and checkpoints.is_complete("abundance", os.path.basename(sam_file),
+                                                   [reference_fasta, reads, reverse], {"pairing": pairing}):
+            reused.append((sample_name, sam_file))
+            continue
+        bwa_command = bwa_mem_command(bwa_exe, reference_fasta, reads, pairing, reverse, sample_threads)
+        job = aligner.submit(bwa_command, threads=sample_threads, stdout=sam_file,
+                             stderr=aln_output_dir + "treesapp_bwa_mem." + sample_name + ".stderr")
+        job_samples[job.index] = (sample_name, reads, reverse, sam_file)
+
+    for sample_name, sam_file in reused:
+        logging.info("Alignment map file {} found.\n".format(sam_file))
+        yield sample_name, sam_file
+    if not job_samples:
+        return
+
+    logging.info("Aligning {} read sets to ORFs with BWA MEM using {} threads each... ".format(len(job_samples),
+                                                                                              sample_threads))
+    bwa_index(bwa_exe, reference_fasta, aln_output_dir)
+    for job in aligner.as_completed():  # type: CommandJob
+        sample_name, reads, reverse, sam_file = job_samples[job.index]
+        if checkpoints:
+            checkpoints.complete("abundance", os.path.basename(sam_file), [reference_fasta, reads, reverse],
+                                 [sam_file], {"pairing": pairing})
+        yield sample_name, sam_file
+    logging.info("done.\n")
+    return
+
+
+def write_abundance_matrix(sample_abundances: dict, ref_names: list, output_file: str) -> None:
+    """
+    Writes a tab-separated table of abundance values with a row for each query sequence and a column for each sample.
+
+    :param sample_abundances: A dictionary of dictionaries, mapping query sequence names to abundance values, indexed
+     by the sample names. Samples are written in the order of the dictionary.
+    :param ref_names: A list of the query sequence names, in the order they are to be written
+    :param output_file: Path to write the abundance matrix
+    :return: None
+    """
+    try:
+        matrix_handler = open(output_file, 'w')
+    except IOError:
+        logging.error("Unable to open " + output_file + " for writing!\n")
+        sys.exit(3)
+
+    samples = list(sample_abundances.keys())
+    matrix_handler.write("\t".join(["Query"] + samples) + "\n")
+    for ref_name in ref_names:
+        matrix_handler.write("\t".join([ref_name] +
+                                       [str(sample_abundances[sample].get(ref_name, 0.0)) for sample in samples]) + "\n")
+    matrix_handler.close()
+    return
+
+
 def abundify_tree_saps(tree_saps: dict, abundance_dict: dict):
     """
     Add abundance (RPKM or presence count) values to the PQuery instances (abundance variable)
@@ -1080,6 +1388,77 @@ def generate_simplebar(target_marker, tree_protein_list, itol_bar_file):
     return tree_protein_list
 
 
+def filter_refpkg_placements(pqueries: list, refpkg: ReferencePackage, svc: bool, min_lwr: float) -> dict:
+    """
+    Filters the PQuery instances placed on a single reference package's phylogeny. The PQuery.classified attribute is
+    set to False if any of the filters (likelihood weight ratio, no placement or SVM classifier) are failed.
+
+    :param pqueries: A list of PQuery instances that were all placed on refpkg's phylogeny
+    :param refpkg: The ReferencePackage instance for the pqueries
+    :param svc: A boolean indicating whether placements should be filtered using ReferencePackage.svc
+    :param min_lwr: Likelihood-weight-ratio (LWR) threshold for filtering pqueries
+    :return: A dictionary mapping the reason for declassification to the list of PQuery instances that were filtered
+    """
+    unclassified_seqs = {"low_lwr": list(), "np": list(), "svm": list()}
+    svc_attempt = False
+
+    for tree_sap in sorted(pqueries, key=lambda x: x.seq_name):  # type: PQuery
+        tree_sap.filter_min_weight_threshold(min_lwr)
+        if not tree_sap.classified:
+            unclassified_seqs["low_lwr"].append(tree_sap)
+            continue
+        if not tree_sap.placements:
+            unclassified_seqs["np"].append(tree_sap)
+            continue
+        elif tree_sap.placements[0] == '{}':
+            unclassified_seqs["np"].append(tree_sap)
+            tree_sap.classified = False
+            continue
+
+        pplace = tree_sap.consensus_placement  # type: PhyloPlace
+
+        leaf_children = tree_sap.node_map[int(pplace.edge_num)]
+
+        avg_tip_dist = round(pplace.mean_tip_length, 4)
+        pendant_length = round(pplace.pendant_length, 4)
+        distal_length = round(pplace.distal_length, 4)
+
+        tree_sap.avg_evo_dist = pplace.total_distance()
+        tree_sap.distances = ','.join([str(distal_length), str(pendant_length), str(avg_tip_dist)])
+
+        # hmm_perc = round((int(tree_sap.seq_len) * 100) / refpkg.profile_length, 1)
+
+        if svc:
+            if refpkg.svc is None:
+                svc_attempt = True
+                call = 1
+            else:
+                call = refpkg.svc.predict(preprocessing.normalize(np_array([len(leaf_children),
+                                                                            tree_sap.evalue,
+                                                                            round(pplace.like_weight_ratio, 2),
+                                                                            distal_length,
+                                                                            pendant_length,
+                                                                            avg_tip_dist]).reshape(1, -1)))
+            # Discard this placement as a false positive if classifier calls this a 0
+            if call == 0:
+                unclassified_seqs["svm"].append(tree_sap)
+                tree_sap.classified = False
+
+    if svc_attempt:
+        logging.warning("SVM classifier unavailable for reference package '{}'\n".format(refpkg.prefix))
+
+    return unclassified_seqs
+
+
+def summarize_declassified(unclassified_seqs: dict) -> str:
+    declass_summary = ""
+    for marker in unclassified_seqs:
+        # unclassified_counts[marker] will always be >= distant_seqs[marker]
+        for declass in unclassified_seqs[marker]:
+            declass_summary += marker + '\t' + declass + '\t' + str(len(unclassified_seqs[marker][declass])) + "\n"
+    return declass_summary
+
+
 def filter_placements(tree_saps: dict, refpkg_dict: dict, svc: bool, min_lwr: float) -> None:
     """
     Determines the total distance of each placement from its branch point on the tree
@@ -1097,67 +1476,38 @@ def filter_placements(tree_saps: dict, refpkg_dict: dict, svc: bool, min_lwr: fl
 
     for refpkg_name, pqueries in tree_saps.items():  # type: (str, list)
         refpkg = refpkg_dict[refpkg_name]  # type: ReferencePackage
-        unclassified_seqs[refpkg.prefix] = dict()
-        unclassified_seqs[refpkg.prefix]["low_lwr"] = list()
-        unclassified_seqs[refpkg.prefix]["np"] = list()
-        unclassified_seqs[refpkg.prefix]["svm"] = list()
-        svc_attempt = False
-
-        for tree_sap in sorted(pqueries, key=lambda x: x.seq_name):  # type: PQuery
-            tree_sap.filter_min_weight_threshold(min_lwr)
-            if not tree_sap.classified:
-                unclassified_seqs[refpkg.prefix]["low_lwr"].append(tree_sap)
-                continue
-            if not tree_sap.placements:
-                unclassified_seqs[tree_sap.ref_name]["np"].append(tree_sap)
-                continue
-            elif tree_sap.placements[0] == '{}':
-                unclassified_seqs[refpkg.prefix]["np"].append(tree_sap)
-                tree_sap.classified = False
-                continue
-
-            pplace = tree_sap.consensus_placement  # type: PhyloPlace
+        unclassified_seqs[refpkg.prefix] = filter_refpkg_placements(pqueries, refpkg, svc, min_lwr)
 
-            leaf_children = tree_sap.node_map[int(pplace.edge_num)]
+    logging.info("done.\n")
 
-            avg_tip_dist = round(pplace.mean_tip_length, 4)
-            pendant_length = round(pplace.pendant_length, 4)
-            distal_length = round(pplace.distal_length, 4)
+    logging.debug(summarize_declassified(unclassified_seqs))
 
-            tree_sap.avg_evo_dist = pplace.total_distance()
-            tree_sap.distances = ','.join([str(distal_length), str(pendant_length), str(avg_tip_dist)])
+    return
 
-            # hmm_perc = round((int(tree_sap.seq_len) * 100) / refpkg.profile_length, 1)
 
-            if svc:
-                if refpkg.svc is None:
-                    svc_attempt = True
-                    call = 1
-                else:
-                    call = refpkg.svc.predict(preprocessing.normalize(np_array([len(leaf_children),
-                                                                                tree_sap.evalue,
-                                                                                round(pplace.like_weight_ratio, 2),
-                                                                                distal_length,
-                                                                                pendant_length,
-                                                                                avg_tip_dist]).reshape(1, -1)))
-                # Discard this placement as a false positive if classifier calls this a 0
-                if call == 0:
-                    unclassified_seqs[tree_sap.ref_name]["svm"].append(tree_sap)
-                    tree_sap.classified = False
-
-        if svc_attempt:
-            logging.warning("SVM classifier unavailable for reference package '{}'\n".format(refpkg.prefix))
-
-    logging.info("done.\n")
+def select_refpkg_query_placements(pqueries: list, refpkg: ReferencePackage, mode="max_lwr") -> None:
+    """
+    Sets the PQuery.consensus_placement attribute for each PQuery placed on a single reference package's phylogeny.
 
-    declass_summary = ""
-    for marker in unclassified_seqs:
-        # unclassified_counts[marker] will always be >= distant_seqs[marker]
-        for declass in unclassified_seqs[marker]:
-            declass_summary += marker + '\t' + declass + '\t' + str(len(unclassified_seqs[marker][declass])) + "\n"
+    :param pqueries: A list of PQuery instances that were all placed on refpkg's phylogeny
+    :param refpkg: The ReferencePackage instance whose taxonomically-labelled tree is used to summarize placements
+    :param mode: The algorithm for consolidating multiple phylogenetic placements, either 'max_lwr' or 'aelw'
+    :return: None
+    """
+    taxa_tree = refpkg.taxonomically_label_tree()
+    for pquery in pqueries:  # type: PQuery
+        if mode == "max_lwr":
+            pquery.process_max_weight_placement(taxa_tree)
+        elif mode == "aelw":
+            pquery.calculate_consensus_placement(taxa_tree)
+        else:
+            logging.error("Unknown PQuery consensus algorithm provided: '{}'.\n".format(mode))
+            raise ValueError
 
-    logging.debug(declass_summary)
+        pquery.placements = [pquery.consensus_placement]
 
+        # I have decided to not remove the original JPlace files since some may find these useful
+        # os.remove(filename)
     return
 
 
@@ -1175,21 +1525,8 @@ def select_query_placements(pquery_dict: dict, refpkg_dict: dict, mode="max_lwr"
 
     for refpkg_code in pquery_dict:  # type: str
         refpkg = refpkg_dict[refpkg_code]  # type: ReferencePackage
-        taxa_tree = refpkg.taxonomically_label_tree()
-        for pquery in pquery_dict[refpkg_code]:  # type: PQuery
-            if mode == "max_lwr":
-                pquery.process_max_weight_placement(taxa_tree)
-            elif mode == "aelw":
-                pquery.calculate_consensus_placement(taxa_tree)
-            else:
-                logging.error("Unknown PQuery consensus algorithm provided: '{}'.\n".format(mode))
-                raise ValueError
-
-            classified_seqs += 1
-            pquery.placements = [pquery.consensus_placement]
-
-            # I have decided to not remove the original JPlace files since some may find these useful
-            # os.remove(filename)
+        select_refpkg_query_placements(pquery_dict[refpkg_code], refpkg, mode)
+        classified_seqs += len(pquery_dict[refpkg_code])
 
     logging.info("done.\n")
 
@@ -1203,6 +1540,54 @@ def select_query_placements(pquery_dict: dict, refpkg_dict: dict, mode="max_lwr"
     return pquery_dict
 
 
+def parse_refpkg_jplaces(jplace_files: list, refpkg: ReferencePackage, pquery_map=None,
+                         merge=True) -> (list, jplace_utils.JPlace):
+    """
+    Demultiplexes the placed query sequences in each of the JPlace files that were generated for a single
+    reference package, returning the PQuery instances and a JPlace instance with all of the PQueries merged.
+
+    :param jplace_files: A list of JPlace files that were all generated by placing sequences onto refpkg's phylogeny
+    :param refpkg: The ReferencePackage instance the JPlace files were generated from
+    :param pquery_map: A dictionary mapping PQuery.place_name strings to their respective PQuery instances
+    :param merge: Flag indicating whether the merged JPlace should be retained. If False, None is returned instead.
+    :return: A list of PQuery instances and a JPlace instance containing the placements from all jplace_files
+    """
+    refpkg_pqueries = list()
+    merged_jplace = None
+    for filename in jplace_files:
+        # Load the JSON placement (jplace) file containing >= 1 pquery into JPlace object
+        jplace_data = jplace_utils.jplace_parser(filename)
+        edge_dist_index = index_tree_edges(jplace_data.tree)
+        internal_node_leaf_map = map_internal_nodes_leaves(jplace_data.tree)
+        # Demultiplex all pqueries in jplace_data into individual PQuery objects
+        jplace_data.pqueries = jplace_utils.demultiplex_pqueries(jplace_data, pquery_map)
+        jplace_utils.calc_pquery_mean_tip_distances(jplace_data, internal_node_leaf_map)
+        for pquery in jplace_data.pqueries:  # type: PQuery
+            # Flesh out the internal-leaf node map
+            pquery.ref_name = refpkg.prefix
+            if not pquery.seq_name:
+                seq_info = re.match(r"(.*)\|" + re.escape(pquery.ref_name) + r"\|(\d+)_(\d+)$", pquery.place_name)
+                pquery.seq_name, pquery.start, pquery.end = seq_info.groups()
+            pquery.seq_len = int(pquery.end) - int(pquery.start)
+            pquery.node_map = internal_node_leaf_map
+            pquery.check_jplace_edge_lengths(edge_dist_index)
+            refpkg_pqueries.append(pquery)
+
+        if not merge:
+            jplace_data.clear_object()
+        elif merged_jplace is None:
+            merged_jplace = jplace_data
+            merged_jplace.ref_name = refpkg.prefix
+        else:
+            # If a JPlace file for that tree has already been parsed, just append the placements
+            merged_jplace.pqueries = merged_jplace.pqueries + jplace_data.pqueries
+
+        # I have decided to not remove the original JPlace files since some may find these useful
+        # os.remove(filename)
+
+    return refpkg_pqueries, merged_jplace
+
+
 def parse_raxml_output(epa_output_dir: str, refpkg_dict: dict, pqueries=None):
     """
     For every JPlace file found in the directory **epa_output_dir**, all placed query sequences in the JPlace
@@ -1234,36 +1619,7 @@ def parse_raxml_output(epa_output_dir: str, refpkg_dict: dict, pqueries=None):
 
     for refpkg_name, jplace_list in jplace_utils.organize_jplace_files(jplace_files).items():
         refpkg = refpkg_dict[refpkg_name]
-        if refpkg.prefix not in tree_saps:
-            tree_saps[refpkg.prefix] = list()
-        for filename in jplace_list:
-            # Load the JSON placement (jplace) file containing >= 1 pquery into JPlace object
-            jplace_data = jplace_utils.jplace_parser(filename)
-            edge_dist_index = index_tree_edges(jplace_data.tree)
-            internal_node_leaf_map = map_internal_nodes_leaves(jplace_data.tree)
-            # Demultiplex all pqueries in jplace_data into individual PQuery objects
-            jplace_data.pqueries = jplace_utils.demultiplex_pqueries(jplace_data, pquery_map)
-            jplace_utils.calc_pquery_mean_tip_distances(jplace_data, internal_node_leaf_map)
-            for pquery in jplace_data.pqueries:  # type: PQuery
-                # Flesh out the internal-leaf node map
-                pquery.ref_name = refpkg.prefix
-                if not pquery.seq_name:
-                    seq_info = re.match(r"(.*)\|" + re.escape(pquery.ref_name) + r"\|(\d+)_(\d+)$", pquery.place_name)
-                    pquery.seq_name, pquery.start, pquery.end = seq_info.groups()
-                pquery.seq_len = int(pquery.end) - int(pquery.start)
-                pquery.node_map = internal_node_leaf_map
-                pquery.check_jplace_edge_lengths(edge_dist_index)
-                tree_saps[refpkg.prefix].append(pquery)
-
-            if refpkg.prefix not in itol_data:
-                itol_data[refpkg.prefix] = jplace_data
-                itol_data[refpkg.prefix].ref_name = refpkg.prefix
-            else:
-                # If a JPlace file for that tree has already been parsed, just append the placements
-                itol_data[refpkg.prefix].pqueries = itol_data[refpkg.prefix].pqueries + jplace_data.pqueries
-
-            # I have decided to not remove the original JPlace files since some may find these useful
-            # os.remove(filename)
+        tree_saps[refpkg.prefix], itol_data[refpkg.prefix] = parse_refpkg_jplaces(jplace_list, refpkg, pquery_map)
 
     logging.info("done.\n")
 
@@ -1329,6 +1685,50 @@ def write_classified_sequences(tree_saps: dict, formatted_fasta_dict: dict, fast
     return
 
 
+def determine_refpkg_confident_lineages(pqueries: list, ref_pkg: ReferencePackage) -> None:
+    """
+    Sets the recommended_lineage attribute of each classified PQuery placed on a single reference package's phylogeny.
+    See determine_confident_lineage for details.
+
+    :param pqueries: A list of PQuery instances that were all placed on ref_pkg's phylogeny
+    :param ref_pkg: The ReferencePackage instance for the pqueries
+    :return: None
+    """
+    # Lineages are handled as tuples of taxon IDs and only converted back to strings for the recommended lineage
+    taxa_trie = ref_pkg.taxa_trie
+    root_id = taxa_trie.intern_taxon(taxa_trie.root_taxon)
+    # All the leaves for that tree [number, translation, lineage]
+    leaf_taxa_map = dict()
+    for leaf in ref_pkg.generate_tree_leaf_references_from_refpkg():
+        leaf_taxa_map[leaf.number] = taxa_trie.intern_lineage(leaf.lineage)
+
+    for pquery in pqueries:  # type: PQuery
+        if not pquery.classified:
+            continue
+
+        lineage_list = pquery.children_lineage(leaf_taxa_map)
+        lct_ids = taxa_trie.intern_lineage(pquery.lct)
+        # algorithm options are "MEGAN", "LCAp", and "LCA*" (default)
+        # pquery.lct = lowest_common_taxonomy(lineage_list, lca, taxonomic_counts, "LCA*")
+        pquery.wtd, status = ts_lca.weighted_taxonomic_distance(lineage_list, lct_ids)
+        if status > 0:
+            pquery.summarize()
+
+        # Based on the calculated distance from the leaves, what rank is most appropriate?
+        recommended_rank = phylo_dist.rank_recommender(pquery.avg_evo_dist, ref_pkg.pfit)
+        if not lct_ids or lct_ids[0] != root_id:
+            lct_ids = (root_id,) + lct_ids
+            pquery.lct = taxa_trie.lineage_from_ids(lct_ids)
+            recommended_rank += 1
+        # Equivalent to PQuery.lowest_confident_taxonomy
+        if recommended_rank < 1:
+            pquery.recommended_lineage = taxa_trie.root_taxon
+        else:
+            pquery.recommended_lineage = taxa_trie.lineage_from_ids(lct_ids[:recommended_rank])
+    leaf_taxa_map.clear()
+    return
+
+
 def determine_confident_lineage(tree_saps: dict, refpkg_dict: dict) -> None:
     """
     Determines the best taxonomic lineage for classified sequences based on their
@@ -1341,75 +1741,306 @@ def determine_confident_lineage(tree_saps: dict, refpkg_dict: dict) -> None:
     :param refpkg_dict: A dictionary of ReferencePackage instances indexed by their prefix values
     :return: None
     """
-    leaf_taxa_map = dict()
     for refpkg_name in tree_saps:
-        # All the leaves for that tree [number, translation, lineage]
-        ref_pkg = refpkg_dict[refpkg_name]  # type: ReferencePackage
-        for leaf in ref_pkg.generate_tree_leaf_references_from_refpkg():
-            leaf_taxa_map[leaf.number] = leaf.lineage
+        determine_refpkg_confident_lineages(tree_saps[refpkg_name], refpkg_dict[refpkg_name])
+    return
+
+
+def classify_refpkg_pqueries(jplace_files: list, refpkg: ReferencePackage, pquery_map: dict,
+                             mode: str, svc: bool, min_lwr: float, keep_jplace=True) -> tuple:
+    """
+    Runs all of the classification steps (JPlace parsing, consensus placement selection, placement filtering and
+    lineage determination) for the PQueries placed onto a single reference package's phylogeny.
+    Since the steps are independent between reference packages, this function is the unit of work for classify_pqueries.
+
+    :param jplace_files: A list of JPlace files that were all generated by placing sequences onto refpkg's phylogeny
+    :param refpkg: The ReferencePackage instance the JPlace files were generated from
+    :param pquery_map: A dictionary mapping PQuery.place_name strings to their respective PQuery instances
+    :param mode: The algorithm for consolidating multiple phylogenetic placements, either 'max_lwr' or 'aelw'
+    :param svc: A boolean indicating whether placements should be filtered using ReferencePackage.svc
+    :param min_lwr: Likelihood-weight-ratio (LWR) threshold for filtering pqueries
+    :param keep_jplace: Flag indicating whether the merged JPlace instance is returned (None otherwise)
+    :return: A tuple of the reference package's prefix, its list of PQuery instances, the merged JPlace instance and
+     a dictionary of the PQuery instances that were declassified, indexed by the filter that removed them
+    """
+    pqueries, jplace_data = parse_refpkg_jplaces(jplace_files, refpkg, pquery_map, merge=keep_jplace)
+    select_refpkg_query_placements(pqueries, refpkg, mode)
+    unclassified_seqs = filter_refpkg_placements(pqueries, refpkg, svc, min_lwr)
+    determine_refpkg_confident_lineages(pqueries, refpkg)
+    return refpkg.prefix, pqueries, jplace_data, unclassified_seqs
+
+
+def classify_pqueries(epa_output_dir: str, refpkg_dict: dict, pqueries=None, mode="max_lwr",
+                      svc=False, min_lwr=0.0, num_proc=1, itol=True) -> (dict, dict):
+    """
+    Classifies the query sequences placed by EPA-ng. The JPlace files in epa_output_dir are grouped by reference
+    package and each group is processed by classify_refpkg_pqueries. When num_proc is greater than one the reference
+    packages are distributed across a pool of worker processes and the results are merged afterwards.
+
+    :param epa_output_dir: Directory where EPA wrote the JPlace files
+    :param refpkg_dict: A dictionary of ReferencePackage instances indexed by their prefix values
+    :param pqueries: A list of instantiated PQuery instances
+    :param mode: The algorithm for consolidating multiple phylogenetic placements, either 'max_lwr' or 'aelw'
+    :param svc: A boolean indicating whether placements should be filtered using ReferencePackage.svc
+    :param min_lwr: Likelihood-weight-ratio (LWR) threshold for filtering pqueries
+    :param num_proc: The maximum number of reference packages to classify in parallel
+    :param itol: Flag indicating whether the merged JPlace instances needed for the iTOL outputs should be kept.
+     When False the returned JPlace dictionary is empty, sparing the memory and inter-process transfer.
+    :return:
+        1. Dictionary of PQuery instances indexed by denominator (refpkg code e.g. M0701)
+        2. Dictionary of an JPlace instance (values) mapped to a refpkg prefix.
+    """
+    logging.info("Classifying placed query sequences... ")
 
-        for pquery in tree_saps[refpkg_name]:  # type: PQuery
-            if not pquery.classified:
+    function_start_time = time.time()
+
+    jplace_files = glob.glob(epa_output_dir + '*.jplace')
+    refpkg_jplaces = jplace_utils.organize_jplace_files(jplace_files)
+
+    # Only send each worker the PQueries that were placed on its reference package
+    refpkg_pquery_maps = {refpkg_name: None for refpkg_name in refpkg_jplaces}
+    if pqueries:
+        for pquery in pqueries:  # type: PQuery
+            if pquery.ref_name not in refpkg_jplaces:
                 continue
+            if not refpkg_pquery_maps[pquery.ref_name]:
+                refpkg_pquery_maps[pquery.ref_name] = dict()
+            refpkg_pquery_maps[pquery.ref_name][pquery.place_name] = pquery
 
-            lineage_list = pquery.children_lineage(leaf_taxa_map)
-            # algorithm options are "MEGAN", "LCAp", and "LCA*" (default)
-            # pquery.lct = lowest_common_taxonomy(lineage_list, lca, taxonomic_counts, "LCA*")
-            pquery.wtd, status = ts_lca.weighted_taxonomic_distance(lineage_list, pquery.lct)
-            if status > 0:
-                pquery.summarize()
-
-            # Based on the calculated distance from the leaves, what rank is most appropriate?
-            recommended_rank = phylo_dist.rank_recommender(pquery.avg_evo_dist, refpkg_dict[refpkg_name].pfit)
-            if pquery.lct.split(ref_pkg.taxa_trie.lin_sep)[0] != "r__Root":
-                pquery.lct = "r__Root; " + pquery.lct
-                recommended_rank += 1
-            pquery.recommended_lineage = pquery.lowest_confident_taxonomy(recommended_rank)
-        leaf_taxa_map.clear()
-    return
+    task_args = [(refpkg_jplaces[refpkg_name], refpkg_dict[refpkg_name], refpkg_pquery_maps[refpkg_name],
+                  mode, svc, min_lwr, itol)
+                 for refpkg_name in sorted(refpkg_jplaces, key=lambda x: len(refpkg_jplaces[x]), reverse=True)]
 
+    num_proc = max(1, min(num_proc, len(task_args)))
+    if num_proc == 1:
+        results = [classify_refpkg_pqueries(*task) for task in task_args]
+    else:
+        with Pool(processes=num_proc) as pool:
+            results = pool.starmap(classify_refpkg_pqueries, task_args, chunksize=1)
+
+    tree_saps = dict()
+    itol_data = dict()
+    unclassified_seqs = dict()
+    for refpkg_prefix, refpkg_pqueries, jplace_data, declassified in results:
+        tree_saps[refpkg_prefix] = refpkg_pqueries
+        if jplace_data:
+            itol_data[refpkg_prefix] = jplace_data
+        unclassified_seqs[refpkg_prefix] = declassified
 
-def write_classification_table(tree_saps, sample_name, output_file):
+    logging.info("done.\n")
+
+    function_end_time = time.time()
+    hours, remainder = divmod(function_end_time - function_start_time, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    logging.debug("\tClassification time required: " +
+                  ':'.join([str(hours), str(minutes), str(round(seconds, 2))]) + "\n")
+    logging.debug("\t" + str(len(jplace_files)) + " JPlace files for " + str(len(task_args)) +
+                  " reference packages classified using " + str(num_proc) + " processes.\n")
+    logging.debug(summarize_declassified(unclassified_seqs))
+
+    return tree_saps, itol_data
+
+
+def classification_table_rows(tree_saps: dict, sample_name: str):
     """
-    Write the final classification table
+    Generator for the fields of each row in the classification table, one row per classified PQuery.
 
     :param tree_saps: A dictionary containing PQuery objects
     :param sample_name: String representing the name of the sample (i.e. Assign.sample_prefix)
-    :param output_file: Path to write the classification table
-    :return: None
+    :return: A list of the classification table's fields for a single PQuery, converted to their respective types
     """
-    tab_out_string = "Sample\tQuery\tMarker\tStart_pos\tEnd_pos\tTaxonomy\tAbundance\t" \
-                     "iNode\tE-value\tLWR\tEvoDist\tDistances\n"
-
     for refpkg_name in tree_saps:
         for tree_sap in tree_saps[refpkg_name]:  # type: PQuery
             if not tree_sap.classified:
                 continue
             pplace = tree_sap.consensus_placement
-            tab_out_string += '\t'.join([sample_name,
-                                         re.sub(r"\|{0}\|\d+_\d+$".format(tree_sap.ref_name), '', tree_sap.place_name),
-                                         tree_sap.ref_name,
-                                         str(tree_sap.start),
-                                         str(tree_sap.end),
-                                         tree_sap.recommended_lineage,
-                                         str(tree_sap.abundance),
-                                         str(pplace.edge_num),
-                                         str(tree_sap.evalue),
-                                         str(pplace.like_weight_ratio),
-                                         str(tree_sap.avg_evo_dist),
-                                         tree_sap.distances]) + "\n"
+            place_suffix = "|{}|{}_{}".format(tree_sap.ref_name, tree_sap.start, tree_sap.end)
+            if tree_sap.place_name.endswith(place_suffix):
+                query_name = tree_sap.place_name[:-len(place_suffix)]
+            else:
+                query_name = re.sub(r"\|{0}\|\d+_\d+$".format(tree_sap.ref_name), '', tree_sap.place_name)
+            yield file_parsers.type_classification_fields([sample_name,
+                                                           query_name,
+                                                           tree_sap.ref_name,
+                                                           tree_sap.start,
+                                                           tree_sap.end,
+                                                           tree_sap.recommended_lineage,
+                                                           tree_sap.abundance,
+                                                           pplace.edge_num,
+                                                           tree_sap.evalue,
+                                                           pplace.like_weight_ratio,
+                                                           tree_sap.avg_evo_dist,
+                                                           tree_sap.distances])
+
+
+def write_classification_parquet(rows, output_file: str, batch_size=100000) -> None:
+    """
+    Writes the classification table rows to an Apache Parquet file in batches, so the whole table is never held
+    in memory. The integer and floating-point columns are typed to allow filters to be pushed down when reading.
+    The SHA1 digest of the equivalent plain-text table is stored in the file's metadata (as 'tsv_sha1') so readers
+    can tell whether the plain-text table has since been modified.
+
+    :param rows: An iterable of lists, each containing the typed fields of a classification table row
+    :param output_file: Path to write the Parquet classification table
+    :param batch_size: The number of rows to buffer before writing a row group
+    :return: None
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        logging.error("pyarrow must be installed to write the classification table in Parquet format.\n")
+        sys.exit(3)
+
+    arrow_types = {str: pa.string(), int: pa.int64(), float: pa.float64()}
+    field_types = [arrow_types[field_type] for field_type in file_parsers.CLASSIFICATION_TABLE_TYPES]
+    schema = pa.schema([(name, dtype) for name, dtype in zip(file_parsers.CLASSIFICATION_TABLE_FIELDS, field_types)])
+    tsv_sha1 = hashlib.sha1(file_parsers.format_classification_line(file_parsers.CLASSIFICATION_TABLE_FIELDS).encode())
+
+    def flush(batch: list) -> None:
+        columns = [pa.array([fields[i] for fields in batch], type=field_types[i]) for i in range(len(field_types))]
+        writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+        return
+
     try:
-        tab_out = open(output_file, 'w')
+        writer = pq.ParquetWriter(output_file, schema)
     except IOError:
         logging.error("Unable to open " + output_file + " for writing!\n")
         sys.exit(3)
 
-    tab_out.write(tab_out_string)
+    buffered_rows = []
+    for fields in rows:
+        tsv_sha1.update(file_parsers.format_classification_line(fields).encode())
+        buffered_rows.append(fields)
+        if len(buffered_rows) == batch_size:
+            flush(buffered_rows)
+            buffered_rows.clear()
+    if buffered_rows:
+        flush(buffered_rows)
+    if hasattr(writer, "add_key_value_metadata"):
+        writer.add_key_value_metadata({"tsv_sha1": tsv_sha1.hexdigest()})
+    else:
+        logging.warning("This version of pyarrow cannot store the plain-text table's digest in '{}'. "
+                        "Its staleness will be checked by row count only.\n".format(output_file))
+    writer.close()
+
+    return
+
+
+def write_classification_table(tree_saps, sample_name, output_file):
+    """
+    Write the final classification table. Rows are streamed to the output file as they are formatted.
+    The format is chosen by the extension of output_file: '.tsv.gz' is gzip-compressed plain-text,
+    '.parquet' is Apache Parquet (requires pyarrow) and anything else is plain-text.
+
+    :param tree_saps: A dictionary containing PQuery objects
+    :param sample_name: String representing the name of the sample (i.e. Assign.sample_prefix)
+    :param output_file: Path to write the classification table
+    :return: None
+    """
+    rows = classification_table_rows(tree_saps, sample_name)
+    if output_file.endswith(".parquet"):
+        write_classification_parquet(rows, output_file)
+        return
+
+    try:
+        if output_file.endswith(".gz"):
+            tab_out = gzip.open(output_file, 'wt')
+        else:
+            tab_out = open(output_file, 'w')
+    except IOError:
+        logging.error("Unable to open " + output_file + " for writing!\n")
+        sys.exit(3)
+
+    tab_out.write(file_parsers.format_classification_line(file_parsers.CLASSIFICATION_TABLE_FIELDS))
+    tab_out.writelines(file_parsers.format_classification_line(fields) for fields in rows)
     tab_out.close()
 
     return
 
 
+def rebuild_itol_data(epa_output_dir: str, refpkg_dict: dict, classified_lines: list,
+                      mode="max_lwr") -> (dict, dict):
+    """
+    Recreates the PQuery and merged JPlace instances required by produce_itol_inputs for a finished *treesapp assign*
+    run, so the iTOL outputs can be generated on demand rather than for every sample.
+    The placements are re-parsed from the JPlace files in epa_output_dir and a PQuery is only flagged as classified
+    if it is in the classification table, from which its abundance is also taken.
+
+    :param epa_output_dir: Directory where EPA wrote the JPlace files (i.e. the intermediates directory)
+    :param refpkg_dict: A dictionary of ReferencePackage instances indexed by their prefix values
+    :param classified_lines: A list of lists, each representing a row of the classification table
+    :param mode: The algorithm for consolidating multiple phylogenetic placements, either 'max_lwr' or 'aelw'
+    :return:
+        1. Dictionary of PQuery instances indexed by denominator (refpkg code e.g. M0701)
+        2. Dictionary of an JPlace instance (values) mapped to a refpkg prefix.
+    """
+    classified_abundances = dict()
+    for fields in classified_lines:
+        classified_abundances["{}|{}|{}_{}".format(fields[1], fields[2], fields[3], fields[4])] = float(fields[6])
+
+    refpkg_jplaces = jplace_utils.organize_jplace_files(glob.glob(epa_output_dir + '*.jplace'))
+    tree_saps = dict()
+    itol_data = dict()
+    for refpkg_name in sorted(set([fields[2] for fields in classified_lines])):
+        if refpkg_name not in refpkg_dict:
+            logging.warning("Reference package '{}' was not found. Skipping its iTOL outputs.\n".format(refpkg_name))
+            continue
+        if refpkg_name not in refpkg_jplaces:
+            logging.warning("No JPlace files for reference package '{}' were found in {}.\n".format(refpkg_name,
+                                                                                                  epa_output_dir))
+            continue
+        refpkg = refpkg_dict[refpkg_name]  # type: ReferencePackage
+        pqueries, jplace_data = parse_refpkg_jplaces(refpkg_jplaces[refpkg_name], refpkg)
+        select_refpkg_query_placements(pqueries, refpkg, mode)
+        for pquery in pqueries:  # type: PQuery
+            pquery.classified = pquery.place_name in classified_abundances
+            pquery.abundance = classified_abundances.get(pquery.place_name, 0.0)
+        tree_saps[refpkg_name] = pqueries
+        itol_data[refpkg_name] = jplace_data
+
+    num_unplaced = len(set(classified_abundances).difference(pquery.place_name
+                                                            for pqueries in tree_saps.values() for pquery in pqueries))
+    if num_unplaced:
+        # Query sequences loaded from a placement cache or identical to a placed representative have no JPlace entry
+        logging.info("{} classified sequences were not placed in the JPlace files so the iTOL inputs are incomplete."
+                     " These were loaded from a placement cache or identical to another query sequence.\n"
+                     "".format(num_unplaced))
+    return tree_saps, itol_data
+
+
+def add_unplaced_pqueries(jplace_data: jplace_utils.JPlace, refpkg_pqueries: list) -> int:
+    """
+    Adds the PQuery instances that were classified without being placed in this run to a merged JPlace, so they are
+    included in the iTOL inputs. These are the query sequences loaded from a PlacementCache, which only retain their
+    consensus placement, and those identical to a placed representative, whose placements are named for it.
+    Each is given its own copy of the placements named for it and the internal node to leaf map of the JPlace tree.
+
+    :param jplace_data: A JPlace instance with the PQueries placed onto a reference package's tree in this run
+    :param refpkg_pqueries: A list of all the PQuery instances classified with the reference package
+    :return: The number of PQuery instances added to jplace_data
+    """
+    placed_names = {pquery.place_name for pquery in jplace_data.pqueries}
+    node_map = next((pquery.node_map for pquery in jplace_data.pqueries if pquery.node_map), dict())
+    num_added = 0
+    for pquery in refpkg_pqueries:  # type: PQuery
+        if pquery.place_name in placed_names:
+            continue
+        pplaces = pquery.placements if pquery.placements else [pquery.consensus_placement]
+        pquery.placements = []
+        for pplace in pplaces:  # type: PhyloPlace
+            if pplace:
+                pquery.placements.append(copy.copy(pplace))
+                pquery.placements[-1].name = pquery.place_name
+        if not pquery.placements:
+            continue
+        if not pquery.node_map:
+            pquery.node_map = node_map
+        jplace_data.pqueries.append(pquery)
+        num_added += 1
+    return num_added
+
+
 def produce_itol_inputs(pqueries: dict, refpkg_dict: dict, jplaces: dict,
                         itol_base_dir: str, treesapp_data_dir: str) -> None:
     """
@@ -1432,15 +2063,22 @@ def produce_itol_inputs(pqueries: dict, refpkg_dict: dict, jplaces: dict,
 
     strip_missing = []
     style_missing = []
+    unplaced_refpkgs = []
     for refpkg_name in pqueries:
         if len(pqueries[refpkg_name]) == 0:
             # No sequences that were mapped met the minimum likelihood weight ration threshold. Skipping!
             continue
         refpkg = refpkg_dict[refpkg_name]  # type: ReferencePackage
+        if refpkg.prefix not in jplaces:
+            # All of the query sequences were classified by a previous run, loaded from a PlacementCache,
+            # so there is no JPlace tree to write their placements onto
+            unplaced_refpkgs.append(refpkg.prefix)
+            continue
         if not os.path.exists(itol_base_dir + refpkg.prefix):
             os.mkdir(itol_base_dir + refpkg.prefix)
         jplace_data = jplaces[refpkg.prefix]
         refpkg_pqueries = pqueries[refpkg_name]
+        add_unplaced_pqueries(jplace_data, refpkg_pqueries)
 
         if os.path.isfile(refpkg.f__boot_tree):
             # TODO: investigate whether this is still valid for JPlace instance, or should be PQuery
@@ -1471,6 +2109,9 @@ def produce_itol_inputs(pqueries: dict, refpkg_dict: dict, jplaces: dict,
         generate_simplebar(refpkg.prefix, refpkg_pqueries, itol_bar_file)
 
     logging.info("done.\n")
+    if unplaced_refpkgs:
+        logging.info("iTOL inputs were not generated for {} since their query sequences were all classified by a"
+                     " previous run, loaded from the placement cache.\n".format(", ".join(unplaced_refpkgs)))
     if style_missing:
         logging.debug("A colours_style.txt file does not yet exist for markers:\n\t" +
                       "\n\t".join(style_missing) + "\n")
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import logging
+import hashlib
+
+__author__ = 'Connor Morgan-Lang'
+
+
+class CheckpointManifest:
+    """
+    A JSON file recording each unit of work (e.g. the hmmsearch of a single reference package) that was completed
+    in a stage, along with the digests of its input files, its parameters and the output files it produced.
+
+    A unit is complete only if its inputs and parameters are unchanged since it was recorded and its outputs still exist,
+    so a run that was interrupted, or is repeated with additional reference packages, only repeats the units that
+    were not completed or whose inputs have changed.
+    """
+    version = 1
+
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        self.stages = dict()
+        self._digests = dict()  # File digests cached by path, with the size and modification time they were made at
+        self.load()
+
+    def load(self) -> None:
+        self.stages.clear()
+        if not os.path.isfile(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path) as manifest_handler:
+                manifest = json.load(manifest_handler)
+        except (IOError, ValueError):
+            logging.warning("Unable to read checkpoint manifest '{}'. All stages will be run.\n"
+                            "".format(self.manifest_path))
+            return
+        if manifest.get("version") != self.version:
+            logging.debug("Ignoring checkpoint manifest '{}' written by a different version.\n"
+                          "".format(self.manifest_path))
+            return
+        self.stages = manifest["stages"]
+        return
+
+    def save(self) -> None:
+        """
+        Writes the manifest to a temporary file that then replaces the manifest,
+        so the manifest is never left partially written if the run is interrupted.
+        """
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, 'w') as manifest_handler:
+            json.dump({"version": self.version, "stages": self.stages}, manifest_handler, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+        return
+
+    def digest(self, file_path: str) -> str:
+        """
+        Calculates the SHA-256 digest of a file's contents.
+        Digests are cached for as long as the file's size and modification time are unchanged.
+
+        :param file_path: Path to a file
+        :return: The hexadecimal digest, or an empty string if the file does not exist
+        """
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return ""
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        if file_path in self._digests and self._digests[file_path][0] == stamp:
+            return self._digests[file_path][1]
+
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as file_handler:
+            for block in iter(lambda: file_handler.read(1 << 20), b''):
+                sha.update(block)
+        self._digests[file_path] = (stamp, sha.hexdigest())
+        return sha.hexdigest()
+
+    def signature(self, inputs: list, params=None) -> dict:
+        # Parameters are passed through JSON so they compare equal to those loaded from the manifest (e.g. tuples)
+        return {"inputs": [self.digest(input_file) for input_file in inputs if input_file],
+                "params": json.loads(json.dumps(params if params else {}, sort_keys=True))}
+
+    def is_complete(self, stage: str, unit: str, inputs: list, params=None) -> bool:
+        """
+        Determines whether a unit of a stage has already been completed with the same inputs and parameters.
+
+        :param stage: Name of the stage
+        :param unit: Name of the unit of work within the stage, such as a reference package or an input file
+        :param inputs: List of paths to the files the unit reads
+        :param params: A dictionary of the parameters that change the unit's outputs
+        :return: True if the unit can be skipped, False otherwise
+        """
+        try:
+            record = self.stages[stage][unit]
+        except KeyError:
+            return False
+        signature = self.signature(inputs, params)
+        if record["inputs"] != signature["inputs"] or record["params"] != signature["params"]:
+            logging.debug("Inputs or parameters of {} unit '{}' have changed since it was completed.\n"
+                          "".format(stage, unit))
+            return False
+        if not all(os.path.isfile(output) for output in record["outputs"]):
+            logging.debug("Outputs of {} unit '{}' are missing.\n".format(stage, unit))
+            return False
+        logging.debug("Skipping {} unit '{}' as it has already been completed.\n".format(stage, unit))
+        return True
+
+    def complete(self, stage: str, unit: str, inputs: list, outputs: list, params=None) -> None:
+        """
+        Records a unit of a stage as complete and saves the manifest.
+        The manifest is first read again so units recorded by other commands sharing it (e.g. treesapp abundance,
+        when it is run by treesapp assign) are not lost.
+
+        :param stage: Name of the stage
+        :param unit: Name of the unit of work within the stage
+        :param inputs: List of paths to the files the unit read
+        :param outputs: List of paths to the files the unit wrote
+        :param params: A dictionary of the parameters that change the unit's outputs
+        :return: None
+        """
+        record = self.signature(inputs, params)
+        record["outputs"] = list(outputs)
+        record["completed"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.load()
+        self.stages.setdefault(stage, dict())[unit] = record
+        self.save()
+        return
+
+    def outputs(self, stage: str, unit: str) -> list:
+        return list(self.stages[stage][unit]["outputs"])
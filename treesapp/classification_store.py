@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import sqlite3
+import logging
+
+from treesapp.file_parsers import CLASSIFICATION_TABLE_FIELDS, iterate_classification_table
+
+__author__ = 'Connor Morgan-Lang'
+
+
+class ClassificationStore:
+    """
+    A cumulative, indexed store of TreeSAPP classification tables (marker_contig_map.tsv) backed by an SQLite database.
+    Classifications from new samples are appended incrementally and tables that have already been ingested are skipped
+    unless they have been modified (e.g. by *treesapp abundance*), in which case the rows from that table are replaced.
+    Rows are keyed by the path of the table they came from, so tables sharing a sample do not overwrite each other.
+    Queries by sample, reference package and lineage use indexes so summaries across many samples do not require
+    re-parsing every classification table.
+    """
+    columns = ["sample", "query", "marker", "start_pos", "end_pos", "taxonomy", "abundance",
+               "inode", "evalue", "lwr", "evo_dist", "distances"]
+    column_types = ["TEXT", "TEXT", "TEXT", "INTEGER", "INTEGER", "TEXT", "REAL",
+                    "INTEGER", "REAL", "REAL", "REAL", "TEXT"]
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.lin_sep = "; "
+        try:
+            self.conn = sqlite3.connect(db_path, timeout=60)
+        except sqlite3.Error as err:
+            logging.error("Unable to open classification store '{}':\n{}\n".format(db_path, err))
+            sys.exit(3)
+        # Write-ahead logging allows readers to continue while a new sample is being appended
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.create_schema()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+        return
+
+    def create_schema(self) -> None:
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS classifications (" +
+                              ", ".join(["{} {}".format(col, col_type)
+                                         for col, col_type in zip(self.columns, self.column_types)]) +
+                              ", source TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS sources "
+                              "(path TEXT PRIMARY KEY, modified REAL, n_rows INTEGER)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_source ON classifications (source)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_sample ON classifications (sample)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_marker_taxonomy ON classifications (marker, taxonomy)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_taxonomy ON classifications (taxonomy)")
+        return
+
+    def append_rows(self, rows, source: str, replace_source=True, batch_size=10000) -> int:
+        """
+        Inserts classification table rows into the store in batches, so rows from a generator are never all held in
+        memory. By default, all rows previously inserted from the same source are first removed so re-ingesting a
+        classification table does not duplicate its classifications. The rows are inserted in a single transaction.
+
+        :param rows: An iterable of lists, each containing the fields of a classification table row
+        :param source: The path of the classification table the rows belong to, used to replace them later
+        :param replace_source: Flag indicating whether the rows already in the store from source should be replaced
+        :param batch_size: The number of rows buffered before they are inserted
+        :return: The number of rows inserted
+        """
+        insert_cols = self.columns + ["source"]
+        insert_stmt = "INSERT INTO classifications ({}) VALUES ({})".format(", ".join(insert_cols),
+                                                                            ", ".join(["?"] * len(insert_cols)))
+        n_rows = 0
+
+        with self.conn:
+            if replace_source:
+                self.conn.execute("DELETE FROM classifications WHERE source = ?", (source,))
+            buffered_rows = []
+            for fields in rows:
+                buffered_rows.append(list(fields) + [source])
+                if len(buffered_rows) == batch_size:
+                    self.conn.executemany(insert_stmt, buffered_rows)
+                    n_rows += len(buffered_rows)
+                    buffered_rows.clear()
+            if buffered_rows:
+                self.conn.executemany(insert_stmt, buffered_rows)
+                n_rows += len(buffered_rows)
+        return n_rows
+
+    def add_table(self, table_path: str, force=False) -> int:
+        """
+        Ingests a classification table into the store, skipping the table if it was already ingested and has not
+        been modified since.
+
+        :param table_path: Path to a classification table written by *treesapp assign*
+        :param force: Ingest the classification table even if it is unchanged since it was last ingested
+        :return: The number of rows inserted
+        """
+        source = os.path.abspath(table_path)
+        modified = os.path.getmtime(table_path)
+        if not force:
+            prior = self.conn.execute("SELECT modified FROM sources WHERE path = ?", (source,)).fetchone()
+            if prior and prior[0] == modified:
+                logging.debug("Classification table '{}' is already in the store.\n".format(table_path))
+                return 0
+
+        n_rows = self.append_rows(iterate_classification_table(table_path), source)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (source, modified, n_rows))
+        return n_rows
+
+    def add_tables(self, table_paths: list, force=False) -> int:
+        n_rows = 0
+        n_tables = 0
+        for table_path in table_paths:
+            n_new = self.add_table(table_path, force)
+            if n_new:
+                n_tables += 1
+            n_rows += n_new
+        logging.debug("{} rows from {}/{} classification tables added to '{}'.\n".format(n_rows, n_tables,
+                                                                                         len(table_paths),
+                                                                                         self.db_path))
+        return n_rows
+
+    def where_clause(self, samples=None, refpkgs=None, lineage=None, min_lwr=0.0) -> (str, list):
+        conditions = []
+        params = []
+        if samples:
+            conditions.append("sample IN (" + ", ".join(["?"] * len(samples)) + ")")
+            params += list(samples)
+        if refpkgs:
+            conditions.append("marker IN (" + ", ".join(["?"] * len(refpkgs)) + ")")
+            params += list(refpkgs)
+        if lineage:
+            # A range over the descendants of lineage can use the taxonomy index, unlike LIKE 'lineage%'
+            conditions.append("(taxonomy = ? OR (taxonomy >= ? AND taxonomy < ?))")
+            params += [lineage, lineage + self.lin_sep, lineage + self.lin_sep[0] + chr(ord(self.lin_sep[1]) + 1)]
+        if min_lwr > 0:
+            conditions.append("lwr >= ?")
+            params.append(min_lwr)
+        if not conditions:
+            return "", params
+        return " WHERE " + " AND ".join(conditions), params
+
+    def select(self, samples=None, refpkgs=None, lineage=None, min_lwr=0.0):
+        """
+        A generator of the classifications matching all of the provided filters (see ClassificationStore.query),
+        yielded as they are read from the database.
+        """
+        where, params = self.where_clause(samples, refpkgs, lineage, min_lwr)
+        cursor = self.conn.execute("SELECT " + ", ".join(self.columns) +
+                                   " FROM classifications" + where + " ORDER BY rowid", params)
+        for fields in cursor:
+            yield [str(value) for value in fields]
+
+    def query(self, samples=None, refpkgs=None, lineage=None, min_lwr=0.0) -> list:
+        """
+        Retrieves the classifications matching all of the provided filters, formatted like the lists returned by
+        file_parsers.read_classification_table.
+
+        :param samples: An optional collection of sample names
+        :param refpkgs: An optional collection of reference package prefixes
+        :param lineage: An optional lineage. Only classifications to this lineage or its descendents are returned.
+        :param min_lwr: Classifications with a likelihood weight ratio less than this are skipped
+        :return: A list of lists, each containing the fields of a classification table row as strings
+        """
+        return list(self.select(samples, refpkgs, lineage, min_lwr))
+
+    def summarize(self, group_by=("sample", "marker", "taxonomy"),
+                  samples=None, refpkgs=None, lineage=None, min_lwr=0.0) -> list:
+        """
+        Counts the number of classified sequences and sums their abundances for each group.
+
+        :param group_by: The columns to aggregate classifications by
+        :param samples: An optional collection of sample names
+        :param refpkgs: An optional collection of reference package prefixes
+        :param lineage: An optional lineage. Only classifications to this lineage or its descendents are summarized.
+        :param min_lwr: Classifications with a likelihood weight ratio less than this are skipped
+        :return: A list of tuples containing the values of group_by, the number of queries and the summed abundance
+        """
+        for col in group_by:
+            if col not in self.columns:
+                logging.error("Unable to group classifications by unknown column '{}'.\n".format(col))
+                sys.exit(3)
+        where, params = self.where_clause(samples, refpkgs, lineage, min_lwr)
+        group_cols = ", ".join(group_by)
+        cursor = self.conn.execute("SELECT " + group_cols + ", COUNT(*), SUM(abundance) FROM classifications" +
+                                   where + " GROUP BY " + group_cols + " ORDER BY " + group_cols, params)
+        return cursor.fetchall()
+
+    def samples(self) -> list:
+        return [sample for sample, in self.conn.execute("SELECT DISTINCT sample FROM classifications ORDER BY sample")]
+
+    def export_table(self, output_file: str, sep="\t", **filters) -> int:
+        """
+        Writes the classifications in the store, optionally filtered (see ClassificationStore.query),
+        to a plain-text classification table. Rows are written as they are read from the database.
+
+        :param output_file: Path to write the classification table
+        :param sep: The field separator
+        :return: The number of rows written
+        """
+        try:
+            tab_out = open(output_file, 'w')
+        except IOError:
+            logging.error("Unable to open " + output_file + " for writing!\n")
+            sys.exit(3)
+        tab_out.write(sep.join(CLASSIFICATION_TABLE_FIELDS) + "\n")
+        n_rows = 0
+        for fields in self.select(**filters):
+            tab_out.write(sep.join(fields) + "\n")
+            n_rows += 1
+        tab_out.close()
+        return n_rows
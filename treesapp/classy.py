@@ -18,6 +18,8 @@ from treesapp import fasta
 from treesapp.utilities import median, write_dict_to_table, validate_new_dir, fetch_executable_path
 from treesapp.lca_calculations import determine_offset, optimal_taxonomic_assignment
 from treesapp import entrez_utils
+from treesapp import profiler
+from treesapp.checkpoint import CheckpointManifest
 from treesapp.wrapper import estimate_ml_model
 
 
@@ -342,6 +344,8 @@ class TreeSAPP:
         self.stages = dict()  # Used to track what progress stages need to be completed
         self.stage_file = ""  # The file to write progress updates to
         self.current_stage = None
+        self.profiler = profiler.StageProfiler(cmd)
+        self.checkpoints = None  # A CheckpointManifest, once loaded
 
     def get_info(self):
         info_string = "Executables:\n\t" + "\n\t".join([k + ": " + v for k, v in self.executables.items()]) + "\n"
@@ -382,6 +386,11 @@ class TreeSAPP:
                                 "Only the first one ({}) will be used.\n".format(self.command, args.pkg_path))
             args.pkg_path = args.pkg_path.pop(0)
 
+        if getattr(args, "taxdump", None):
+            entrez_utils.configure_local_taxonomy(args.taxdump)
+        if getattr(args, "entrez_cache", None):
+            entrez_utils.configure_entrez_cache(args.entrez_cache, args.entrez_ttl)
+
         self.executables = self.find_executables(args)
         return
 
@@ -521,8 +530,62 @@ class TreeSAPP:
         return
 
     def stage_status(self, name):
+        """
+        Returns whether the stage is to be run.
+
+        :param name: Name of a stage
+        :return: Boolean indicating whether the stage should be run
+        """
         return self.stage_lookup(name).run
 
+    def profile_stage(self, name: str) -> None:
+        """
+        Stops profiling the current stage and begins profiling the stage called name, unless it has already been profiled.
+        This is called where each stage begins, and end_profile_stage where it ends.
+
+        :param name: Name of the stage
+        :return: None
+        """
+        if name in self.profiler.started:
+            return
+        if os.path.isdir(self.output_dir):
+            self.profiler.log_commands(self.profile_prefix() + "_commands.jsonl")
+        self.profiler.start(name)
+        return
+
+    def end_profile_stage(self) -> None:
+        self.profiler.stop()
+        return
+
+    def profile_prefix(self) -> str:
+        return os.path.join(self.output_dir, "TreeSAPP_{}_profile".format(self.command))
+
+    def write_profile(self) -> None:
+        """
+        Writes the wall time, CPU time, peak RSS and I/O of each stage, and each external command that was run,
+        to a JSON and a tab-separated file in the output directory, alongside the log.
+        On Linux the peak RSS of TreeSAPP is measured for each stage alone, while that of the child processes
+        (child_max_rss_kb) is cumulative; the peak of each external command is in its own record.
+
+        :return: None
+        """
+        if not os.path.isdir(self.output_dir):
+            return
+        records = self.profiler.write(self.profile_prefix())
+        for record in records:
+            if record["kind"] == "stage":
+                logging.debug("\tStage '{}' completed in {}s.\n".format(record["name"], round(record["wall_time"], 2)))
+        return
+
+    def load_checkpoints(self) -> None:
+        """
+        Loads the manifest of units completed by previous runs that wrote to the same intermediates directory.
+
+        :return: None
+        """
+        self.checkpoints = CheckpointManifest(os.path.join(self.var_output_dir, "checkpoints.json"))
+        return
+
     def change_stage_status(self, name: str, new_status: bool):
         stage = self.stage_lookup(name)
         stage.run = new_status
@@ -599,6 +662,8 @@ class TreeSAPP:
         # Extra executables necessary for certain modes of TreeSAPP
         if self.command == "abundance":
             dependencies += ["bwa"]
+            if hasattr(args, "keep_bam") and args.keep_bam:
+                dependencies.append("samtools")
 
         if self.command in ["create", "update", "train", "evaluate"]:
             dependencies += ["mmseqs", "mafft"]
@@ -656,12 +721,18 @@ class TreeSAPP:
             self.ref_pkg.taxa_trie.build_multifurcating_trie()
 
         if self.stage_status("lineages"):
+            self.profile_stage("lineages")
+            # Sequences already in the reference package don't need their accessions queried again
+            if entrez_utils.entrez_cache() and self.ref_pkg.lineage_ids:
+                entrez_utils.entrez_cache().prewarm_from_refpkg(self.ref_pkg, entrez_utils.validate_target_db(molecule))
             entrez_query_list, num_lineages_provided = entrez_utils.build_entrez_queries(entrez_record_dict)
             logging.debug("\tNumber of queries =\t" + str(len(entrez_query_list)) + "\n")
 
             if len(entrez_query_list) >= 1:
                 entrez_utils.map_accessions_to_lineages(entrez_query_list, self.ref_pkg.taxa_trie,
                                                         molecule, acc_to_taxid)
+                self.ref_pkg.entrez_accessions = sorted(set(self.ref_pkg.entrez_accessions).union(
+                    {e_record.accession for e_record in entrez_query_list if e_record.lineage}))
                 # Repair entrez_record instances either lacking lineages or whose lineages do not contain rank-prefixes
                 entrez_utils.repair_lineages(entrez_record_dict, self.ref_pkg.taxa_trie)
                 self.seq_lineage_map = entrez_utils.entrez_records_to_accession_lineage_map(entrez_query_list)
@@ -679,6 +750,7 @@ class TreeSAPP:
             # Write the accession-lineage mapping file - essential for training too
             write_dict_to_table(self.seq_lineage_map, self.acc_to_lin)
             self.increment_stage_dir()
+            self.end_profile_stage()
         elif self.stage_status("lineages") is False and os.path.isfile(self.acc_to_lin):
             logging.info("Reading cached lineages in '{}'... ".format(self.acc_to_lin))
             self.seq_lineage_map.update(entrez_utils.read_accession_taxa_map(self.acc_to_lin))
@@ -741,6 +813,7 @@ class Updater(TreeSAPP):
 2. update date
 3. code name
 4. description
+5. accessions whose lineages were fetched from Entrez
         :return: None
         """
         # Change the creation and update dates, code name and description
@@ -748,6 +821,8 @@ class Updater(TreeSAPP):
         self.updated_refpkg.update = dt.now().strftime("%Y-%m-%d")
         self.updated_refpkg.refpkg_code = self.ref_pkg.refpkg_code
         self.updated_refpkg.description = self.ref_pkg.description
+        self.updated_refpkg.entrez_accessions = sorted(set(self.updated_refpkg.entrez_accessions).union(
+            self.ref_pkg.entrez_accessions))
         self.updated_refpkg.pickle_package()
 
         logging.info("Summary of the updated reference package:\n" + self.updated_refpkg.get_info() + "\n")
@@ -1438,6 +1513,12 @@ class Abundance(TreeSAPP):
             logging.error("Unable to find classified sequences FASTA file in %s.\n" % self.final_output_dir)
         self.classifications = self.output_dir + "final_outputs" + os.sep + "marker_contig_map.tsv"
 
+        if not args.reads and not args.reads_table:
+            logging.error("Either a FASTQ file (--reads) or a table of read sets (--reads_table) is required.\n")
+            sys.exit(5)
+        if args.reads_table and args.stream:
+            logging.warning("Alignments of multiple read sets are not streamed; --stream will be ignored.\n")
+
         if not os.path.isdir(self.var_output_dir):
             os.makedirs(self.var_output_dir)
 
@@ -31,6 +31,9 @@ from treesapp import clade_exclusion_evaluator as ts_clade_ex
 from treesapp import assign as ts_assign_mod
 from treesapp import create_refpkg as ts_create_mod
 from treesapp import update_refpkg as ts_update_mod
+from treesapp.classification_store import ClassificationStore
+from treesapp.external_command_interface import CommandScheduler
+from treesapp.placement_cache import PlacementCache, merge_cached_pqueries
 
 
 def info(sys_args):
@@ -47,7 +50,6 @@ def info(sys_args):
     import Bio
     import numpy
     import packaging
-    import pygtrie
     import scipy
     import ete3
     import sklearn
@@ -65,7 +67,6 @@ def info(sys_args):
                "numpy": numpy.__version__,
                "packaging": packaging.__version__,
                "pyfastx": pyfastx.version(),
-               "pygtrie": pygtrie.__version__,
                "samsum": samsum.__version__,
                "scikit-learn": sklearn.__version__,
                "scipy": scipy.__version__,
@@ -172,11 +173,13 @@ def train(sys_args):
     # STAGE 1: Optionally validate and reformat the input FASTA
     ##
     if ts_trainer.stage_status("clean"):
+        ts_trainer.profile_stage("clean")
         logging.info("Reading and formatting {}... ".format(ts_trainer.input_sequences))
         train_seqs.header_registry = fasta.format_fasta(fasta_input=ts_trainer.input_sequences, molecule="prot",
                                                         output_fasta=ts_trainer.formatted_input)
         logging.info("done.\n")
         ts_trainer.increment_stage_dir()
+        ts_trainer.end_profile_stage()
     else:
         ts_trainer.formatted_input = ts_trainer.input_sequences
         train_seqs.header_registry = fasta.register_headers(fasta.get_headers(ts_trainer.formatted_input), True)
@@ -186,13 +189,13 @@ def train(sys_args):
     # STAGE 2: Run hmmsearch on the query sequences to search for reference package homologs
     ##
     if ts_trainer.stage_status("search"):
+        ts_trainer.profile_stage("search")
         logging.info("Searching for homologous sequences with hmmsearch... ")
-        hmm_domtbl_files = wrapper.run_hmmsearch(ts_trainer.executables["hmmsearch"],
-                                                 ts_trainer.ref_pkg.f__search_profile,
-                                                 ts_trainer.formatted_input,
-                                                 ts_trainer.stage_output_dir)
+        domain_table = wrapper.stream_hmmsearch(ts_trainer.executables["hmmsearch"],
+                                                ts_trainer.ref_pkg.f__search_profile,
+                                                ts_trainer.formatted_input)
         logging.info("done.\n")
-        hmm_matches = file_parsers.parse_domain_tables(args, hmm_domtbl_files)
+        hmm_matches = file_parsers.parse_domain_tables(args, [domain_table])
         ts_assign_mod.load_homologs(hmm_matches, ts_trainer.formatted_input, train_seqs)
 
         logging.info(train_seqs.summarize_fasta_sequences())
@@ -200,6 +203,7 @@ def train(sys_args):
         train_seqs.file = ts_trainer.hmm_purified_seqs
         utilities.hmm_pile(hmm_matches)
         ts_trainer.increment_stage_dir()
+        ts_trainer.end_profile_stage()
     else:
         if not os.path.isfile(ts_trainer.hmm_purified_seqs):
             ts_trainer.hmm_purified_seqs = ts_trainer.input_sequences
@@ -236,6 +240,7 @@ def train(sys_args):
 
     # Goal is to use the distances already calculated but re-print
     if ts_trainer.stage_status("place"):
+        ts_trainer.profile_stage("place")
         clade_ex_pqueries = dict()
         if os.path.isfile(ts_trainer.placement_summary):
             # Read the summary file and pull the phylogenetic distances for each rank
@@ -289,6 +294,7 @@ def train(sys_args):
         cl_log.disabled = False
         logging.info("done.\n")
         ts_trainer.increment_stage_dir()
+        ts_trainer.end_profile_stage()
     else:
         logging.info("Phylogenetic placement stage is being skipped. Reading saved pickles... ")
         # Load saved pquery instances from a previous run
@@ -301,6 +307,7 @@ def train(sys_args):
     ts_trainer.pqueries.update(plain_pqueries)
 
     if ts_trainer.stage_status("train"):
+        ts_trainer.profile_stage("train")
         # Finish up the linear regression model
         ts_trainer.ref_pkg.pfit = placement_trainer.complete_regression(taxa_evo_dists, ts_trainer.training_ranks)
         if ts_trainer.ref_pkg.pfit:
@@ -348,10 +355,12 @@ def train(sys_args):
                                                                         grid_search=args.grid_search,
                                                                         num_procs=args.num_threads)
         ts_trainer.increment_stage_dir()
+        ts_trainer.end_profile_stage()
     else:
         refpkg_classifiers = {}
 
     if ts_trainer.stage_status("update"):
+        ts_trainer.profile_stage("update")
         if not ts_trainer.ref_pkg.pfit:
             logging.warning("Linear regression parameters could not be estimated. " +
                             "Taxonomic ranks will not be distance-adjusted during classification for this package.\n")
@@ -363,6 +372,7 @@ def train(sys_args):
 
         ts_trainer.ref_pkg.validate()
         ts_trainer.ref_pkg.pickle_package()
+        ts_trainer.end_profile_stage()
 
     # Write the text file containing distances used in the regression analysis
     with open(ts_trainer.placement_summary, 'w') as out_handler:
@@ -377,6 +387,7 @@ def train(sys_args):
     if args.delete and os.path.isdir(ts_trainer.var_output_dir):
         shutil.rmtree(ts_trainer.var_output_dir)
 
+    ts_trainer.write_profile()
     return
 
 
@@ -405,6 +416,7 @@ def create(sys_args):
     ref_seqs = fasta.FASTA(args.input)
 
     if ts_create.stage_status("search"):
+        ts_create.profile_stage("search")
         profile_match_dict = dict()
         # Read the FASTA into a dictionary - homologous sequences will be extracted from this
         ref_seqs.fasta_dict = fasta.format_read_fasta(args.input, ts_create.ref_pkg.molecule)
@@ -412,16 +424,17 @@ def create(sys_args):
         logging.debug("Raw, unfiltered sequence summary:\n" + ref_seqs.summarize_fasta_sequences())
 
         logging.info("Searching for domain sequences... ")
-        hmm_domtbl_files = wrapper.run_hmmsearch(ts_create.executables["hmmsearch"], ts_create.hmm_profile,
-                                                 args.input, ts_create.var_output_dir, args.num_threads)
+        domain_table = wrapper.stream_hmmsearch(ts_create.executables["hmmsearch"], ts_create.hmm_profile,
+                                                args.input, args.num_threads)
         logging.info("done.\n")
-        hmm_matches = file_parsers.parse_domain_tables(args, hmm_domtbl_files)
+        hmm_matches = file_parsers.parse_domain_tables(args, [domain_table])
         for k, v in utilities.extract_hmm_matches(hmm_matches, ref_seqs.fasta_dict, ref_seqs.header_registry).items():
             profile_match_dict.update(v)
         fasta.write_new_fasta(profile_match_dict, ts_create.hmm_purified_seqs)
         profile_match_dict.clear()
 
         utilities.hmm_pile(hmm_matches)
+        ts_create.end_profile_stage()
     else:
         ts_create.hmm_purified_seqs = ts_create.input_sequences
 
@@ -466,6 +479,7 @@ def create(sys_args):
     prefilter_ref_seqs = entrez_utils.entrez_record_snapshot(fasta_records)
 
     if ts_create.stage_status("clean"):
+        ts_create.profile_stage("clean")
         # Remove the sequences failing 'filter' and/or only retain the sequences in 'screen'
         fasta_records = ts_create_mod.screen_filter_taxa(fasta_records, args.screen, args.filter, ref_seqs.amendments)
         # Remove the sequence records with low resolution lineages, according to args.min_taxonomic_rank
@@ -475,6 +489,7 @@ def create(sys_args):
         if len(fasta_records.keys()) < 2:
             logging.error("{} sequences post-homology + taxonomy filtering\n".format(len(fasta_records)))
             sys.exit(11)
+        ts_create.end_profile_stage()
         # Write a new FASTA file containing the sequences that passed the homology and taxonomy filters
 
     ref_seqs.file = ts_create.filtered_fasta
@@ -489,6 +504,7 @@ def create(sys_args):
     # Optionally cluster the input sequences using MMSeqs' linclust at the specified identity
     ##
     if ts_create.stage_status("cluster"):
+        ts_create.profile_stage("cluster")
         pre_cluster = ref_seqs.n_seqs()
         ref_seqs.change_dict_keys("num")
         # Write a FASTA for clustering containing the formatted headers since
@@ -540,12 +556,15 @@ def create(sys_args):
         ref_seqs.keep_only(header_subset=[x for x in fasta_records if fasta_records[x].cluster_rep])
         post_cluster = ref_seqs.n_seqs()
         ts_create.overcluster_warning(pre_cluster, post_cluster)
+        ts_create.end_profile_stage()
 
     if ts_create.stage_status("build"):
+        ts_create.profile_stage("build")
         if args.od_seq:
             ts_create_mod.remove_outlier_sequences(fasta_records,
                                                    ts_create.executables["OD-seq"], ts_create.executables["mafft"],
-                                                   ts_create.var_output_dir, args.num_threads)
+                                                   ts_create.var_output_dir, args.num_threads,
+                                                   ts_create_mod.OUTLIER_PARTITION_SIZE if args.profile_align else 0)
 
         # This precautionary measure is for `create` called from `update` and reference seqs have the assign signature
         accession_ids = [fasta_records[num_id].accession for num_id in fasta_records]
@@ -579,7 +598,13 @@ def create(sys_args):
         else:
             ts_create_mod.create_new_ref_fasta(ts_create.unaln_ref_fasta, fasta_replace_dict)
 
-        if args.multiple_alignment is False:
+        if args.multiple_alignment is False and args.profile_align:
+            logging.info("Aligning the sequences to the HMM profile... ")
+            ts_create_mod.profile_align_references(fasta_replace_dict, ts_create.executables, ts_create.hmm_profile,
+                                                   ts_create.ref_pkg.f__msa, ts_create.var_output_dir,
+                                                   args.num_threads)
+            logging.info("done.\n")
+        elif args.multiple_alignment is False:
             logging.info("Aligning the sequences using MAFFT... ")
             ts_create_mod.run_mafft(ts_create.executables["mafft"],
                                     ts_create.unaln_ref_fasta, ts_create.ref_pkg.f__msa, args.num_threads)
@@ -651,22 +676,27 @@ def create(sys_args):
         ts_create.determine_model(ts_create.ref_pkg)
         best_tree = ts_create.ref_pkg.infer_phylogeny(ts_create.phylip_file, ts_create.executables, ts_create.phy_dir,
                                                       args.num_threads)
+        ts_create.end_profile_stage()
 
     if ts_create.stage_status("evaluate"):
+        ts_create.profile_stage("evaluate")
         # Evaluate the model parameters with RAxML-NG. Output is required by EPA-NG
         wrapper.model_parameters(ts_create.executables["raxml-ng"],
                                  ts_create.phylip_file, best_tree, ts_create.phy_dir + ts_create.ref_pkg.prefix,
                                  ts_create.ref_pkg.sub_model, args.num_threads)
+        ts_create.end_profile_stage()
     ts_create.ref_pkg.recover_raxmlng_model_outputs(ts_create.phy_dir)
     ts_create.ref_pkg.recover_raxmlng_tree_outputs(ts_create.phy_dir)
 
     if ts_create.stage_status("support"):
+        ts_create.profile_stage("support")
         # Perform non-parametric bootstrapping with RAxML-NG and calculate branch support values from bootstraps
         wrapper.support_tree_raxml(raxml_exe=ts_create.executables["raxml-ng"], model=ts_create.ref_pkg.sub_model,
                                    ref_tree=best_tree, ref_msa=ts_create.phylip_file,
                                    tree_prefix=ts_create.phy_dir + ts_create.ref_pkg.prefix,
                                    mre=True, n_bootstraps=args.bootstraps, num_threads=args.num_threads)
         ts_create.ref_pkg.recover_raxmlng_supports(ts_create.phy_dir)
+        ts_create.end_profile_stage()
 
     ts_create.ref_pkg.band()
     # Build the regression model of placement distances to taxonomic ranks
@@ -680,7 +710,9 @@ def create(sys_args):
         trainer_cmd.append("--trim_align")
 
     if ts_create.stage_status("train"):
+        ts_create.profile_stage("train")
         train(trainer_cmd)
+        ts_create.end_profile_stage()
     else:
         logging.info("Skipping training:\n$ treesapp train {}.\n".format(' '.join(trainer_cmd)))
 
@@ -688,16 +720,19 @@ def create(sys_args):
     # Finish validating the file and append the reference package build parameters to the master table
     ##
     if ts_create.stage_status("update"):
+        ts_create.profile_stage("update")
         ts_create.ref_pkg.f__json = os.path.join(ts_create.var_output_dir, "placement_trainer", "final_outputs",
                                                  ts_create.ref_pkg.prefix + ts_create.ref_pkg.refpkg_suffix)
         ts_create.ref_pkg.slurp()
         ts_create.ref_pkg.validate()
         ts_create.ref_pkg.change_file_paths(ts_create.final_output_dir)
         ts_create.ref_pkg.pickle_package()
+        ts_create.end_profile_stage()
 
     ts_create.remove_intermediates(args.delete)
     ts_create.print_terminal_commands()
 
+    ts_create.write_profile()
     return
 
 
@@ -911,6 +946,7 @@ def update(sys_args):
     ts_updater.updated_refpkg.slurp()
     ts_updater.update_refpkg_fields()
 
+    ts_updater.write_profile()
     return
 
 
@@ -1102,6 +1138,47 @@ def layer(sys_args):
     return
 
 
+def itol(sys_args):
+    """
+    TreeSAPP subcommand for generating the inputs for the interactive tree of life (iTOL) webservice from the outputs
+    of a *treesapp assign* run. The classified sequences are read from the classification table and their placements
+    are parsed from the JPlace files in the intermediates directory.
+    """
+    parser = treesapp_args.TreeSAPPArgumentParser(description="Generate iTOL inputs from TreeSAPP classifications.")
+    treesapp_args.add_itol_arguments(parser)
+    args = parser.parse_args(sys_args)
+
+    ts_itol = classy.TreeSAPP("itol")
+    ts_itol.output_dir = args.output
+    if ts_itol.output_dir[-1] != os.sep:
+        ts_itol.output_dir += os.sep
+    ts_itol.var_output_dir = ts_itol.output_dir + "intermediates" + os.sep
+    ts_itol.final_output_dir = ts_itol.output_dir + "final_outputs" + os.sep
+
+    log_file_name = ts_itol.output_dir + "TreeSAPP_itol_log.txt"
+    classy.prep_logging(log_file_name, args.verbose)
+    logging.info("\n##\t\t\tGenerating iTOL inputs for TreeSAPP classifications\t\t\t##\n\n")
+
+    ts_itol.validate_refpkg_dir(args.refpkg_dir)
+    classification_table = ts_itol.final_output_dir + "marker_contig_map.tsv"
+    if not file_parsers.classification_table_variants(classification_table):
+        logging.error("Could not find a classification file in " + ts_itol.final_output_dir + "\n")
+        sys.exit(3)
+    if not os.path.isdir(ts_itol.var_output_dir):
+        logging.error("Could not find the intermediates directory containing the JPlace files in " +
+                      ts_itol.output_dir + "\n")
+        sys.exit(3)
+
+    classified_lines = file_parsers.read_classification_table(classification_table)
+    refpkg_dict = file_parsers.gather_ref_packages(ts_itol.refpkg_dir,
+                                                   targets=list(set([fields[2] for fields in classified_lines])))
+    tree_saps, itol_data = ts_assign_mod.rebuild_itol_data(ts_itol.var_output_dir, refpkg_dict, classified_lines,
+                                                           mode=args.p_sum)
+    ts_assign_mod.produce_itol_inputs(tree_saps, refpkg_dict, itol_data,
+                                      ts_itol.output_dir + 'iTOL_output' + os.sep, ts_itol.refpkg_dir)
+    return
+
+
 def assign(sys_args):
     # STAGE 1: Prompt the user and prepare files and lists for the pipeline
     parser = treesapp_args.TreeSAPPArgumentParser(description='Classify sequences through evolutionary placement.')
@@ -1118,6 +1195,7 @@ def assign(sys_args):
 
     treesapp_args.check_parser_arguments(args, sys_args)
     ts_assign.check_classify_arguments(args)
+    ts_assign.load_checkpoints()
     ts_assign.decide_stage(args)
 
     refpkg_dict = file_parsers.gather_ref_packages(ts_assign.refpkg_dir, ts_assign.target_refpkgs)
@@ -1127,16 +1205,25 @@ def assign(sys_args):
     ##
     # STAGE 2: Predict open reading frames (ORFs) if the input is an assembly, read, format and write the FASTA
     ##
+    orf_header_registry = dict()
     if ts_assign.stage_status("orf-call"):
-        ts_assign.predict_orfs(args.composition, args.num_threads)
+        ts_assign.profile_stage("orf-call")
+        # The predicted ORFs are formatted as Prodigal writes them if the clean stage is to be run
+        orf_header_registry = ts_assign.predict_orfs(args.composition, args.num_threads,
+                                                     format_orfs=ts_assign.stage_lookup("clean").run)
+        ts_assign.end_profile_stage()
 
     query_seqs = fasta.FASTA(ts_assign.query_sequences)
     # Read the query sequences provided and (by default) write a new FASTA file with formatted headers
-    if ts_assign.stage_status("clean"):
+    if ts_assign.stage_status("clean") and orf_header_registry:
+        query_seqs.header_registry = orf_header_registry
+    elif ts_assign.stage_status("clean"):
+        ts_assign.profile_stage("clean")
         logging.info("Reading and formatting {}... ".format(ts_assign.query_sequences))
         query_seqs.header_registry = fasta.format_fasta(fasta_input=ts_assign.query_sequences, molecule="prot",
                                                         output_fasta=ts_assign.formatted_input)
         logging.info("done.\n")
+        ts_assign.end_profile_stage()
     else:
         ts_assign.formatted_input = ts_assign.query_sequences
         query_seqs.load_fasta()
@@ -1145,31 +1232,52 @@ def assign(sys_args):
     ##
     # STAGE 3: Run hmmsearch on the query sequences to search for marker homologs
     ##
+    placement_cache = None
+    cached_pqueries = dict()
+    cache_params = {"p_sum": args.p_sum, "min_lwr": args.min_lwr, "svm": args.svm, "trim_align": args.trim_align}
+    if args.placement_cache:
+        placement_cache = PlacementCache(args.placement_cache, args.cache_size)
     if ts_assign.stage_status("search"):
+        ts_assign.profile_stage("search")
         hmm_domtbl_files = wrapper.hmmsearch_orfs(ts_assign.executables["hmmsearch"],
                                                   refpkg_dict, ts_assign.formatted_input,
-                                                  ts_assign.var_output_dir, args.num_threads, args.max_e)
+                                                  ts_assign.var_output_dir, args.num_threads, args.max_e,
+                                                  ts_assign.checkpoints)
         hmm_matches = file_parsers.parse_domain_tables(args, hmm_domtbl_files)
         ts_assign_mod.load_homologs(hmm_matches, ts_assign.formatted_input, query_seqs)
         pqueries = ts_assign_mod.load_pqueries(hmm_matches, query_seqs)
         query_seqs.change_dict_keys("num")
         extracted_seq_dict, numeric_contig_index = ts_assign_mod.bin_hmm_matches(hmm_matches, query_seqs.fasta_dict)
         numeric_contig_index = ts_assign_mod.replace_contig_names(numeric_contig_index, query_seqs)
-        homolog_seq_files = ts_assign_mod.write_grouped_fastas(extracted_seq_dict, numeric_contig_index,
+        if placement_cache:
+            # Only the query sequences that weren't classified by a previous run are aligned and placed
+            cached_pqueries = placement_cache.lookup(pqueries, refpkg_dict, cache_params)
+            logging.info("\t{} query sequences were classified by previous runs.\n".format(len(cached_pqueries)))
+        uncached_seq_dict = ts_assign_mod.exclude_cached_queries(extracted_seq_dict, numeric_contig_index,
+                                                                 cached_pqueries)
+        # Identical query sequences are placed once, by a representative, and expanded after classification
+        derep_seq_dict, query_members = ts_assign_mod.dereplicate_queries(uncached_seq_dict, numeric_contig_index)
+        homolog_seq_files = ts_assign_mod.write_grouped_fastas(derep_seq_dict, numeric_contig_index,
                                                                refpkg_dict, ts_assign.var_output_dir)
+        if cached_pqueries and not homolog_seq_files:
+            ts_assign.change_stage_status("align", False)
+            ts_assign.change_stage_status("place", False)
         # TODO: Replace this merge_fasta_dicts_by_index with FASTA - only necessary for writing the classified sequences
         extracted_seq_dict = fasta.merge_fasta_dicts_by_index(extracted_seq_dict, numeric_contig_index)
         ts_assign_mod.delete_files(args.delete, ts_assign.var_output_dir, 1)
+        ts_assign.end_profile_stage()
     ##
     # STAGE 4: Run hmmalign, and optionally BMGE, to produce the MSAs for phylogenetic placement
     ##
     combined_msa_files = dict()
     split_msa_files = dict()
     if ts_assign.stage_status("align"):
+        ts_assign.profile_stage("align")
         ts_assign_mod.create_ref_phy_files(refpkg_dict, ts_assign.var_output_dir,
                                            homolog_seq_files, ref_alignment_dimensions)
         concatenated_msa_files = ts_assign_mod.multiple_alignments(ts_assign.executables, homolog_seq_files,
-                                                                   refpkg_dict, "hmmalign", args.num_threads)
+                                                                   refpkg_dict, "hmmalign", args.num_threads,
+                                                                   ts_assign.checkpoints)
         file_type = utilities.find_msa_type(concatenated_msa_files)
         alignment_length_dict = ts_assign_mod.get_sequence_counts(concatenated_msa_files, ref_alignment_dimensions,
                                                                   args.verbose, file_type)
@@ -1177,7 +1285,8 @@ def assign(sys_args):
         if args.trim_align:
             tool = "BMGE"
             trimmed_mfa_files = wrapper.filter_multiple_alignments(ts_assign.executables, concatenated_msa_files,
-                                                                   refpkg_dict, args.num_threads, tool)
+                                                                   refpkg_dict, args.num_threads, tool,
+                                                                   ts_assign.checkpoints)
             qc_ma_dict = ts_assign_mod.check_for_removed_sequences(trimmed_mfa_files, concatenated_msa_files,
                                                                    refpkg_dict, args.min_seq_length)
             ts_assign_mod.evaluate_trimming_performance(qc_ma_dict, alignment_length_dict, concatenated_msa_files, tool)
@@ -1198,22 +1307,33 @@ def assign(sys_args):
                 split_msa_files[denominator].append(split_msa)
         combined_msa_files.clear()
         ts_assign_mod.delete_files(args.delete, ts_assign.var_output_dir, 3)
+        ts_assign.end_profile_stage()
 
     ##
     # STAGE 5: Run EPA-ng to compute the ML estimations
     ##
     if ts_assign.stage_status("place"):
+        ts_assign.profile_stage("place")
         wrapper.launch_evolutionary_placement_queries(ts_assign.executables, split_msa_files, refpkg_dict,
-                                                      ts_assign.var_output_dir, args.num_threads)
+                                                      ts_assign.var_output_dir, args.num_threads,
+                                                      ts_assign.checkpoints)
         jplace_utils.sub_indices_for_seq_names_jplace(ts_assign.var_output_dir, numeric_contig_index, refpkg_dict)
+        ts_assign.end_profile_stage()
 
     if ts_assign.stage_status("classify"):
+        ts_assign.profile_stage("classify")
         itol_out_dir = ts_assign.output_dir + 'iTOL_output' + os.sep
-        tree_saps, itol_data = ts_assign_mod.parse_raxml_output(ts_assign.var_output_dir, refpkg_dict, pqueries)
-        # Set PQuery.consensus_placement attributes
-        ts_assign_mod.select_query_placements(tree_saps, refpkg_dict, mode=args.p_sum)
-        ts_assign_mod.filter_placements(tree_saps, refpkg_dict, ts_assign.svc_filter, args.min_lwr)
-        ts_assign_mod.determine_confident_lineage(tree_saps, refpkg_dict)
+        # Parse the JPlace files, set PQuery.consensus_placement, filter and determine lineages for each refpkg
+        tree_saps, itol_data = ts_assign_mod.classify_pqueries(ts_assign.var_output_dir, refpkg_dict, pqueries,
+                                                               mode=args.p_sum, svc=ts_assign.svc_filter,
+                                                               min_lwr=args.min_lwr, num_proc=args.num_threads,
+                                                               itol=not args.skip_itol)
+        if placement_cache:
+            placement_cache.store(tree_saps, refpkg_dict, cache_params)
+        ts_assign_mod.expand_dereplicated_pqueries(tree_saps, query_members, pqueries)
+        if placement_cache:
+            merge_cached_pqueries(tree_saps, cached_pqueries)
+            placement_cache.close()
 
         ts_assign.write_classified_orfs(tree_saps, extracted_seq_dict)
         abundance_dict = dict()
@@ -1230,20 +1350,71 @@ def assign(sys_args):
                               "--report", "nothing"]
             if args.reverse:
                 abundance_args += ["--reverse", args.reverse]
+            if args.stream:
+                abundance_args.append("--stream")
+            if args.keep_bam:
+                abundance_args.append("--keep_bam")
             abundance_dict = abundance(abundance_args)
         ts_assign_mod.abundify_tree_saps(tree_saps, abundance_dict)
 
-        ts_assign_mod.write_classification_table(tree_saps, ts_assign.sample_prefix,
-                                                 output_file=ts_assign.final_output_dir + os.sep + "marker_contig_map.tsv")
-
-        ts_assign_mod.produce_itol_inputs(tree_saps, refpkg_dict, itol_data, itol_out_dir, ts_assign.refpkg_dir)
+        for table_format in args.table_formats:
+            ts_assign_mod.write_classification_table(tree_saps, ts_assign.sample_prefix,
+                                                     output_file=os.path.join(ts_assign.final_output_dir,
+                                                                              "marker_contig_map." + table_format))
+        if args.classification_store:
+            with ClassificationStore(args.classification_store) as classification_store:
+                classification_store.append_rows(ts_assign_mod.classification_table_rows(tree_saps,
+                                                                                         ts_assign.sample_prefix),
+                                                 source=os.path.abspath(os.path.join(ts_assign.final_output_dir,
+                                                                                     "marker_contig_map.tsv")))
+
+        if not args.skip_itol:
+            ts_assign_mod.produce_itol_inputs(tree_saps, refpkg_dict, itol_data, itol_out_dir, ts_assign.refpkg_dir)
         ts_assign_mod.delete_files(args.delete, ts_assign.var_output_dir, 4)
+        ts_assign.end_profile_stage()
 
     ts_assign_mod.delete_files(args.delete, ts_assign.var_output_dir, 5)
 
+    ts_assign.write_profile()
     return
 
 
+def batch_abundance(ts_abund: classy.Abundance, args) -> dict:
+    """
+    Calculates the abundance of the classified sequences in each of the read sets listed in a table.
+    The classified sequences are indexed once, the read sets are aligned concurrently within the thread budget and
+    each alignment map is summarized by samsum as soon as it is written. The abundances are written as a matrix with a
+    row for each classified sequence and a column for each sample to final_outputs/abundance_matrix.tsv.
+
+    :param ts_abund: An Abundance instance with its arguments checked
+    :param args: The parsed treesapp abundance arguments
+    :return: A dictionary of dictionaries, mapping the sequence names to FPKM values, indexed by the sample names
+    """
+    read_sets = file_parsers.read_reads_table(args.reads_table)
+    if not read_sets:
+        logging.warning("No read sets were found in '{}'.\n".format(args.reads_table))
+        return {}
+
+    ts_abund.profile_stage("align_map")
+    # Samples are written to the matrix in the order of the table, not the order their alignments finish
+    sample_abundances = {sample_name: {} for sample_name, _, _ in read_sets}
+    ref_names = []
+    for sample_name, sam_file in ts_assign_mod.map_read_sets(ts_abund.executables["bwa"], ts_abund.classified_nuc_seqs,
+                                                             ts_abund.var_output_dir, read_sets, args.pairing,
+                                                             args.num_threads, ts_abund.checkpoints):
+        ref_seq_abunds = samsum_cmd.ref_sequence_abundances(aln_file=sam_file, seq_file=ts_abund.classified_nuc_seqs,
+                                                            min_aln=10, p_cov=50, map_qual=1, multireads=False)
+        sample_abundances[sample_name] = {ref_seq.name: ref_seq.fpkm for ref_seq in ref_seq_abunds.values()}
+        if not ref_names:
+            ref_names = [ref_seq.name for ref_seq in ref_seq_abunds.values()]
+        ref_seq_abunds.clear()
+
+    ts_assign_mod.delete_files(args.delete, ts_abund.var_output_dir, 4)
+    ts_assign_mod.write_abundance_matrix(sample_abundances, ref_names,
+                                         os.path.join(ts_abund.final_output_dir, "abundance_matrix.tsv"))
+    return sample_abundances
+
+
 def abundance(sys_args):
     """
     TreeSAPP subcommand that is used to add read-inferred abundance information (e.g. FPKM, TPM) to classified sequences
@@ -1260,8 +1431,11 @@ def abundance(sys_args):
     Optionally, `treesapp abundance` can be called with `--report nothing` and a dictionary containing the abundance
     values would be returned.
 
+    Many read sets can instead be provided in a table with `--reads_table`. See batch_abundance.
+
     :param sys_args: treesapp abundance arguments with the treesapp subcommand removed
-    :return: A dictionary containing the abundance values indexed by the reference sequence (e.g. ORF, contig) names
+    :return: A dictionary containing the abundance values indexed by the reference sequence (e.g. ORF, contig) names,
+     or with `--reads_table`, a dictionary of these dictionaries indexed by the sample names
     """
     parser = treesapp_args.TreeSAPPArgumentParser(description="Calculate classified sequence abundances from read coverage.")
     treesapp_args.add_abundance_arguments(parser)
@@ -1276,33 +1450,54 @@ def abundance(sys_args):
 
     treesapp_args.check_parser_arguments(args, sys_args)
     ts_abund.check_arguments(args)
-    # TODO: Implement check-pointing for abundance
-    # ts_abund.decide_stage(args)
+    ts_abund.load_checkpoints()
 
-    sam_file = ts_assign_mod.align_reads_to_nucs(ts_abund.executables["bwa"], ts_abund.classified_nuc_seqs,
-                                                 ts_abund.var_output_dir, args.reads, args.pairing, args.reverse,
-                                                 args.num_threads)
-    ts_abund.sample_prefix = ts_abund.fq_suffix_re.sub('', '.'.join(os.path.basename(args.reads).split('.')[:-1]))
+    if args.reads_table:
+        sample_abundances = batch_abundance(ts_abund, args)
+        ts_abund.write_profile()
+        return sample_abundances
 
-    if os.path.isfile(sam_file):
+    ts_abund.sample_prefix = ts_abund.fq_suffix_re.sub('', '.'.join(os.path.basename(args.reads).split('.')[:-1]))
+    ts_abund.profile_stage("align_map")
+    if args.stream:
+        # Alignments are counted as BWA MEM writes them so there is no separate samsum stage or SAM file
+        bam_file = None
+        if args.keep_bam:
+            bam_file = os.path.join(ts_abund.var_output_dir, ts_abund.sample_prefix + ".bam")
+        ref_seq_abunds = ts_assign_mod.stream_read_abundances(ts_abund.executables["bwa"],
+                                                              ts_abund.classified_nuc_seqs, ts_abund.var_output_dir,
+                                                              args.reads, args.pairing, args.reverse, args.num_threads,
+                                                              p_cov=50, bam_file=bam_file,
+                                                              samtools_exe=ts_abund.executables.get("samtools"))
+    else:
+        sam_file = ts_assign_mod.align_reads_to_nucs(ts_abund.executables["bwa"], ts_abund.classified_nuc_seqs,
+                                                     ts_abund.var_output_dir, args.reads, args.pairing, args.reverse,
+                                                     args.num_threads, ts_abund.checkpoints)
+
+        ts_abund.profile_stage("sam_sum")
+        if not os.path.isfile(sam_file):
+            logging.warning("SAM file '%s' was not generated.\n" % sam_file)
+            ts_abund.write_profile()
+            return {}
         ref_seq_abunds = samsum_cmd.ref_sequence_abundances(aln_file=sam_file, seq_file=ts_abund.classified_nuc_seqs,
                                                             min_aln=10, p_cov=50, map_qual=1, multireads=False)
-        abundance_dict = {ref_seq.name: ref_seq.fpkm for ref_seq in ref_seq_abunds.values()}
-        ref_seq_abunds.clear()
-    else:
-        logging.warning("SAM file '%s' was not generated.\n" % sam_file)
-        return {}
+    abundance_dict = {ref_seq.name: ref_seq.fpkm for ref_seq in ref_seq_abunds.values()}
+    ref_seq_abunds.clear()
 
     ts_assign_mod.delete_files(args.delete, ts_abund.var_output_dir, 4)
 
     # TODO: Index each PQuery's abundance by the dataset name, write a new row for each dataset's abundance
-    if args.report != "nothing" and os.path.isfile(ts_abund.classifications):
+    classification_tables = file_parsers.classification_table_variants(ts_abund.classifications)
+    if args.report != "nothing" and classification_tables:
         assignments = file_parsers.read_classification_table(ts_abund.classifications)
         # Convert assignments to PQuery instances
         pqueries = ts_phylo_seq.assignments_to_treesaps(assignments)
         ts_assign_mod.abundify_tree_saps(pqueries, abundance_dict)
-        ts_assign_mod.write_classification_table(pqueries, ts_abund.sample_prefix, ts_abund.classifications)
+        # Overwrite each of the classification table formats so none are left with stale abundances
+        for classification_table in classification_tables:
+            ts_assign_mod.write_classification_table(pqueries, ts_abund.sample_prefix, classification_table)
 
+    ts_abund.write_profile()
     return abundance_dict
 
 
@@ -1336,6 +1531,7 @@ def purity(sys_args):
     fasta.write_new_fasta(ref_seqs.fasta_dict, ts_purity.formatted_input)
 
     if ts_purity.stage_status("assign"):
+        ts_purity.profile_stage("assign")
         assign_args = ["-i", ts_purity.formatted_input, "-o", ts_purity.assign_dir,
                        "-m", ts_purity.molecule_type, "-n", str(args.num_threads),
                        "-t", ts_purity.ref_pkg.prefix, "--refpkg_dir", ts_purity.refpkg_dir,
@@ -1347,11 +1543,13 @@ def purity(sys_args):
             assign(assign_args)
         except:  # Just in case treesapp assign fails, just continue
             logging.error("TreeSAPP failed.\n")
+        ts_purity.end_profile_stage()
 
     if ts_purity.stage_status("summarize"):
+        ts_purity.profile_stage("summarize")
         metadat_dict = dict()
         # Parse classification table and identify the groups that were assigned
-        if os.path.isfile(ts_purity.classifications):
+        if file_parsers.classification_table_variants(ts_purity.classifications):
             assigned_lines = file_parsers.read_classification_table(ts_purity.classifications)
             ts_purity.assignments = file_parsers.parse_assignments(assigned_lines)
         else:
@@ -1382,7 +1580,9 @@ def purity(sys_args):
             summary_str += ortholog_name + ":\n\t"
             summary_str += "\n\t".join(ortholog_map[ortholog_name]) + "\n"
         logging.debug(summary_str)
+        ts_purity.end_profile_stage()
 
+    ts_purity.write_profile()
     return
 
 
@@ -1446,12 +1646,16 @@ def evaluate(sys_args):
 
     # Checkpoint three: We have accessions linked to taxa, and sequences to analyze with TreeSAPP, but not classified
     if ts_evaluate.stage_status("classify"):
+        ts_evaluate.profile_stage("classify")
         # Run TreeSAPP against the provided tax_ids file and the unique taxa FASTA file
         if args.length:
             min_seq_length = str(min(args.length - 10, 30))
         else:
             min_seq_length = str(30)
 
+        # The RAxML-NG model parameters of the reference packages, with each taxon excluded, are estimated in parallel
+        model_scheduler = CommandScheduler("Clade exclusion model parameters", args.num_threads)
+        clade_tests = list()
         for rank in args.taxon_rank:
             for lineage in ts_clade_ex.get_testable_lineages_for_rank(ref_lineages, rep_accession_lineage_map, rank):
                 # Select representative sequences belonging to the taxon being tested
@@ -1522,47 +1726,53 @@ def evaluate(sys_args):
                     ce_refpkg = ts_evaluate.ref_pkg.clone(clade_exclusion_json)
                     classification_table = classifier_output + "final_outputs" + os.sep + "marker_contig_map.tsv"
 
-                    if not os.path.isfile(classification_table):
+                    if not file_parsers.classification_table_variants(classification_table):
                         # Copy reference files, then exclude all clades belonging to the taxon being tested
-
                         ce_refpkg.exclude_clade_from_ref_files(intermediates_path, lineage,
-                                                               ts_evaluate.executables, args.fresh)
+                                                               ts_evaluate.executables, args.fresh, model_scheduler)
                         # Write the query sequences
                         fasta.write_new_fasta(taxon_rep_seqs, test_rep_taxa_fasta)
-                        assign_args = ["-i", test_rep_taxa_fasta, "-o", classifier_output,
-                                       "--refpkg_dir", os.path.dirname(ce_refpkg.f__json),
-                                       "-m", ts_evaluate.molecule_type, "-n", str(args.num_threads),
-                                       "--min_seq_length", str(min_seq_length),
-                                       "--overwrite", "--delete"]
-                        if args.trim_align:
-                            assign_args.append("--trim_align")
-                        try:
-                            assign(assign_args)
-                        except:  # Just in case treesapp assign fails, just continue
-                            pass
+                    clade_tests.append((lineage, test_obj, ce_refpkg, intermediates_path,
+                                        test_rep_taxa_fasta, classifier_output, classification_table))
+        model_scheduler.run()
+
+        for lineage, test_obj, ce_refpkg, intermediates_path, test_rep_taxa_fasta, classifier_output, \
+                classification_table in clade_tests:
+            if not file_parsers.classification_table_variants(classification_table):
+                ce_refpkg.finish_clade_exclusion(intermediates_path)
+                assign_args = ["-i", test_rep_taxa_fasta, "-o", classifier_output,
+                               "--refpkg_dir", os.path.dirname(ce_refpkg.f__json),
+                               "-m", ts_evaluate.molecule_type, "-n", str(args.num_threads),
+                               "--min_seq_length", str(min_seq_length),
+                               "--overwrite", "--delete"]
+                if args.trim_align:
+                    assign_args.append("--trim_align")
+                try:
+                    assign(assign_args)
+                except:  # Just in case treesapp assign fails, just continue
+                    pass
+
+                if not file_parsers.classification_table_variants(classification_table):
+                    # The TaxonTest object is maintained for record-keeping (to track # queries & classifieds)
+                    logging.warning("TreeSAPP did not generate output for '{}'. Skipping.\n".format(lineage))
+                    shutil.rmtree(classifier_output)
+                    continue
 
-                        if not os.path.isfile(classification_table):
-                            # The TaxonTest object is maintained for record-keeping (to track # queries & classifieds)
-                            logging.warning("TreeSAPP did not generate output for '{}'. Skipping.\n".format(lineage))
-                            shutil.rmtree(classifier_output)
-                            continue
-                    else:
-                        # Valid number of queries and these sequences have already been classified
-                        pass
-
-                    test_obj.taxonomic_tree = ce_refpkg.all_possible_assignments()
-                    if os.path.isfile(classification_table):
-                        assigned_lines = file_parsers.read_classification_table(classification_table)
-                        test_obj.assignments = file_parsers.parse_assignments(assigned_lines)
-                        test_obj.filter_assignments(ts_evaluate.ref_pkg.prefix)
-                        test_obj.distances = ts_clade_ex.parse_distances(assigned_lines)
-                    else:
-                        logging.error("marker_contig_map.tsv is missing from output directory '" +
-                                      os.path.dirname(classification_table) + "'\n" +
-                                      "Please remove this directory and re-run.\n")
-                        sys.exit(21)
+            test_obj.taxonomic_tree = ce_refpkg.all_possible_assignments()
+            if file_parsers.classification_table_variants(classification_table):
+                assigned_lines = file_parsers.read_classification_table(classification_table)
+                test_obj.assignments = file_parsers.parse_assignments(assigned_lines)
+                test_obj.filter_assignments(ts_evaluate.ref_pkg.prefix)
+                test_obj.distances = ts_clade_ex.parse_distances(assigned_lines)
+            else:
+                logging.error("marker_contig_map.tsv is missing from output directory '" +
+                              os.path.dirname(classification_table) + "'\n" +
+                              "Please remove this directory and re-run.\n")
+                sys.exit(21)
+        ts_evaluate.end_profile_stage()
 
     if ts_evaluate.stage_status("calculate"):
+        ts_evaluate.profile_stage("calculate")
         # everything has been prepared, only need to parse the classifications and map lineages
         logging.info("Finishing up the mapping of classified, filtered taxonomic sequences.\n")
         for rank in sorted(ts_evaluate.taxa_tests):
@@ -1620,8 +1830,10 @@ def evaluate(sys_args):
         ts_evaluate.summarize_taxonomic_diversity()
         containment_strings = ts_clade_ex.determine_containment(ts_evaluate)
         ts_evaluate.write_containment_table(containment_strings, args.tool)
+        ts_evaluate.end_profile_stage()
 
     if args.delete and os.path.isdir(ts_evaluate.var_output_dir):
         shutil.rmtree(ts_evaluate.var_output_dir)
 
+    ts_evaluate.write_profile()
     return
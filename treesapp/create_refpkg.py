@@ -14,10 +14,12 @@ try:
 
     from time import gmtime, strftime, sleep
 
+    from treesapp import wrapper
     from treesapp.wrapper import run_odseq, run_mafft
-    from treesapp.external_command_interface import launch_write_command
+    from treesapp.external_command_interface import launch_write_command, CommandScheduler
     from treesapp.lca_calculations import megan_lca, clean_lineage_list
     from treesapp.taxonomic_hierarchy import TaxonomicHierarchy
+    from treesapp.taxonomy_index import TaxonomyIndex
     from treesapp import entrez_utils
     from treesapp import fasta
     from treesapp import classy
@@ -28,6 +30,9 @@ except ImportError:
     sys.stderr.write(str(traceback.print_exc(10)))
     sys.exit(13)
 
+# The maximum number of sequences aligned and screened for outliers together when building with --profile_align
+OUTLIER_PARTITION_SIZE = 2000
+
 
 def generate_cm_data(args, unaligned_fasta):
     """
@@ -542,24 +547,85 @@ def parse_model_parameters(placement_trainer_file):
     return params
 
 
+def partition_records(ref_seq_dict: dict, num_partitions: int) -> list:
+    """
+    Splits a dictionary of reference sequences into contiguous partitions of near-equal size, following the order of
+    their numerical keys. When ref_seq_dict is ordered by lineage each partition is a group of related sequences.
+
+    :param ref_seq_dict: A dictionary of EntrezRecord instances indexed by their numerical TreeSAPP IDs
+    :param num_partitions: The number of partitions to split the records into
+    :return: A list of dictionaries, each a subset of ref_seq_dict
+    """
+    num_ids = sorted(ref_seq_dict, key=int)
+    num_partitions = max(1, min(num_partitions, len(num_ids)))
+    partitions = []
+    for i in range(num_partitions):
+        start = i * len(num_ids) // num_partitions
+        stop = (i + 1) * len(num_ids) // num_partitions
+        partitions.append({num_id: ref_seq_dict[num_id] for num_id in num_ids[start:stop]})
+    return partitions
+
+
 def remove_outlier_sequences(fasta_record_objects: dict, od_seq_exe: str, mafft_exe: str,
-                             output_dir="./outliers", num_threads=2) -> None:
-    od_input = output_dir + "od_input.fasta"
-    od_output = output_dir + "outliers.fasta"
+                             output_dir="./outliers", num_threads=2, partition_size=0) -> None:
+    """
+    Detects outliers among the cluster representatives with OD-seq, after aligning them with MAFFT,
+    and removes them by setting their EntrezRecord.cluster_rep attribute to False.
+
+    If there are more representatives than partition_size, these are split into partitions of related sequences
+    (by their lineages) and each partition is aligned and screened for outliers in parallel.
+    This avoids aligning, and calculating the distances between, all sequences at once.
+
+    :param fasta_record_objects: A dictionary of EntrezRecord instances indexed by their numerical TreeSAPP IDs
+    :param od_seq_exe: Path to the OD-seq executable
+    :param mafft_exe: Path to the MAFFT executable
+    :param output_dir: Path to the directory for writing the intermediate files
+    :param num_threads: The number of threads used by all of the MAFFT and OD-seq processes
+    :param partition_size: The maximum number of sequences in a partition. Zero means they are never partitioned.
+    :return: None
+    """
     outlier_names = list()
+    outlier_seqs = dict()
     tmp_dict = dict()
 
     outlier_test_fasta_dict = order_dict_by_lineage(fasta_record_objects)
+    num_partitions = 1
+    if partition_size:
+        num_partitions = -(-len(outlier_test_fasta_dict) // partition_size)
 
     logging.info("Detecting outlier reference sequences... ")
-    create_new_ref_fasta(od_input, outlier_test_fasta_dict)
-    od_input_m = '.'.join(od_input.split('.')[:-1]) + ".mfa"
-    # Perform MSA with MAFFT
-    run_mafft(mafft_exe, od_input, od_input_m, num_threads)
-    # Run OD-seq on MSA to identify outliers
-    run_odseq(od_seq_exe, od_input_m, od_output, num_threads)
+    align_scheduler = CommandScheduler("Outlier detection alignment", num_threads)
+    od_scheduler = CommandScheduler("Outlier detection", num_threads)
+    job_threads = max(1, num_threads // num_partitions)
+    od_inputs = []
+    od_outputs = []
+    for i, partition in enumerate(partition_records(outlier_test_fasta_dict, num_partitions)):
+        suffix = "_{}".format(i) if num_partitions > 1 else ""
+        od_input = output_dir + "od_input" + suffix + ".fasta"
+        od_input_m = output_dir + "od_input" + suffix + ".mfa"
+        od_output = output_dir + "outliers" + suffix + ".fasta"
+        create_new_ref_fasta(od_input, partition)
+        # Perform MSA with MAFFT then run OD-seq on the MSA to identify outliers
+        align_scheduler.submit(wrapper.mafft_command(mafft_exe, od_input, job_threads),
+                               threads=job_threads, memory=wrapper.DEPENDENCY_MEMORY["mafft"],
+                               stdout=od_input_m, stderr=os.devnull)
+        od_scheduler.submit(wrapper.odseq_command(od_seq_exe, od_input_m, od_output, job_threads),
+                            threads=job_threads, memory=wrapper.DEPENDENCY_MEMORY["OD-seq"])
+        od_inputs.append(od_input_m)
+        od_outputs.append(od_output)
+
+    # Ensure MAFFT generated a proper alignment for each partition before OD-seq is run, as run_mafft does
+    for align_job, od_input_m in zip(align_scheduler.run(), od_inputs):
+        if len(fasta.read_fasta_to_dict(od_input_m)) < 1:
+            logging.error("MAFFT did not generate a proper FASTA file. " +
+                          "Check the output by running:\n" + ' '.join(align_job.cmd_list) + "\n")
+            sys.exit(7)
+    od_scheduler.run()
+
+    for od_output in od_outputs:
+        outlier_seqs.update(fasta.read_fasta_to_dict(od_output))
+
     # Remove outliers from fasta_record_objects collection
-    outlier_seqs = fasta.read_fasta_to_dict(od_output)
     for seq_num_id in fasta_record_objects:
         ref_seq = fasta_record_objects[seq_num_id]
         tmp_dict[ref_seq.short_id] = ref_seq
@@ -576,6 +642,59 @@ def remove_outlier_sequences(fasta_record_objects: dict, od_seq_exe: str, mafft_
     return
 
 
+def profile_align_references(ref_seq_dict: dict, executables: dict, hmm_profile: str, msa_out: str,
+                             output_dir: str, num_threads=2, seed_size=500) -> None:
+    """
+    Aligns the reference sequences to a profile HMM with hmmalign, rather than by progressive multiple alignment of
+    all sequences, so the time required increases linearly with the number of references.
+
+    If a profile isn't provided, a seed profile is built from a MAFFT alignment of seed_size references sampled evenly
+    across the lineage-ordered ref_seq_dict. The references are aligned in a partition per thread, in parallel, and
+    the partitions' alignments are written to msa_out as they are read, without the columns of residues in the
+    profile's insert states. Therefore, every partition's alignment has the same columns: the profile's match states.
+
+    :param ref_seq_dict: A dictionary of EntrezRecord instances indexed by their numerical TreeSAPP IDs
+    :param executables: A dictionary mapping software to a path of their respective executable
+    :param hmm_profile: Path to an HMM profile to align the sequences to. May be empty.
+    :param msa_out: Path to write the multiple alignment of the references, in FASTA format
+    :param output_dir: Path to the directory for writing the intermediate files
+    :param num_threads: The number of hmmalign processes to run in parallel
+    :param seed_size: The number of references used to build the seed profile
+    :return: None
+    """
+    if not hmm_profile:
+        num_ids = sorted(ref_seq_dict, key=int)
+        step = max(1, len(num_ids) // seed_size)
+        seed_fasta = output_dir + "seed_refs.fasta"
+        seed_msa = output_dir + "seed_refs.mfa"
+        hmm_profile = output_dir + "seed_refs.hmm"
+        create_new_ref_fasta(seed_fasta, {num_id: ref_seq_dict[num_id] for num_id in num_ids[::step][:seed_size]})
+        run_mafft(executables["mafft"], seed_fasta, seed_msa, num_threads)
+        wrapper.build_hmm_profile(executables["hmmbuild"], seed_msa, hmm_profile, name="seed")
+
+    scheduler = CommandScheduler("hmmalign", num_threads)
+    partition_msas = []
+    for i, partition in enumerate(partition_records(ref_seq_dict, num_threads)):
+        partition_fasta = output_dir + "profile_align_{}.fasta".format(i)
+        partition_msa = output_dir + "profile_align_{}.mfa".format(i)
+        create_new_ref_fasta(partition_fasta, partition)
+        scheduler.submit(wrapper.hmmalign_afa_command(executables["hmmalign"], hmm_profile,
+                                                      partition_fasta, partition_msa),
+                         memory=wrapper.DEPENDENCY_MEMORY["hmmalign"])
+        partition_msas.append(partition_msa)
+
+    insert_re = re.compile(r"[a-z.]")
+    with open(msa_out, 'w') as msa_handle:
+        for _, partition_msa in zip(scheduler.as_completed(ordered=True), partition_msas):
+            with open(partition_msa) as partition_handle:
+                for line in partition_handle:
+                    if line[0] == '>':
+                        msa_handle.write(line)
+                    else:
+                        msa_handle.write(insert_re.sub('', line))
+    return
+
+
 def guarantee_ref_seqs(cluster_dict: dict, important_seqs: set) -> dict:
     """
     Ensures all "guaranteed sequences" are representative sequences, swapping non-guaranteed sequences for the
@@ -646,8 +765,11 @@ def cluster_lca(cluster_dict: dict, fasta_record_objects: dict, header_registry:
     """
     # Create a temporary dictionary for faster mapping
     formatted_to_num_map = dict()
+    # Index all lineages once so each cluster's LCA is found without splitting and comparing the lineage strings
+    t_index = TaxonomyIndex()
     for num_id in fasta_record_objects:
         formatted_to_num_map[header_registry[num_id].original] = num_id
+        t_index.add(fasta_record_objects[num_id].lineage.strip())
 
     lineages = list()
     for cluster_id in sorted(cluster_dict, key=int):
@@ -665,7 +787,7 @@ def cluster_lca(cluster_dict: dict, fasta_record_objects: dict, header_registry:
                                 "It will not be used in determining the cluster LCA.\n".format(member))
 
         cleaned_lineages = clean_lineage_list(lineages)
-        cluster_inst.lca = megan_lca(cleaned_lineages)
+        cluster_inst.lca = megan_lca(cleaned_lineages, t_index)
 
         lineages.clear()
     formatted_to_num_map.clear()
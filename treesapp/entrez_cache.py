@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import time
+import sqlite3
+import logging
+
+from treesapp.refpkg import ReferencePackage
+
+__author__ = 'Connor Morgan-Lang'
+
+
+class EntrezCache:
+    """
+    A persistent cache of the records returned by Entrez queries, backed by an SQLite database, so accessions, taxids
+    and organism names queried by a previous run are not queried again.
+    Records are keyed by the Entrez database and query method (e.g. 'Taxonomy:fetch') and the identifier queried.
+    Records older than the time-to-live (ttl, in days) are ignored and are replaced when they are next queried.
+    Records derived from a reference package (see prewarm_from_refpkg) are kept apart, in the 'prewarmed' table, and are
+    only used for identifiers that have no unexpired record fetched from Entrez.
+    """
+    # The number of identifiers looked up in each SELECT, below SQLite's default limit of host parameters
+    batch_size = 500
+
+    def __init__(self, db_path: str, ttl=30):
+        self.db_path = db_path
+        self.ttl = ttl
+        try:
+            self.conn = sqlite3.connect(db_path, timeout=120, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS records "
+                              "(db TEXT, id TEXT, record TEXT, fetched REAL, PRIMARY KEY (db, id))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS prewarmed "
+                              "(db TEXT, id TEXT, record TEXT, refpkg TEXT, PRIMARY KEY (db, id))")
+        except sqlite3.Error as err:
+            logging.error("Unable to open Entrez cache '{}':\n{}\n".format(db_path, err))
+            sys.exit(3)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+        return
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def expiry(self) -> float:
+        return time.time() - self.ttl * 86400
+
+    def lookup(self, db: str, ids: list) -> dict:
+        """
+        :param db: The Entrez database and query method, separated by a colon (e.g. 'protein:fetch')
+        :param ids: A list of identifiers (e.g. accessions, taxids or organism names) that were queried
+        :return: A dictionary of the unexpired records indexed by the identifiers found in the cache. Records from the
+         prewarmed table are only returned for identifiers without a record from Entrez.
+        """
+        records = dict()
+        unique_ids = list(set(ids))
+        for i in range(0, len(unique_ids), self.batch_size):
+            batch = unique_ids[i:i + self.batch_size]
+            rows = self.conn.execute("SELECT id, record FROM records WHERE db = ? AND fetched >= ? AND id IN (" +
+                                     ", ".join(["?"] * len(batch)) + ")", [db, self.expiry()] + batch)
+            for entrez_id, record in rows:
+                records[entrez_id] = json.loads(record)
+        num_fetched = len(records)
+        missing = [entrez_id for entrez_id in unique_ids if entrez_id not in records]
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            rows = self.conn.execute("SELECT id, record FROM prewarmed WHERE db = ? AND id IN (" +
+                                     ", ".join(["?"] * len(batch)) + ")", [db] + batch)
+            for entrez_id, record in rows:
+                records[entrez_id] = json.loads(record)
+        logging.debug("{} of {} {} queries were found in the Entrez cache ({} from reference packages).\n"
+                      "".format(len(records), len(unique_ids), db, len(records) - num_fetched))
+        return records
+
+    def store(self, db: str, keyed_records: list, replace=True) -> int:
+        """
+        :param db: The Entrez database and query method, separated by a colon (e.g. 'protein:fetch')
+        :param keyed_records: A list of tuples with the identifier queried and the record returned by Entrez
+        :param replace: Flag indicating whether records already in the cache should be replaced
+        :return: The number of records written
+        """
+        now = time.time()
+        rows = [(db, str(entrez_id), json.dumps(record), now) for entrez_id, record in keyed_records]
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            written = self.conn.executemany("INSERT OR " + ("REPLACE" if replace else "IGNORE") +
+                                            " INTO records VALUES (?, ?, ?, ?)", rows).rowcount
+            self.conn.execute("DELETE FROM records WHERE fetched < ?", (self.expiry(),))
+            self.conn.execute("COMMIT")
+        except sqlite3.Error:
+            self.conn.execute("ROLLBACK")
+            raise
+        return written
+
+    def prewarm_from_refpkg(self, refpkg: ReferencePackage, db: str) -> int:
+        """
+        Adds the organism of reference sequences in a reference package to the prewarmed table, keyed by their accession,
+        so the accessions of sequences already in the reference package are not queried again.
+        Only the reference sequences whose lineages were fetched from Entrez when the reference package was built
+        (ReferencePackage.entrez_accessions) are added, since the organism names of the others may not be NCBI's.
+        The records fetched from Entrez are never modified and prewarmed records that are already cached are left unchanged.
+
+        :param refpkg: A ReferencePackage instance with its lineage_ids loaded
+        :param db: The Entrez database name the reference sequences are from (e.g. 'protein')
+        :return: The number of accessions added to the cache
+        """
+        entrez_accessions = set(refpkg.entrez_accessions)
+        keyed_records = []
+        for leaf in refpkg.generate_tree_leaf_references_from_refpkg():
+            try:
+                organism, accession = leaf.description.rsplit(" | ", 1)
+            except ValueError:
+                continue
+            if organism and accession in entrez_accessions:
+                keyed_records.append((accession, {"GBSeq_primary-accession": accession, "GBSeq_organism": organism}))
+        if not keyed_records:
+            return 0
+        rows = [(db + ":fetch", accession, json.dumps(record), refpkg.prefix) for accession, record in keyed_records]
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            added = self.conn.executemany("INSERT OR IGNORE INTO prewarmed VALUES (?, ?, ?, ?)", rows).rowcount
+            self.conn.execute("COMMIT")
+        except sqlite3.Error:
+            self.conn.execute("ROLLBACK")
+            raise
+        logging.debug("Pre-warmed the Entrez cache with {} accessions from {}.\n".format(added, refpkg.prefix))
+        return added
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import time
+import socket
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.request import urlopen, Request
+from urllib.parse import urlencode
+from urllib.error import HTTPError, URLError
+
+from Bio import Entrez
+
+__author__ = 'Connor Morgan-Lang'
+
+NCBI_API_KEY = "849e32266531ee0cee64c6edbbdcf7b62e09"
+# The base URL of the E-utilities and the API key sent with each request. The URL may point to a local mock server.
+_eutils = {"url": "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/", "api_key": NCBI_API_KEY}
+
+
+def configure_eutils(url=None, api_key=None) -> None:
+    """
+    :param url: The base URL of the E-utilities (e.g. 'http://localhost:8080/'). The default is NCBI's.
+    :param api_key: The NCBI API key used for each request. Empty to query without an API key.
+    :return: None
+    """
+    if url is not None:
+        _eutils["url"] = url if url.endswith('/') else url + '/'
+    if api_key is not None:
+        _eutils["api_key"] = api_key
+    return
+
+
+def eutils_rate(api_key: str) -> float:
+    """
+    NCBI allows 10 requests per second with an API key and 3 without one.
+    """
+    return 10.0 if api_key else 3.0
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket for limiting the rate of requests shared by several threads.
+    Tokens are added at `rate` per second up to `capacity`, and each request waits for, then removes, a token.
+
+    When the server indicates requests are too frequent (HTTP 429) the rate is halved by throttle(), then recovers
+    towards the maximum rate with each successful request.
+    """
+    def __init__(self, rate: float, capacity=1):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                # Sleeping while holding the lock keeps waiting threads in line
+                time.sleep((1 - self.tokens) / self.rate)
+
+    def throttle(self) -> None:
+        with self.lock:
+            self.rate = max(self.rate / 2, 0.5)
+            self.tokens = 0
+        logging.debug("Entrez request rate reduced to {} per second.\n".format(round(self.rate, 2)))
+        return
+
+    def recover(self) -> None:
+        with self.lock:
+            self.rate = min(self.rate * 1.1, self.max_rate)
+        return
+
+
+class EntrezFetcher:
+    """
+    Queries the Entrez E-utilities (efetch or esearch) with several requests in flight at once, limited to the rate
+    NCBI allows by a TokenBucket. The records are parsed by Bio.Entrez.read and yielded as each request completes.
+
+    Chunks of query terms that fail are split in half and each half is queried again, so the terms that cannot be
+    queried are found in O(log n) requests rather than querying each term of the chunk individually.
+    """
+    max_tries = 3
+    retry_delay = 5
+    # Seconds to wait on a connection or a response before the request is abandoned and tried again
+    timeout = 120
+
+    def __init__(self, db="Taxonomy", method="fetch", retmode="xml", max_in_flight=4, bucket=None):
+        """
+        :param db: Name of the Entrez database to query
+        :param method: Either fetch or search corresponding to efetch and esearch, respectively
+        :param retmode: The format of the Entrez records to be returned
+        :param max_in_flight: The maximum number of requests waiting on a response at once
+        :param bucket: A TokenBucket instance. By default, one is created for the rate allowed by the API key.
+        """
+        self.db = db
+        self.method = method
+        self.retmode = retmode
+        self.max_in_flight = max_in_flight
+        self.url = _eutils["url"] + ("efetch.fcgi" if method == "fetch" else "esearch.fcgi")
+        self.api_key = _eutils["api_key"]
+        self.bucket = bucket if bucket else TokenBucket(eutils_rate(self.api_key))
+        self.failures = []
+        self.num_requests = 0
+        self.lock = threading.Lock()
+
+    def build_request(self, terms: list) -> Request:
+        params = {"db": self.db, "tool": Entrez.tool}
+        if self.method == "fetch":
+            params.update({"id": ','.join(terms), "retmode": self.retmode})
+        else:
+            params["term"] = ','.join(terms)
+        if self.api_key:
+            params["api_key"] = self.api_key
+        if Entrez.email:
+            params["email"] = Entrez.email
+        # POST requests allow for many more terms than GET requests
+        return Request(self.url, data=urlencode(params).encode("utf-8"))
+
+    def request(self, terms: list):
+        """
+        Sends a single request for a list of terms, retrying after server errors, time-outs, or if the request rate was
+        exceeded.
+
+        :param terms: A list of query terms, as strings
+        :return: The parsed records
+        """
+        request = self.build_request(terms)
+        for i in range(self.max_tries):
+            self.bucket.acquire()
+            with self.lock:
+                self.num_requests += 1
+            try:
+                with urlopen(request, timeout=self.timeout) as handle:
+                    records = Entrez.read(handle)
+            except HTTPError as err:
+                # Errors due to a bad request are not retried, other than 'Too Many Requests'
+                if i == self.max_tries - 1 or (err.code // 100 == 4 and err.code != 429):
+                    raise
+                if err.code == 429:
+                    self.bucket.throttle()
+                else:
+                    time.sleep(self.retry_delay)
+                continue
+            except (URLError, socket.timeout):
+                if i == self.max_tries - 1:
+                    raise
+                time.sleep(self.retry_delay)
+                continue
+            self.bucket.recover()
+            return records
+
+    def stream(self, search_terms: list, chunk_size=100):
+        """
+        Queries the search terms in chunks, yielding the records of each chunk as they are returned.
+        Chunks are not necessarily yielded in the order of search_terms.
+        Terms that could not be queried are appended to EntrezFetcher.failures.
+
+        :param search_terms: A list of GenBank accessions, NCBI taxonomy IDs, or organism names
+        :param chunk_size: The number of terms in each request
+        :return: A generator of tuples with the list of terms queried and the list of records returned
+        """
+        terms = [str(sid) for sid in search_terms]
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            pending = {}
+            for i in range(0, len(terms), chunk_size):
+                sub_list = terms[i:i + chunk_size]
+                pending[executor.submit(self.request, sub_list)] = sub_list
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    sub_list = pending.pop(future)
+                    try:
+                        records = future.result()
+                    # Broad exception clause but THE NUMBER OF POSSIBLE ERRORS IS TOO DAMN HIGH!
+                    except Exception as err:
+                        if len(sub_list) == 1:
+                            logging.debug("Entrez query for '{}' failed: {}\n".format(sub_list[0], err))
+                            self.failures.append(sub_list[0])
+                            continue
+                        half = len(sub_list) // 2
+                        for split in [sub_list[:half], sub_list[half:]]:
+                            pending[executor.submit(self.request, split)] = split
+                        continue
+                    # Searches return a single record while fetches return a list of records
+                    yield sub_list, (records if isinstance(records, list) else [records])
@@ -3,6 +3,7 @@ __author__ = 'Connor Morgan-Lang'
 import sys
 import time
 import re
+import gzip
 import logging
 import csv
 
@@ -12,6 +13,61 @@ from tqdm import tqdm
 
 from treesapp.utilities import get_list_positions, get_field_delimiter
 from treesapp.taxonomic_hierarchy import TaxonomicHierarchy, Taxon
+from treesapp.accession_index import fetch_accession2taxid_index
+from treesapp.ncbi_taxonomy import NCBITaxonomy, load_ncbi_taxonomy
+from treesapp.entrez_cache import EntrezCache
+from treesapp.entrez_fetcher import EntrezFetcher
+
+# An optional local copy of the NCBI taxonomy, used in place of Entrez to resolve taxids and organism names
+_local_taxonomy = {"path": "", "taxonomy": None}
+# An optional persistent cache of Entrez records, used by tolerant_entrez_query
+_entrez_cache = {"path": "", "ttl": 30, "cache": None}
+
+
+def configure_local_taxonomy(taxdump_path: str) -> None:
+    """
+    Sets the NCBI taxdump (see ncbi_taxonomy.load_ncbi_taxonomy) used instead of Entrez to resolve NCBI taxids and
+    organism names to lineages. It is only loaded when it is first needed.
+
+    :param taxdump_path: Path to an NCBI taxdump directory or a binary NCBI taxonomy file. Empty to use Entrez.
+    :return: None
+    """
+    if taxdump_path != _local_taxonomy["path"]:
+        _local_taxonomy["path"] = taxdump_path
+        _local_taxonomy["taxonomy"] = None
+    return
+
+
+def configure_entrez_cache(db_path: str, ttl=30) -> None:
+    """
+    Sets the SQLite database used to cache the records returned by Entrez queries (see entrez_cache.EntrezCache).
+
+    :param db_path: Path to the SQLite database, which is created if it doesn't exist. Empty to disable the cache.
+    :param ttl: The number of days records are used for before they are queried again
+    :return: None
+    """
+    if _entrez_cache["cache"]:
+        _entrez_cache["cache"].close()
+    _entrez_cache.update({"path": db_path, "ttl": ttl, "cache": None})
+    return
+
+
+def entrez_cache():
+    """
+    :return: The configured EntrezCache instance, or None if Entrez records are not being cached
+    """
+    if _entrez_cache["path"] and _entrez_cache["cache"] is None:
+        _entrez_cache["cache"] = EntrezCache(_entrez_cache["path"], _entrez_cache["ttl"])
+    return _entrez_cache["cache"]
+
+
+def local_taxonomy():
+    """
+    :return: The configured NCBITaxonomy instance, or None if the local NCBI taxonomy is not in use
+    """
+    if _local_taxonomy["path"] and _local_taxonomy["taxonomy"] is None:
+        _local_taxonomy["taxonomy"] = load_ncbi_taxonomy(_local_taxonomy["path"])
+    return _local_taxonomy["taxonomy"]
 
 
 class EntrezRecord:
@@ -91,82 +147,91 @@ def validate_target_db(db_type: str):
     return database
 
 
-def tolerant_entrez_query(search_term_list: list, db="Taxonomy", method="fetch", retmode="xml", chunk_size=100):
+def tolerant_entrez_query(search_term_list: list, db="Taxonomy", method="fetch", retmode="xml", chunk_size=100,
+                          max_in_flight=4):
     """
-    Function for performing Entrez-database queries using BioPython's Entrez utilities.
-    It is able to break up the complete list of search terms,
-    perform the search and if any chunks fail send individual queries for each item in the sub_list.
+    Function for performing Entrez-database queries using the E-utilities.
+    It is able to break up the complete list of search terms and query several chunks at once, at the rate allowed by
+    NCBI (see entrez_fetcher.EntrezFetcher). Chunks that fail are split in half until the problematic terms are found.
 
     :param search_term_list: A list of GenBank accessions, NCBI taxonomy IDs, or organism names
     :param db: Name of the Entrez database to query
     :param method: Either fetch or search corresponding to Entrez.efetch and Entrez.esearch, respectively
     :param retmode: The format of the Entrez records to be returned ('fasta' or 'xml', typically)
     :param chunk_size: Size of the sub_lists for each Entrez query. Fewer than 100 is recommended.
+    :param max_in_flight: The maximum number of Entrez queries waiting on a response at once
     :return: A list of Entrez records, in the format specific by `retmode`
     """
     read_records = list()
     durations = list()
     failures = list()
+    keyed_records = list()  # Tuples of the term queried and the record returned, for the Entrez cache
 
     # Check the database name
     if db not in ["nucleotide", "protein", "Taxonomy"]:
         logging.error("Unknown Entrez database '" + db + "'.\n")
         sys.exit(9)
 
+    # Records cached by previous queries are used instead of querying Entrez again. XML records only.
+    cache = entrez_cache() if retmode == "xml" else None
+    cache_db = db + ':' + method
+    if cache and search_term_list:
+        cached = cache.lookup(cache_db, [str(sid) for sid in search_term_list])
+        read_records += list(cached.values())
+        search_term_list = [sid for sid in search_term_list if str(sid) not in cached]
+
     if len(search_term_list) == 0:
         return read_records, durations, failures
 
-    # Create the sub-lists from `search_term_list` of length `chunk_size`
-    for i in range(0, len(search_term_list), chunk_size):
-        start_time = time.time()
-        sub_list = search_term_list[i:i + chunk_size]
-        try:
-            if method == "fetch":
-                handle = Entrez.efetch(db=db, id=','.join([str(sid) for sid in sub_list]), retmode=retmode,
-                                       api_key="849e32266531ee0cee64c6edbbdcf7b62e09")
-            else:
-                handle = Entrez.esearch(db=db, term=','.join([str(sid) for sid in sub_list]),
-                                        api_key="849e32266531ee0cee64c6edbbdcf7b62e09")
-            if chunk_size > 1:
-                read_records += Entrez.read(handle)
-            else:
-                read_records.append(Entrez.read(handle))
-        # Broad exception clause but THE NUMBER OF POSSIBLE ERRORS IS TOO DAMN HIGH!
-        # Try sending individual queries instead to determine problematic query IDs
-        except:
-            for sid in sub_list:
-                try:
-                    if method == "fetch":
-                        handle = Entrez.efetch(db=db, id=sid, retmode=retmode,
-                                               api_key="849e32266531ee0cee64c6edbbdcf7b62e09")
-                    else:
-                        handle = Entrez.esearch(db=db, term=sid,
-                                                api_key="849e32266531ee0cee64c6edbbdcf7b62e09")
-                    record = Entrez.read(handle)
-                    read_records.append(record[0])
-                except:
-                    failures.append("\t" + str(sid))
-
-        end_time = time.time()
-        duration = end_time - start_time
-        if duration < 0.66:
-            time.sleep(0.66 - duration)
-            duration = 0.66
-        # TODO: allow for the durations to be summed by a number of queries
-        hours, remainder = divmod(duration, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        durations.append(str(i) + ' - ' + str(i + chunk_size) + "\t" + ':'.join([str(minutes), str(round(seconds, 2))]))
-
-    logging.debug("Entrez query time for accessions (minutes:seconds):\n\t" +
-                  "\n\t".join(durations) + "\n")
+    start_time = time.time()
+    fetcher = EntrezFetcher(db, method, retmode, max_in_flight)
+    for sub_list, chunk_records in fetcher.stream(search_term_list, chunk_size):
+        read_records += chunk_records
+        if method == "fetch":
+            keyed_records += key_entrez_records(chunk_records, sub_list)
+        elif len(sub_list) == 1:
+            keyed_records.append((sub_list[0], chunk_records[0]))
+        minutes, seconds = divmod(time.time() - start_time, 60)
+        durations.append(sub_list[0] + ' - ' + sub_list[-1] + "\t" + ':'.join([str(int(minutes)),
+                                                                               str(round(seconds, 2))]))
+    failures += ["\t" + sid for sid in fetcher.failures]
+
+    logging.debug("Entrez query time for accessions (minutes:seconds elapsed):\n\t" +
+                  "\n\t".join(durations) + "\n" +
+                  "{} requests were sent for {} query terms.\n".format(fetcher.num_requests, len(search_term_list)))
 
     if failures:
         logging.warning("Unable to parse XML data from Entrez! "
                         "Either the XML is corrupted or the query terms cannot be found in the database.\n"
                         "Offending accessions from this batch:\n" + "\n".join(failures) + "\n")
+    if cache and keyed_records:
+        cache.store(cache_db, keyed_records)
     return read_records, durations, failures
 
 
+def key_entrez_records(records: list, search_terms: list) -> list:
+    """
+    Matches the records returned by an Entrez efetch query to the terms (accessions or taxids) that were queried,
+    since Entrez does not necessarily return a record for each term or in the same order.
+
+    :param records: A list of records returned by Entrez.efetch
+    :param search_terms: The list of terms that were queried
+    :return: A list of tuples with the term queried and its record
+    """
+    terms = {str(sid) for sid in search_terms}
+    keyed_records = []
+    for record in records:
+        record_ids = set()
+        if "TaxId" in record:
+            record_ids.add(str(record["TaxId"]))
+            record_ids.update(str(aka) for aka in record.get("AkaTaxIds", []))
+        accession, versioned, alternatives = parse_accessions_from_entrez_xml(record)
+        record_ids.update([accession, versioned] + alternatives)
+        for term in terms.intersection(record_ids):
+            keyed_records.append((term, record))
+    return keyed_records
+
+
 def parse_accessions_from_entrez_xml(record):
     accession = ""
     versioned = ""
@@ -468,75 +533,97 @@ def match_file_to_dict(file_handler, key_dict, sep="\t", join_by=0):
 
 def map_accession2taxid(query_accessions: list, accession2taxid_list: str) -> dict:
     """
-    Maps NCBI accessions to taxonomy IDs via NCBI .accession2taxid files
+    Maps NCBI accessions to taxonomy IDs via NCBI .accession2taxid files.
+    Each accession2taxid file is indexed the first time it is used (see accession_index.Accession2TaxidIndex)
+    so accessions are looked up without reading the entire file. Paths to the indices can also be provided.
 
     :param query_accessions: A list of EntrezRecord instances with accessions that need to be mapped to NCBI taxids
     :param accession2taxid_list: A comma-separated list of files
     :return: A dictionary mapping sequence accessions to EntrezRecord instances
     """
     er_acc_dict = dict()
-    unmapped_queries = list()
 
-    # Create a dictionary for O(1) look-ups, load all the query accessions into unmapped queries
+    # Create a dictionary for O(1) look-ups
     for e_record in query_accessions:  # type: EntrezRecord
         try:
             er_acc_dict[e_record.accession].append(e_record)
         except KeyError:
             er_acc_dict[e_record.accession] = [e_record]
-        unmapped_queries.append(e_record.accession)
+    unmapped_queries = set(er_acc_dict.keys())
 
     logging.info("Mapping query accessions to NCBI taxonomy IDs... ")
     for accession2taxid in accession2taxid_list.split(','):
         init_qlen = len(unmapped_queries)
-        final_qlen = len(unmapped_queries)
         start = time.time()
-        try:
-            rosetta_handler = open(accession2taxid, 'r')
-        except IOError:
-            logging.error("Unable to open '" + accession2taxid + "' for reading.\n")
-            sys.exit(13)
+        acc_index = fetch_accession2taxid_index(accession2taxid)
+        if acc_index:
+            with acc_index:
+                mapped = dict()
+                for accession in unmapped_queries:
+                    match = acc_index.lookup(accession)
+                    if match:
+                        mapped[accession] = match
+        else:
+            mapped = scan_accession2taxid(accession2taxid, unmapped_queries)
 
-        for line_match in match_file_to_dict(rosetta_handler, er_acc_dict):
-            try:
-                accession, ver, taxid, _ = line_match.strip().split("\t")
-            except (ValueError, IndexError):
-                logging.warning("Parsing '" + accession2taxid + "' failed.\n")
-                break
+        for accession, (ver, taxid) in mapped.items():
+            # Update the EntrezRecord elements
+            for record in er_acc_dict[accession]:
+                if not record.versioned:
+                    record.versioned = ver
+                record.ncbi_tax = taxid
+                record.bitflag = 3  # Necessary for downstream filters - indicates taxid has been found
+        unmapped_queries.difference_update(mapped)
 
-            try:
-                # Update the EntrezRecord elements
-                records = er_acc_dict[accession]
-                for record in records:
-                    if not record.versioned:
-                        record.versioned = ver
-                    record.ncbi_tax = taxid
-                    record.bitflag = 3  # Necessary for downstream filters - indicates taxid has been found
-                # Remove accession from unmapped queries
-                i = 0
-                while i < final_qlen:
-                    if unmapped_queries[i] == accession:
-                        unmapped_queries.pop(i)
-                        final_qlen -= 1
-                        break
-                    i += 1
-                if final_qlen == 0:
-                    break
-            except KeyError:
-                logging.error("Bad key returned by generator.\n")
-                sys.exit(13)
-
-        rosetta_handler.close()
         end = time.time()
-        logging.debug("Time required to parse '" + accession2taxid + "': " + str(round(end - start, 1)) + "s.\n")
+        logging.debug("Time required to map accessions with '" + accession2taxid + "': " +
+                      str(round(end - start, 1)) + "s.\n")
         # Report the number percentage of query accessions mapped
         logging.debug(
-            str(round(((init_qlen - final_qlen) * 100 / len(query_accessions)), 2)) +
+            str(round(((init_qlen - len(unmapped_queries)) * 100 / max(1, len(er_acc_dict))), 2)) +
             "% of query accessions mapped by " + accession2taxid + ".\n")
+        if not unmapped_queries:
+            break
     logging.info("done.\n")
 
     return er_acc_dict
 
 
+def scan_accession2taxid(accession2taxid: str, query_accessions: set) -> dict:
+    """
+    Reads an NCBI accession2taxid file line by line to find the versioned accessions and taxids of query accessions.
+    Used when the accession2taxid file cannot be indexed. As with the index, the file may be gzip-compressed and only the
+    first record of each accession is used.
+
+    :param accession2taxid: Path to an NCBI accession2taxid file
+    :param query_accessions: A set of accessions without versions
+    :return: A dictionary of tuples with the versioned accession and taxid indexed by the accessions found
+    """
+    mapped = dict()
+    try:
+        if accession2taxid.endswith(".gz"):
+            rosetta_handler = gzip.open(accession2taxid, 'rt')
+        else:
+            rosetta_handler = open(accession2taxid, 'r')
+    except IOError:
+        logging.error("Unable to open '" + accession2taxid + "' for reading.\n")
+        sys.exit(13)
+
+    for line_match in match_file_to_dict(rosetta_handler, query_accessions):
+        try:
+            accession, ver, taxid, _ = line_match.strip().split("\t")
+        except (ValueError, IndexError):
+            logging.warning("Parsing '" + accession2taxid + "' failed.\n")
+            break
+        if accession not in mapped:
+            mapped[accession] = (ver, taxid)
+        if len(mapped) == len(query_accessions):
+            break
+
+    rosetta_handler.close()
+    return mapped
+
+
 def pull_unmapped_entrez_records(entrez_records: list):
     """
     Prepares a list of accession identifiers for EntrezRecord instances where the bitflag is not equal to 7,
@@ -572,7 +659,9 @@ def fetch_lineages_from_taxids(entrez_records: list, t_hierarchy=None) -> None:
     pulled_tax_ids = set()
     if not t_hierarchy:
         t_hierarchy = TaxonomicHierarchy()
-    prep_for_entrez_query()
+    taxonomy = local_taxonomy()  # type: NCBITaxonomy
+    if not taxonomy:
+        prep_for_entrez_query()
 
     # Create a dictionary that will enable rapid look-ups and mapping to EntrezRecord instances
     for e_record in entrez_records:  # type: EntrezRecord
@@ -589,7 +678,10 @@ def fetch_lineages_from_taxids(entrez_records: list, t_hierarchy=None) -> None:
         tax_id_map[taxid].append(e_record)
 
     logging.info("Retrieving lineage information for each taxonomy ID... ")
-    records_batch, durations, lin_failures = tolerant_entrez_query(list(tax_id_map.keys()))
+    if taxonomy:
+        records_batch, lin_failures = taxonomy.taxonomy_records(list(tax_id_map.keys()))
+    else:
+        records_batch, durations, lin_failures = tolerant_entrez_query(list(tax_id_map.keys()))
     logging.info("done.\n")
     for record in records_batch:
         tax_id = parse_gbseq_info_from_entrez_xml(record, "TaxId")
@@ -723,6 +815,30 @@ def fetch_taxids_from_organisms(search_terms: dict) -> None:
     :return: None
     """
     logging.debug(str(len(search_terms.keys())) + " unique organism queries.\n")
+    taxonomy = local_taxonomy()  # type: NCBITaxonomy
+    if taxonomy:
+        ambiguous_terms = dict()
+        for organism, e_records in search_terms.items():
+            name = re.sub(r"\[All Names]$", '', organism)
+            for e_record in e_records:  # type: EntrezRecord
+                if e_record.bitflag == 7:
+                    continue
+                # Names shared by multiple taxa are resolved with the record's lineage, if it has one, or by Entrez
+                tax_id = taxonomy.taxid_from_name(name, e_record.lineage)
+                if tax_id:
+                    e_record.ncbi_tax = tax_id
+                    e_record.tracking_stamp()
+                elif taxonomy.is_ambiguous(name):
+                    ambiguous_terms.setdefault(organism, []).append(e_record)
+                else:
+                    logging.debug("Organism '{}' was not found in the local NCBI taxonomy.\n".format(organism))
+        if not ambiguous_terms:
+            return
+        logging.debug("{} organism names are shared by multiple taxa in the local NCBI taxonomy"
+                      " and will be queried with Entrez.\n".format(len(ambiguous_terms)))
+        prep_for_entrez_query()
+        search_terms = ambiguous_terms
+
     logging.info("Retrieving NCBI taxonomy IDs for each organism... ")
     records_batch, durations, taxid_failures = tolerant_entrez_query(list(search_terms.keys()),
                                                                      "Taxonomy", "search", "xml", 1)
@@ -805,6 +921,7 @@ def get_multiple_lineages(entrez_query_list: list, t_hierarchy: TaxonomicHierarc
      1. Query Entrez's Taxonomy database using accession IDs to obtain corresponding organisms
      2. Query Entrez's Taxonomy database using organism names to obtain corresponding TaxIds
      3. Query Entrez's Taxonomy database using TaxIds to obtain corresponding taxonomic lineages
+    Steps 2 and 3 use the local NCBI taxonomy instead of Entrez if it has been configured.
 
     :param entrez_query_list: A list of EntrezRecord instances with accession IDs to be mapped to lineages
     :param t_hierarchy: A TaxonomicHierarchy instance
@@ -1,109 +1,427 @@
 __author__ = 'Connor Morgan-Lang'
 
 import os
+import io
 import re
 import sys
+import time
+import queue
+import signal
 import logging
+import tempfile
+import threading
 import subprocess
-from multiprocessing import Process, JoinableQueue
 
+from treesapp import profiler
 
-def launch_write_command(cmd_list, collect_all=True):
+
+def open_redirect(target, mode='w'):
+    """
+    Opens the file a command's standard stream should be redirected to.
+
+    :param target: Either a path to a file, or None, subprocess.PIPE, subprocess.DEVNULL or an open file,
+     which are returned unchanged
+    :param mode: The mode to open a path with; 'r' for stdin and 'w' or 'a' for stdout and stderr
+    :return: Either an open file object or the target
+    """
+    if not isinstance(target, str):
+        return target
+    try:
+        return open(target, mode + 'b')
+    except IOError:
+        logging.error("Unable to open '{}' for redirecting a command's {}.\n".format(target,
+                                                                                     "input" if mode == 'r' else
+                                                                                     "output"))
+        sys.exit(3)
+
+
+def wait_for_process(proc: subprocess.Popen):
+    """
+    Waits for a process to terminate using os.wait4, which also returns the resources used by that process alone.
+    The return code is set as it would have been by Popen.wait().
+
+    :param proc: A running subprocess.Popen instance
+    :return: The resource usage of the process (a resource.struct_rusage instance), or None if the process
+     had already been waited for by subprocess
+    """
+    if proc.returncode is not None:
+        return None
+    try:
+        _, status, rusage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        proc.wait()
+        return None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+
+def start_process(cmd_list: list, stdin=None, stdout=None, stderr=None) -> subprocess.Popen:
+    try:
+        return subprocess.Popen(cmd_list, stdin=stdin, stdout=stdout, stderr=stderr, start_new_session=True)
+    except OSError as error:
+        logging.error("Unable to run '{}': {}\nCommand used:\n{}\n".format(cmd_list[0], error, ' '.join(cmd_list)))
+        sys.exit(19)
+
+
+def launch_write_command(cmd_list, collect_all=True, stdout=None, stderr=None, stdin=None):
     """
     Wrapper function for opening subprocesses through subprocess.Popen()
+    The command is run directly, without a shell, so the elements of cmd_list are passed to the executable verbatim.
+    Rather than including shell redirections (e.g. '1>/dev/null') in cmd_list, the standard streams can be
+    redirected to files with the stdout, stderr and stdin parameters; os.devnull discards the output.
 
     :param cmd_list: A list of strings forming a complete command call
     :param collect_all: A flag determining whether stdout and stderr are returned
     via stdout or just stderr is returned leaving stdout to be written to the screen
+    :param stdout: Optional path to a file that standard output is written to, instead of being returned
+    :param stderr: Optional path to a file that standard error is written to, instead of being returned
+    :param stdin: Optional path to a file that is read as standard input
     :return: A string with stdout and/or stderr text and the returncode of the executable
     """
-    stdout = ""
+    output = ""
+    out_handle = open_redirect(stdout)
+    err_handle = open_redirect(stderr)
+    in_handle = open_redirect(stdin, 'r')
     if collect_all:
-        proc = subprocess.Popen(' '.join(cmd_list),
-                                shell=True,
-                                preexec_fn=os.setsid,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT)
-        stdout = proc.communicate()[0].decode("utf-8")
-    else:
-        proc = subprocess.Popen(' '.join(cmd_list),
-                                shell=True,
-                                preexec_fn=os.setsid)
-        proc.wait()
+        if out_handle is None:
+            out_handle = subprocess.PIPE
+        if err_handle is None:
+            err_handle = subprocess.STDOUT if out_handle == subprocess.PIPE else subprocess.PIPE
+
+    start_time = time.time()
+    proc = start_process(cmd_list, stdin=in_handle, stdout=out_handle, stderr=err_handle)
+    # Only a single pipe is ever read from so the process can't be blocked writing to the other
+    if proc.stdout:
+        output = proc.stdout.read().decode("utf-8")
+        proc.stdout.close()
+    elif proc.stderr:
+        output = proc.stderr.read().decode("utf-8")
+        proc.stderr.close()
+    rusage = wait_for_process(proc)
+    profiler.record_command(cmd_list, time.time() - start_time, rusage)
+
+    for handle, target in [(out_handle, stdout), (err_handle, stderr), (in_handle, stdin)]:
+        if isinstance(target, str):
+            handle.close()
 
     # Ensure the command completed successfully
     if proc.returncode != 0:
         logging.error(cmd_list[0] + " did not complete successfully! Command used:\n" +
-                      ' '.join(cmd_list) + "\nOutput:\n" + stdout)
+                      ' '.join(cmd_list) + "\nOutput:\n" + output)
         sys.exit(19)
 
-    return stdout, proc.returncode
-
-
-class CommandLineWorker(Process):
-    def __init__(self, task_queue, commander):
-        Process.__init__(self)
-        self.task_queue = task_queue
-        self.master = commander
-
-    def run(self):
-        while True:
-            next_task = self.task_queue.get()
-            if next_task is None:
-                # Poison pill means shutdown
-                self.task_queue.task_done()
-                break
-            logging.debug("STAGE: " + self.master + "\n" +
-                          "\tCOMMAND:\n" + " ".join(next_task) + "\n")
-            launch_write_command(next_task)
-            self.task_queue.task_done()
+    return output, proc.returncode
+
+
+class CommandPipeline:
+    """
+    Runs a series of commands with the standard output of each streamed to the standard input of the next,
+    like a shell pipeline but without a shell. The final command's output can either be written to a file or read
+    from CommandPipeline.stdout, line by line, while the commands are still running so it is never held in memory.
+
+    Usage:
+        with CommandPipeline([["hmmsearch", "--domtblout", "/dev/stdout", "-o", os.devnull, hmm, fasta]]) as pipe:
+            domain_table = hmmer_tbl_parser.DomainTableParser(pipe.stdout)
+            domain_table.read_domtbl_lines()
+    """
+    def __init__(self, cmd_lists: list, stdin=None, stdout=None):
+        """
+        :param cmd_lists: A list of commands, each a list of strings, in the order data flows through them
+        :param stdin: Optional path to a file that is read as the first command's standard input
+        :param stdout: Optional path to a file the final command's standard output is written to.
+         If not provided it is available as a text stream from CommandPipeline.stdout.
+        """
+        self.cmd_lists = cmd_lists
+        self.stdin_path = stdin
+        self.stdout_path = stdout
+        self.stdout = None
+        self.processes = []
+        self.start_times = []
+        self.stderr_files = []
+        self._handles = []
+
+    def start(self) -> None:
+        upstream = open_redirect(self.stdin_path, 'r')
+        if upstream is not None:
+            self._handles.append(upstream)
+        for i, cmd_list in enumerate(self.cmd_lists):
+            if i == len(self.cmd_lists) - 1 and self.stdout_path:
+                downstream = open_redirect(self.stdout_path)
+                self._handles.append(downstream)
+            else:
+                downstream = subprocess.PIPE
+            # Standard error is spooled to a temporary file so it can be reported if the command fails
+            stderr_file = tempfile.TemporaryFile()
+            self.stderr_files.append(stderr_file)
+            self.start_times.append(time.time())
+            proc = start_process(cmd_list, stdin=upstream, stdout=downstream, stderr=stderr_file)
+            if i > 0:
+                # Only the downstream process should hold the pipe open so it receives SIGPIPE if this one exits
+                upstream.close()
+            self.processes.append(proc)
+            upstream = proc.stdout
+        if upstream is not None:
+            self.stdout = io.TextIOWrapper(upstream)
         return
 
+    def wait(self, check=True) -> list:
+        """
+        Waits for all commands to terminate, recording the resources each used in the profile.
+        If any command failed its standard error is logged and TreeSAPP exits.
+
+        :param check: Flag indicating whether to exit if a command failed
+        :return: A list of the return code of each command
+        """
+        if self.stdout:
+            self.stdout.close()
+        failed = []
+        for i, proc in enumerate(self.processes):
+            rusage = wait_for_process(proc)
+            profiler.record_command(self.cmd_lists[i], time.time() - self.start_times[i], rusage)
+            # Commands are killed by SIGPIPE when whatever is downstream stops reading, which is not an error
+            if proc.returncode not in [0, -signal.SIGPIPE]:
+                failed.append(i)
+        for handle in self._handles:
+            handle.close()
 
-class CommandLineFarmer:
+        if not check:
+            failed.clear()
+        for i in failed:
+            self.stderr_files[i].seek(0)
+            logging.error(self.cmd_lists[i][0] + " did not complete successfully! Command used:\n" +
+                          ' | '.join([' '.join(cmd_list) for cmd_list in self.cmd_lists]) + "\n" +
+                          "Output:\n" + self.stderr_files[i].read().decode("utf-8"))
+        for stderr_file in self.stderr_files:
+            stderr_file.close()
+        if failed:
+            sys.exit(19)
+        return [proc.returncode for proc in self.processes]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            # Don't leave the commands running, or blocked writing to a pipe, if the consumer raised an exception
+            for proc in [p for p in self.processes if p.returncode is None]:
+                try:
+                    os.kill(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        self.wait(check=exc_type is None)
+        return False
+
+
+def available_memory() -> int:
+    """
+    Reads the amount of memory available for starting new processes without swapping, on Linux.
+
+    :return: The available memory in megabytes, or zero if it could not be determined
+    """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(int(line.split()[1]) / 1024)
+    except (IOError, ValueError, IndexError):
+        pass
+    return 0
+
+
+class CommandJob:
+    """
+    A single external command to be run by a CommandScheduler, along with the resources it is expected to use.
+    """
+    def __init__(self, cmd_list: list, threads=1, memory=0, priority=0, depends_on=None, stdout=None, stderr=None):
+        """
+        :param cmd_list: A list of strings forming a complete command call
+        :param threads: The number of threads (cores) the command uses
+        :param memory: The peak memory the command is expected to use, in megabytes
+        :param priority: Jobs with a greater priority are started before those with a lesser priority
+        :param depends_on: A list of CommandJob instances that must complete successfully before this job can start
+        :param stdout: Optional path to a file that standard output is written to, instead of being collected
+        :param stderr: Optional path to a file that standard error is written to, instead of being collected
+        """
+        self.cmd_list = cmd_list
+        self.threads = max(1, int(threads))
+        self.memory = max(0, int(memory))
+        self.priority = priority
+        self.depends_on = list(depends_on) if depends_on else []
+        self.stdout = stdout
+        self.stderr = stderr
+        self.index = 0
+        self.state = "pending"  # One of pending, running, done, failed or cancelled
+        self.returncode = None
+        self.output = ""
+        self.process = None
+
+    def run(self, finished: queue.Queue) -> None:
+        """
+        Runs the command to completion, collecting its output and resource usage, then puts itself in finished.
+        Intended to be the target of a thread so it must never raise, or exit, without putting itself in finished.
+        """
+        start_time = time.time()
+        try:
+            out_handle = open_redirect(self.stdout)
+            err_handle = open_redirect(self.stderr)
+            if out_handle is None:
+                out_handle = subprocess.PIPE
+            if err_handle is None:
+                err_handle = subprocess.STDOUT if out_handle == subprocess.PIPE else subprocess.PIPE
+            self.process = start_process(self.cmd_list, stdout=out_handle, stderr=err_handle)
+            stream = self.process.stdout or self.process.stderr
+            if stream:
+                self.output = stream.read().decode("utf-8")
+                stream.close()
+            rusage = wait_for_process(self.process)
+            profiler.record_command(self.cmd_list, time.time() - start_time, rusage)
+            for handle, target in [(out_handle, self.stdout), (err_handle, self.stderr)]:
+                if isinstance(target, str):
+                    handle.close()
+            self.returncode = self.process.returncode
+        except (SystemExit, Exception) as error:
+            self.output += str(error)
+            self.returncode = -1
+        finished.put(self)
+        return
+
+    def terminate(self) -> None:
+        # Commands are started in their own session so the whole process group can be signalled
+        if self.process is not None and self.process.returncode is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        return
+
+
+class CommandScheduler:
     """
-    A worker that will launch command-line jobs using multiple processes in its queue
+    Runs external commands in parallel, packing them onto the available threads and memory according to the demands
+    each CommandJob declares. Jobs are started in order of priority, then submission, but a smaller job may start
+    ahead of a larger one that is waiting for resources to become free.
+    If a job fails its dependents are cancelled and, unless fail_fast is False, the running jobs are terminated and
+    TreeSAPP exits.
     """
+    def __init__(self, name: str, max_threads=1, max_memory=None, fail_fast=True):
+        """
+        :param name: A description of the jobs, used for logging
+        :param max_threads: The maximum number of threads used by all running jobs
+        :param max_memory: The maximum memory (megabytes) used by all running jobs.
+         By default, the memory currently available. Zero means memory is not limited.
+        :param fail_fast: Flag indicating whether to exit as soon as any job fails
+        """
+        self.name = name
+        self.max_threads = max(1, int(max_threads))
+        self.max_memory = available_memory() if max_memory is None else int(max_memory)
+        self.fail_fast = fail_fast
+        self.jobs = []
 
-    def __init__(self, command, num_threads):
+    def submit(self, cmd_list: list, threads=1, memory=0, priority=0, depends_on=None,
+               stdout=None, stderr=None) -> CommandJob:
         """
-        Instantiate a CommandLineFarmer object to oversee multiprocessing of command-line jobs
-        :param command:
-        :param num_threads:
+        Adds a command to the jobs to be run. See CommandJob for descriptions of the parameters.
+
+        :return: The CommandJob instance, which can be used as a dependency for other jobs
         """
-        self.max_size = 32767  # The actual size limit of a JoinableQueue
-        self.task_queue = JoinableQueue(self.max_size)
-        self.num_threads = int(num_threads)
+        job = CommandJob(cmd_list, threads, memory, priority, depends_on, stdout, stderr)
+        job.index = len(self.jobs)
+        self.jobs.append(job)
+        return job
 
-        process_queues = [CommandLineWorker(self.task_queue, command) for i in range(int(self.num_threads))]
-        for process in process_queues:
-            process.start()
+    def fits(self, job: CommandJob, free_threads: int, free_memory: int, num_running: int) -> bool:
+        # Jobs demanding more than the maximum are limited to it, and run alone
+        if min(job.threads, self.max_threads) > free_threads:
+            return False
+        if self.max_memory and job.memory > free_memory and num_running > 0:
+            return False
+        return True
 
-    def add_tasks_to_queue(self, task_list):
+    def as_completed(self, ordered=False):
         """
-        Function for adding commands from task_list to task_queue while ensuring space in the JoinableQueue
-        :param task_list: List of commands
-        :return: Nothing
+        Runs all of the submitted jobs, yielding each one as it finishes.
+
+        :param ordered: Flag indicating whether jobs should be yielded in the order they were submitted
+         rather than the order they finished. Jobs are still started as soon as resources are available.
+        :return: A generator of the finished (either done, failed or cancelled) CommandJob instances
         """
-        num_tasks = len(task_list)
+        logging.debug("Scheduling {} {} jobs on {} threads and {} MB.\n".format(len(self.jobs), self.name,
+                                                                                self.max_threads,
+                                                                                self.max_memory or "unlimited"))
+        finished = queue.Queue()
+        pending = sorted([job for job in self.jobs if job.state == "pending"], key=lambda j: (-j.priority, j.index))
+        running = set()
+        free_threads, free_memory = self.max_threads, self.max_memory
+        completed = dict()
+        next_index = 0
+        try:
+            while pending or running:
+                cancelled = False
+                for job in list(pending):
+                    if any(dep.state in ["failed", "cancelled"] for dep in job.depends_on):
+                        job.state = "cancelled"
+                        pending.remove(job)
+                        completed[job.index] = job
+                        cancelled = True
+                    elif any(dep.state != "done" for dep in job.depends_on):
+                        continue
+                    elif self.fits(job, free_threads, free_memory, len(running)):
+                        logging.debug("STAGE: " + self.name + "\n" +
+                                      "\tCOMMAND:\n" + " ".join(job.cmd_list) + "\n")
+                        job.state = "running"
+                        pending.remove(job)
+                        running.add(job)
+                        free_threads -= min(job.threads, self.max_threads)
+                        free_memory -= job.memory
+                        threading.Thread(target=job.run, args=(finished,), daemon=True).start()
 
-        task = task_list.pop()
-        while task:
-            if not self.task_queue.full():
-                self.task_queue.put(task)
-                if num_tasks > 1:
-                    task = task_list.pop()
-                    num_tasks -= 1
+                if running:
+                    job = finished.get()
+                    running.remove(job)
+                    free_threads += min(job.threads, self.max_threads)
+                    free_memory += job.memory
+                    if job.returncode == 0:
+                        job.state = "done"
+                    else:
+                        job.state = "failed"
+                        if self.fail_fast:
+                            logging.error(job.cmd_list[0] + " did not complete successfully! Command used:\n" +
+                                          ' '.join(job.cmd_list) + "\nOutput:\n" + job.output + "\n")
+                            sys.exit(19)
+                    completed[job.index] = job
+                elif pending and not cancelled:
+                    logging.error("Unable to schedule {} {} jobs as their dependencies are never run.\n"
+                                  "".format(len(pending), self.name))
+                    sys.exit(19)
+
+                if ordered:
+                    while next_index in completed:
+                        yield completed.pop(next_index)
+                        next_index += 1
                 else:
-                    task = None
+                    for index in sorted(completed):
+                        yield completed.pop(index)
+        finally:
+            # Reached if a job failed, or the consumer stopped early, while jobs were still running
+            for job in running:
+                job.terminate()
+            for _ in range(len(running)):
+                finished.get()
+        return
 
-        i = self.num_threads
-        while i:
-            if not self.task_queue.full():
-                self.task_queue.put(None)
-                i -= 1
+    def run(self) -> list:
+        """
+        Runs all of the submitted jobs and waits for them to finish.
 
-        return
+        :return: The list of CommandJob instances, in the order they were submitted
+        """
+        for _ in self.as_completed():
+            continue
+        return self.jobs
 
 
 def create_dir_from_taxon_name(taxon_lineage: str, output_dir: str):
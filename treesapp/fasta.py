@@ -4,6 +4,7 @@ import sys
 import re
 import os
 import logging
+import heapq
 from time import sleep, time
 from math import ceil
 
@@ -14,10 +15,12 @@ from collections import namedtuple
 from treesapp.utilities import median, reformat_string, rekey_dict
 
 
-def fastx_split(fastx: str, outdir: str, file_num=1) -> list:
+def fastx_split(fastx: str, outdir: str, file_num=1, balanced=False) -> list:
     fastx_type = fastx_format_check(fastx)
 
-    if fastx_type == 'fasta':
+    if fastx_type == 'fasta' and balanced:
+        split_files = split_fa_by_length(fastx, outdir, file_num)
+    elif fastx_type == 'fasta':
         split_files = split_fa(fastx, outdir, file_num)
     elif fastx_type == 'fastq':
         split_files = fq2fa(fastx, outdir, file_num)
@@ -137,6 +140,70 @@ def split_fa(fastx: str, outdir: str, file_num=1, max_seq_count=0):
     return outputs
 
 
+def split_fa_by_length(fastx: str, outdir: str, num_chunks=1) -> list:
+    """
+    Splits a FASTA file into (at most) num_chunks files with approximately equal total sequence lengths.
+    Unlike split_fa, which balances the size of the output files in the order sequences are read, the sequences are
+    assigned longest-first to the chunk with the smallest total length. This prevents a few long sequences (e.g. a
+    large contig) from being grouped together and dominating the runtime of whichever process handles that chunk.
+    Sequences within each chunk are written in the same order they appear in the input file.
+
+    :param fastx: Path to a FASTA file to be split
+    :param outdir: Path to write the output files
+    :param num_chunks: Number of files to split the input FASTA file into
+    :return: List of fasta files generated, ordered by their chunk number
+    """
+    start = time()
+    fastx = os.path.expanduser(fastx)
+    outdir = os.path.expanduser(outdir)
+    fa = Fasta(file_name=fastx, build_index=False, full_name=True)
+
+    file_name, _ = os.path.splitext(os.path.basename(fastx))
+    if fa.is_gzip:
+        file_name, _ = os.path.splitext(file_name)
+
+    # The first pass only records the sequence lengths
+    seq_lengths = [len(seq) for _, seq in fa]
+    if not seq_lengths:
+        logging.warning("No sequences were found in '{}' to split.\n".format(fastx))
+        return []
+
+    num_chunks = max(1, min(num_chunks, len(seq_lengths)))
+    chunk_heap = [(0, chunk) for chunk in range(num_chunks)]
+    seq_chunks = [0] * len(seq_lengths)
+    for seq_index in sorted(range(len(seq_lengths)), key=lambda i: seq_lengths[i], reverse=True):
+        chunk_len, chunk = heapq.heappop(chunk_heap)
+        seq_chunks[seq_index] = chunk
+        heapq.heappush(chunk_heap, (chunk_len + seq_lengths[seq_index], chunk))
+
+    outputs = []
+    file_handlers = []
+    for chunk in range(num_chunks):
+        fh, _ = spawn_new_file(chunk, outdir, file_name)
+        file_handlers.append(fh)
+        outputs.append(fh.name)
+
+    # Buffer the sequences for each chunk to reduce the number of I/O operations
+    buffers = [[] for _ in range(num_chunks)]
+    buffer_sizes = [0] * num_chunks
+    max_buffer_size = 1E5
+    for seq_index, (name, seq) in enumerate(Fasta(file_name=fastx, build_index=False, full_name=True)):
+        chunk = seq_chunks[seq_index]
+        buffers[chunk].append(">%s\n%s\n" % (name, seq))
+        buffer_sizes[chunk] += len(seq)
+        if buffer_sizes[chunk] >= max_buffer_size:
+            file_handlers[chunk].write("".join(buffers[chunk]))
+            buffers[chunk].clear()
+            buffer_sizes[chunk] = 0
+
+    for chunk in range(num_chunks):
+        file_handlers[chunk].write("".join(buffers[chunk]))
+        file_handlers[chunk].close()
+
+    logging.debug("{} completed split_fa_by_length in {}s.\n".format(fastx, time() - start))
+    return outputs
+
+
 def fq2fa(fastx: str, outdir: str, file_num=1, max_seq_count=0) -> list:
     """
     Credit: Lianming Du of pyfastx (v0.6.10)
@@ -747,19 +814,28 @@ def merge_fasta_dicts_by_index(extracted_seq_dict, numeric_contig_index):
     return merged_extracted_seq_dict
 
 
-def format_fasta(fasta_input: str, molecule: str, output_fasta: str, min_seq_length=10) -> dict:
+def format_fasta(fasta_input, molecule: str, output_fasta: str, min_seq_length=10, copy_fasta="") -> dict:
     """
     Reads a FASTA file, ensuring each sequence and sequence name is valid, and writes the valid sequence to a new FASTA.
     Only headers are read into memory and the formatted FASTA is saved to a buffer before written to a file and cleared.
 
-    :param fasta_input: Absolute path of the FASTA file to be read
+    Multiple FASTA files can be provided as an iterable of paths, in which case they are formatted as if they were
+    concatenated. Since the iterable is consumed lazily, a generator that yields each file as it is created
+    (e.g. by Prodigal) allows the files to be formatted while the remaining ones are still being written.
+
+    :param fasta_input: Absolute path of the FASTA file to be read, or an iterable of paths to FASTA files
     :param molecule: Molecule type of the sequences ['prot', 'dna', 'rrna']
     :param output_fasta: Path to the formatted FASTA file to write
     :param min_seq_length: All sequences shorter than this will not be included in the returned list.
+    :param copy_fasta: Optional path to a FASTA file where all of the sequences read, valid or not, are written
+     with their original names. This avoids a separate pass over the inputs to concatenate them.
     :return: A dictionary of Header instances indexed by a numerical identifier
     """
     start = time()
 
+    if isinstance(fasta_input, str):
+        fasta_input = [fasta_input]
+
     # Select the alphabet to use when determining whether there are any bad characters
     if molecule == "prot":
         bad_chars = re.compile(r"[OUou\d]")
@@ -770,6 +846,7 @@ def format_fasta(fasta_input: str, molecule: str, output_fasta: str, min_seq_len
     # Open the output FASTA for writing
     try:
         fa_out_handle = open(output_fasta, 'w')
+        copy_handle = open(copy_fasta, 'w') if copy_fasta else None
     except IOError:
         logging.error("Unable to open '{}' for writing.\n")
         sys.exit(15)
@@ -778,24 +855,41 @@ def format_fasta(fasta_input: str, molecule: str, output_fasta: str, min_seq_len
     max_buffer_size = 1E4
     seq_acc = 0
     fasta_string = ""
-    for name, seq in Fasta(fasta_input, build_index=False, full_name=True):  # type: (str, str)
-        if len(seq) < min_seq_length:
-            continue
-        if bad_chars.search(seq):
-            bad_seqs.add(name)
+    copy_string = ""
+    fasta_files = []
+    for fasta_file in fasta_input:
+        fasta_files.append(fasta_file)
+        if os.path.getsize(fasta_file) == 0:
+            # e.g. Prodigal did not predict any ORFs for a chunk of the input
             continue
+        for name, seq in Fasta(fasta_file, build_index=False, full_name=True):  # type: (str, str)
+            if copy_handle:
+                copy_string += ">{}\n{}\n".format(name, seq)
+                if len(copy_string) > max_buffer_size:
+                    copy_handle.write(copy_string)
+                    copy_string = ""
+            if len(seq) < min_seq_length:
+                continue
+            if bad_chars.search(seq):
+                bad_seqs.add(name)
+                continue
 
-        seq_acc += 1
-        headers.append(name)
-        fasta_string += ">{}\n{}\n".format(seq_acc, seq)
+            seq_acc += 1
+            headers.append(name)
+            fasta_string += ">{}\n{}\n".format(seq_acc, seq)
 
-        # Write the fasta_string to the output fasta if the size exceeds the max_buffer_size
-        if len(fasta_string) > max_buffer_size:
-            fa_out_handle.write(fasta_string)
-            fasta_string = ""
+            # Write the fasta_string to the output fasta if the size exceeds the max_buffer_size
+            if len(fasta_string) > max_buffer_size:
+                fa_out_handle.write(fasta_string)
+                fasta_string = ""
 
     # Write the final chunk in the FASTA file
     fa_out_handle.write(fasta_string)
+    fa_out_handle.close()
+    if copy_handle:
+        copy_handle.write(copy_string)
+        copy_handle.close()
+    fasta_input = ", ".join(fasta_files)
 
     end = time()
     logging.debug("{} read by pyfastx in {} seconds.\n".format(fasta_input, round(end-start, 2)))
@@ -3,19 +3,26 @@
 import sys
 import os
 import re
+import gzip
+import hashlib
 import logging
 from glob import glob
 
 from collections import namedtuple
-from pygtrie import StringTrie
 
 from treesapp.classy import Cluster, BlastAln
 from treesapp.refpkg import ReferencePackage
 from treesapp.fasta import read_fasta_to_dict
 from treesapp import hmmer_tbl_parser
+from treesapp.taxonomy_index import TaxonomyIndex
 
 __author__ = 'Connor Morgan-Lang'
 
+CLASSIFICATION_TABLE_FIELDS = ["Sample", "Query", "Marker", "Start_pos", "End_pos", "Taxonomy", "Abundance",
+                               "iNode", "E-value", "LWR", "EvoDist", "Distances"]
+# The type of each classification table field, so the numerical columns are stored as numbers in Parquet tables
+CLASSIFICATION_TABLE_TYPES = [str, str, str, int, int, str, float, int, float, float, float, str]
+
 
 def gather_ref_packages(refpkg_data_dir: str, targets=None) -> dict:
     """
@@ -154,20 +161,168 @@ def parse_assignments(classified_lines: list) -> dict:
     return assignments
 
 
-def read_classification_table(assignment_file) -> list:
+def type_classification_fields(fields) -> list:
     """
-    Function for reading the tabular assignments file (currently marker_contig_map.tsv)
-    Assumes column 2 is the TreeSAPP assignment and column 3 is the sequence header
-    (leaving 1 for marker name and 4 for numerical abundance)
+    Converts the fields of a classification table row to the types in CLASSIFICATION_TABLE_TYPES.
+    Missing values (None or 'None') are left as None.
 
-    :param assignment_file: Path to the file containing sequence phylogenetic origin and assignment
-    :return: A list of lines that have been split by tabs into lists themselves
+    :param fields: A list of the classification table's fields for a single row, as strings or their proper types
+    :return: A list of the fields converted to their respective types
     """
-    classified_lines = list()
-    header = "Sample\tQuery\tMarker\tStart_pos\tEnd_pos\tTaxonomy\tAbundance\tiNode\tE-value\tLWR\tEvoDist\tDistances\n"
+    return [None if value is None or value == "None" else field_type(value)
+            for field_type, value in zip(CLASSIFICATION_TABLE_TYPES, fields)]
+
+
+def format_classification_line(fields) -> str:
+    return "\t".join([str(field) for field in fields]) + "\n"
+
+
+def file_sha1(file_path: str) -> str:
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as file_handler:
+        for chunk in iter(lambda: file_handler.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def count_table_rows(table_path: str) -> int:
+    """
+    :param table_path: Path to a plain-text table with a header line
+    :return: The number of rows in the table, excluding the header
+    """
+    n_lines = 0
+    with open(table_path, 'rb') as table_handler:
+        for chunk in iter(lambda: table_handler.read(1 << 20), b''):
+            n_lines += chunk.count(b'\n')
+    return max(0, n_lines - 1)
+
+
+def parquet_matches_tsv(parquet_file: str, tsv_file: str) -> bool:
+    """
+    Determines whether a Parquet classification table holds the same rows as the plain-text version, as it will unless
+    the plain-text table has been modified since both were written.
+    Parquet tables store the SHA1 digest of the plain-text table they correspond to (see
+    assign.write_classification_parquet) which is compared to the digest of tsv_file. For Parquet tables lacking
+    this digest the number of rows are compared instead.
+
+    :param parquet_file: Path to a Parquet classification table
+    :param tsv_file: Path to the plain-text version of the same classification table
+    :return: True if the tables have the same content, otherwise False
+    """
+    import pyarrow.parquet as pq
 
     try:
-        assignments_handle = open(assignment_file, 'r')
+        parquet_meta = pq.read_metadata(parquet_file)
+    except (IOError, ValueError):
+        return False
+    key_values = parquet_meta.metadata if parquet_meta.metadata else {}
+    if b"tsv_sha1" in key_values:
+        return key_values[b"tsv_sha1"].decode("utf-8") == file_sha1(tsv_file)
+    return parquet_meta.num_rows == count_table_rows(tsv_file)
+
+
+def classification_table_variants(assignment_file: str) -> list:
+    """
+    A classification table may be written as plain-text (marker_contig_map.tsv), gzip-compressed (.tsv.gz) or as an
+    Apache Parquet file (.parquet). This returns the paths to all of these variants that exist for assignment_file,
+    ordered from the fastest to the slowest to read. Parquet is only considered if pyarrow can be imported and
+    its content matches the plain-text version, which is not the case if the plain-text table was modified after the
+    Parquet table was written. The gzip-compressed table is only read when there is no plain-text table.
+
+    :param assignment_file: Path to any variant of the classification table (e.g. final_outputs/marker_contig_map.tsv)
+    :return: A list of paths to classification tables that exist, the first being the fastest to read
+    """
+    table_stem = assignment_file
+    for suffix in [".tsv.gz", ".tsv", ".parquet"]:
+        if assignment_file.endswith(suffix):
+            table_stem = assignment_file[:-len(suffix)]
+            break
+
+    tsv_file = table_stem + ".tsv"
+    variants = []
+    for suffix in [".parquet", ".tsv", ".tsv.gz"]:
+        table_path = table_stem + suffix
+        if not os.path.isfile(table_path):
+            continue
+        if suffix == ".parquet":
+            if not pyarrow_available():
+                continue
+            if os.path.isfile(tsv_file) and not parquet_matches_tsv(table_path, tsv_file):
+                logging.debug("Skipping '{}' as its rows differ from '{}'.\n".format(table_path, tsv_file))
+                continue
+        variants.append(table_path)
+
+    if assignment_file not in variants and os.path.isfile(assignment_file):
+        variants.append(assignment_file)
+    return variants
+
+
+def pyarrow_available() -> bool:
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+
+def read_classification_parquet(assignment_file: str, refpkgs=None, min_lwr=0.0) -> list:
+    """
+    Reads a classification table that was written in the Apache Parquet format, pushing the reference package and
+    likelihood weight ratio filters down to pyarrow so rows that fail are never loaded.
+    The typed values are formatted as they are in the plain-text table, so the rows are identical to those read from
+    the TSV variant.
+
+    :param assignment_file: Path to the Parquet classification table
+    :param refpkgs: An optional collection of reference package prefixes. Rows for other refpkgs are skipped.
+    :param min_lwr: Rows with a likelihood weight ratio less than this are skipped
+    :return: A list of lines that have been split by tabs into lists themselves, identical to the TSV format
+    """
+    import pyarrow.parquet as pq
+
+    filters = []
+    if refpkgs:
+        filters.append(("Marker", "in", list(refpkgs)))
+    if min_lwr > 0:
+        filters.append(("LWR", ">=", min_lwr))
+
+    try:
+        table = pq.read_table(assignment_file, filters=filters if filters else None)
+    except (IOError, ValueError) as err:
+        logging.error("Unable to read Parquet classification table '" + assignment_file + "':\n" + str(err) + "\n")
+        sys.exit(21)
+
+    if table.column_names != CLASSIFICATION_TABLE_FIELDS:
+        logging.error("Header of assignments file is unexpected!\n")
+        sys.exit(21)
+
+    columns = [[str(value) for value in table.column(field_name).to_pylist()]
+               for field_name in CLASSIFICATION_TABLE_FIELDS]
+    return [list(fields) for fields in zip(*columns)]
+
+
+def iterate_classification_table(assignment_file, refpkgs=None, min_lwr=0.0):
+    """
+    Generator for the rows of a classification table, yielded as they are read.
+    See read_classification_table for a description of the parameters.
+
+    :return: A generator of lists, each containing the fields of a classification table row
+    """
+    header = "\t".join(CLASSIFICATION_TABLE_FIELDS) + "\n"
+    if refpkgs:
+        refpkgs = set(refpkgs)
+
+    variants = classification_table_variants(assignment_file)
+    if variants:
+        assignment_file = variants[0]
+    if assignment_file.endswith(".parquet"):
+        yield from read_classification_parquet(assignment_file, refpkgs, min_lwr)
+        return
+
+    try:
+        if assignment_file.endswith(".gz"):
+            assignments_handle = gzip.open(assignment_file, 'rt')
+        else:
+            assignments_handle = open(assignment_file, 'r')
     except IOError:
         logging.error("Unable to open classification file '" + assignment_file + "' for reading.\n")
         sys.exit(21)
@@ -183,19 +338,35 @@ def read_classification_table(assignment_file) -> list:
         sys.exit(21)
 
     # First line in the table containing data
-    line = assignments_handle.readline()
     n_fields = len(header_line.split("\t"))
-    while line:
-        fields = line.strip().split('\t')
-        if len(fields) == n_fields:
-            classified_lines.append(fields)
-        else:
-            logging.error("Unable to parse line:\n" + str(line))
-            sys.exit(21)
-        line = assignments_handle.readline()
-    assignments_handle.close()
+    with assignments_handle:
+        for line in assignments_handle:
+            fields = line.strip().split('\t')
+            if len(fields) != n_fields:
+                logging.error("Unable to parse line:\n" + str(line))
+                sys.exit(21)
+            if refpkgs and fields[2] not in refpkgs:
+                continue
+            if min_lwr > 0 and float(fields[9]) < min_lwr:
+                continue
+            yield fields
 
-    return classified_lines
+
+def read_classification_table(assignment_file, refpkgs=None, min_lwr=0.0) -> list:
+    """
+    Function for reading the tabular assignments file (currently marker_contig_map.tsv)
+    Assumes column 2 is the TreeSAPP assignment and column 3 is the sequence header
+    (leaving 1 for marker name and 4 for numerical abundance)
+
+    The fastest variant of the classification table that is available (see classification_table_variants) is read.
+    Rows can be filtered while reading to avoid loading classifications that will be discarded.
+
+    :param assignment_file: Path to the file containing sequence phylogenetic origin and assignment
+    :param refpkgs: An optional collection of reference package prefixes. Rows for other refpkgs are skipped.
+    :param min_lwr: Rows with a likelihood weight ratio less than this are skipped
+    :return: A list of lines that have been split by tabs into lists themselves
+    """
+    return list(iterate_classification_table(assignment_file, refpkgs, min_lwr))
 
 
 def best_discrete_matches(matches: list) -> list:
@@ -246,7 +417,8 @@ def parse_domain_tables(args, hmm_domtbl_files: list) -> dict:
     """
 
     :param args:
-    :param hmm_domtbl_files: A list of domain table files written by hmmsearch
+    :param hmm_domtbl_files: A list of domain table files written by hmmsearch, or DomainTableParser instances that
+     have already read their domain tables (e.g. from wrapper.stream_hmmsearch)
     :return: Dictionary of HmmMatch objects indexed by their reference package and/or HMM name
     """
     # Check if the HMM filtering thresholds have been set
@@ -261,9 +433,13 @@ def parse_domain_tables(args, hmm_domtbl_files: list) -> dict:
 
     # TODO: Capture multimatches across multiple domain table files
     for domtbl_file in hmm_domtbl_files:
-        prefix, reference = re.sub("_domtbl.txt", '', os.path.basename(domtbl_file)).split("_to_")
-        domain_table = hmmer_tbl_parser.DomainTableParser(domtbl_file)
-        domain_table.read_domtbl_lines()
+        if isinstance(domtbl_file, hmmer_tbl_parser.DomainTableParser):
+            domain_table = domtbl_file
+            reference = "ORFs"
+        else:
+            prefix, reference = re.sub("_domtbl.txt", '', os.path.basename(domtbl_file)).split("_to_")
+            domain_table = hmmer_tbl_parser.DomainTableParser(domtbl_file)
+            domain_table.read_domtbl_lines()
         distinct_hits = hmmer_tbl_parser.format_split_alignments(domain_table, search_stats)
         purified_hits = hmmer_tbl_parser.filter_poor_hits(thresholds, distinct_hits, search_stats)
         complete_hits = hmmer_tbl_parser.filter_incomplete_hits(thresholds, purified_hits, search_stats)
@@ -829,8 +1005,52 @@ def read_annotation_mapping_file(annot_map_file: str) -> dict:
     return annot_map
 
 
+def read_reads_table(reads_table: str) -> list:
+    """
+    Reads a table describing the read sets (e.g. the samples of a time-series) to calculate abundances from.
+    The first column is the sample name, the second is the path to the FASTQ file and the optional third column is the
+    path to the FASTQ file containing the reverse mates. Lines beginning with '#' are ignored.
+    Sample names are used to name the alignment files so, as in create_dir_from_taxon_name, apostrophes are removed
+    and spaces and slashes are replaced by underscores.
+
+    :param reads_table: Path to a tab-delimited file
+    :return: A list of tuples, each with the sample name, forward FASTQ path and reverse FASTQ path (or None)
+    """
+    read_sets = list()
+    try:
+        reads_handler = open(reads_table)
+    except IOError:
+        logging.error("Unable to open reads table '{}' for reading!\n".format(reads_table))
+        sys.exit(3)
+
+    n = 0
+    for line in reads_handler:
+        n += 1
+        if not line.strip() or line[0] == '#':
+            continue
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) not in [2, 3] or not all(fields):
+            logging.error("Unexpected number of fields on line {} in {}!\n".format(n, reads_table) +
+                          "Each line must have a sample name, the path to a FASTQ file and,"
+                          " optionally, the path to a FASTQ file of reverse mates.\n")
+            sys.exit(9)
+        sample_name, forward = re.sub(r"([ /])", '_', re.sub("'", '', fields[0])), fields[1]
+        reverse = fields[2] if len(fields) == 3 else None
+        if sample_name in [read_set[0] for read_set in read_sets]:
+            logging.error("Sample name '{}' is used more than once in {}.\n".format(sample_name, reads_table))
+            sys.exit(9)
+        for fastq in [forward, reverse]:
+            if fastq and not os.path.isfile(fastq):
+                logging.error("FASTQ file '{}' for sample '{}' does not exist.\n".format(fastq, sample_name))
+                sys.exit(5)
+        read_sets.append((sample_name, forward, reverse))
+
+    reads_handler.close()
+    return read_sets
+
+
 def grab_graftm_taxa(tax_ids_file):
-    taxonomic_tree = StringTrie(separator='; ')
+    taxonomic_tree = TaxonomyIndex(separator='; ')
     with open(tax_ids_file) as tax_ids:
         header = tax_ids.readline().strip()
         last_rank = int(header[-1])
@@ -859,11 +1079,7 @@ def grab_graftm_taxa(tax_ids_file):
                     lineage_list.append(re.sub(r'_graftm_\d+$', '', rank))
                     # lineage_list.append(rank)
             lineage = re.sub('_', ' ', '; '.join(lineage_list))
-            i = 0
-            ranks = len(lineage)
-            while i < len(lineage):
-                taxonomic_tree["; ".join(lineage.split("; ")[:ranks - i])] = True
-                i += 1
+            taxonomic_tree.add(lineage, True, prefixes=True)
 
             line = tax_ids.readline().strip()
     return taxonomic_tree
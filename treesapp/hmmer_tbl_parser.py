@@ -373,12 +373,19 @@ class HmmMatch:
 class DomainTableParser(object):
 
     def __init__(self, dom_tbl):
+        """
+        :param dom_tbl: Either a path to a domain table or a text stream the domain table is being read from,
+         such as the standard output of hmmsearch run through external_command_interface.CommandPipeline
+        """
         self.alignments = {}
         self.i = 0
         self.lines = []
         self.size = 0
+        self.commentPattern = re.compile(r'^#')
+        if hasattr(dom_tbl, "readline"):
+            self.src = dom_tbl
+            return
         try:
-            self.commentPattern = re.compile(r'^#')
             self.src = open(dom_tbl)
         except IOError:
             logging.error("Could not open " + dom_tbl + " or file is not available for reading.\n")
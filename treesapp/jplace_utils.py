@@ -131,8 +131,8 @@ def jplace_parser(filename: str) -> JPlace:
     :return: JPlace object
     """
     jplace_data = JPlace()
-    with open(filename) as jplace:
-        jplace_json = load(jplace, encoding="utf-8")
+    with open(filename, encoding="utf-8") as jplace:
+        jplace_json = load(jplace)
         jplace_data.tree = jplace_json["tree"]
         # A list of strings
         if sys.version_info > (2, 9):
@@ -233,7 +233,9 @@ def organize_jplace_files(jplace_files: list) -> dict:
 
 def sub_indices_for_seq_names_jplace(jplace_dir, numeric_contig_index, refpkg_dict) -> None:
     """
-    Replaces the numerical identifier for each query sequence with their true names for all JPlace files in a directory
+    Replaces the numerical identifier for each query sequence with their true names for all JPlace files in a directory.
+    JPlace files whose names were already replaced, such as those from placements reused from a previous run,
+    are left unchanged.
 
     :param jplace_dir: A directory containing JPlace files (extension is .jplace)
     :param numeric_contig_index: A dictionary mapping numerical identifiers to sequence name strings
@@ -251,6 +253,8 @@ def sub_indices_for_seq_names_jplace(jplace_dir, numeric_contig_index, refpkg_di
             continue
         for jplace_path in jplace_files:
             jplace_data = jplace_parser(jplace_path)
+            if not all(str(pquery["n"][0]).lstrip('-').isdigit() for pquery in jplace_data.pqueries):
+                continue
             for pquery in jplace_data.pqueries:
                 pquery["n"] = numeric_contig_index[refpkg.prefix][int(pquery["n"][0])]
             jplace_data.pqueries = demultiplex_pqueries(jplace_data)
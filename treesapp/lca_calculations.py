@@ -4,27 +4,27 @@ __author__ = 'Connor Morgan-Lang'
 import re
 import logging
 
-from pygtrie import StringTrie
-
 from .utilities import median
+from .taxonomy_index import TaxonomyIndex
 
 
-def optimal_taxonomic_assignment(trie: StringTrie, query_taxon: str):
-    while not trie.__contains__(query_taxon) and len(query_taxon.split('; ')) > 1:
-        query_taxon = "; ".join(query_taxon.split('; ')[:-1])
-    if not trie.__contains__(query_taxon):
-        query_taxon = "r__Root"
-    return query_taxon
+def optimal_taxonomic_assignment(trie: TaxonomyIndex, query_taxon: str):
+    """
+    :param trie: A TaxonomyIndex of the reference sequence lineages
+    :param query_taxon: The true lineage of a query sequence, where taxa are separated by '; '
+    :return: The most resolved lineage in trie that the query's lineage descends from, or 'r__Root' if there are none
+    """
+    return trie.longest_prefix(query_taxon) or "r__Root"
 
 
-def identify_excluded_clade(assignment_dict: dict, trie: StringTrie, marker: str) -> dict:
+def identify_excluded_clade(assignment_dict: dict, trie: TaxonomyIndex, marker: str) -> dict:
     """
     Using the taxonomic information from the sequence headers and the lineages of the reference sequence,
     this function determines the rank at which each sequence's clade is excluded.
     These data are returned and sorted in the form of a dictionary.
 
     :param assignment_dict:
-    :param trie: A pygtrie.StringTrie object containing all reference sequence lineages
+    :param trie: A TaxonomyIndex object containing all reference sequence lineages
     :param marker: Name of the marker gene being tested
 
     :return: rank_assigned_dict; key is rank, values are dictionaries with assigned (reference) lineage as key and
@@ -70,39 +70,49 @@ def identify_excluded_clade(assignment_dict: dict, trie: StringTrie, marker: str
     return rank_assigned_dict
 
 
-def megan_lca(lineage_list: list):
+def common_lineage_prefix(lineages: list) -> list:
+    """
+    Finds the taxa shared by all lineages, starting from the root, until the first rank where the lineages diverge.
+
+    :param lineages: A list of lineages, each a sequence of taxa (e.g. lists of taxon names or tuples of taxon IDs)
+    :return: A list of the taxa that all lineages have in common
+    """
+    common_prefix = []
+    for taxa in zip(*lineages):
+        first = taxa[0]
+        for taxon in taxa[1:]:
+            if taxon != first:
+                return common_prefix
+        common_prefix.append(first)
+    return common_prefix
+
+
+def megan_lca(lineage_list: list, t_index=None):
     """
     Using the lineages of all leaves to which this sequence was mapped (n >= 1),
     A lowest common ancestor is found at the point which these lineages converge.
     This emulates the LCA algorithm employed by the MEtaGenome ANalyzer (MEGAN).
 
     :param lineage_list: List of '; '-separated lineage strings
+    :param t_index: An optional TaxonomyIndex containing the lineages, used to find their LCA without splitting them
     :return:
     """
     # If there is only one child, return the joined string
     if len(lineage_list) == 1:
         return "; ".join(lineage_list[0])
 
-    listed_lineages = [lineage.strip().split("; ") for lineage in lineage_list]
-    max_depth = max([len(lineage) for lineage in listed_lineages])
-    lca_set = set()
-    lca_lineage_strings = list()
-    i = 0
-    while i < max_depth:
-        contributors = 0
-        for lineage in sorted(listed_lineages):
-            try:
-                lca_set.add(lineage[i])
-                contributors += 1
-            except IndexError:
-                pass
-
-        if len(lca_set) == 1 and contributors == len(listed_lineages):
-            lca_lineage_strings.append(list(lca_set)[0])
-            i += 1
-            lca_set.clear()
+    if t_index is not None:
+        try:
+            lca_lineage = t_index.lineage_lca([lineage.strip() for lineage in lineage_list])
+        except KeyError:
+            pass
         else:
-            i = max_depth
+            if not lca_lineage:
+                logging.debug("Empty LCA from lineages:\n\t" + "\n\t".join(lineage_list) + "\n")
+                lca_lineage = "Unclassified"
+            return lca_lineage
+
+    lca_lineage_strings = common_lineage_prefix([lineage.strip().split("; ") for lineage in lineage_list])
     if len(lca_lineage_strings) == 0:
         logging.debug("Empty LCA from lineages:\n\t" + "\n\t".join(lineage_list) + "\n")
         lca_lineage_strings.append("Unclassified")
@@ -112,7 +122,9 @@ def megan_lca(lineage_list: list):
 
 def weighted_taxonomic_distance(lineage_list, common_ancestor):
     """
-    Input is a list >= 2, potentially either a leaf string or NCBI lineage
+    Input is a list >= 2, potentially either a leaf string or NCBI lineage.
+    The lineages may also be tuples of taxon IDs from TaxonomicHierarchy.intern_lineage,
+    in which case common_ancestor must be too.
 
     :param lineage_list: Lineages of all leaves for this sequence
     :param common_ancestor: The common ancestor for the elements in lineage_list
@@ -124,7 +136,7 @@ def weighted_taxonomic_distance(lineage_list, common_ancestor):
     for lineage in lineage_list:
         distance, status = compute_taxonomic_distance(lineage, common_ancestor)
         if status:
-            logging.debug("Taxonomic lineages didn't converge between " + common_ancestor + " and " + lineage + ".\n")
+            logging.debug("Taxonomic lineages didn't converge between {} and {}.\n".format(common_ancestor, lineage))
         status += 1
 
         numerator += 2**distance
@@ -133,35 +145,25 @@ def weighted_taxonomic_distance(lineage_list, common_ancestor):
     return wtd, status
 
 
-def compute_taxonomic_distance(ref_lineage: str, query_lineage: str):
+def compute_taxonomic_distance(ref_lineage, query_lineage):
     """
     Calculates the number of taxonomic ranks need to be climbed in the taxonomic hierarchy before a common ancestor
     is identified between the two taxa.
     If no common ancestor is reached, the distance is returned along with a status of 1 to indicate non-convergence.
 
-    :param ref_lineage: A taxonomic lineage string, where each rank is separated by semi-colons (;)
-    :param query_lineage: Another taxonomic lineage string, where each rank is separated by semi-colons (;)
+    :param ref_lineage: A taxonomic lineage string, where each rank is separated by semi-colons (;),
+     or a tuple of taxon IDs
+    :param query_lineage: Another taxonomic lineage string, where each rank is separated by semi-colons (;),
+     or a tuple of taxon IDs
     :return: Tuple of (distance, status)
     """
-    distance = 0
-    l1 = ref_lineage.split("; ")
-    l2 = query_lineage.split("; ")
-    # Compare the last elements of each list to see if the lineage is equal
-    try:
-        while l1 != l2:
-            if len(l1) > len(l2):
-                l1 = l1[:-1]
-            elif len(l2) > len(l1):
-                l2 = l2[:-1]
-            else:
-                # They are the same length, but disagree
-                l2 = l2[:-1]
-                l1 = l1[:-1]
-            distance += 1
-    except IndexError:
-        return distance, 1
-
-    return distance, 0
+    if isinstance(ref_lineage, str):
+        ref_lineage = ref_lineage.split("; ")
+    if isinstance(query_lineage, str):
+        query_lineage = query_lineage.split("; ")
+    # Climbing from the deeper lineage to the common ancestor is the distance
+    shared_depth = len(common_lineage_prefix([ref_lineage, query_lineage]))
+    return max(len(ref_lineage), len(query_lineage)) - shared_depth, 0
 
 
 def determine_offset(classified: str, optimal: str) -> int:
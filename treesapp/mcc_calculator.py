@@ -826,7 +826,7 @@ def mcc_calculator(sys_args):
     if args.tool == "treesapp":
         ref_pkgs = ','.join(test_obj.ref_packages.keys())
         classification_table = os.path.join(args.output, "TreeSAPP_output", "final_outputs", "marker_contig_map.tsv")
-        if not os.path.isfile(classification_table):
+        if not file_parsers.classification_table_variants(classification_table):
             classify_args = ["-i", args.input,
                              "-t", ref_pkgs,
                              "-n", str(args.num_threads),
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import pickle
+import logging
+from array import array
+
+__author__ = 'Connor Morgan-Lang'
+
+
+class NCBITaxonomy:
+    """
+    An in-memory copy of the NCBI taxonomy, loaded from the nodes.dmp and names.dmp files of an NCBI taxdump
+    (https://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz), for resolving NCBI taxids and organism names to
+    lineages without querying Entrez.
+
+    Parent taxids and ranks are stored in arrays indexed by taxid. Once the dump files are parsed this compact form is
+    written alongside them (see NCBITaxonomy.binary_name) so subsequent runs can load it rapidly.
+    """
+    binary_name = "taxdump.tspkl"
+    version = 2
+
+    def __init__(self):
+        self.parents = array('I')  # Parent taxid of each taxid; zero for taxids that are not in the taxonomy
+        self.ranks = array('B')  # Index of each taxid's rank in rank_names
+        self.rank_names = []
+        self.sci_names = dict()  # Scientific name of each taxid
+        self.name_taxids = dict()  # Taxid of each unambiguous name, of any class (e.g. synonym, equivalent name)
+        self.homonyms = dict()  # The taxids of names shared by multiple taxa (e.g. 'Bacteria')
+        self.merged = dict()  # Deprecated taxids mapped to the taxid they were merged into
+
+    def __len__(self):
+        return len(self.sci_names)
+
+    @staticmethod
+    def dmp_fields(line: str) -> list:
+        return line.rstrip("\t|\n").split("\t|\t")
+
+    def load_dump(self, taxdump_dir: str) -> None:
+        """
+        Parses the nodes.dmp, names.dmp and, if present, merged.dmp files from an NCBI taxdump directory.
+
+        :param taxdump_dir: Path to a directory containing the decompressed NCBI taxdump files
+        :return: None
+        """
+        logging.info("Reading the NCBI taxonomy from '{}'... ".format(taxdump_dir))
+        nodes_dmp = os.path.join(taxdump_dir, "nodes.dmp")
+        names_dmp = os.path.join(taxdump_dir, "names.dmp")
+        merged_dmp = os.path.join(taxdump_dir, "merged.dmp")
+        for dmp in [nodes_dmp, names_dmp]:
+            if not os.path.isfile(dmp):
+                logging.error("NCBI taxonomy dump file '{}' does not exist.\n".format(dmp))
+                sys.exit(5)
+
+        rank_index = dict()
+        with open(nodes_dmp) as nodes_handler:
+            for line in nodes_handler:
+                fields = self.dmp_fields(line)
+                taxid, parent = int(fields[0]), int(fields[1])
+                if taxid >= len(self.parents):
+                    extension = taxid + 1 - len(self.parents)
+                    self.parents.extend([0] * extension)
+                    self.ranks.extend([0] * extension)
+                if fields[2] not in rank_index:
+                    rank_index[fields[2]] = len(self.rank_names)
+                    self.rank_names.append(fields[2])
+                self.parents[taxid] = parent
+                self.ranks[taxid] = rank_index[fields[2]]
+
+        with open(names_dmp) as names_handler:
+            for line in names_handler:
+                fields = self.dmp_fields(line)
+                taxid, name, unique_name, name_class = fields[0:4]
+                if name_class == "scientific name":
+                    self.sci_names[taxid] = name
+                self.add_name(name, taxid)
+                # Homonyms are distinguished by their unique names, e.g. 'Bacteria <walking sticks>'
+                if unique_name:
+                    self.add_name(unique_name, taxid)
+
+        if os.path.isfile(merged_dmp):
+            with open(merged_dmp) as merged_handler:
+                for line in merged_handler:
+                    old_taxid, new_taxid = self.dmp_fields(line)[0:2]
+                    self.merged[old_taxid] = new_taxid
+        logging.info("done.\n")
+        logging.debug("{} taxa were loaded from the NCBI taxonomy.\n".format(len(self)))
+        return
+
+    def add_name(self, name: str, taxid: str) -> None:
+        if name in self.homonyms:
+            if taxid not in self.homonyms[name]:
+                self.homonyms[name].append(taxid)
+        elif self.name_taxids.get(name, taxid) != taxid:
+            self.homonyms[name] = [self.name_taxids.pop(name), taxid]
+        else:
+            self.name_taxids[name] = taxid
+        return
+
+    def save(self, binary_path: str) -> None:
+        tmp_path = binary_path + ".tmp"
+        with open(tmp_path, 'wb') as binary_handler:
+            # The version is written first so it can be checked without loading the rest
+            pickle.dump(self.version, binary_handler, protocol=4)
+            pickle.dump((self.parents, self.ranks, self.rank_names,
+                         self.sci_names, self.name_taxids, self.homonyms, self.merged), binary_handler, protocol=4)
+        os.replace(tmp_path, binary_path)
+        return
+
+    @classmethod
+    def binary_version(cls, binary_path: str):
+        try:
+            with open(binary_path, 'rb') as binary_handler:
+                return pickle.load(binary_handler)
+        except (IOError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def load_binary(self, binary_path: str) -> None:
+        if self.binary_version(binary_path) != self.version:
+            logging.error("Unable to read NCBI taxonomy from '{}'. If it was written by a different version of"
+                          " TreeSAPP please provide the NCBI taxdump directory so it can be rebuilt.\n"
+                          "".format(binary_path))
+            sys.exit(5)
+        with open(binary_path, 'rb') as binary_handler:
+            pickle.load(binary_handler)
+            (self.parents, self.ranks, self.rank_names,
+             self.sci_names, self.name_taxids, self.homonyms, self.merged) = pickle.load(binary_handler)
+        return
+
+    def resolve_taxid(self, taxid: str) -> str:
+        taxid = self.merged.get(str(taxid), str(taxid))
+        return taxid if taxid in self.sci_names else ""
+
+    def taxid_from_name(self, organism: str, lineage="") -> str:
+        """
+        Finds the taxid of a taxon by its name. Names shared by multiple taxa (homonyms) are resolved to the only taxon
+        with it as its scientific name or, failing that, the taxon with the most ancestors in the lineage provided.
+
+        :param organism: The name of a taxon, either its scientific name or any other name in names.dmp
+        :param lineage: The lineage of the taxon, with ranks separated by '; ', used to tell homonyms apart [OPTIONAL]
+        :return: The NCBI taxid of the taxon or an empty string if the name is not in the taxonomy or is ambiguous
+        """
+        if organism not in self.homonyms:
+            return self.name_taxids.get(organism, "")
+
+        candidates = [taxid for taxid in self.homonyms[organism] if self.sci_names.get(taxid) == organism]
+        if len(candidates) != 1 and lineage:
+            # Rank prefixes (e.g. 'd__') are removed so the names can be compared
+            lineage_names = {re.sub(r"^[a-z]__", '', name) for name in lineage.split("; ")}
+            shared = {taxid: len(lineage_names.intersection(ancestor["ScientificName"]
+                                                            for ancestor in self.lineage_ex(taxid)))
+                      for taxid in self.homonyms[organism]}
+            most_shared = max(shared.values())
+            candidates = [taxid for taxid, num_shared in shared.items() if num_shared == most_shared > 0]
+        if len(candidates) == 1:
+            return candidates[0]
+        logging.debug("Name '{}' is shared by NCBI taxids {}.\n".format(organism, ", ".join(self.homonyms[organism])))
+        return ""
+
+    def is_ambiguous(self, organism: str) -> bool:
+        return organism in self.homonyms
+
+    def rank(self, taxid: str) -> str:
+        return self.rank_names[self.ranks[int(taxid)]]
+
+    def lineage_ex(self, taxid: str) -> list:
+        """
+        The ancestors of a taxon from the most inclusive (excluding the root) to its parent, like the 'LineageEx'
+        of an Entrez Taxonomy record.
+
+        :param taxid: An NCBI taxid in the taxonomy
+        :return: A list of dictionaries with the TaxId, ScientificName and Rank of each ancestor
+        """
+        ancestors = []
+        node = self.parents[int(taxid)]
+        while node > 1:
+            ancestors.append({"TaxId": str(node), "ScientificName": self.sci_names[str(node)],
+                              "Rank": self.rank_names[self.ranks[node]]})
+            parent = self.parents[node]
+            if parent == node:
+                break
+            node = parent
+        return ancestors[::-1]
+
+    def taxonomy_records(self, taxids: list) -> (list, list):
+        """
+        Creates records equivalent to those returned by Entrez for queries to the Taxonomy database,
+        with the TaxId, ScientificName, Rank, Lineage and LineageEx keys. Merged taxids are resolved to their current
+        taxon though the record's TaxId is the one queried so records can be matched to their queries.
+
+        :param taxids: A list of NCBI taxids
+        :return: A list of records (dictionaries) and a list of the taxids that are not in the taxonomy
+        """
+        records = []
+        failures = []
+        for query in taxids:
+            taxid = self.resolve_taxid(query)
+            if not taxid:
+                failures.append(str(query))
+                continue
+            lineage_ex = self.lineage_ex(taxid)
+            records.append({"TaxId": str(query),
+                            "ScientificName": self.sci_names[taxid],
+                            "Rank": self.rank(taxid),
+                            "Lineage": "; ".join([ancestor["ScientificName"] for ancestor in lineage_ex]),
+                            "LineageEx": lineage_ex})
+        if failures:
+            logging.warning("{} NCBI taxids were not found in the local NCBI taxonomy:\n\t{}\n"
+                            "".format(len(failures), ", ".join(failures)))
+        return records, failures
+
+
+def load_ncbi_taxonomy(taxdump_path: str) -> NCBITaxonomy:
+    """
+    Loads the NCBI taxonomy from either an NCBI taxdump directory or the binary form written by NCBITaxonomy.save.
+    If a taxdump directory contains the binary form, written by this version and newer than nodes.dmp and names.dmp,
+    the binary is read.
+    Otherwise the dump files are parsed and the binary is written to the directory, if possible, for future runs.
+
+    :param taxdump_path: Path to an NCBI taxdump directory or a binary NCBI taxonomy file
+    :return: An NCBITaxonomy instance
+    """
+    taxonomy = NCBITaxonomy()
+    if os.path.isfile(taxdump_path):
+        taxonomy.load_binary(taxdump_path)
+        return taxonomy
+    if not os.path.isdir(taxdump_path):
+        logging.error("NCBI taxonomy dump '{}' does not exist.\n".format(taxdump_path))
+        sys.exit(5)
+
+    binary_path = os.path.join(taxdump_path, NCBITaxonomy.binary_name)
+    dmp_files = [os.path.join(taxdump_path, dmp) for dmp in ["nodes.dmp", "names.dmp"]]
+    if os.path.isfile(binary_path) and NCBITaxonomy.binary_version(binary_path) == NCBITaxonomy.version and \
+            all(os.path.getmtime(binary_path) >= os.path.getmtime(dmp) for dmp in dmp_files if os.path.isfile(dmp)):
+        taxonomy.load_binary(binary_path)
+        return taxonomy
+
+    taxonomy.load_dump(taxdump_path)
+    try:
+        taxonomy.save(binary_path)
+    except (IOError, OSError) as err:
+        logging.debug("Unable to write the NCBI taxonomy to '{}': {}\n".format(binary_path, err))
+    return taxonomy
@@ -179,6 +179,26 @@ class PQuery:
     #     self.version = jplace_inst.version
     #     self.metadata = jplace_inst.metadata
 
+    def transfer_classification(self, pquery) -> None:
+        """
+        Copies the placements and classification of another PQuery, such as the representative of a group of
+        identical query sequences that was placed on their behalf. The names, coordinates and homology search
+        information of this PQuery are unchanged.
+
+        :param pquery: The PQuery instance to copy the placements and classification from
+        :return: None
+        """
+        self.placements = list(pquery.placements)
+        self.consensus_placement = pquery.consensus_placement
+        self.classified = pquery.classified
+        self.parent_node = pquery.parent_node
+        self.wtd = pquery.wtd
+        self.lct = pquery.lct
+        self.recommended_lineage = pquery.recommended_lineage
+        self.avg_evo_dist = pquery.avg_evo_dist
+        self.distances = pquery.distances
+        return
+
     def summarize(self) -> str:
         summary_str = "Summarizing placement of query '{}' onto the {} reference tree:\n" \
                       "".format(self.seq_name, self.ref_name)
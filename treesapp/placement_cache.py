@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+
+from treesapp.phylo_seq import PQuery, PhyloPlace
+from treesapp.refpkg import ReferencePackage
+
+__author__ = 'Connor Morgan-Lang'
+
+
+class PlacementCache:
+    """
+    A persistent cache of query sequence classifications that is shared across *treesapp assign* runs, backed by an
+    SQLite database. Entries are keyed by the sequence that would be placed, the reference package (its code and the
+    dates it was built and updated) and the parameters that influence classification, so a sequence classified by a
+    previous run does not need to be aligned and placed again.
+
+    The number of entries is bounded; the least recently used entries are evicted once there are more than max_entries.
+    Writes are made in immediate transactions with write-ahead logging so several runs on the same node can
+    read and write the cache concurrently.
+    """
+    # The number of keys looked up in each SELECT, below SQLite's default limit of host parameters
+    batch_size = 500
+
+    def __init__(self, db_path: str, max_entries=1000000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        try:
+            # Transactions are managed explicitly, rather than by the sqlite3 module, to use BEGIN IMMEDIATE
+            self.conn = sqlite3.connect(db_path, timeout=120, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS placements "
+                              "(key TEXT PRIMARY KEY, refpkg TEXT, record TEXT, last_used REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON placements (last_used)")
+        except sqlite3.Error as err:
+            logging.error("Unable to open placement cache '{}':\n{}\n".format(db_path, err))
+            sys.exit(3)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+        return
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM placements").fetchone()[0]
+
+    @staticmethod
+    def cache_key(pquery: PQuery, refpkg: ReferencePackage, params: dict) -> str:
+        """
+        The key is a digest of the query's sequence over the aligned region (i.e. the sequence that is placed),
+        the reference package's identity and version, and the classification parameters.
+        """
+        sha = hashlib.sha256()
+        sha.update(pquery.seq[pquery.start - 1:pquery.end].upper().encode())
+        sha.update("\t".join([refpkg.prefix, refpkg.refpkg_code, refpkg.date, refpkg.update]).encode())
+        sha.update(json.dumps(params, sort_keys=True).encode())
+        return sha.hexdigest()
+
+    @staticmethod
+    def pquery_record(pquery: PQuery) -> dict:
+        record = {"classified": pquery.classified,
+                  "lct": pquery.lct,
+                  "recommended_lineage": pquery.recommended_lineage,
+                  "avg_evo_dist": pquery.avg_evo_dist,
+                  "distances": pquery.distances,
+                  "placement": None}
+        pplace = pquery.consensus_placement  # type: PhyloPlace
+        if pplace:
+            record["placement"] = [pplace.edge_num, pplace.like_weight_ratio, pplace.likelihood,
+                                   pplace.distal_length, pplace.pendant_length, pplace.mean_tip_length]
+        return record
+
+    @staticmethod
+    def load_record(pquery: PQuery, record: dict) -> None:
+        pquery.classified = record["classified"]
+        pquery.lct = record["lct"]
+        pquery.recommended_lineage = record["recommended_lineage"]
+        pquery.avg_evo_dist = record["avg_evo_dist"]
+        pquery.distances = record["distances"]
+        if record["placement"]:
+            pplace = PhyloPlace()
+            pplace.name = pquery.place_name
+            pplace.edge_num, pplace.like_weight_ratio, pplace.likelihood, \
+                pplace.distal_length, pplace.pendant_length, pplace.mean_tip_length = record["placement"]
+            pquery.consensus_placement = pplace
+        return
+
+    def lookup(self, pqueries: list, refpkg_dict: dict, params: dict) -> dict:
+        """
+        Finds the PQuery instances that were classified by a previous run, loading their classification.
+        The entries that were found are marked as recently used.
+
+        :param pqueries: A list of PQuery instances with their seq, start, end and ref_name attributes set
+        :param refpkg_dict: A dictionary of ReferencePackage instances indexed by their prefix values
+        :param params: A dictionary of the parameters that influence classification
+        :return: A dictionary of the PQuery instances found in the cache indexed by their place_name
+        """
+        keyed_pqueries = dict()
+        for pquery in pqueries:  # type: PQuery
+            if pquery.ref_name in refpkg_dict:
+                key = self.cache_key(pquery, refpkg_dict[pquery.ref_name], params)
+                keyed_pqueries.setdefault(key, []).append(pquery)
+
+        hits = dict()
+        found_keys = list()
+        keys = list(keyed_pqueries.keys())
+        for i in range(0, len(keys), self.batch_size):
+            batch = keys[i:i + self.batch_size]
+            rows = self.conn.execute("SELECT key, record FROM placements WHERE key IN (" +
+                                     ", ".join(["?"] * len(batch)) + ")", batch)
+            for key, record in rows:
+                found_keys.append(key)
+                for pquery in keyed_pqueries[key]:
+                    self.load_record(pquery, json.loads(record))
+                    hits[pquery.place_name] = pquery
+
+        if found_keys:
+            now = time.time()
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany("UPDATE placements SET last_used = ? WHERE key = ?",
+                                  [(now, key) for key in found_keys])
+            self.conn.execute("COMMIT")
+        logging.debug("{} of {} query sequences were found in the placement cache.\n".format(len(hits),
+                                                                                            len(pqueries)))
+        return hits
+
+    def store(self, tree_saps: dict, refpkg_dict: dict, params: dict) -> int:
+        """
+        Adds the classifications of PQuery instances to the cache, then evicts the least recently used entries
+        if the cache holds more than max_entries.
+
+        :param tree_saps: A dictionary of PQuery instances indexed by their reference package's prefix
+        :param refpkg_dict: A dictionary of ReferencePackage instances indexed by their prefix values
+        :param params: A dictionary of the parameters that influence classification
+        :return: The number of entries written
+        """
+        now = time.time()
+        rows = list()
+        for refpkg_name, pqueries in tree_saps.items():
+            refpkg = refpkg_dict[refpkg_name]
+            for pquery in pqueries:  # type: PQuery
+                if not pquery.seq:
+                    continue
+                rows.append((self.cache_key(pquery, refpkg, params), refpkg.prefix,
+                             json.dumps(self.pquery_record(pquery)), now))
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany("INSERT OR REPLACE INTO placements VALUES (?, ?, ?, ?)", rows)
+            self.evict()
+            self.conn.execute("COMMIT")
+        except sqlite3.Error:
+            self.conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used entries in excess of max_entries. Must be called within a transaction.
+
+        :return: The number of entries removed
+        """
+        excess = len(self) - self.max_entries
+        if excess <= 0:
+            return 0
+        self.conn.execute("DELETE FROM placements WHERE key IN "
+                          "(SELECT key FROM placements ORDER BY last_used LIMIT ?)", (excess,))
+        logging.debug("Evicted {} entries from the placement cache.\n".format(excess))
+        return excess
+
+
+def merge_cached_pqueries(tree_saps: dict, cached_pqueries: dict) -> int:
+    """
+    Adds the PQuery instances loaded from a PlacementCache to those classified in this run.
+    PQueries that were also placed in this run are not added again.
+
+    :param tree_saps: A dictionary of PQuery instances indexed by their reference package's prefix
+    :param cached_pqueries: A dictionary of PQuery instances indexed by their place_name, from PlacementCache.lookup
+    :return: The number of PQuery instances added
+    """
+    placed_names = {pquery.place_name for pqueries in tree_saps.values() for pquery in pqueries}
+    merged = 0
+    for place_name, pquery in cached_pqueries.items():  # type: (str, PQuery)
+        if place_name in placed_names:
+            continue
+        tree_saps.setdefault(pquery.ref_name, []).append(pquery)
+        merged += 1
+    return merged
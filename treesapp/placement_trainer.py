@@ -16,7 +16,7 @@ from treesapp.phylo_seq import PQuery
 from treesapp.phylo_dist import cull_outliers, regress_ranks
 from treesapp.taxonomic_hierarchy import TaxonomicHierarchy
 from treesapp.refpkg import ReferencePackage
-from treesapp.training_utils import rarefy_rank_distances, generate_pquery_data_for_trainer
+from treesapp.training_utils import rarefy_rank_distances, clade_exclusion_pqueries
 
 
 def fail_training(msg) -> None:
@@ -355,16 +355,12 @@ def clade_exclusion_phylo_placement(rank_training_seqs: dict,
 
     logging.info("Estimating branch-length placement distances for taxonomic ranks\n")
     pbar = tqdm(total=num_training_queries, ncols=100)
+    pbar.set_description("Placing excluded clades")
 
-    for rank in sorted(rank_training_seqs, reverse=True):
-        pbar.set_description("Processing %s" % rank)
-        pqueries[rank] = {}
-        for taxonomy in sorted(rank_training_seqs[rank]):
-            logging.debug("Testing placements for {}:\n".format(taxonomy))
-            pqueries[rank][taxonomy] = generate_pquery_data_for_trainer(ref_pkg, taxonomy, test_fasta,
-                                                                        rank_training_seqs[rank][taxonomy], rank,
-                                                                        executables, output_dir, pbar, raxml_threads)
-
+    # The taxa of all ranks are tested together so their external commands can be run in parallel
+    pqueries = clade_exclusion_pqueries(ref_pkg, rank_training_seqs, test_fasta,
+                                        executables, output_dir, pbar, raxml_threads)
+    for rank in pqueries:
         if len(pqueries[rank]) == 0:
             logging.debug("No samples available for " + rank + ".\n")
 
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import logging
+import resource
+
+__author__ = 'Connor Morgan-Lang'
+
+# Path to a JSON-lines file that external command profiles are appended to. Since it is a module-level variable it is
+# inherited by the processes forked to run commands in parallel (e.g. multiprocessing.Pool)
+_command_log = ""
+# Name of the stage that is currently running, used to attribute external commands to a stage
+_current_stage = ""
+# The peak RSS of this process each time it was reset, so stages enclosing a reset still report their true peak
+_rss_resets = []
+
+PROFILE_FIELDS = ["kind", "name", "stage", "wall_time", "cpu_user", "cpu_system", "child_cpu_user", "child_cpu_system",
+                  "max_rss_kb", "child_max_rss_kb", "read_bytes", "write_bytes", "child_read_bytes",
+                  "child_write_bytes"]
+
+
+def max_rss_kb(rusage) -> int:
+    # ru_maxrss is reported in bytes on macOS and kilobytes on Linux
+    if sys.platform == "darwin":
+        return int(rusage.ru_maxrss / 1024)
+    return int(rusage.ru_maxrss)
+
+
+def peak_rss_kb() -> int:
+    """
+    Reads the peak resident set size of this process since it was last reset (see reset_peak_rss) from
+    /proc/self/status. Elsewhere the high-water mark of the whole process is returned by getrusage.
+
+    :return: The peak RSS in kilobytes
+    """
+    try:
+        with open("/proc/self/status") as status_handler:
+            for line in status_handler:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (IOError, ValueError, IndexError):
+        pass
+    return max_rss_kb(resource.getrusage(resource.RUSAGE_SELF))
+
+
+def reset_peak_rss() -> None:
+    """
+    Resets the peak RSS of this process to its current RSS so the peak of each stage can be measured.
+    This is only possible on Linux; elsewhere each stage's peak RSS is the high-water mark of the whole process.
+
+    :return: None
+    """
+    peak = peak_rss_kb()
+    try:
+        with open("/proc/self/clear_refs", 'w') as clear_handler:
+            clear_handler.write("5")
+    except (IOError, OSError):
+        return
+    _rss_resets.append(peak)
+    return
+
+
+def process_io_bytes() -> (int, int):
+    """
+    Reads the number of bytes this process has caused to be read from and written to storage.
+    This information is only available on Linux, through /proc/self/io.
+
+    :return: A tuple of the bytes read and bytes written, both zero if unavailable
+    """
+    read_bytes, write_bytes = 0, 0
+    try:
+        with open("/proc/self/io") as io_handler:
+            for line in io_handler:
+                field, value = line.strip().split(": ")
+                if field == "read_bytes":
+                    read_bytes = int(value)
+                elif field == "write_bytes":
+                    write_bytes = int(value)
+    except (IOError, ValueError):
+        pass
+    return read_bytes, write_bytes
+
+
+def resource_usage() -> dict:
+    """
+    Takes a snapshot of the wall time, CPU time, peak resident set size (RSS) and I/O of this process
+    and of all its child processes that have terminated and been waited for.
+    The peak RSS of the child processes can not be reset, so it is always the high-water mark of all of them.
+
+    :return: A dictionary of resource measurements
+    """
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = process_io_bytes()
+    return {"wall_time": time.time(),
+            "cpu_user": self_usage.ru_utime,
+            "cpu_system": self_usage.ru_stime,
+            "child_cpu_user": child_usage.ru_utime,
+            "child_cpu_system": child_usage.ru_stime,
+            "max_rss_kb": peak_rss_kb(),
+            "child_max_rss_kb": max_rss_kb(child_usage),
+            "read_bytes": read_bytes,
+            "write_bytes": write_bytes,
+            # Block I/O operations are counted in 512-byte units
+            "child_read_bytes": child_usage.ru_inblock * 512,
+            "child_write_bytes": child_usage.ru_oublock * 512,
+            # The number of times the peak RSS had been reset, used by usage_delta
+            "rss_resets": len(_rss_resets)}
+
+
+def usage_delta(start: dict, end: dict) -> dict:
+    """
+    Calculates the resources used between two resource_usage snapshots.
+    The peak RSS values are not differences but the high-water marks at the time of the end snapshot.
+    Any peak recorded by reset_peak_rss since the start snapshot is included in the peak RSS of this process.
+
+    :param start: A resource_usage dictionary from the beginning of the measured interval
+    :param end: A resource_usage dictionary from the end of the measured interval
+    :return: A dictionary of resources used in the interval
+    """
+    delta = dict()
+    for field, value in end.items():
+        if field == "max_rss_kb":
+            delta[field] = max([value] + _rss_resets[start["rss_resets"]:])
+        elif field == "rss_resets":
+            continue
+        elif field.endswith("max_rss_kb"):
+            delta[field] = value
+        elif isinstance(value, float):
+            delta[field] = round(value - start[field], 4)
+        else:
+            delta[field] = value - start[field]
+    return delta
+
+
+def set_command_log(log_path: str) -> None:
+    global _command_log
+    _command_log = log_path
+    if log_path:
+        open(log_path, 'w').close()
+    return
+
+
+def get_command_log() -> str:
+    return _command_log
+
+
+def set_current_stage(stage_name: str) -> None:
+    global _current_stage
+    _current_stage = stage_name
+    return
+
+
+def record_command(cmd_list: list, wall_time: float, rusage) -> None:
+    """
+    Appends the resources used by an external command to the command log, if one has been set.
+    This should be called by the process that launched the command, with the resource usage returned by os.wait4 so
+    the resources are those of the command alone rather than all of the child processes that have terminated.
+
+    :param cmd_list: A list of strings forming the command that was run
+    :param wall_time: The number of seconds between the command being launched and it being waited for
+    :param rusage: The resource usage of the command's process, as returned by os.wait4
+    :return: None
+    """
+    if not _command_log or rusage is None:
+        return
+    record = {"kind": "command", "name": os.path.basename(cmd_list[0]), "stage": _current_stage,
+              "wall_time": round(wall_time, 4),
+              "child_cpu_user": round(rusage.ru_utime, 4),
+              "child_cpu_system": round(rusage.ru_stime, 4),
+              "child_max_rss_kb": max_rss_kb(rusage),
+              # Block I/O operations are counted in 512-byte units
+              "child_read_bytes": rusage.ru_inblock * 512,
+              "child_write_bytes": rusage.ru_oublock * 512,
+              "command": " ".join(cmd_list)}
+    try:
+        with open(_command_log, 'a') as log_handler:
+            log_handler.write(json.dumps(record) + "\n")
+    except IOError:
+        logging.debug("Unable to append command profile to '{}'.\n".format(_command_log))
+    return
+
+
+class StageProfiler:
+    """
+    Records the wall time, CPU time, peak RSS and bytes read and written for each stage of a TreeSAPP subcommand and
+    for each external command that was run, so it can be written as a profile of where the resources were spent.
+    """
+    def __init__(self, command: str):
+        self.command = command
+        self.records = []
+        self.started = dict()
+        self.current = ""
+        self.command_log = ""
+        # The stage of an enclosing subcommand (e.g. *treesapp assign* running *treesapp abundance*), if any
+        self.outer_stage = _current_stage
+        self.initial_usage = resource_usage()
+
+    def log_commands(self, log_path: str) -> None:
+        """
+        Begins recording external commands to log_path, unless this profiler was created during a stage of an enclosing
+        subcommand, in which case the commands are recorded by the enclosing subcommand's profiler.
+
+        :param log_path: Path to the JSON-lines file that external command profiles are appended to
+        :return: None
+        """
+        if self.command_log or (self.outer_stage and get_command_log()):
+            return
+        self.command_log = log_path
+        set_command_log(log_path)
+        return
+
+    def start(self, name: str) -> None:
+        """
+        Begins measuring a stage, stopping the stage that is currently being measured, if any.
+
+        :param name: Name of the stage
+        :return: None
+        """
+        if self.current:
+            self.stop()
+        self.current = name
+        # The peak RSS of this process is reset so it is the peak of this stage alone, where possible
+        reset_peak_rss()
+        self.started[name] = resource_usage()
+        set_current_stage(name)
+        return
+
+    def stop(self) -> None:
+        if not self.current:
+            return
+        record = {"kind": "stage", "name": self.current, "stage": self.current}
+        record.update(usage_delta(self.started[self.current], resource_usage()))
+        self.records.append(record)
+        self.current = ""
+        set_current_stage(self.outer_stage)
+        return
+
+    def summarize(self) -> list:
+        """
+        Stops the current stage and collects the stage, external command and overall records.
+
+        :return: A list of dictionaries, one for each record
+        """
+        self.stop()
+        records = list(self.records)
+        if self.command_log and os.path.isfile(self.command_log):
+            with open(self.command_log) as log_handler:
+                records += [json.loads(line) for line in log_handler if line.strip()]
+        total = {"kind": "total", "name": self.command, "stage": ""}
+        total.update(usage_delta(self.initial_usage, resource_usage()))
+        records.append(total)
+        return records
+
+    def write(self, output_prefix: str) -> list:
+        """
+        Writes the profile in both JSON and tab-separated formats to files named output_prefix + '.json' and '.tsv'.
+
+        :param output_prefix: Path prefix of the profile files
+        :return: A list of the profile records
+        """
+        records = self.summarize()
+        try:
+            with open(output_prefix + ".json", 'w') as json_handler:
+                json.dump({"command": self.command, "records": records}, json_handler, indent=2)
+            with open(output_prefix + ".tsv", 'w') as tsv_handler:
+                tsv_handler.write("\t".join(PROFILE_FIELDS) + "\n")
+                for record in records:
+                    tsv_handler.write("\t".join([str(record.get(field, "")) for field in PROFILE_FIELDS]) + "\n")
+        except IOError:
+            logging.error("Unable to write the resource profile to '{}'.\n".format(output_prefix))
+            sys.exit(3)
+
+        if self.command_log:
+            if os.path.isfile(self.command_log):
+                os.remove(self.command_log)
+            set_command_log("")
+            self.command_log = ""
+        return records
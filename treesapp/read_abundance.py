@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import logging
+
+__author__ = 'Connor Morgan-Lang'
+
+CIGAR_RE = re.compile(r"(\d+)([MIDNSHP=X])")
+
+
+class RefAbundance:
+    """
+    The read alignments to a single reference sequence (e.g. a classified ORF), reduced to the totals required for
+    its abundance, so alignments never need to be held in memory.
+    """
+    def __init__(self, name: str, length: int):
+        self.name = name
+        self.length = length
+        self.reads_mapped = 0
+        self.weight_total = 0.0
+        self.covered = 0.0
+        self.fpkm = 0.0
+        self.tpm = 0.0
+        self.intervals = []  # Half-open intervals of the reference sequence covered by reads, merged periodically
+
+    def add_alignment(self, start: int, end: int, weight: float) -> None:
+        self.reads_mapped += 1
+        self.weight_total += weight
+        self.intervals.append((start, end))
+        if len(self.intervals) >= 1024:
+            self.merge_intervals()
+        return
+
+    def merge_intervals(self) -> None:
+        merged = []
+        for start, end in sorted(self.intervals):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((start, end))
+        self.intervals = merged
+        return
+
+    def proportion_covered(self) -> float:
+        self.merge_intervals()
+        return sum(end - start for start, end in self.intervals) / self.length
+
+    def clear_alignments(self) -> None:
+        self.reads_mapped = 0
+        self.weight_total = 0.0
+        self.intervals.clear()
+        return
+
+
+class StreamingAbundance:
+    """
+    Calculates the abundance (FPKM and TPM) of reference sequences from SAM-formatted alignments as they are streamed,
+    for example from the standard output of BWA MEM. The alignments are filtered and weighted exactly as they are by
+    samsum's ref_sequence_abundances (with multireads=False), so the two give the same abundances:
+
+        - Lines with '*' for the reference name are unmapped reads. Each contributes half of a fragment if the library
+          is paired-end and one fragment if it is single-end.
+        - Other lines with the unmapped flag (e.g. the unaligned mate of an aligned read) are ignored.
+        - Secondary or supplementary alignments of paired reads are ignored. Those of single-end reads are counted.
+        - A read's weight is divided between its alignments in the same orientation, and halved if both mates aligned.
+        - Alignments that do not span any of the reference sequence are counted as unmapped.
+        - Reference sequences less than p_cov percent covered by reads are given an abundance of zero.
+
+    samsum never applies a mapping quality threshold, and its aligned percentage is calculated from a read length that
+    is mis-decoded as a denormal float so min_aln only ever removes the alignments above. Neither threshold is
+    accepted here.
+    A read's alignments are expected on consecutive lines, as they are written by BWA MEM.
+    """
+    def __init__(self, ref_lengths: dict, p_cov=50):
+        """
+        :param ref_lengths: A dictionary of reference sequence lengths indexed by their names (FASTA headers)
+        :param p_cov: The minimum percentage of a reference sequence covered by reads for it to be assigned abundance
+        """
+        self.p_cov = p_cov
+        self.unmapped_reads = 0
+        self.unmapped_weight = 0.0
+        self.num_alignments = 0
+        self.library_pairing = set()  # Whether the counted alignments were from paired reads
+        self._read_name = None
+        self._read_alignments = []
+        # SAM reference names are the first word of the FASTA header
+        self.references = {name.split(' ')[0]: RefAbundance(name, length) for name, length in ref_lengths.items()}
+
+    def add_sam_line(self, line: str) -> None:
+        if line[0] == '@':
+            return
+        fields = line.split('\t', 6)
+        qname, flag, rname, pos, _, cigar = fields[:6]
+        if rname[0] == '*':
+            self.unmapped_reads += 1
+            return
+        flag = int(flag)
+        paired = bool(flag & 0xC0)
+        # Ambiguously aligned paired reads (multireads) are not counted
+        if paired and bool(flag & 0x100) != bool(flag & 0x800):
+            return
+        if flag & 0x4:
+            return
+
+        if qname != self._read_name:
+            self.add_read()
+            self._read_name = qname
+        reverse = bool(flag & 0x80) and not flag & 0x40
+        self._read_alignments.append((rname, int(pos), cigar, reverse, paired))
+        return
+
+    def add_read(self) -> None:
+        """
+        Weights each of the buffered alignments of a read by the number of alignments in the same orientation and
+        whether both of its mates aligned, then adds them to their reference sequences.
+
+        :return: None
+        """
+        if not self._read_alignments:
+            return
+        num_fwd = sum(1 for aln in self._read_alignments if not aln[3])
+        num_rev = len(self._read_alignments) - num_fwd
+        pair_weight = 0.5 if num_fwd and num_rev else 1.0
+        for rname, pos, cigar, reverse, paired in self._read_alignments:
+            self.num_alignments += 1
+            self.library_pairing.add(paired)
+            weight = pair_weight / (num_rev if reverse else num_fwd)
+            ref_span = sum(int(length) for length, op in CIGAR_RE.findall(cigar) if op in "MDN=X")
+            if ref_span == 0:
+                self.unmapped_weight += weight
+                continue
+
+            try:
+                ref_seq = self.references[rname]
+            except KeyError:
+                logging.error("Reference sequence from the alignments not found in FASTA: {}\n".format(rname))
+                sys.exit(3)
+            ref_seq.add_alignment(pos, pos + ref_span, weight)
+        self._read_alignments.clear()
+        return
+
+    def count(self, sam_stream, tee=None) -> None:
+        """
+        Counts the alignments in sam_stream, line by line.
+
+        :param sam_stream: An iterable of SAM-formatted lines, such as a file handler or CommandPipeline.stdout
+        :param tee: An optional writable text stream that each line is also written to. If it is closed by its reader
+         (e.g. samtools exits) the lines are no longer written to it but are still counted.
+        :return: None
+        """
+        for line in sam_stream:
+            if tee:
+                try:
+                    tee.write(line)
+                except BrokenPipeError:
+                    logging.warning("The alignments could no longer be written, though they are still being counted.\n")
+                    tee = None
+            self.add_sam_line(line)
+        self.add_read()
+        return
+
+    def summarize(self) -> dict:
+        """
+        Filters the reference sequences with too little coverage and calculates the FPKM and TPM of the others.
+
+        :return: A dictionary of RefAbundance instances indexed by the reference sequence names
+        """
+        self.add_read()
+        if len(self.library_pairing) > 1:
+            logging.error("Mixture of single- and paired-end reads detected in alignments.\n")
+            sys.exit(5)
+        # Unmapped reads are taken to be paired when none of the reads aligned, as they are by samsum
+        if False in self.library_pairing:
+            self.unmapped_weight += self.unmapped_reads
+        else:
+            self.unmapped_weight += self.unmapped_reads * 0.5
+        self.unmapped_reads = 0
+
+        for ref_seq in self.references.values():  # type: RefAbundance
+            if ref_seq.reads_mapped == 0:
+                continue
+            ref_seq.covered = ref_seq.proportion_covered()
+            if 100 * ref_seq.covered < self.p_cov:
+                self.unmapped_weight += ref_seq.weight_total
+                ref_seq.clear_alignments()
+
+        mill_frags = (self.unmapped_weight + sum(r.weight_total for r in self.references.values())) / 1E6
+        fpkm_sum = 0.0
+        for ref_seq in self.references.values():
+            if ref_seq.weight_total > 0:
+                ref_seq.fpkm = (ref_seq.weight_total / ref_seq.length) / mill_frags
+                fpkm_sum += ref_seq.fpkm
+        for ref_seq in self.references.values():
+            if ref_seq.weight_total > 0:
+                ref_seq.tpm = 1E6 * ref_seq.fpkm / fpkm_sum
+        logging.debug("{} alignments were counted.\n".format(self.num_alignments))
+        return self.references
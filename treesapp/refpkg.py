@@ -14,7 +14,7 @@ from treesapp.phylo_seq import TreeLeafReference
 from treesapp.entish import annotate_partition_tree, label_internal_nodes_ete, verify_bifurcations
 from treesapp.external_command_interface import launch_write_command
 from treesapp.fasta import read_fasta_to_dict, write_new_fasta, multiple_alignment_dimensions, FASTA, register_headers
-from treesapp.taxonomic_hierarchy import TaxonomicHierarchy, Taxon
+from treesapp.taxonomic_hierarchy import TaxonomicHierarchy
 from treesapp.utilities import base_file_prefix, load_taxonomic_trie, match_file, get_hmm_value
 from treesapp import wrapper
 from treesapp import __version__ as ts_version
@@ -50,6 +50,7 @@ class ReferencePackage:
         self.f__model_info = self.prefix + "_epa.model"  # RAxML-NG --evaluate model file
         self.svc = None
         self.lineage_ids = dict()  # Reference sequence lineage map
+        self.entrez_accessions = []  # Accessions of the reference sequences whose lineages were fetched from Entrez
 
         # These are metadata values
         self.ts_version = ts_version
@@ -139,6 +140,7 @@ class ReferencePackage:
         for a, v in self.__iter__():
             if a not in non_primitives:
                 refpkg_dict[a] = v
+        refpkg_dict["taxa_trie_state"] = self.serialize_taxonomic_hierarchy()
 
         joblib.dump(value=refpkg_dict, filename=refpkg_handler)
 
@@ -269,6 +271,7 @@ class ReferencePackage:
             logging.error("Joblib was unable to load reference package pickle '{}'.\n".format(self.f__json))
             sys.exit(17)
 
+        taxa_trie_state = refpkg_data.pop("taxa_trie_state", None)
         for a, v in refpkg_data.items():
             self.__dict__[a] = v
 
@@ -283,7 +286,9 @@ class ReferencePackage:
                               "".format(self.prefix, self.f__json))
                 return
 
-        self.load_taxonomic_hierarchy()
+        # The hierarchy stored by pickle_package is only used if there are no other lineages in the hierarchy already
+        if self.taxa_trie.hierarchy or not self.taxa_trie.load_serialized(taxa_trie_state):
+            self.load_taxonomic_hierarchy()
 
         return
 
@@ -457,6 +462,19 @@ class ReferencePackage:
         self.taxa_trie.validate_rank_prefixes()
         return
 
+    def serialize_taxonomic_hierarchy(self) -> dict:
+        """
+        Builds the TaxonomicHierarchy of the reference package's current lineages, exactly as load_taxonomic_hierarchy
+        would, and serializes it (see TaxonomicHierarchy.serialize) so it can be stored in the pickled file.
+        The hierarchy is rebuilt since self.taxa_trie may have been modified or fed other lineages.
+
+        :return: The serialized TaxonomicHierarchy
+        """
+        t_hierarchy = TaxonomicHierarchy(self.taxa_trie.lin_sep)
+        t_hierarchy.feed_leaf_nodes(self.generate_tree_leaf_references_from_refpkg())
+        t_hierarchy.validate_rank_prefixes()
+        return t_hierarchy.serialize()
+
     def create_itol_labels(self, output_dir) -> None:
         """
         Create the marker_labels.txt file for each marker gene that was used for classification
@@ -742,7 +760,7 @@ class ReferencePackage:
         return
 
     def exclude_clade_from_ref_files(self, tmp_dir: str, target_clade: str, executables: dict,
-                                     fresh=False) -> None:
+                                     fresh=False, scheduler=None):
         """
         Removes all reference sequences/leaf nodes from a reference package that are descendents of a target clade.
         All reference package files are regenerated without these sequences and written to the original reference
@@ -750,6 +768,10 @@ class ReferencePackage:
 
         Original reference package files (so, still containing descendent sequences) are saved to a specified location.
 
+        If a CommandScheduler is provided the tree (when fresh) and RAxML-NG model parameter commands are submitted to
+        it rather than run, so the clades of many taxa can be excluded in parallel. Once the scheduler has run them,
+        ReferencePackage.finish_clade_exclusion must be called with the same tmp_dir.
+
         :param tmp_dir: Path to the treesapp/data (or reference package) directory for RAxML-NG to write
          output files from its `--evaluate` routine.
         :param target_clade: Taxonomic lineage of the clade that is being excluded from the reference package.
@@ -757,7 +779,8 @@ class ReferencePackage:
          'hmmbuild', 'FastTree' and 'raxml-ng'.
         :param fresh: Boolean indicating whether the reference package's tree should be built from scratch (True) or
          if the clades that are descendents of 'target_clade' should just be pruned (False) by ETE3
-        :return: None
+        :param scheduler: An optional CommandScheduler instance to submit the tree and model parameter commands to
+        :return: The CommandJob for the RAxML-NG model parameter command if a scheduler was provided, otherwise None
         """
         if tmp_dir[-1] != os.sep:
             tmp_dir = tmp_dir + os.sep
@@ -798,6 +821,7 @@ class ReferencePackage:
                              realign=False)
 
         # Trees
+        tree_job = None
         if fresh:
             tree_build_cmd = [executables["FastTree"]]
             if self.molecule == "rrna" or self.molecule == "dna":
@@ -806,11 +830,14 @@ class ReferencePackage:
                 tree_build_cmd += ["-lg", "-gamma"]
             tree_build_cmd += ["-out", self.f__tree]
             tree_build_cmd.append(self.f__msa)
-            logging.info("Building Approximately-Maximum-Likelihood tree with FastTree... ")
-            stdout, returncode = launch_write_command(tree_build_cmd, True)
-            with open(tmp_dir + os.sep + "FastTree_info." + self.prefix, 'w') as fast_info:
-                fast_info.write(stdout + "\n")
-            logging.info("done.\n")
+            if scheduler:
+                tree_job = scheduler.submit(tree_build_cmd, stdout=tmp_dir + "FastTree_info." + self.prefix)
+            else:
+                logging.info("Building Approximately-Maximum-Likelihood tree with FastTree... ")
+                stdout, returncode = launch_write_command(tree_build_cmd, True)
+                with open(tmp_dir + os.sep + "FastTree_info." + self.prefix, 'w') as fast_info:
+                    fast_info.write(stdout + "\n")
+                logging.info("done.\n")
         else:
             ref_tree = self.get_ete_tree()
             ref_tree.prune(off_target_ref_headers, preserve_branch_length=True)
@@ -819,12 +846,26 @@ class ReferencePackage:
 
         # Model parameters
         model_output_prefix = os.path.join(tmp_dir, "tree_data")
+        if scheduler:
+            model_eval_cmd, _ = wrapper.model_parameters_command(executables["raxml-ng"], self.f__msa, self.f__tree,
+                                                                 model_output_prefix, self.sub_model)
+            return scheduler.submit(model_eval_cmd, threads=2, depends_on=[tree_job] if tree_job else None)
         wrapper.model_parameters(executables["raxml-ng"],
                                  self.f__msa, self.f__tree, model_output_prefix, self.sub_model)
-        self.recover_raxmlng_model_outputs(model_output_prefix)
+        self.finish_clade_exclusion(tmp_dir)
 
-        self.band()
+        return None
+
+    def finish_clade_exclusion(self, tmp_dir: str) -> None:
+        """
+        Imports the RAxML-NG model parameters estimated for a reference package with a clade excluded
+        (see ReferencePackage.exclude_clade_from_ref_files) and writes the reference package's pickled file.
 
+        :param tmp_dir: The directory RAxML-NG wrote its outputs to, passed to exclude_clade_from_ref_files
+        :return: None
+        """
+        self.recover_raxmlng_model_outputs(os.path.join(tmp_dir, "tree_data"))
+        self.band()
         return
 
     def dereplicate_hmm(self, dereplication_rank: str, hmmbuild_exe, mafft_exe,
@@ -938,7 +979,7 @@ class ReferencePackage:
 
     def all_possible_assignments(self):
         """
-        Returns a StringTrie (prefix-tree) representation of the taxonomic lineages of the ReferencePackage
+        Returns a TaxonomyIndex (prefix-tree) representation of the taxonomic lineages of the ReferencePackage
         """
         if len(self.lineage_ids) == 0:
             logging.error("ReferencePackage.lineage_ids is empty - information hasn't been slurped up yet.\n")
@@ -990,9 +1031,9 @@ class ReferencePackage:
                 for c in n.children:
                     if not hasattr(c, "taxon"):
                         c.add_feature(pr_name="taxon", pr_value=None)
-                        c.taxon = Taxon.lca(c.children[0].taxon, c.children[1].taxon)
+                        c.taxon = self.taxa_trie.lca(c.children[0].taxon, c.children[1].taxon)
             l_node, r_node = n.get_children()
-            lca = Taxon.lca(l_node.taxon, r_node.taxon)
+            lca = self.taxa_trie.lca(l_node.taxon, r_node.taxon)
             n.taxon = lca
 
         return rt
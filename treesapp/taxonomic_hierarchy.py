@@ -3,10 +3,10 @@ __author__ = 'Connor Morgan-Lang'
 import logging
 import sys
 import re
-
-from pygtrie import StringTrie
+from array import array
 
 from treesapp.phylo_seq import TreeLeafReference
+from treesapp.taxonomy_index import TaxonomyIndex, EulerTourLCA
 
 
 class Taxon:
@@ -117,6 +117,8 @@ class TaxonomicHierarchy:
     """
     Used for storing and querying the taxonomic hierarchy of a reference package.
     """
+    serial_version = 1  # Incremented whenever the format returned by TaxonomicHierarchy.serialize changes
+
     def __init__(self, sep="; "):
         # Private variables - should not be changed after instantiation
         self.rank_name_map = {'superkingdom': 'domain', "strain": "type_strain"}
@@ -132,10 +134,19 @@ class TaxonomicHierarchy:
         self.no_rank_re = re.compile(r"^" + re.escape(self.no_rank_name[0] + self.taxon_sep) + r".*")
         self.conflicts = set()  # A tuple to store Taxon instances that create conflicting paths in the hierarchy
         # Main data structures
-        self.trie = StringTrie(separator=sep)  # Trie used for more efficient searches of taxa and whole lineages
+        self.trie = TaxonomyIndex(separator=sep)  # Prefix tree used for more efficient searches of whole lineages
         self.hierarchy = dict()  # Dict of prefix_taxon (e.g. p__Proteobacteria) name to Taxon instances
         self.rank_prefix_map = {self.no_rank_name[0]: {self.no_rank_name},  # Tracks prefixes representing ranks
                                 'r': {"root"}}
+        # Integer identifiers for taxa and interned lineages, used instead of strings in the classification hot paths
+        self.taxon_ids = dict()  # Maps prefix_taxon strings to their integer ID
+        self.taxon_names = list()  # The prefix_taxon strings, indexed by their integer ID
+        self.lineage_ids = dict()  # Maps lineage strings to a tuple of taxon IDs
+        self.lineage_strings = dict()  # Maps tuples of taxon IDs to lineage strings
+        # Euler tour of the hierarchy for constant-time LCA queries, built on demand and reset when taxa are re-parented
+        self.lca_table = None
+        self.lca_nodes = dict()  # Maps Taxon instances to their node in self.lca_table
+        self.lca_taxa = list()  # The Taxon instances, indexed by their node in self.lca_table
         # The following are used for tracking the state of the instance's data structures
         self.rooted = False
         self.trie_key_prefix = True  # Keeps track of the trie's prefix for automated updates
@@ -174,6 +185,72 @@ class TaxonomicHierarchy:
         else:
             return set([self.hierarchy[taxon].name for taxon in self.hierarchy])
 
+    def index_taxa(self) -> None:
+        """
+        Assigns an integer ID to every Taxon in the hierarchy, in sorted order of their rank-prefixed names, so the
+        same hierarchy always produces the same IDs. Taxa encountered later are assigned the next available IDs.
+
+        :return: None
+        """
+        for prefix_taxon in sorted(self.hierarchy):
+            if prefix_taxon not in self.taxon_ids:
+                self.taxon_ids[prefix_taxon] = len(self.taxon_names)
+                self.taxon_names.append(prefix_taxon)
+        return
+
+    def intern_taxon(self, prefix_taxon: str) -> int:
+        """
+        Retrieves the integer ID for a taxon name, assigning a new one if it has not been seen before.
+
+        :param prefix_taxon: A taxon name, typically with its rank-prefix (e.g. 'd__Bacteria')
+        :return: The integer ID of prefix_taxon
+        """
+        try:
+            return self.taxon_ids[prefix_taxon]
+        except KeyError:
+            if not self.taxon_ids and self.hierarchy:
+                self.index_taxa()
+                if prefix_taxon in self.taxon_ids:
+                    return self.taxon_ids[prefix_taxon]
+            taxon_id = len(self.taxon_names)
+            self.taxon_ids[prefix_taxon] = taxon_id
+            self.taxon_names.append(prefix_taxon)
+        return taxon_id
+
+    def intern_lineage(self, lineage: str) -> tuple:
+        """
+        Converts a lineage string into a tuple of taxon IDs. Identical lineages share the same tuple instance,
+        so these can be used as compact, hashable and quickly comparable representations of lineages.
+
+        :param lineage: A taxonomic lineage string where each rank is separated by self.lin_sep
+        :return: A tuple of the integer IDs for each taxon in lineage, ordered from the root
+        """
+        try:
+            return self.lineage_ids[lineage]
+        except KeyError:
+            pass
+        if lineage:
+            lineage_ids = tuple([self.intern_taxon(taxon) for taxon in lineage.split(self.lin_sep)])
+        else:
+            lineage_ids = tuple()
+        self.lineage_ids[lineage] = lineage_ids
+        self.lineage_strings.setdefault(lineage_ids, lineage)
+        return lineage_ids
+
+    def lineage_from_ids(self, lineage_ids: tuple) -> str:
+        """
+        The inverse of TaxonomicHierarchy.intern_lineage.
+
+        :param lineage_ids: A tuple of taxon IDs, ordered from the root
+        :return: The lineage string, where each rank is separated by self.lin_sep
+        """
+        try:
+            return self.lineage_strings[lineage_ids]
+        except KeyError:
+            lineage = self.lin_sep.join([self.taxon_names[taxon_id] for taxon_id in lineage_ids])
+            self.lineage_strings[lineage_ids] = lineage
+        return lineage
+
     def get_rank_from_lineage(self, prefix_taxon: str, rank: str):
         """
         Retrieves the Taxon of a specific rank from the lineage of a Taxon instance.
@@ -265,6 +342,70 @@ class TaxonomicHierarchy:
         except IndexError:
             self.so_long_and_thanks_for_all_the_fish("Empty taxon in lineage '{}'\n".format(lineage))
 
+    def build_lca_table(self) -> None:
+        """
+        Numbers every Taxon in the hierarchy, along with any ancestors that have since been removed from it, and builds
+        the EulerTourLCA used to answer lowest common ancestor queries between them.
+
+        :return: None
+        """
+        self.lca_nodes = dict()
+        self.lca_taxa = list()
+        for taxon in self.hierarchy.values():  # type: Taxon
+            while taxon is not None and taxon not in self.lca_nodes:
+                self.lca_nodes[taxon] = len(self.lca_taxa)
+                self.lca_taxa.append(taxon)
+                taxon = taxon.parent
+        parents = array('i', [self.lca_nodes[t.parent] if t.parent is not None else -1 for t in self.lca_taxa])
+        self.lca_table = EulerTourLCA(parents)
+        return
+
+    def reset_lca_table(self) -> None:
+        """
+        Must be called whenever the parent of a Taxon in the hierarchy is changed.
+        Taxa that are added to the hierarchy afterwards don't invalidate the table, as their LCA is found by Taxon.lca.
+        """
+        self.lca_table = None
+        return
+
+    def lca(self, left_taxon: Taxon, right_taxon: Taxon):
+        """
+        Finds the lowest common ancestor of two Taxon instances, returning the same as Taxon.lca but in constant time
+        after the LCA table is built on the first query.
+
+        :param left_taxon: A Taxon instance
+        :param right_taxon: Another Taxon instance
+        :return: The Taxon instance that is the LCA of both, or None if either is None or they share no ancestor
+        """
+        if left_taxon is None or right_taxon is None:
+            return None
+        if self.lca_table is None:
+            self.build_lca_table()
+        try:
+            node = self.lca_table.query(self.lca_nodes[left_taxon], self.lca_nodes[right_taxon])
+        except KeyError:
+            return Taxon.lca(left_taxon, right_taxon)
+        return self.lca_taxa[node] if node >= 0 else None
+
+    def lca_of_taxa(self, taxa):
+        """
+        :param taxa: An iterable of Taxon instances
+        :return: The Taxon instance that is the LCA of all taxa, or None if they share no ancestor or taxa is empty
+        """
+        taxa = list(taxa)
+        if not taxa or None in taxa:
+            return None
+        if self.lca_table is None:
+            self.build_lca_table()
+        try:
+            node = self.lca_table.query_set([self.lca_nodes[taxon] for taxon in taxa])
+        except KeyError:
+            lca = taxa[0]
+            for taxon in taxa[1:]:
+                lca = Taxon.lca(lca, taxon)
+            return lca
+        return self.lca_taxa[node] if node >= 0 else None
+
     def find_root_taxon(self) -> Taxon:
         """
         Searches for the taxa that represent the root of the taxonomic hierarchy, returning the Taxon.prefix_taxon()
@@ -312,6 +453,7 @@ class TaxonomicHierarchy:
             if domain_taxon.parent is None:
                 domain_taxon.parent = root
             root.coverage += domain_taxon.coverage
+        self.reset_lca_table()
         self.build_multifurcating_trie()
         self.rooted = True
         return root
@@ -365,6 +507,7 @@ class TaxonomicHierarchy:
                     pass
                 else:
                     taxon.parent = rep
+        self.reset_lca_table()
         if rep is not None:
             # Do not add values to rep since old is likely in its lineage so double counting
             for t in rep.lineage():
@@ -710,6 +853,115 @@ class TaxonomicHierarchy:
         self.digest_taxon(taxon=child, previous=parent_taxon, rank=rank)
         return
 
+    def parse_prefixed_taxon(self, prefixed_name: str):
+        """
+        Determines the rank of a rank-prefixed taxon name (e.g. 'p__Proteobacteria') as digest_taxon would.
+
+        :param prefixed_name: A taxon name with its rank-prefix
+        :return: A tuple of the taxon's key in self.hierarchy, its name, rank and rank-prefix, or None if the taxon is
+         bad or digest_taxon would need to modify the rank-prefix map to add it
+        """
+        rank_prefix = prefixed_name.split(self.taxon_sep)[0]
+        rank = self.rank_prefix_map.get(rank_prefix)
+        if rank not in self.accepted_ranks_depths:
+            rank = self.rank_name_map.get(rank, self.no_rank_name)
+        if rank != self.rank_prefix_map.get(rank_prefix) or not prefixed_name.startswith(rank_prefix + self.taxon_sep):
+            return None
+        name = prefixed_name.lstrip(rank_prefix + self.taxon_sep)
+        if name in self.bad_taxa:
+            return None
+        return rank_prefix + self.taxon_sep + name, name, rank, rank_prefix
+
+    def bulk_load_lineages(self, lineage_counts: dict) -> list:
+        """
+        Loads rank-prefixed lineages into self.hierarchy in a single pass, rather than digesting every taxon of every
+        lineage. Each taxon is first assigned an index into arrays of parent indices and coverages, then the Taxon
+        instances are created once all lineages have been read.
+
+        Lineages that would clash with the hierarchy (i.e. one of their taxa has a different parent than the first
+        lineage it was encountered in), or that contain taxa with bad names or unexpected rank-prefixes, are not loaded.
+        These must be fed to digest_taxon after the others, in their original order, to resolve the clashes.
+        Taxa first encountered in one of these lineages are reserved for it, so later lineages containing them are
+        also returned.
+
+        :param lineage_counts: A dictionary of rank-prefixed lineages mapped to the number of times each was observed,
+         in the order they were first observed
+        :return: A list of the lineages that were not loaded
+        """
+        deferred_parent = -2  # The parent of taxa reserved for lineages that were not loaded
+        taxa = []  # The Taxon instances, created by this function or already in the hierarchy
+        taxon_index = dict()
+        parents = array('i')
+        coverages = array('L')
+        for prefix_name, taxon in self.hierarchy.items():  # type: (str, Taxon)
+            taxon_index[prefix_name] = len(taxa)
+            taxa.append(taxon)
+        for taxon in taxa:
+            if not taxon.parent:
+                parents.append(-1)
+            else:
+                parents.append(taxon_index.get(taxon.parent.prefix_taxon(), deferred_parent))
+            coverages.append(0)
+
+        deferred = []
+        parsed = dict()  # Taxa as they appear in the lineages mapped to their hierarchy key, name, rank and prefix
+        for lineage, count in lineage_counts.items():
+            path = []
+            parent = -1
+            clash = False
+            for prefixed_name in lineage.split(self.lin_sep):
+                if not clash:
+                    try:
+                        taxon_info = parsed[prefixed_name]
+                    except KeyError:
+                        taxon_info = self.parse_prefixed_taxon(prefixed_name)
+                        parsed[prefixed_name] = taxon_info
+                    if taxon_info is None:
+                        clash = True
+                    else:
+                        prefixed_name = taxon_info[0]
+                if not clash:
+                    try:
+                        i = taxon_index[prefixed_name]
+                        clash = parents[i] == deferred_parent or (parent >= 0 and parents[i] != parent)
+                    except KeyError:
+                        i = len(taxa)
+                        taxon_index[prefixed_name] = i
+                        _, name, rank, rank_prefix = taxon_info
+                        taxa.append(Taxon(name, rank))
+                        taxa[i].prefix = rank_prefix
+                        parents.append(parent)
+                        coverages.append(0)
+                    path.append(i)
+                    parent = i
+                if clash:
+                    # Reserve the remaining taxa so lineages containing them are also deferred
+                    if prefixed_name not in taxon_index:
+                        taxon_index[prefixed_name] = len(taxa)
+                        taxa.append(None)
+                        parents.append(deferred_parent)
+                        coverages.append(0)
+            if clash:
+                deferred.append(lineage)
+                continue
+            for i in path:
+                coverages[i] += count
+
+        # Create the new Taxon instances and link each to its parent
+        for i, taxon in enumerate(taxa):
+            if taxon is None:
+                continue
+            prefix_name = taxon.prefix_taxon()
+            if prefix_name in self.hierarchy:
+                taxon.coverage += coverages[i]
+                continue
+            taxon.coverage = coverages[i]
+            taxon.parent = taxa[parents[i]] if parents[i] >= 0 else None
+            self.hierarchy[prefix_name] = taxon
+            if taxon.rank == "root":
+                self.rooted = True
+        return deferred
+
     def feed_leaf_nodes(self, ref_leaves: list, rank_prefix_name_map=None) -> None:
         """
         Loads TreeLeafReference instances (objects with 'lineage', 'accession' and 'number' variables among others) into
@@ -719,6 +971,9 @@ class TaxonomicHierarchy:
         a rank-prefix name map is required to infer the taxonomic rank of each prefix. One is loaded by default if none
         are provided.
 
+        Identical lineages are loaded together by bulk_load_lineages and only the lineages that clash with others are
+        digested taxon by taxon, after all others have been loaded.
+
         :param ref_leaves: A list of TreeLeafReference instances to be loaded into the hierarchy
         :param rank_prefix_name_map: A dictionary mapping rank-prefixes (str) to a set of potential rank names
         :return: None
@@ -731,36 +986,123 @@ class TaxonomicHierarchy:
         self.whet()
         self.validate_rank_prefixes()
 
-        previous = None
+        lineage_counts = dict()
+        for ref_leaf in ref_leaves:  # type: TreeLeafReference
+            if ref_leaf.lineage:
+                lineage_counts[ref_leaf.lineage] = lineage_counts.get(ref_leaf.lineage, 0) + 1
+        deferred = set(self.bulk_load_lineages(lineage_counts))
+
         for ref_leaf in ref_leaves:  # type: TreeLeafReference
             if not ref_leaf.lineage:
                 continue
-            taxa = ref_leaf.lineage.split(self.lin_sep)
-            while taxa:
-                taxon_name = taxa.pop(0)  # type: str
-                rank_prefix = taxon_name.split(self.taxon_sep)[0]
-                try:
-                    rank = self.rank_prefix_map[rank_prefix]
-                except KeyError:
-                    logging.debug("Unexpected format of taxon '{}' in lineage {} - no rank prefix separated by '{}'?\n"
-                                  "".format(taxon_name, ref_leaf.lineage, self.taxon_sep))
-                    taxa.clear()
-                    continue
-                taxon = self.digest_taxon(taxon=taxon_name, rank=rank,
-                                          rank_prefix=rank_prefix, previous=previous)  # type: Taxon
-                if not taxon and previous:
-                    ref_leaf.lineage = self.lin_sep.join([taxon.prefix_taxon() for taxon in previous.lineage()])
-                    break
-                else:
-                    previous = taxon
-                if taxon.rank == "root":
-                    self.rooted = True
-
+            if ref_leaf.lineage in deferred:
+                self.feed_leaf_lineage(ref_leaf)
             # Update the number of lineages provided to TaxonomicHierarchy
             self.lineages_fed += 1
-            previous = None
         return
 
+    def feed_leaf_lineage(self, ref_leaf: TreeLeafReference) -> None:
+        """
+        Adds each taxon in a TreeLeafReference's lineage to the hierarchy with digest_taxon, resolving any clashes.
+        If the lineage contains a bad taxon (see self.bad_taxa) the TreeLeafReference's lineage is truncated.
+
+        :param ref_leaf: A TreeLeafReference instance with a rank-prefixed lineage
+        :return: None
+        """
+        previous = None
+        taxa = ref_leaf.lineage.split(self.lin_sep)
+        while taxa:
+            taxon_name = taxa.pop(0)  # type: str
+            rank_prefix = taxon_name.split(self.taxon_sep)[0]
+            try:
+                rank = self.rank_prefix_map[rank_prefix]
+            except KeyError:
+                logging.debug("Unexpected format of taxon '{}' in lineage {} - no rank prefix separated by '{}'?\n"
+                              "".format(taxon_name, ref_leaf.lineage, self.taxon_sep))
+                taxa.clear()
+                continue
+            taxon = self.digest_taxon(taxon=taxon_name, rank=rank,
+                                      rank_prefix=rank_prefix, previous=previous)  # type: Taxon
+            if not taxon and previous:
+                ref_leaf.lineage = self.lin_sep.join([taxon.prefix_taxon() for taxon in previous.lineage()])
+                break
+            else:
+                previous = taxon
+            if taxon.rank == "root":
+                self.rooted = True
+        return
+
+    def serialize(self) -> dict:
+        """
+        Converts the hierarchy into a compact form that can be pickled and loaded by load_serialized without feeding
+        the lineages again. Taxa are stored in parallel lists and their parents as indices into these lists.
+
+        :return: A dictionary of the hierarchy's taxa, parent indices, rank-prefix map and state
+        """
+        self.validate_rank_prefixes()
+        taxa = list(self.hierarchy.values())
+        taxon_index = {taxon: i for i, taxon in enumerate(taxa)}
+        keys = list(self.hierarchy.keys())
+        # Parents of taxa that are no longer in the hierarchy (e.g. scrubbed during conflict resolution) are included
+        i = 0
+        while i < len(taxa):
+            parent = taxa[i].parent
+            if parent and parent not in taxon_index:
+                taxon_index[parent] = len(taxa)
+                taxa.append(parent)
+                keys.append("")
+            i += 1
+
+        return {"version": self.serial_version,
+                "lin_sep": self.lin_sep,
+                "taxon_sep": self.taxon_sep,
+                "rank_prefix_map": dict(self.rank_prefix_map),
+                "rooted": self.rooted,
+                "lineages_fed": self.lineages_fed,
+                "keys": keys,
+                "names": [taxon.name for taxon in taxa],
+                "ranks": [taxon.rank for taxon in taxa],
+                "prefixes": [taxon.prefix for taxon in taxa],
+                "taxids": [taxon.taxid for taxon in taxa],
+                "coverages": array('l', [taxon.coverage for taxon in taxa]),
+                "parents": array('i', [taxon_index[taxon.parent] if taxon.parent else -1 for taxon in taxa]),
+                "conflicts": [(taxon_index[t1], taxon_index[t2]) for t1, t2 in self.conflicts
+                              if t1 in taxon_index and t2 in taxon_index]}
+
+    def load_serialized(self, state: dict) -> bool:
+        """
+        Loads a hierarchy from the form returned by TaxonomicHierarchy.serialize.
+        The state is only loaded if it was written by the same version of serialize and uses the same separators.
+
+        :param state: A dictionary returned by TaxonomicHierarchy.serialize
+        :return: True if the hierarchy was loaded, False otherwise
+        """
+        if not state or state.get("version") != self.serial_version or \
+                state["lin_sep"] != self.lin_sep or state["taxon_sep"] != self.taxon_sep:
+            return False
+
+        taxa = []
+        for name, rank, prefix, taxid, coverage in zip(state["names"], state["ranks"], state["prefixes"],
+                                                       state["taxids"], state["coverages"]):
+            taxon = Taxon(name, rank)
+            taxon.prefix = prefix
+            taxon.taxid = taxid
+            taxon.coverage = coverage
+            taxa.append(taxon)
+        for taxon, parent in zip(taxa, state["parents"]):
+            if parent >= 0:
+                taxon.parent = taxa[parent]
+        self.hierarchy = {key: taxon for key, taxon in zip(state["keys"], taxa) if key}
+        self.reset_lca_table()
+        self.conflicts = {(taxa[i], taxa[j]) for i, j in state["conflicts"]}
+        self.rank_prefix_map = dict(state["rank_prefix_map"])
+        self.rank_prefix_map_values = str
+        self.rooted = state["rooted"]
+        self.lineages_fed = state["lineages_fed"]
+        self.lineages_into_trie = 0
+        self.trie.clear()
+        return True
+
     def emit(self, prefix_taxon: str, with_prefix=False) -> str:
         """
         Taking a prefixed-taxon (e.g. g__Actinomyces) as input it
@@ -790,10 +1132,10 @@ class TaxonomicHierarchy:
         However, finding the Keys across a set of taxa names is inefficient coming in at O(n^2).
         This function builds a prefix trie that could be leveraged for more efficiently determining whether
         all taxa in a lineage are present.
-        Using self.trie (pygtrie.StringTrie object), it is populated by the lineage of each taxon in self.hierarchy.
+        Using self.trie (a TaxonomyIndex), it is populated by the lineage of each taxon in self.hierarchy.
         Nodes in the tree follow the format (lineage: taxon) where taxon lacks its rank-prefix. An example:
 
-        StringTrie(n__cellular organisms: cellular organisms,
+        TaxonomyIndex(n__cellular organisms: cellular organisms,
         n__cellular organisms; d__Bacteria: Bacteria,
         n__cellular organisms; d__Bacteria; n__Terrabacteria group: Terrabacteria group,
         n__cellular organisms; d__Bacteria; n__Terrabacteria group; p__Actinobacteria: Actinobacteria, separator=; )
@@ -1006,7 +1348,7 @@ class TaxonomicHierarchy:
 
     def match_organism(self, organism: str, lineage: list) -> str:
         """
-        Searches the taxonomic hierarchy's prefix tree (StringTrie instance) for organisms that are descendents
+        Searches the taxonomic hierarchy's prefix tree (TaxonomyIndex instance) for organisms that are descendents
         of the provided lineage.
 
         :param organism: The organism name to query against the prefix tree
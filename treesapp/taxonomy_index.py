@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+from array import array
+
+__author__ = 'Connor Morgan-Lang'
+
+
+class EulerTourLCA:
+    """
+    Answers lowest common ancestor (LCA) queries on a forest of nodes, numbered 0 to n-1 and linked by their parents,
+    in constant time after O(n log n) pre-processing.
+
+    The Euler tour of the forest lists each node whenever the traversal enters or returns to it, so the LCA of two
+    nodes is the shallowest node in the tour between their first occurrences. These range-minimum queries are answered
+    by a sparse table that stores the minimum of every range in the tour whose length is a power of two.
+    Trees of the forest are joined under a virtual root, the LCA of nodes in different trees.
+    """
+    def __init__(self, parents):
+        """
+        :param parents: A sequence of the parent of each node, or a negative number if the node is a root
+        """
+        self.num_nodes = num_nodes = len(parents)
+        children = [[] for _ in range(num_nodes + 1)]
+        for node, parent in enumerate(parents):
+            children[parent if parent >= 0 else num_nodes].append(node)
+
+        # Nodes in the tour are encoded by their depth and ID so the minimum of the codes is the shallowest node
+        width = num_nodes + 1
+        self.width = width
+        self.first = array('i', [0] * width)
+        tour = [num_nodes]
+        stack = [[num_nodes, 0]]
+        while stack:
+            frame = stack[-1]
+            siblings = children[frame[0]]
+            if frame[1] < len(siblings):
+                child = siblings[frame[1]]
+                frame[1] += 1
+                self.first[child] = len(tour)
+                tour.append(len(stack) * width + child)
+                stack.append([child, 0])
+            else:
+                stack.pop()
+                if stack:
+                    tour.append((len(stack) - 1) * width + stack[-1][0])
+
+        # Row k of the table holds the minimum of the 2^k codes starting at each position of the tour
+        self.table = [tour]
+        span = 1
+        while 2 * span <= len(tour):
+            previous = self.table[-1]
+            self.table.append([a if a < b else b for a, b in zip(previous, previous[span:])])
+            span *= 2
+        return
+
+    def _range_min(self, start: int, stop: int) -> int:
+        k = (stop - start + 1).bit_length() - 1
+        row = self.table[k]
+        return min(row[start], row[stop - (1 << k) + 1]) % self.width
+
+    def query(self, node_a: int, node_b: int) -> int:
+        """
+        :return: The lowest common ancestor of node_a and node_b, or -1 if they are in different trees of the forest
+        """
+        start, stop = self.first[node_a], self.first[node_b]
+        if start > stop:
+            start, stop = stop, start
+        lca = self._range_min(start, stop)
+        return -1 if lca == self.num_nodes else lca
+
+    def query_set(self, nodes) -> int:
+        """
+        The LCA of a set of nodes is the LCA of the two whose first occurrences in the Euler tour are furthest apart.
+
+        :param nodes: An iterable of node IDs
+        :return: The lowest common ancestor of all nodes, or -1 if they are in different trees or nodes is empty
+        """
+        positions = [self.first[node] for node in nodes]
+        if not positions:
+            return -1
+        lca = self._range_min(min(positions), max(positions))
+        return -1 if lca == self.num_nodes else lca
+
+
+class TaxonomyIndex:
+    """
+    A prefix tree of taxonomic lineages where each lineage, and every prefix of it, is a node with an integer ID.
+    Lineages are mapped to their node by a dictionary and nodes are linked by arrays of parent node IDs and depths, and
+    lists of child node IDs, so a lineage is found with a single hash look-up rather than by walking a tree of strings.
+
+    Like a pygtrie.StringTrie, a node is only a key of the index if a value was assigned to it, though all prefixes of
+    a key are nodes. Node 0 is the root, an empty lineage.
+
+    Ancestor and lowest common ancestor (LCA) queries are answered in O(1), using the pre-order intervals and an
+    EulerTourLCA that are built on the first query after the index is modified.
+    """
+    def __init__(self, separator="; "):
+        self.separator = separator
+        self.node_ids = {"": 0}  # Maps lineages to their node ID
+        self.lineages = [""]  # The lineage of each node, indexed by node ID
+        self.parents = array('i', [-1])
+        self.depths = array('H', [0])
+        self.children = [[]]
+        self.values = [None]
+        self.is_key = bytearray(1)
+        self.num_keys = 0
+        # Pre-order intervals and the Euler tour for the ancestor and LCA queries
+        self._entries = array('i')
+        self._exits = array('i')
+        self._euler = None
+        self._dirty = True
+
+    def __len__(self):
+        return self.num_keys
+
+    def __contains__(self, lineage: str) -> bool:
+        node = self.node_ids.get(lineage)
+        return node is not None and self.is_key[node] == 1
+
+    def __getitem__(self, lineage: str):
+        node = self.node_ids.get(lineage)
+        if node is None or not self.is_key[node]:
+            raise KeyError(lineage)
+        return self.values[node]
+
+    def __setitem__(self, lineage: str, value) -> None:
+        self.add(lineage, value)
+
+    def __iter__(self):
+        for node in self.preorder():
+            if self.is_key[node]:
+                yield self.lineages[node]
+
+    def clear(self) -> None:
+        self.__init__(self.separator)
+        return
+
+    def get(self, lineage: str, default=None):
+        try:
+            return self[lineage]
+        except KeyError:
+            return default
+
+    def keys(self) -> list:
+        return list(self.__iter__())
+
+    def add(self, lineage: str, value=True, prefixes=False) -> int:
+        """
+        Adds a lineage to the index as a key, creating the nodes for each of its prefixes if they don't exist.
+
+        :param lineage: A taxonomic lineage, where taxa are separated by self.separator
+        :param value: The value assigned to the lineage's node
+        :param prefixes: Flag indicating whether the value should also be assigned to every prefix of the lineage
+        :return: The node ID of the lineage
+        """
+        node = self.node_ids.get(lineage)
+        if node is None or prefixes:
+            node = 0
+            prefix = ""
+            for taxon in lineage.split(self.separator) if lineage else []:
+                prefix = prefix + self.separator + taxon if node else taxon
+                child = self.node_ids.get(prefix)
+                if child is None:
+                    child = len(self.lineages)
+                    self.node_ids[prefix] = child
+                    self.lineages.append(prefix)
+                    self.parents.append(node)
+                    self.depths.append(self.depths[node] + 1)
+                    self.children.append([])
+                    self.children[node].append(child)
+                    self.values.append(None)
+                    self.is_key.append(0)
+                    self._dirty = True
+                if prefixes:
+                    self._set_value(child, value)
+                node = child
+        self._set_value(node, value)
+        return node
+
+    def _set_value(self, node: int, value) -> None:
+        if not self.is_key[node]:
+            self.is_key[node] = 1
+            self.num_keys += 1
+        self.values[node] = value
+        return
+
+    def node_id(self, lineage: str) -> int:
+        """
+        :param lineage: A taxonomic lineage, where taxa are separated by self.separator
+        :return: The node ID of the lineage, or -1 if it isn't a node in the index
+        """
+        return self.node_ids.get(lineage, -1)
+
+    def has_node(self, lineage: str) -> bool:
+        return lineage in self.node_ids
+
+    def has_subtrie(self, lineage: str) -> bool:
+        """
+        :return: True if lineage is a node in the index with at least one descendent, False otherwise
+        """
+        node = self.node_ids.get(lineage)
+        return node is not None and len(self.children[node]) > 0
+
+    def preorder(self, node=0):
+        """
+        Generator for the IDs of a node and its descendents, in pre-order with children in the order they were added.
+        """
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(self.children[node]))
+
+    def items(self, prefix=None) -> list:
+        """
+        :param prefix: An optional lineage to restrict the items to itself and its descendents
+        :return: A list of (lineage, value) tuples for each key in the index, in pre-order
+        """
+        node = 0
+        if prefix:
+            node = self.node_ids.get(prefix)
+            if node is None:
+                raise KeyError(prefix)
+        return [(self.lineages[n], self.values[n]) for n in self.preorder(node) if self.is_key[n]]
+
+    def longest_prefix(self, lineage: str) -> str:
+        """
+        Finds the most resolved lineage in the index that is a prefix of lineage, or lineage itself.
+
+        :param lineage: A taxonomic lineage, where taxa are separated by self.separator
+        :return: The longest key that is a prefix of lineage, or an empty string if there are none
+        """
+        taxa = lineage.split(self.separator)
+        while taxa:
+            node = self.node_ids.get(self.separator.join(taxa))
+            if node is not None and self.is_key[node]:
+                return self.lineages[node]
+            taxa.pop()
+        return ""
+
+    def index(self) -> None:
+        """
+        Numbers the nodes in pre-order, so a node's descendents are within its entry and exit numbers,
+        and builds the Euler tour of the nodes used for LCA queries.
+
+        :return: None
+        """
+        num_nodes = len(self.lineages)
+        self._entries = array('i', [0] * num_nodes)
+        self._exits = array('i', [0] * num_nodes)
+        counter = 0
+        stack = [(0, False)]
+        while stack:
+            node, exiting = stack.pop()
+            if exiting:
+                self._exits[node] = counter - 1
+                continue
+            self._entries[node] = counter
+            counter += 1
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(self.children[node]))
+
+        self._euler = EulerTourLCA(self.parents)
+        self._dirty = False
+        return
+
+    def is_ancestor(self, ancestor: int, node: int) -> bool:
+        """
+        :return: True if ancestor is node, or one of its ancestors, False otherwise
+        """
+        if self._dirty:
+            self.index()
+        return self._entries[ancestor] <= self._entries[node] <= self._exits[ancestor]
+
+    def lca(self, node_a: int, node_b: int) -> int:
+        """
+        :return: The node ID of the lowest common ancestor of two nodes
+        """
+        if self._dirty:
+            self.index()
+        return self._euler.query(node_a, node_b)
+
+    def lineage_lca(self, lineages: list) -> str:
+        """
+        :param lineages: A list of lineages that are nodes in the index
+        :return: The lineage of the lowest common ancestor of all lineages, an empty string if they share no taxa
+        """
+        if self._dirty:
+            self.index()
+        lca_node = self._euler.query_set([self.node_ids[lineage] for lineage in lineages])
+        return self.lineages[lca_node] if lca_node > 0 else ""
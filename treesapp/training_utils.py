@@ -18,7 +18,7 @@ from treesapp import file_parsers
 from treesapp import wrapper
 from treesapp import fasta
 from treesapp.phylo_seq import PQuery, PhyloPlace
-from treesapp.external_command_interface import launch_write_command, create_dir_from_taxon_name
+from treesapp.external_command_interface import CommandScheduler, create_dir_from_taxon_name
 from treesapp.jplace_utils import jplace_parser, demultiplex_pqueries, calc_pquery_mean_tip_distances
 from treesapp.entish import map_internal_nodes_leaves
 from treesapp.refpkg import ReferencePackage
@@ -182,6 +182,45 @@ def rarefy_rank_distances(rank_distances: dict) -> dict:
     return rarefied_dists
 
 
+class CladeExclusionTrial:
+    def __init__(self, ref_pkg: ReferencePackage, taxon: str, rank: str, training_seqs: list, output_dir: str):
+        """
+        The files and reference package used to place the query sequences of a taxon excluded from a reference package.
+
+        :param ref_pkg: A ReferencePackage instance that has not been modified
+        :param taxon: A taxonomic lineage of the query sequences that will be removed and placed
+        :param rank: The taxonomic rank the taxon represents
+        :param training_seqs: A list of the query sequence names to be placed
+        :param output_dir: Path to a directory to write the output files
+        """
+        self.taxon = taxon
+        self.rank = rank
+        self.training_seqs = training_seqs
+        # Clean up the query taxon's name
+        self.test_dir = create_dir_from_taxon_name(taxon, output_dir)
+        self.query_name = os.path.split(self.test_dir[:-1])[1]
+        # Create the cloned ReferencePackage to be used for this taxon's trials
+        self.ce_refpkg = ref_pkg.clone(self.test_dir + ref_pkg.prefix + ref_pkg.refpkg_suffix)
+
+        # Paths to temporary files
+        self.query_fasta_file = self.test_dir + "queries.fa"
+        self.query_sto_file = os.path.splitext(self.query_fasta_file)[0] + ".sto"
+        self.all_msa = os.path.splitext(self.query_fasta_file)[0] + ".mfa"
+        self.query_msa = self.test_dir + "queries.mfa"
+        self.ref_msa = self.test_dir + "references.mfa"
+        self.combined_msa = ""
+        self.intermediate_files = [self.query_fasta_file, self.query_sto_file, self.all_msa,
+                                   self.query_msa, self.ref_msa]
+        return
+
+    def remove_intermediates(self) -> None:
+        for old_file in self.intermediate_files:
+            if os.path.isfile(old_file):
+                os.remove(old_file)
+        self.intermediate_files.clear()
+        return
+
+
 def generate_pquery_data_for_trainer(ref_pkg: ReferencePackage, taxon: str,
                                      test_fasta: fasta.FASTA, training_seqs: list, rank: str,
                                      executables: dict, output_dir: str, pbar: tqdm, num_threads=2) -> list:
@@ -201,104 +240,136 @@ def generate_pquery_data_for_trainer(ref_pkg: ReferencePackage, taxon: str,
     :param num_threads: The number of threads to use during phylogenetic placement
     :return: A list of PQuery instances representing the best phylogenetic placement for each query sequence
     """
-    intermediate_files = list()
-    pqueries = list()
-    taxonomy_filtered_query_seqs = dict()
-    query_seq_name_map = dict()
-    # Clean up the query taxon's name
-    taxon_test_dir = create_dir_from_taxon_name(taxon, output_dir)
-    query_name = os.path.split(taxon_test_dir[:-1])[1]
-
-    # Create the cloned ReferencePackage to be used for this taxon's trials
-    clade_exclusion_json = taxon_test_dir + ref_pkg.prefix + ref_pkg.refpkg_suffix
-    ce_refpkg = ref_pkg.clone(clade_exclusion_json)
-    # Remove all sequences belonging to a taxonomic rank from the reference package
-    ce_refpkg.exclude_clade_from_ref_files(tmp_dir=taxon_test_dir, target_clade=taxon, executables=executables)
-
-    ce_fasta = fasta.FASTA(ce_refpkg.f__msa)
-    ce_fasta.load_fasta()
-    ce_tree = ce_refpkg.taxonomically_label_tree()
-
-    # Paths to temporary files
-    query_fasta_file = taxon_test_dir + "queries.fa"
-    query_sto_file = os.path.splitext(query_fasta_file)[0] + ".sto"
-    all_msa = os.path.splitext(query_fasta_file)[0] + ".mfa"
-    query_msa = taxon_test_dir + "queries.mfa"
-    ref_msa = taxon_test_dir + "references.mfa"
-    intermediate_files += [query_fasta_file, query_sto_file, all_msa, query_msa, ref_msa]
-
-    # Write query FASTA containing sequences belonging to `taxon`
-    query_seq_decrementor = -1
-    for seq_name in training_seqs:
-        query_seq_name_map[query_seq_decrementor] = seq_name
-        taxonomy_filtered_query_seqs[str(query_seq_decrementor)] = test_fasta.fasta_dict[seq_name]
-        query_seq_decrementor -= 1
-    logging.debug("\t{} query sequences.\n".format(len(taxonomy_filtered_query_seqs.keys())))
-
-    fasta.write_new_fasta(taxonomy_filtered_query_seqs, fasta_name=query_fasta_file)
+    pqueries = clade_exclusion_pqueries(ref_pkg, {rank: {taxon: training_seqs}}, test_fasta,
+                                        executables, output_dir, pbar, num_threads)
+    return pqueries[rank][taxon]
+
+
+def clade_exclusion_pqueries(ref_pkg: ReferencePackage, rank_training_seqs: dict, test_fasta: fasta.FASTA,
+                             executables: dict, output_dir: str, pbar: tqdm, num_threads=2) -> dict:
+    """
+    Performs phylogenetic placement of the query sequences of every taxon in rank_training_seqs, each onto a clone of
+    ref_pkg with that taxon excluded (see generate_pquery_data_for_trainer).
+    The taxa are processed together, one step at a time, so the external commands of each step (RAxML-NG and hmmalign,
+    then BMGE, then EPA-ng) are run in parallel for all taxa by a CommandScheduler.
+
+    :param ref_pkg: A ReferencePackage instance that has not been modified
+    :param rank_training_seqs: A dictionary of taxonomic ranks indexing dictionaries of taxonomic lineages,
+     which in turn index lists of the names of query sequences in test_fasta to be placed
+    :param test_fasta: A FASTA instance containing the query sequences to be placed
+    :param executables: A dictionary of executable names mapped to their respective absolute paths
+    :param output_dir: Path to a directory to write the output files
+    :param pbar: A tqdm.tqdm progress bar instance
+    :param num_threads: The number of threads shared by the external commands of each step
+    :return: A dictionary of ranks indexing a dictionary of taxa of that rank indexing a list of PQuery instances
+     representing the best phylogenetic placement for each query sequence
+    """
+    pqueries = {rank: {} for rank in rank_training_seqs}
+    trials = list()
+
+    ##
+    # Exclude each taxon from a clone of the reference package and align its query sequences to the clone's profile
+    ##
+    align_scheduler = CommandScheduler("Clade exclusion model parameters and alignment", num_threads)
+    for rank in sorted(rank_training_seqs, reverse=True):
+        for taxon in sorted(rank_training_seqs[rank]):
+            trial = CladeExclusionTrial(ref_pkg, taxon, rank, rank_training_seqs[rank][taxon], output_dir)
+            pqueries[rank][taxon] = []
+            # Remove all sequences belonging to a taxonomic rank from the reference package
+            trial.ce_refpkg.exclude_clade_from_ref_files(tmp_dir=trial.test_dir, target_clade=taxon,
+                                                         executables=executables, scheduler=align_scheduler)
+
+            # Write query FASTA containing sequences belonging to `taxon`
+            taxonomy_filtered_query_seqs = dict()
+            query_seq_decrementor = -1
+            for seq_name in trial.training_seqs:
+                taxonomy_filtered_query_seqs[str(query_seq_decrementor)] = test_fasta.fasta_dict[seq_name]
+                query_seq_decrementor -= 1
+            logging.debug("\t{} query sequences for {}.\n".format(len(taxonomy_filtered_query_seqs), taxon))
+            fasta.write_new_fasta(taxonomy_filtered_query_seqs, fasta_name=trial.query_fasta_file)
+
+            align_scheduler.submit(wrapper.hmmalign_command(executables["hmmalign"], trial.ce_refpkg.f__msa,
+                                                            trial.ce_refpkg.f__profile,
+                                                            trial.query_fasta_file, trial.query_sto_file),
+                                   memory=wrapper.DEPENDENCY_MEMORY["hmmalign"])
+            trials.append(trial)
+    align_scheduler.run()
+
+    ##
+    # Trim the multiple alignments of the reference and query sequences
+    ##
+    trim_scheduler = CommandScheduler("Clade exclusion alignment trimming", num_threads)
+    for trial in trials:
+        trial.ce_refpkg.finish_clade_exclusion(trial.test_dir)
+        # Reformat the Stockholm format created by cmalign or hmmalign to FASTA
+        sto_dict = file_parsers.read_stockholm_to_dict(trial.query_sto_file)
+        fasta.write_new_fasta(sto_dict, trial.all_msa)
+        trim_command, trial.combined_msa = wrapper.get_msa_trim_command(executables, trial.all_msa,
+                                                                        trial.ce_refpkg.molecule)
+        trim_scheduler.submit(trim_command, memory=wrapper.DEPENDENCY_MEMORY["BMGE"])
+    trim_scheduler.run()
 
     ##
-    # Run hmmalign, BMGE and EPA-NG to map sequences from the taxonomic rank onto the tree
+    # Run EPA-NG to map sequences from each taxon onto its tree
     ##
-    aln_stdout = wrapper.profile_aligner(executables, ce_refpkg.f__msa, ce_refpkg.f__profile,
-                                         query_fasta_file, query_sto_file)
-    # Reformat the Stockholm format created by cmalign or hmmalign to FASTA
-    sto_dict = file_parsers.read_stockholm_to_dict(query_sto_file)
-    fasta.write_new_fasta(sto_dict, all_msa)
-
-    logging.debug(str(aln_stdout) + "\n")
-
-    trim_command, combined_msa = wrapper.get_msa_trim_command(executables, all_msa, ce_refpkg.molecule)
-    launch_write_command(trim_command)
-    intermediate_files += glob(combined_msa + "*")
-
-    # Ensure reference sequences haven't been removed during MSA trimming
-    msa_dict, failed_msa_files, summary_str = file_parsers.validate_alignment_trimming([combined_msa],
-                                                                                       set(ce_fasta.fasta_dict),
-                                                                                       True)
-    nrow, ncolumn = fasta.multiple_alignment_dimensions(mfa_file=combined_msa,
-                                                        seq_dict=fasta.read_fasta_to_dict(combined_msa))
-    logging.debug("Columns = " + str(ncolumn) + "\n")
-    if combined_msa not in msa_dict.keys():
-        logging.debug("Placements for '{}' are being skipped after failing MSA validation.\n".format(taxon))
-        for old_file in intermediate_files:
-            os.remove(old_file)
-            intermediate_files.clear()
-        return pqueries
-    logging.debug("Number of sequences discarded: " + summary_str + "\n")
-
-    # Create the query-only FASTA file required by EPA-ng
-    fasta.split_combined_ref_query_fasta(combined_msa, query_msa, ref_msa)
-
-    raxml_files = wrapper.raxml_evolutionary_placement(epa_exe=executables["epa-ng"],
-                                                       refpkg_tree=ce_refpkg.f__tree,
-                                                       refpkg_msa=ref_msa,
-                                                       refpkg_model=ce_refpkg.f__model_info,
-                                                       query_msa=query_msa, query_name=query_name,
-                                                       output_dir=output_dir, num_threads=num_threads)
-
-    # Parse the JPlace file to pull distal_length+pendant_length for each placement
-    jplace_data = jplace_parser(raxml_files["jplace"])
-    placement_tree = jplace_data.tree
-    node_map = map_internal_nodes_leaves(placement_tree)
-    jplace_data.pqueries = demultiplex_pqueries(jplace_data=jplace_data)
-    calc_pquery_mean_tip_distances(jplace_data, internal_node_leaf_map=node_map)
-    for pquery in jplace_data.pqueries:  # type: PQuery
-        pquery.ref_name = ref_pkg.prefix
-        pquery.rank = rank
-        pquery.lineage = taxon
-        pquery.process_max_weight_placement(ce_tree)
-
-        if pquery.consensus_placement.like_weight_ratio >= 0.5:
-            pqueries.append(pquery)
-
-    # Remove intermediate files from the analysis of this taxon
-    intermediate_files += list(raxml_files.values())
-    for old_file in intermediate_files:
-        if os.path.isfile(old_file):
-            os.remove(old_file)
-
-    pbar.update(len(taxonomy_filtered_query_seqs.keys()))
+    placements = dict()
+    threads_per_job = max(1, int(num_threads / max(1, len(trials))))
+    place_scheduler = CommandScheduler("Clade exclusion EPA-ng", num_threads)
+    for trial in trials:
+        trial.intermediate_files += glob(trial.combined_msa + "*")
+        ce_fasta = fasta.FASTA(trial.ce_refpkg.f__msa)
+        ce_fasta.load_fasta()
+        # Ensure reference sequences haven't been removed during MSA trimming
+        msa_dict, failed_msa_files, summary_str = file_parsers.validate_alignment_trimming([trial.combined_msa],
+                                                                                           set(ce_fasta.fasta_dict),
+                                                                                           True)
+        nrow, ncolumn = fasta.multiple_alignment_dimensions(mfa_file=trial.combined_msa,
+                                                            seq_dict=fasta.read_fasta_to_dict(trial.combined_msa))
+        logging.debug("Columns = " + str(ncolumn) + "\n")
+        if trial.combined_msa not in msa_dict.keys():
+            logging.debug("Placements for '{}' are being skipped after failing MSA validation.\n".format(trial.taxon))
+            trial.remove_intermediates()
+            continue
+        logging.debug("Number of sequences discarded: " + summary_str + "\n")
+
+        # Create the query-only FASTA file required by EPA-ng
+        fasta.split_combined_ref_query_fasta(trial.combined_msa, trial.query_msa, trial.ref_msa)
+
+        # EPA-ng writes to each taxon's directory so the outputs of the parallel runs don't collide
+        epa_command, epa_files = wrapper.epa_placement_command(executables["epa-ng"], trial.ce_refpkg.f__tree,
+                                                               trial.ref_msa, trial.ce_refpkg.f__model_info,
+                                                               trial.query_msa, trial.query_name, output_dir,
+                                                               threads_per_job, trial.test_dir)
+        memory = wrapper.estimate_epa_memory(trial.ref_msa, trial.ce_refpkg.molecule)
+        job = place_scheduler.submit(epa_command, threads=threads_per_job, memory=memory, priority=memory,
+                                     stdout=epa_files["stdout"])
+        placements[job.index] = (trial, epa_files)
+
+    for job in place_scheduler.as_completed():
+        trial, epa_files = placements[job.index]
+        wrapper.collect_epa_outputs(trial.query_name, trial.test_dir, epa_files)
+        ce_tree = trial.ce_refpkg.taxonomically_label_tree()
+
+        # Parse the JPlace file to pull distal_length+pendant_length for each placement
+        jplace_data = jplace_parser(epa_files["jplace"])
+        placement_tree = jplace_data.tree
+        node_map = map_internal_nodes_leaves(placement_tree)
+        jplace_data.pqueries = demultiplex_pqueries(jplace_data=jplace_data)
+        calc_pquery_mean_tip_distances(jplace_data, internal_node_leaf_map=node_map)
+        for pquery in jplace_data.pqueries:  # type: PQuery
+            pquery.ref_name = ref_pkg.prefix
+            pquery.rank = trial.rank
+            pquery.lineage = trial.taxon
+            pquery.process_max_weight_placement(ce_tree)
+
+            if pquery.consensus_placement.like_weight_ratio >= 0.5:
+                pqueries[trial.rank][trial.taxon].append(pquery)
+
+        # Remove intermediate files from the analysis of this taxon
+        trial.intermediate_files += list(epa_files.values())
+        trial.remove_intermediates()
+
+        pbar.update(len(trial.training_seqs))
 
     return pqueries
 
@@ -105,6 +105,11 @@ class TreeSAPPArgumentParser(argparse.ArgumentParser):
                                     help="FASTQ file containing to reverse mate-pair reads to be aligned using BWA MEM")
         self.rpkm_opts.add_argument("-p", "--pairing", required=False, default='pe', choices=['pe', 'se'],
                                     help="Indicating whether the reads are paired-end (pe) or single-end (se)")
+        self.rpkm_opts.add_argument("--stream", required=False, default=False, action="store_true",
+                                    help="Count the read alignments as they are streamed from BWA MEM "
+                                         "instead of writing and then parsing a SAM file.")
+        self.rpkm_opts.add_argument("--keep_bam", required=False, default=False, action="store_true",
+                                    help="With --stream, also write the alignments to a BAM file using samtools.")
 
     def add_search_params(self):
         self.optopt.add_argument("-s", "--stringency", choices=["relaxed", "strict"], default="relaxed", required=False,
@@ -152,6 +157,23 @@ class TreeSAPPArgumentParser(argparse.ArgumentParser):
         self.taxa_args.add_argument("-a", "--accession2lin", dest="acc_to_lin", required=False, default=None,
                                     help="Path to a file that maps sequence accessions to taxonomic lineages, "
                                          "possibly made by `treesapp create`...")
+        self.add_taxdump_param()
+        self.add_entrez_cache_params()
+
+    def add_taxdump_param(self):
+        self.taxa_args.add_argument("--taxdump", dest="taxdump", required=False, default=None,
+                                    help="Path to a directory containing the NCBI taxonomy dump files (nodes.dmp and "
+                                         "names.dmp) used to find lineages from NCBI taxids and organism names "
+                                         "without querying Entrez.\n")
+
+    def add_entrez_cache_params(self):
+        self.taxa_args.add_argument("--entrez_cache", dest="entrez_cache", required=False, default=None,
+                                    help="Path to an SQLite database caching the records returned by Entrez, "
+                                         "shared between runs so the same accessions, taxids and organisms are not "
+                                         "queried again. Created if it doesn't exist.\n")
+        self.taxa_args.add_argument("--entrez_ttl", dest="entrez_ttl", required=False, default=30, type=float,
+                                    help="The number of days records in the Entrez cache are used before they are "
+                                         "queried again. [ DEFAULT = 30 ]\n")
 
     def add_lineage_table_param(self):
         self.taxa_args.add_argument("--seqs2lineage", dest="seq_names_to_taxa", required=False, default=None,
@@ -281,6 +303,17 @@ def add_layer_arguments(parser: TreeSAPPArgumentParser):
     return
 
 
+def add_itol_arguments(parser: TreeSAPPArgumentParser):
+    parser.add_refpkg_opt()
+    parser.reqs.add_argument("-o", "--treesapp_output", dest="output", required=True,
+                             help="The TreeSAPP output directory.")
+    parser.optopt.add_argument("--placement_summary", default="max_lwr", choices=["aelw", "max_lwr"],
+                               dest="p_sum",
+                               help="The algorithm used for consolidating multiple phylogenetic placements. "
+                                    "This should match the one used by *treesapp assign*. [ DEFAULT = max_lwr ]")
+    return
+
+
 def add_classify_arguments(assign_parser: TreeSAPPArgumentParser) -> None:
     """
     Adds command-line arguments that are specific to *treesapp assign*
@@ -306,9 +339,31 @@ def add_classify_arguments(assign_parser: TreeSAPPArgumentParser) -> None:
                                       help="Sample composition being either a single organism or a metagenome.")
     assign_parser.optopt.add_argument("--stage", default="continue", required=False,
                                       choices=["continue", "orf-call", "search", "align", "place", "classify"],
-                                      help="The stage(s) for TreeSAPP to execute [DEFAULT = continue]")
+                                      help="The last stage for TreeSAPP to execute. Work recorded as complete in "
+                                           "the output directory's checkpoint manifest is not repeated, "
+                                           "unless --overwrite is used. [DEFAULT = continue]")
     assign_parser.rpkm_opts.add_argument("--rpkm", action="store_true", default=False,
                                          help="Flag indicating RPKM values should be calculated for the sequences detected")
+    assign_parser.optopt.add_argument("--table_formats", nargs='+', default=["tsv"],
+                                      choices=["tsv", "tsv.gz", "parquet"],
+                                      help="Format(s) to write the classification table (marker_contig_map) in. "
+                                           "The Parquet format requires pyarrow. "
+                                           "[ DEFAULT = tsv ]")
+    assign_parser.optopt.add_argument("--classification_store", default=None, required=False,
+                                      help="Path to an SQLite database that the classifications are appended to, "
+                                           "replacing any previous classifications from this output directory. "
+                                           "The database is created if it does not exist.")
+    assign_parser.optopt.add_argument("--placement_cache", default=None, required=False,
+                                      help="Path to an SQLite database of classified query sequences shared between "
+                                           "runs. Sequences found in it are not aligned and placed again, and the "
+                                           "new classifications are added. The database is created if it does not "
+                                           "exist.")
+    assign_parser.optopt.add_argument("--cache_size", default=1000000, required=False, type=int,
+                                      help="The maximum number of sequences held by the placement cache. "
+                                           "The least recently used are removed first. [ DEFAULT = 1000000 ]")
+    assign_parser.optopt.add_argument("--skip_itol", default=False, required=False, action="store_true",
+                                      help="Do not generate the iTOL_output files. "
+                                           "These can be created later with `treesapp itol`.")
 
     # The miscellany
     assign_parser.miscellany.add_argument('-R', '--reftree', required=False, default="", type=str,
@@ -324,6 +379,11 @@ def add_abundance_arguments(parser: TreeSAPPArgumentParser):
     parser.reqs.add_argument("--treesapp_output", dest="output", required=True,
                              help="Path to the directory containing TreeSAPP outputs, "
                                   "including sequences to be used for the update.")
+    parser.rpkm_opts.add_argument("--reads_table", required=False, default=None,
+                                  help="A tab-separated table of read sets (e.g. time-series samples) with the sample "
+                                       "name, FASTQ path and optionally the reverse FASTQ path on each line. "
+                                       "The read sets are aligned concurrently and their abundances are written "
+                                       "to final_outputs/abundance_matrix.tsv instead of the classification table.")
     # TODO: Include an option to append new values to the classification table
     parser.optopt.add_argument("--report", choices=["update", "nothing"], required=False, default="update",
                                help="What should be done with the abundance values? The TreeSAPP classification table "
@@ -356,6 +416,11 @@ def add_create_arguments(parser: TreeSAPPArgumentParser) -> None:
                                     'In this workflow, alignment with MAFFT is skipped and this file is used instead.',
                                action="store_true",
                                default=False)
+    parser.seqops.add_argument("--profile_align", action="store_true", default=False,
+                               help="Align the reference sequences to the HMM profile (--profile) with hmmalign,\n"
+                                    "or a profile built from a sample of them, instead of aligning all with MAFFT.\n"
+                                    "Outliers are also detected in partitions of related sequences, in parallel.\n"
+                                    "Recommended for building reference packages from many thousands of sequences.")
     parser.seqops.add_argument("-d", "--profile", dest="profile",
                                help="An HMM profile representing a specific domain.\n"
                                     "Domains will be excised from input sequences based on hmmsearch alignments.",
@@ -441,6 +506,8 @@ def add_update_arguments(parser: TreeSAPPArgumentParser) -> None:
     parser.add_taxa_args()  # s, f, t
     parser.add_refpkg_file_param()  # r
     parser.add_lineage_table_param()
+    parser.add_taxdump_param()
+    parser.add_entrez_cache_params()
     parser.add_phylogeny_params()  # b, e
     parser.add_compute_miscellany()  # n
     parser.reqs.add_argument("--treesapp_output", dest="ts_out", required=True,
@@ -637,6 +704,10 @@ def check_create_arguments(creator: Creator, args) -> None:
                 logging.error("--similarity {} is not between the supported range [0.5-1.0].\n".format(args.similarity))
                 sys.exit(13)
 
+    if args.profile_align and args.multiple_alignment:
+        logging.error("--profile_align and --multiple_alignment are mutually exclusive!\n")
+        sys.exit(13)
+
     if args.taxa_lca and not args.cluster:
         logging.error("Unable to perform LCA for representatives without clustering information: " +
                       "either with a provided VSEARCH file or by clustering within the pipeline.\n")
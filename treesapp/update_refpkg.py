@@ -2,8 +2,6 @@ import sys
 import re
 import logging
 
-from pygtrie import StringTrie
-
 from treesapp.utilities import load_taxonomic_trie
 from treesapp.classy import Cluster, Updater
 from treesapp.entrez_utils import EntrezRecord
@@ -69,7 +67,7 @@ def validate_mixed_lineages(mixed_seq_lineage_map: dict) -> None:
     superfluous_prefixes = set()
     
     lineage_list = list(mixed_seq_lineage_map.values())
-    taxa_trie = load_taxonomic_trie(lineage_list)  # type: StringTrie
+    taxa_trie = load_taxonomic_trie(lineage_list)  # type: TaxonomyIndex
     for taxon in taxa_trie:
         # Find all the prefixes that are inconsistent across lineages,
         # by seeing if the entire subtrees are present in the trie
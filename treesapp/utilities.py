@@ -9,24 +9,24 @@ import shutil
 from glob import glob
 from csv import Sniffer
 
-from pygtrie import StringTrie
-
 from treesapp.external_command_interface import launch_write_command
+from treesapp.taxonomy_index import TaxonomyIndex
 
 
 def base_file_prefix(file_path: str) -> str:
     return os.path.splitext(os.path.basename(file_path))[0]
 
 
-def load_taxonomic_trie(lineages: list) -> StringTrie:
-    taxonomic_tree = StringTrie(separator='; ')
+def load_taxonomic_trie(lineages: list) -> TaxonomyIndex:
+    """
+    :param lineages: A list of taxonomic lineages where taxa are separated by '; '
+    :return: A TaxonomyIndex where each lineage, and each of their prefixes, is a key
+    """
+    taxonomic_tree = TaxonomyIndex(separator='; ')
 
     for lineage in lineages:
-        i = 0
-        ranks = len(lineage)
-        while i < len(lineage):
-            taxonomic_tree["; ".join(lineage.split("; ")[:ranks - i])] = True
-            i += 1
+        if lineage:
+            taxonomic_tree.add(lineage, True, prefixes=True)
 
     return taxonomic_tree
 
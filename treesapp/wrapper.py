@@ -8,8 +8,19 @@ from shutil import copy, rmtree
 
 from tqdm import tqdm
 
-from treesapp.external_command_interface import launch_write_command, CommandLineFarmer
+from treesapp.external_command_interface import launch_write_command, CommandScheduler, CommandPipeline
 from treesapp.fasta import read_fasta_to_dict
+from treesapp.hmmer_tbl_parser import DomainTableParser
+
+# The approximate peak memory (megabytes) of single-threaded external dependencies, declared by their jobs
+# so a CommandScheduler can run as many in parallel as will fit in the available memory
+DEPENDENCY_MEMORY = {"prodigal": 256,
+                     "hmmalign": 256,
+                     "mafft": 1024,
+                     "OD-seq": 512,
+                     "cmalign": 2048,
+                     "BMGE": 768,  # The Java heap is limited to 512MB (-Xmx512m)
+                     "trimAl": 256}
 
 
 def estimate_ml_model(modeltest_exe: str, msa: str, output_prefix: str, molecule: str, threads=1) -> str:
@@ -52,6 +63,25 @@ def estimate_ml_model(modeltest_exe: str, msa: str, output_prefix: str, molecule
     return evo_model
 
 
+def model_parameters_command(raxml_exe: str, ref_msa: str, tree_file: str, output_prefix: str, model: str,
+                             threads=2) -> (list, str):
+    """
+    The RAxML-NG `evaluate` command used by model_parameters, and the path of the bestModel file it writes.
+    """
+    output_prefix += "_evaluate"
+    model_params_file = output_prefix + ".raxml.bestModel"
+    model_eval_cmd = [raxml_exe, "--evaluate"]
+    model_eval_cmd += ["--msa", ref_msa]
+    model_eval_cmd += ["--tree", tree_file]
+    model_eval_cmd += ["--prefix", output_prefix]
+    model_eval_cmd += ["--model", model]
+    model_eval_cmd += ["--threads", "auto{{{}}}".format(threads)]
+    model_eval_cmd += ["--seed", str(12345)]
+    model_eval_cmd += ["--workers", "auto{{{}}}".format(threads)]
+    model_eval_cmd.append("--force")
+    return model_eval_cmd, model_params_file
+
+
 def model_parameters(raxml_exe: str, ref_msa: str, tree_file: str, output_prefix: str, model: str, threads=2) -> str:
     """
     Wrapper function for RAxML-ng's `evaluate` sub-command that generates a file to be used by EPA-ng.
@@ -66,17 +96,8 @@ def model_parameters(raxml_exe: str, ref_msa: str, tree_file: str, output_prefix
     :param threads: The number of threads that should be used by RAxML-NG
     :return: Path to the bestModel file that can be used by epa-ng for phylogenetic placement
     """
-    output_prefix += "_evaluate"
-    model_params_file = output_prefix + ".raxml.bestModel"
-    model_eval_cmd = [raxml_exe, "--evaluate"]
-    model_eval_cmd += ["--msa", ref_msa]
-    model_eval_cmd += ["--tree", tree_file]
-    model_eval_cmd += ["--prefix", output_prefix]
-    model_eval_cmd += ["--model", model]
-    model_eval_cmd += ["--threads", "auto{{{}}}".format(threads)]
-    model_eval_cmd += ["--seed", str(12345)]
-    model_eval_cmd += ["--workers", "auto{{{}}}".format(threads)]
-    model_eval_cmd.append("--force")
+    model_eval_cmd, model_params_file = model_parameters_command(raxml_exe, ref_msa, tree_file, output_prefix, model,
+                                                                 threads)
 
     logging.debug("Evaluating phylogenetic tree with RAxML-NG... ")
     stdout, returncode = launch_write_command(model_eval_cmd)
@@ -84,7 +105,8 @@ def model_parameters(raxml_exe: str, ref_msa: str, tree_file: str, output_prefix
 
     if returncode != 0:
         logging.error("{} did not complete successfully! Look in {}_info.txt for an error message.\n"
-                      "RAxML-NG command used:\n{}\n".format(raxml_exe, output_prefix, ' '.join(model_eval_cmd)))
+                      "RAxML-NG command used:\n{}\n".format(raxml_exe, output_prefix + "_evaluate",
+                                                             ' '.join(model_eval_cmd)))
         sys.exit(13)
 
     return model_params_file
@@ -199,9 +221,11 @@ def construct_tree(tree_builder: str, executables: dict, evo_model: str, multipl
 
 def launch_evolutionary_placement_queries(executables: dict, split_msa_files: dict,
                                           refpkg_dict: dict, output_dir: str,
-                                          num_threads: int) -> None:
+                                          num_threads: int, checkpoints=None) -> None:
     """
-    Run EPA-ng using FASTA files containing the reference and query sequences, and the reference trees
+    Run EPA-ng using FASTA files containing the reference and query sequences, and the reference trees.
+    The EPA-ng jobs are run in parallel, sharing the threads, with each job writing to its own directory
+    since the names of the files EPA-ng writes can't be changed.
 
     :param executables: Dictionary of executables where executable name strings are keys and paths are values
     :param split_msa_files: Dictionary of TreeSAPP refpkg code (denominator) keys indexing a list of
@@ -210,13 +234,18 @@ def launch_evolutionary_placement_queries(executables: dict, split_msa_files: di
     :param refpkg_dict: Dictionary of ReferencePackage instances indexed by their TreeSAPP refpkg code (denominator)
     :param output_dir: Path to write the EPA-ng outputs
     :param num_threads: Number of threads to use during placement
+    :param checkpoints: A CheckpointManifest. Query alignments that were already placed on the same reference tree
+     by a previous run are not placed again.
     :return: None
     """
     logging.info("Running EPA... ")
 
     start_time = time.time()
 
-    epa_calls = 0
+    num_jobs = sum([len(split_msa_files[refpkg_name]) for refpkg_name in split_msa_files])
+    threads_per_job = max(1, int(num_threads / max(1, num_jobs)))
+    scheduler = CommandScheduler("EPA-ng", num_threads)
+    placements = dict()
     # Maximum-likelihood sequence placement analyses
     for refpkg_name in sorted(split_msa_files.keys()):
         if not isinstance(refpkg_name, str):
@@ -226,10 +255,27 @@ def launch_evolutionary_placement_queries(executables: dict, split_msa_files: di
         for split_msa in split_msa_files[refpkg_name]:
             query_name = re.sub("_queries.mfa", '', os.path.basename(split_msa.query))
             query_name = re.sub(ref_pkg.prefix, refpkg_name, query_name)
-            # Find the query names
-            raxml_evolutionary_placement(executables["epa-ng"], ref_pkg.f__tree, split_msa.ref, ref_pkg.f__model_info,
-                                         split_msa.query, query_name, output_dir, num_threads)
-            epa_calls += 1
+            place_inputs = [split_msa.ref, split_msa.query, ref_pkg.f__tree, ref_pkg.f__model_info]
+            if checkpoints and checkpoints.is_complete("place", query_name, place_inputs):
+                continue
+            work_dir = os.path.join(output_dir, query_name + "_EPA_tmp")
+            if not os.path.isdir(work_dir):
+                os.makedirs(work_dir)
+            epa_command, epa_files = epa_placement_command(executables["epa-ng"], ref_pkg.f__tree, split_msa.ref,
+                                                           ref_pkg.f__model_info, split_msa.query, query_name,
+                                                           output_dir, threads_per_job, work_dir)
+            memory = estimate_epa_memory(split_msa.ref, ref_pkg.molecule)
+            job = scheduler.submit(epa_command, threads=threads_per_job, memory=memory, priority=memory,
+                                   stdout=epa_files["stdout"])
+            placements[job.index] = (query_name, work_dir, epa_files, place_inputs)
+
+    # The outputs of each query are collected as soon as EPA-ng finishes so they are kept if the run is interrupted
+    for job in scheduler.as_completed():
+        query_name, work_dir, epa_files, place_inputs = placements[job.index]
+        collect_epa_outputs(query_name, work_dir, epa_files)
+        rmtree(work_dir, ignore_errors=True)
+        if checkpoints:
+            checkpoints.complete("place", query_name, place_inputs, [epa_files["jplace"]])
 
     end_time = time.time()
     hours, remainder = divmod(end_time - start_time, 3600)
@@ -238,19 +284,34 @@ def launch_evolutionary_placement_queries(executables: dict, split_msa_files: di
 
     logging.debug("\tEPA-ng time required: " +
                   ':'.join([str(hours), str(minutes), str(round(seconds, 2))]) + "\n")
-    logging.debug("\tEPA-ng was called " + str(epa_calls) + " times.\n")
+    logging.debug("\tEPA-ng was called " + str(len(placements)) + " times.\n")
 
     return
 
 
-def raxml_evolutionary_placement(epa_exe: str, refpkg_tree: str, refpkg_msa: str, refpkg_model: str,
-                                 query_msa: str, query_name: str, output_dir: str, num_threads=2):
+def estimate_epa_memory(refpkg_msa: str, molecule: str) -> int:
     """
-    A wrapper for evolutionary placement algorithm (EPA) next-generation
-        1. checks to ensure the output files do not already exist, and removes them if they do
-        2. ensures the output directory is an absolute path, satisfying EPA
-        3. Runs EPA with the provided parameters
-        4. Renames the files for consistency in TreeSAPP
+    Roughly estimates the peak memory used by EPA-ng from the size of the reference alignment, which approximates
+    the number of reference sequences times the number of alignment columns. EPA-ng stores three conditional
+    likelihood vectors of double-precision floats for each of these, for every character state and rate category.
+
+    :param refpkg_msa: Path to the reference multiple sequence alignment (FASTA)
+    :param molecule: The molecule type of the reference package, 'prot', 'dna' or 'rrna'
+    :return: The estimated memory in megabytes
+    """
+    num_states = 20 if molecule == "prot" else 4
+    try:
+        cells = os.path.getsize(refpkg_msa)
+    except OSError:
+        cells = 0
+    return 64 + int(cells * num_states * 4 * 8 * 3 / 2 ** 20)
+
+
+def epa_placement_command(epa_exe: str, refpkg_tree: str, refpkg_msa: str, refpkg_model: str,
+                          query_msa: str, query_name: str, output_dir: str,
+                          num_threads=2, work_dir=None) -> (list, dict):
+    """
+    Builds the EPA-ng command and determines the names of its output files, removing any pre-existing output files.
 
     :param epa_exe: Path to the EPA-ng executable to be used
     :param refpkg_tree: The reference tree for evolutionary placement to operate on
@@ -260,7 +321,9 @@ def raxml_evolutionary_placement(epa_exe: str, refpkg_tree: str, refpkg_msa: str
     :param query_name: Prefix name for all of the output files
     :param output_dir: Path to write the EPA outputs
     :param num_threads: Number of threads EPA should use (default = 2)
-    :return: A dictionary of files written by EPA-ng that are used by TreeSAPP. For example epa_files["jplace"]
+    :param work_dir: The directory EPA-ng writes its outputs to before they are renamed and moved to output_dir.
+     By default, output_dir.
+    :return: The EPA-ng command, as a list, and a dictionary of the files that are used by TreeSAPP
     """
     epa_files = dict()
     ##
@@ -272,6 +335,9 @@ def raxml_evolutionary_placement(epa_exe: str, refpkg_tree: str, refpkg_msa: str
         output_dir = os.getcwd() + os.sep + output_dir
     if output_dir[-1] != os.sep:
         output_dir += os.sep
+    if not work_dir:
+        work_dir = output_dir
+    work_dir = os.path.abspath(work_dir) + os.sep
 
     if refpkg_model is None:
         logging.error("No substitution model provided for evolutionary placement of " + query_name + ".\n")
@@ -288,12 +354,10 @@ def raxml_evolutionary_placement(epa_exe: str, refpkg_tree: str, refpkg_msa: str
 
     # This is the final set of files that will be written by EPA-ng
     epa_files["stdout"] = output_dir + query_name + '_EPA.txt'
-    epa_info = output_dir + 'epa_info.log'
     epa_files["info"] = output_dir + query_name + '.EPA_info.txt'
-    epa_jplace = output_dir + "epa_result.jplace"
     epa_files["jplace"] = output_dir + "epa_result." + query_name + ".jplace"
 
-    for raxml_file in [epa_info, epa_jplace]:
+    for raxml_file in [work_dir + 'epa_info.log', work_dir + "epa_result.jplace"]:
         try:
             os.remove(raxml_file)
         except OSError:
@@ -310,12 +374,18 @@ def raxml_evolutionary_placement(epa_exe: str, refpkg_tree: str, refpkg_msa: str
                    # "--fix-heur", str(0.2),
                    "--preserve-rooting", "on",
                    "--filter-min-lwr", str(0.01),
-                   "--outdir", output_dir,
-                   '-T', str(num_threads),
-                   '>', epa_files["stdout"]]
-    launch_write_command(epa_command)
+                   "--outdir", work_dir,
+                   '-T', str(num_threads)]
+    return epa_command, epa_files
+
 
-    # Rename the RAxML output files
+def collect_epa_outputs(query_name: str, work_dir: str, epa_files: dict) -> None:
+    """
+    Renames the files written by EPA-ng in work_dir to those in epa_files, for consistency in TreeSAPP.
+    TreeSAPP exits if the JPlace file was not written.
+    """
+    epa_info = os.path.join(work_dir, 'epa_info.log')
+    epa_jplace = os.path.join(work_dir, "epa_result.jplace")
     if os.path.exists(epa_info):
         copy(epa_info, epa_files["info"])
         os.remove(epa_info)
@@ -326,6 +396,32 @@ def raxml_evolutionary_placement(epa_exe: str, refpkg_tree: str, refpkg_msa: str
         logging.error("Some files were not successfully created for " + query_name + "\n" +
                       "Check " + epa_files["stdout"] + " for an error!\n")
         sys.exit(3)
+    return
+
+
+def raxml_evolutionary_placement(epa_exe: str, refpkg_tree: str, refpkg_msa: str, refpkg_model: str,
+                                 query_msa: str, query_name: str, output_dir: str, num_threads=2):
+    """
+    A wrapper for evolutionary placement algorithm (EPA) next-generation
+        1. checks to ensure the output files do not already exist, and removes them if they do
+        2. ensures the output directory is an absolute path, satisfying EPA
+        3. Runs EPA with the provided parameters
+        4. Renames the files for consistency in TreeSAPP
+
+    :param epa_exe: Path to the EPA-ng executable to be used
+    :param refpkg_tree: The reference tree for evolutionary placement to operate on
+    :param refpkg_msa: The reference multiple sequence alignment for the reference package (FASTA)
+    :param refpkg_model: The substitution model to be used by EPA e.g. PROTGAMMALG, GTRCAT
+    :param query_msa: Path to a multiple alignment file containing aligned query sequences (FASTA)
+    :param query_name: Prefix name for all of the output files
+    :param output_dir: Path to write the EPA outputs
+    :param num_threads: Number of threads EPA should use (default = 2)
+    :return: A dictionary of files written by EPA-ng that are used by TreeSAPP. For example epa_files["jplace"]
+    """
+    epa_command, epa_files = epa_placement_command(epa_exe, refpkg_tree, refpkg_msa, refpkg_model,
+                                                   query_msa, query_name, output_dir, num_threads)
+    launch_write_command(epa_command, stdout=epa_files["stdout"])
+    collect_epa_outputs(query_name, os.path.dirname(epa_files["jplace"]), epa_files)
 
     return epa_files
 
@@ -355,8 +451,21 @@ def hmmalign_command(executable, ref_aln, ref_profile, input_fasta, output_multi
     malign_command = [executable,
                       '--mapali', ref_aln,
                       '--outformat', 'Stockholm',
-                      ref_profile, input_fasta,
-                      '>', output_multiple_alignment]
+                      '-o', output_multiple_alignment,
+                      ref_profile, input_fasta]
+
+    return malign_command
+
+
+def hmmalign_afa_command(executable, ref_profile, input_fasta, output_multiple_alignment):
+    """
+    Command for aligning sequences to a profile HMM alone, without mapping them onto a reference alignment.
+    The alignment is written in aligned FASTA format, where residues in the profile's insert states are lower case.
+    """
+    malign_command = [executable,
+                      '--outformat', 'afa',
+                      '-o', output_multiple_alignment,
+                      ref_profile, input_fasta]
 
     return malign_command
 
@@ -611,44 +720,54 @@ def build_hmm_profile(hmmbuild_exe: str, msa_in: str, output_hmm: str, name=None
     return
 
 
-def run_hmmsearch(hmmsearch_exe: str, hmm_profile: str, query_fasta: str, output_dir: str,
-                  num_threads=2, e_value=1) -> list:
+def hmmsearch_command(hmmsearch_exe: str, hmm_profile: str, query_fasta: str, domtbl: str,
+                      num_threads=2, e_value=1) -> list:
+    """
+    The hmmsearch command for searching query_fasta with hmm_profile, writing the domain table to domtbl.
+    Only the domain table is parsed so the per-sequence output, which can be very large, is discarded.
     """
-    Function for searching a fasta file with a profile HMM
+    hmmsearch_command_base = [hmmsearch_exe]
+    hmmsearch_command_base += ["--cpu", str(num_threads)]
+    hmmsearch_command_base += ["-E", str(e_value)]
+    hmmsearch_command_base.append("--noali")
+    hmmsearch_command_base += ["-o", os.devnull]
+    return hmmsearch_command_base + ["--domtblout", domtbl, hmm_profile, query_fasta]
+
+
+def stream_hmmsearch(hmmsearch_exe: str, hmm_profile: str, query_fasta: str,
+                     num_threads=2, e_value=1) -> DomainTableParser:
+    """
+    Searches a FASTA file with a profile HMM, reading the domain table from hmmsearch's standard output as it is
+    written rather than writing it to a file that is read again.
 
     :param hmmsearch_exe: Path to the executable for hmmsearch
     :param hmm_profile: Path to the HMM profile file
     :param query_fasta: Path to the FASTA file to be queried by the profile
-    :param output_dir: Path to the directory for writing the outputs
     :param num_threads: Number of threads to be used by hmmsearch
     :param e_value: report sequences <= this E-value threshold in output
-    :return: A list of domain tables created
+    :return: A DomainTableParser instance with the lines of the domain table read
     """
-    # Find the name of the HMM. Use it to name the output file
-    rp_marker = re.sub(r".hmm", '', os.path.basename(hmm_profile), flags=re.IGNORECASE)
-    domtbl = output_dir + rp_marker + "_to_ORFs_domtbl.txt"
-
-    # Basic hmmsearch command
-    hmmsearch_command_base = [hmmsearch_exe]
-    hmmsearch_command_base += ["--cpu", str(num_threads)]
-    hmmsearch_command_base += ["-E", str(e_value)]
-    hmmsearch_command_base.append("--noali")
-    # Customize the command for this input and HMM
-    final_hmmsearch_command = hmmsearch_command_base + ["--domtblout", domtbl]
-    final_hmmsearch_command += [hmm_profile, query_fasta]
-    stdout, ret_code = launch_write_command(final_hmmsearch_command)
-
-    # Check to ensure the job finished properly
-    if ret_code != 0:
-        logging.error("hmmsearch did not complete successfully! Output:\n" + stdout + "\n" +
-                      "Command used:\n" + ' '.join(final_hmmsearch_command) + "\n")
-        sys.exit(13)
-
-    return [domtbl]
+    with CommandPipeline([hmmsearch_command(hmmsearch_exe, hmm_profile, query_fasta, "/dev/stdout",
+                                            num_threads, e_value)]) as hmmsearch:
+        domain_table = DomainTableParser(hmmsearch.stdout)
+        domain_table.read_domtbl_lines()
+    return domain_table
 
 
 def hmmsearch_orfs(hmmsearch_exe: str, refpkg_dict: dict, fasta_file: str, output_dir: str,
-                   num_threads=2, e_value=1) -> list:
+                   num_threads=2, e_value=1, checkpoints=None) -> list:
+    """
+    Searches the query sequences with the search profile HMM of each protein reference package.
+
+    :param hmmsearch_exe: Path to the executable for hmmsearch
+    :param refpkg_dict: A dictionary of ReferencePackage instances indexed by their prefix values
+    :param fasta_file: Path to the FASTA file to be queried by the profiles
+    :param output_dir: Path to the directory for writing the domain tables
+    :param num_threads: Number of threads to be used by hmmsearch
+    :param e_value: report sequences <= this E-value threshold in output
+    :param checkpoints: A CheckpointManifest. Profiles that were already searched against the same sequences are skipped
+    :return: A list of domain tables
+    """
     hmm_domtbl_files = list()
     nucl_target_hmm_files = list()
     prot_target_hmm_files = list()
@@ -666,21 +785,38 @@ def hmmsearch_orfs(hmmsearch_exe: str, refpkg_dict: dict, fasta_file: str, outpu
                 nucl_target_hmm_files.append(refpkg.f__search_profile)
 
     logging.info("Searching for marker proteins in ORFs using hmmsearch.\n")
+    searches = list()
+    for hmm_file in prot_target_hmm_files:
+        unit = os.path.basename(hmm_file)
+        if checkpoints and checkpoints.is_complete("search", unit, [hmm_file, fasta_file], {"e_value": e_value}):
+            hmm_domtbl_files += checkpoints.outputs("search", unit)
+        else:
+            # Find the name of the HMM. Use it to name the output file
+            domtbl = output_dir + re.sub(r".hmm", '', unit, flags=re.IGNORECASE) + "_to_ORFs_domtbl.txt"
+            hmm_domtbl_files.append(domtbl)
+            searches.append((unit, hmm_file, domtbl))
+
+    # Each profile is searched by its own hmmsearch process, sharing the threads, since hmmsearch's throughput
+    # scales poorly beyond a few threads
+    threads_per_job = max(1, int(num_threads / max(1, len(searches))))
+    scheduler = CommandScheduler("hmmsearch", num_threads)
+    for unit, hmm_file, domtbl in searches:
+        scheduler.submit(hmmsearch_command(hmmsearch_exe, hmm_file, fasta_file, domtbl, threads_per_job, e_value),
+                         threads=threads_per_job)
+
     if logging.getLogger().disabled:
         pbar = None
     else:
-        pbar = tqdm(total=len(prot_target_hmm_files) + len(nucl_target_hmm_files), ncols=120)
-
-    # Create and launch the hmmsearch commands iteratively.
-    for hmm_file in prot_target_hmm_files:
-        if pbar:
-            pbar.set_description("Processing {}".format(os.path.basename(hmm_file)))
-
-        # TODO: Parallelize this by allocating no more than 2 threads per process
-        hmm_domtbl_files += run_hmmsearch(hmmsearch_exe, hmm_file, fasta_file, output_dir, num_threads, e_value)
+        pbar = tqdm(total=len(searches), ncols=120)
 
+    # Searches are recorded as they finish so they are not repeated if the run is interrupted
+    for job in scheduler.as_completed():
+        unit, hmm_file, domtbl = searches[job.index]
         if pbar:
+            pbar.set_description("Processing {}".format(unit))
             pbar.update()
+        if checkpoints:
+            checkpoints.complete("search", unit, [hmm_file, fasta_file], [domtbl], {"e_value": e_value})
 
     if pbar:
         pbar.close()
@@ -688,6 +824,18 @@ def hmmsearch_orfs(hmmsearch_exe: str, refpkg_dict: dict, fasta_file: str, outpu
     return hmm_domtbl_files
 
 
+def mafft_command(mafft_exe: str, fasta_in: str, num_threads) -> list:
+    """
+    The MAFFT command for aligning fasta_in using `--auto`. The alignment is written to standard output.
+    """
+    mafft_align_command = [mafft_exe, "--auto", "--anysymbol"]
+    mafft_align_command += ["--maxiterate", str(1000)]
+    mafft_align_command += ["--thread", str(num_threads)]
+    mafft_align_command += ["--randomseed", str(12345)]
+    mafft_align_command.append(fasta_in)
+    return mafft_align_command
+
+
 def run_mafft(mafft_exe: str, fasta_in: str, fasta_out: str, num_threads) -> None:
     """
     Wrapper function for the MAFFT multiple sequence alignment tool.
@@ -699,14 +847,10 @@ def run_mafft(mafft_exe: str, fasta_in: str, fasta_out: str, num_threads) -> Non
     :param num_threads: Integer (or string) for the number of threads MAFFT can use
     :return:
     """
-    mafft_align_command = [mafft_exe, "--auto", "--anysymbol"]
-    mafft_align_command += ["--maxiterate", str(1000)]
-    mafft_align_command += ["--thread", str(num_threads)]
-    mafft_align_command += ["--randomseed", str(12345)]
-    mafft_align_command += [fasta_in, '1>' + fasta_out]
-    mafft_align_command += ["2>", "/dev/null"]
+    mafft_align_command = mafft_command(mafft_exe, fasta_in, num_threads)
 
-    stdout, mafft_proc_returncode = launch_write_command(mafft_align_command, False)
+    stdout, mafft_proc_returncode = launch_write_command(mafft_align_command, False,
+                                                         stdout=fasta_out, stderr=os.devnull)
 
     if mafft_proc_returncode != 0:
         logging.error("Multiple sequence alignment using " + mafft_exe +
@@ -722,6 +866,19 @@ def run_mafft(mafft_exe: str, fasta_in: str, fasta_out: str, num_threads) -> Non
     return
 
 
+def odseq_command(odseq_exe: str, fasta_in: str, outliers_fa: str, num_threads: int) -> list:
+    odseq_cmd = [odseq_exe]
+    odseq_cmd += ["-i", fasta_in]
+    odseq_cmd += ["-f", "fasta"]
+    odseq_cmd += ["-o", outliers_fa]
+    odseq_cmd += ["-m", "linear"]
+    odseq_cmd += ["--boot-rep", str(1000)]
+    odseq_cmd += ["--threads", str(num_threads)]
+    odseq_cmd += ["--score", str(5)]
+    odseq_cmd.append("--full")
+    return odseq_cmd
+
+
 def run_odseq(odseq_exe: str, fasta_in: str, outliers_fa: str, num_threads: int) -> None:
     """
     Wrapper for OD-Seq, software for detecting outliers in a multiple sequence alignment.
@@ -734,21 +891,13 @@ def run_odseq(odseq_exe: str, fasta_in: str, outliers_fa: str, num_threads: int)
     :param num_threads: Number of threads for OD-Seq to use
     :return: None
     """
-    odseq_command = [odseq_exe]
-    odseq_command += ["-i", fasta_in]
-    odseq_command += ["-f", "fasta"]
-    odseq_command += ["-o", outliers_fa]
-    odseq_command += ["-m", "linear"]
-    odseq_command += ["--boot-rep", str(1000)]
-    odseq_command += ["--threads", str(num_threads)]
-    odseq_command += ["--score", str(5)]
-    odseq_command.append("--full")
+    odseq_cmd = odseq_command(odseq_exe, fasta_in, outliers_fa, num_threads)
 
-    stdout, odseq_proc_returncode = launch_write_command(odseq_command)
+    stdout, odseq_proc_returncode = launch_write_command(odseq_cmd)
 
     if odseq_proc_returncode != 0:
         logging.error("Outlier detection using " + odseq_exe +
-                      " did not complete successfully! Command used:\n" + ' '.join(odseq_command) + "\n")
+                      " did not complete successfully! Command used:\n" + ' '.join(odseq_cmd) + "\n")
         sys.exit(7)
 
     return
@@ -781,7 +930,8 @@ def get_msa_trim_command(executables, mfa_file, molecule, tool="BMGE"):
     return trim_command, trimmed_msa_file
 
 
-def filter_multiple_alignments(executables, concatenated_mfa_files, refpkg_dict, n_proc=1, tool="BMGE"):
+def filter_multiple_alignments(executables, concatenated_mfa_files, refpkg_dict, n_proc=1, tool="BMGE",
+                               checkpoints=None):
     """
     Runs BMGE using the provided lists of the concatenated hmmalign files, and the number of sequences in each file.
 
@@ -790,13 +940,15 @@ def filter_multiple_alignments(executables, concatenated_mfa_files, refpkg_dict,
     :param refpkg_dict: A dictionary of ReferencePackage instances indexed by their respective denominators
     :param n_proc: The number of parallel processes to be launched for alignment trimming
     :param tool: The software to use for alignment trimming
+    :param checkpoints: A CheckpointManifest used to skip the multiple alignments that were already trimmed
     :return: A list of files resulting from BMGE multiple sequence alignment masking.
     """
     logging.info("Running " + tool + "... ")
 
     start_time = time.time()
-    task_list = list()
+    scheduler = CommandScheduler("Multiple alignment trimming with " + tool, n_proc)
     trimmed_output_files = {}
+    trim_units = dict()
 
     for refpkg_code in sorted(concatenated_mfa_files.keys()):
         if refpkg_code not in trimmed_output_files:
@@ -806,14 +958,17 @@ def filter_multiple_alignments(executables, concatenated_mfa_files, refpkg_dict,
             trim_command, trimmed_msa_file = get_msa_trim_command(executables, concatenated_mfa_file,
                                                                   refpkg_dict[refpkg_code].molecule, tool)
             trimmed_output_files[refpkg_code].append(trimmed_msa_file)
-            task_list.append(trim_command)
-
-    if len(task_list) > 0:
-        cl_farmer = CommandLineFarmer("Multiple alignment trimming with " + tool, n_proc)
-        cl_farmer.add_tasks_to_queue(task_list)
-
-        cl_farmer.task_queue.close()
-        cl_farmer.task_queue.join()
+            unit = os.path.basename(concatenated_mfa_file)
+            if checkpoints and checkpoints.is_complete("trim", unit, [concatenated_mfa_file], {"tool": tool}):
+                continue
+            job = scheduler.submit(trim_command, memory=DEPENDENCY_MEMORY[tool],
+                                   priority=os.path.getsize(concatenated_mfa_file))
+            trim_units[job.index] = (unit, concatenated_mfa_file, trimmed_msa_file)
+
+    for job in scheduler.as_completed():
+        if checkpoints:
+            unit, concatenated_mfa_file, trimmed_msa_file = trim_units[job.index]
+            checkpoints.complete("trim", unit, [concatenated_mfa_file], [trimmed_msa_file], {"tool": tool})
 
     logging.info("done.\n")
 